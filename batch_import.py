@@ -0,0 +1,273 @@
+# Non-interactive batch import of assay workbooks (e.g. the 10-40 workbooks received at once from a core facility).
+# Workbooks are parsed in a pool of processes, and their rows are written by a fixed number of writer processes,
+# each with its own database connection. Rows are routed to writers by study ID, so all the updates to a
+# participant's clinical data document are made by one writer, one after another, and can't overwrite each other.
+# Each workbook's import is logged once, with its validation report, after all its rows have been written.
+# A throughput report for the whole batch is printed at the end.
+#
+# Usage:
+#   python batch_import.py ../data/incoming/ --user someone@cornell.edu
+#   python batch_import.py "../data/incoming/*proteomics*.xlsx" --user someone@cornell.edu --writers 2
+
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import argparse
+import glob
+import multiprocessing
+import os
+import sys
+import time
+import traceback
+
+import pandas as pd
+
+import data.mongo_setup as mongo_setup
+import services.data_service as svc
+import services.import_pipeline as import_pipeline
+import set_up_globals
+
+defaultParseWorkers = max(1, min(4, (os.cpu_count() or 2) - 1))
+defaultWriters = 4
+
+
+# Return the workbooks named by a list of directories, glob patterns, and file names (sorted, without duplicates)
+def find_workbooks(paths) -> list:
+    workbooks = []
+    for path in paths:
+        if os.path.isdir(path):
+            candidates = [os.path.join(path, name) for name in os.listdir(path)]
+        else:
+            candidates = glob.glob(path)
+        for candidate in candidates:
+            name = os.path.basename(candidate)
+            if name.lower().endswith(('.xlsx', '.xls')) and not name.startswith('~') and os.path.isfile(candidate):
+                workbooks.append(os.path.abspath(candidate))
+    return sorted(set(workbooks))
+
+
+# Parse and validate one workbook (run in the parse pool). Only the rows without validation errors are returned,
+# with the validation report and stage times for the workbook's import log entry.
+# Errors are returned rather than raised, so one bad workbook doesn't stop the batch.
+def parse_workbook(file_path) -> dict:
+    import program_actions  # Imported here so that only the parse processes load the text interface
+
+    result = {'file_path': file_path, 'data_file_name': os.path.basename(file_path), 'error': None}
+    startTime = time.perf_counter()
+    try:
+        metaDataDict, documentName, externalFileName = program_actions.read_custom_assay_metadata(file_path)
+        context = program_actions.prepare_custom_assay_file(file_path, metaDataDict, documentName, externalFileName)
+        result.update({'df': context.valid_rows(), 'meta_data': metaDataDict, 'document_name': documentName,
+                       'fast_load': context.fast_load, 'validation': context.validation,
+                       'invalid_rows': context.validation.invalid_row_count, 'dropped_rows': context.dropped_rows,
+                       'timings': context.timings})
+    except Exception as e:
+        result['error'] = f'{e.__class__.__name__}: {e}'
+    result['parse_seconds'] = time.perf_counter() - startTime
+
+    return result
+
+
+# Split a workbook's rows by writer (study ID modulo the number of writers), keeping the unique_id index.
+# Rows without a numeric study ID all go to the first writer, which logs them as errors.
+def partition_by_participant(df, writer_count) -> dict:
+    studyIDs = pd.to_numeric(df['study_id'], errors='coerce').fillna(0).astype('int64')
+    return {int(writerIndex): partDF for writerIndex, partDF in df.groupby(studyIDs.to_numpy() % writer_count,
+                                                                            sort=True)}
+
+
+# Writer process: connect to the database, then import the row partitions sent to this writer in the order received
+# (the resolve, diff, and write stages of the assay import pipeline; the parse process has already run the stages
+# before them, and the import is logged by run_batch once every partition of the workbook has been written)
+def writer_main(writer_index, database_name, email, task_queue, result_queue):
+    mongo_setup.global_init(database_name)
+    active_account = svc.find_account_by_email(email)
+
+    while True:
+        task = task_queue.get()
+        if task is None:
+            break
+
+        counts = {'rows': 0, 'errors': 0}
+
+        def progress(rows_processed, total_rows, error_count):
+            counts['rows'] = rows_processed
+            counts['errors'] = error_count
+
+        startTime = time.perf_counter()
+        error = None
+        context = import_pipeline.new_context(active_account, 'Assay', task['file_path'],
+                                              data_file_name=task['data_file_name'], meta_data=task['meta_data'],
+                                              document_name=task['document_name'], fast_load=task['fast_load'],
+                                              progress_callback=progress)
+        context.df = task['df']
+        try:
+            import_pipeline.get_pipeline('Assay').run(context, ('resolve', 'diff', 'write'))
+        except Exception as e:
+            error = f'{e.__class__.__name__}: {e}'
+            traceback.print_exc()
+
+        result_queue.put({'writer': writer_index,
+                          'file_path': task['file_path'],
+                          'rows': counts['rows'],
+                          'errors': counts['errors'],
+                          'write_seconds': time.perf_counter() - startTime,
+                          'timings': dict(context.timings),
+                          'error': error})
+
+
+# Log the import of a workbook once all its partitions have been written: the rows written, the validation report of
+# the whole workbook, and the stage times (parse stages from the parse process, the others summed over the writers)
+def log_workbook_import(active_account, parsed, summary, write_timings):
+    context = import_pipeline.new_context(active_account, 'Assay', parsed['file_path'],
+                                          data_file_name=parsed['data_file_name'], meta_data=parsed['meta_data'],
+                                          document_name=parsed['document_name'])
+    context.validation = parsed['validation']
+    context.dropped_rows = parsed['dropped_rows']
+    context.rows_processed = summary['rows']
+    context.error_count = summary['errors'] - parsed['invalid_rows']  # The validation errors are logged separately
+    context.timings.update(parsed['timings'])
+    for stageName, seconds in write_timings.items():
+        context.timings[stageName] = context.timings.get(stageName, 0.0) + seconds
+    import_pipeline.get_pipeline('Assay').run(context, ('log',))
+
+
+# Import a batch of workbooks, returning one summary dictionary per workbook
+def run_batch(workbooks, email, parse_workers=defaultParseWorkers, writer_count=defaultWriters,
+              database_name=set_up_globals.database_name) -> list:
+    context = multiprocessing.get_context('spawn')  # Each writer opens its own connection
+    resultQueue = context.Queue()
+    taskQueues = [context.Queue() for _ in range(writer_count)]
+    writers = [context.Process(target=writer_main, args=(i, database_name, email, taskQueues[i], resultQueue),
+                               name=f'mecfs-writer-{i}')
+               for i in range(writer_count)]
+    for writer in writers:
+        writer.start()
+
+    activeAccount = svc.find_account_by_email(email)
+    summaries = {}
+    parsedWorkbooks = {}  # File path -> parse result (without its rows), for the workbook's import log entry
+    writeTimings = {}  # File path -> stage name -> seconds, summed over the writers
+    pendingWrites = {}  # File path -> partitions not written yet
+    try:
+        with ProcessPoolExecutor(max_workers=parse_workers, mp_context=context) as parsePool:
+            futures = [parsePool.submit(parse_workbook, file_path) for file_path in workbooks]
+            for future in as_completed(futures):
+                parsed = future.result()
+                data_file_name = parsed['data_file_name']
+                summary = {'data_file_name': data_file_name,
+                           'document_name': parsed.get('document_name', ''),
+                           'rows': 0,
+                           'errors': parsed.get('invalid_rows', 0),
+                           'parse_seconds': parsed['parse_seconds'],
+                           'write_seconds': 0.0,
+                           'error': parsed['error']}
+                summaries[parsed['file_path']] = summary
+
+                if parsed['error']:
+                    svc.error_msg(f'Unable to read {data_file_name}: {parsed["error"]}')
+                    continue
+                print(f'Parsed {data_file_name} ({len(parsed["df"])} valid rows) in {parsed["parse_seconds"]:.1f} s. '
+                      f'Validation: {parsed["validation"].summary()}.')
+
+                partitions = partition_by_participant(parsed.pop('df'), writer_count)
+                parsedWorkbooks[parsed['file_path']] = parsed
+                writeTimings[parsed['file_path']] = {}
+                pendingWrites[parsed['file_path']] = len(partitions)
+                if not partitions:
+                    log_workbook_import(activeAccount, parsed, summary, {})
+                for writerIndex, partDF in partitions.items():
+                    taskQueues[writerIndex].put({'file_path': parsed['file_path'],
+                                                 'data_file_name': data_file_name,
+                                                 'df': partDF,
+                                                 'meta_data': parsed['meta_data'],
+                                                 'document_name': parsed['document_name'],
+                                                 'fast_load': parsed['fast_load']})
+
+        for taskQueue in taskQueues:
+            taskQueue.put(None)
+
+        # Collect the results before joining the writers (a process can't exit with items left in its queue)
+        while sum(pendingWrites.values()) > 0:
+            result = resultQueue.get()
+            filePath = result['file_path']
+            pendingWrites[filePath] -= 1
+            summary = summaries[filePath]
+            summary['rows'] += result['rows']
+            summary['errors'] += result['errors']
+            summary['write_seconds'] = max(summary['write_seconds'], result['write_seconds'])
+            if result['error']:
+                summary['error'] = result['error']
+                summary['errors'] += 1
+            for stageName, seconds in result['timings'].items():
+                writeTimings[filePath][stageName] = writeTimings[filePath].get(stageName, 0.0) + seconds
+            if pendingWrites[filePath] == 0:
+                log_workbook_import(activeAccount, parsedWorkbooks[filePath], summary, writeTimings[filePath])
+
+    except BaseException:
+        for taskQueue in taskQueues:
+            taskQueue.put(None)  # Let the writers finish what they were sent, then stop
+        raise
+
+    finally:
+        for writer in writers:
+            writer.join()
+
+    return [summaries[file_path] for file_path in workbooks]
+
+
+def print_throughput_report(summaries, elapsed_seconds, parse_workers, writer_count):
+    print()
+    print(' ********************     Batch import throughput report     ******************** ')
+    nameWidth = max([len('File')] + [len(s['data_file_name']) for s in summaries])
+    print(f'{"File":<{nameWidth}}  {"Assay type":<16}{"Rows":>8}{"Errors":>8}{"Parse (s)":>11}{"Write (s)":>11}')
+    for s in summaries:
+        print(f'{s["data_file_name"]:<{nameWidth}}  {s["document_name"] or "":<16}{s["rows"]:>8}{s["errors"]:>8}'
+              f'{s["parse_seconds"]:>11.1f}{s["write_seconds"]:>11.1f}')
+        if s['error']:
+            svc.error_msg(f'    {s["error"]}')
+
+    totalRows = sum(s['rows'] for s in summaries)
+    totalErrors = sum(s['errors'] for s in summaries)
+    failedFiles = sum(1 for s in summaries if s['error'])
+    rowsPerSecond = totalRows / elapsed_seconds if elapsed_seconds > 0 else 0.0
+    print()
+    print(f'{len(summaries)} workbooks ({failedFiles} failed), {totalRows} rows, {totalErrors} errors '
+          f'in {elapsed_seconds:.1f} s ({rowsPerSecond:.1f} rows/s) '
+          f'with {parse_workers} parse workers and {writer_count} writers.')
+    print(f'Parse time: {sum(s["parse_seconds"] for s in summaries):.1f} s, '
+          f'longest write: {max([s["write_seconds"] for s in summaries] + [0.0]):.1f} s.')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Import a batch of assay workbooks without prompting.')
+    parser.add_argument('paths', nargs='+', help='Directories, glob patterns, or workbook files to import')
+    parser.add_argument('--user', required=True, help='Email of the user the import is recorded against')
+    parser.add_argument('--parse-workers', type=int, default=defaultParseWorkers,
+                        help=f'Number of processes parsing workbooks (default {defaultParseWorkers})')
+    parser.add_argument('--writers', type=int, default=defaultWriters,
+                        help=f'Number of processes writing to the database (default {defaultWriters})')
+    parser.add_argument('--database', default=set_up_globals.database_name, help='Database name')
+    args = parser.parse_args(argv)
+
+    workbooks = find_workbooks(args.paths)
+    if not workbooks:
+        svc.error_msg(f'No workbooks found in {", ".join(args.paths)}')
+        return 1
+
+    mongo_setup.global_init(args.database)
+    if not svc.find_account_by_email(args.user.strip().lower()):
+        svc.error_msg(f'There is no user with email {args.user}')
+        return 1
+
+    print(f'Importing {len(workbooks)} workbooks with {args.parse_workers} parse workers and '
+          f'{args.writers} writers.')
+    startTime = time.perf_counter()
+    summaries = run_batch(workbooks, args.user.strip().lower(), max(1, args.parse_workers), max(1, args.writers),
+                          args.database)
+    print_throughput_report(summaries, time.perf_counter() - startTime, args.parse_workers, args.writers)
+
+    return 0 if not any(s['error'] for s in summaries) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
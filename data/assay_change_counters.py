@@ -0,0 +1,18 @@
+import datetime
+import mongoengine
+
+
+class AssayChangeCounter(mongoengine.Document):
+    # Bumped by every write of an assay's results (see data_service.bump_assay_change_counter), so a cached
+    # assay matrix built at an earlier count is known to be out of date (see services/assay_matrix_cache.py)
+    unique_assay_name = mongoengine.StringField(required=True)
+    counter = mongoengine.IntField(default=0)
+    last_modified_date = mongoengine.DateTimeField(default=datetime.datetime.now)
+
+    meta = {
+        'db_alias': 'core',
+        'collection': 'assay_change_counters',
+        'indexes': [
+            {'fields': ['unique_assay_name'], 'unique': True}
+        ]
+    }
@@ -52,6 +52,8 @@ class AssayMetaData(mongoengine.EmbeddedDocument):
     study_type = mongoengine.StringField()
     sample = mongoengine.StringField()
     file_name_location = mongoengine.StringField()
+    # Results of 0 aren't stored (see set_up_globals.sparseAssayDocumentNames)
+    zero_results_omitted = mongoengine.BooleanField()
 
     assay_results = mongoengine.EmbeddedDocumentListField(AssayResults)
     assay_summary = mongoengine.EmbeddedDocumentListField(AssaySummary)
@@ -49,8 +49,8 @@ class Biospecimen(mongoengine.Document):
     #     return dt.days
     meta = {
         'db_alias': 'core',
-        'collection': 'biospecimen_data'
-        # 'indexes': ['study_id', 'site', '$phenotype']
+        'collection': 'biospecimen_data',
+        'indexes': ['specimen_id', 'study_id']
     }
 
 
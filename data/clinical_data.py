@@ -8,7 +8,7 @@ from data.assay_classes import AssayMetaData
 # from data.assay_classes import Cytokine
 # from data.assay_classes import Metabolomic
 # from data.assay_classes import scRNAseq
-# from data.scrnaseq_summary import ScRNAseqSummary
+from data.scrnaseq_summary import ScRNAseqSummary
 from data.users import User
 
 site_choices = (('1', 'ITH'),
@@ -62,6 +62,8 @@ class ClinicalData(mongoengine.Document):
 
     data_file_name = mongoengine.StringField(required=True)
     version_number = mongoengine.IntField(required=True)
+    content_hash = mongoengine.StringField()  # Hash of the imported row, used to skip unchanged rows on re-import
+    revision = mongoengine.IntField(default=0)  # Incremented by every save (compare-and-swap for concurrent imports)
     study_id = mongoengine.IntField(required=True)
     cu_id = mongoengine.StringField(required=True)
     cor_id = mongoengine.StringField(required=True)
@@ -433,13 +435,13 @@ class ClinicalData(mongoengine.Document):
 
     # biospecimens = mongoengine.EmbeddedDocumentListField(Biospecimen)
     assay_meta_data = mongoengine.EmbeddedDocumentListField(AssayMetaData)
-    # scrnaseq_summary = mongoengine.EmbeddedDocumentListField(ScRNAseqSummary)
+    scrnaseq_summary = mongoengine.EmbeddedDocumentListField(ScRNAseqSummary)
 
     @classmethod
     def get_demographic_attributes(cls):
         # Remove non-JSON serializable objects
         excludeFields = ['objects', 'DoesNotExist', 'MultipleObjectsReturned', 'id',
-                         'biospecimen_data_references', 'assay_meta_data',
+                         'biospecimen_data_references', 'assay_meta_data', 'content_hash', 'revision',
                          'scrnaseq_summary', 'get_demographic_attributes', 'demographic_data_only',
                          'assay_data_only', 'scrnaseq_summary_data_only']
         return [i for i in cls.__dict__.keys() if not i.startswith('_') and i not in excludeFields]
@@ -465,7 +467,8 @@ class ClinicalData(mongoengine.Document):
         'ordering': ['-study_id'],
         'indexes': ['study_id',
                     '$phenotype',
-                    'assay_meta_data.unique_id']
+                    'assay_meta_data.unique_id',
+                    'assay_meta_data.unique_assay_name']
     }
 
 
@@ -480,6 +483,8 @@ class ClinicalDataVersionHistory(mongoengine.Document):
 
     data_file_name = mongoengine.StringField(required=True)
     version_number = mongoengine.IntField(required=True)
+    content_hash = mongoengine.StringField()  # Hash of the imported row, used to skip unchanged rows on re-import
+    revision = mongoengine.IntField(default=0)  # Incremented by every save (compare-and-swap for concurrent imports)
     study_id = mongoengine.IntField(required=True)
     cu_id = mongoengine.StringField(required=True)
     cor_id = mongoengine.StringField(required=True)
@@ -855,5 +860,7 @@ class ClinicalDataVersionHistory(mongoengine.Document):
 
     meta = {
         'db_alias': 'core',
-        'collection': 'demographic_data_version_history'
+        'collection': 'demographic_data_version_history',
+        'indexes': [('study_id', 'version_number'),
+                    ('study_id', 'last_modified_date')]
     }
@@ -0,0 +1,42 @@
+import datetime
+import mongoengine
+from data.users import User
+
+
+class Cohort(mongoengine.Document):
+    created_by = mongoengine.ReferenceField(User, required=True)
+    created_date = mongoengine.DateTimeField(required=True)
+    last_modified_by = mongoengine.ReferenceField(User, required=True)
+    last_modified_date = mongoengine.DateTimeField(default=datetime.datetime.now)
+
+    data_file_name = mongoengine.StringField()
+    cohort_name = mongoengine.StringField(required=True)
+    version_number = mongoengine.IntField(required=True)
+    description = mongoengine.StringField()
+    # Study IDs are stored sorted and de-duplicated, so they can be loaded straight into a NumPy array
+    study_ids = mongoengine.ListField(mongoengine.IntField())
+
+    meta = {
+        'db_alias': 'core',
+        'collection': 'cohorts',
+        'ordering': ['cohort_name'],
+        'indexes': ['cohort_name']
+    }
+
+
+class CohortVersionHistory(mongoengine.Document):
+    created_by = mongoengine.ReferenceField(User, required=True)
+    created_date = mongoengine.DateTimeField(required=True)
+    last_modified_by = mongoengine.ReferenceField(User, required=True)
+    last_modified_date = mongoengine.DateTimeField(default=datetime.datetime.now)
+
+    data_file_name = mongoengine.StringField()
+    cohort_name = mongoengine.StringField(required=True)
+    version_number = mongoengine.IntField(required=True)
+    description = mongoengine.StringField()
+    study_ids = mongoengine.ListField(mongoengine.IntField())
+
+    meta = {
+        'db_alias': 'core',
+        'collection': 'cohort_version_history'
+    }
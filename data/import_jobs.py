@@ -0,0 +1,48 @@
+import datetime
+import mongoengine
+from data.users import User
+
+job_type_choice = ('Clinical',
+                   'Biospecimen',
+                   'Assay')
+job_status_choice = ('Queued',
+                     'Running',
+                     'Completed',
+                     'Failed',
+                     'Cancelled',
+                     'Interrupted')
+
+
+class ImportJob(mongoengine.Document):
+    created_by = mongoengine.ReferenceField(User, required=True)
+    created_date = mongoengine.DateTimeField(required=True)
+    last_modified_date = mongoengine.DateTimeField(default=datetime.datetime.now)
+
+    job_type = mongoengine.StringField(required=True, choices=job_type_choice)
+    status = mongoengine.StringField(required=True, choices=job_status_choice, default='Queued')
+    file_name = mongoengine.StringField(required=True)  # Name of the uploaded file (recorded as data_file_name)
+    file_path = mongoengine.StringField(required=True)  # The job's own copy of the file, so it can be resumed
+    meta_data = mongoengine.DictField()  # e.g. the metadata dictionary of an assay file
+
+    # Progress (a resumed job carries on from its import journal; resumed_from_row is where it picked up)
+    total_rows = mongoengine.IntField(default=0)
+    rows_processed = mongoengine.IntField(default=0)
+    resumed_from_row = mongoengine.IntField(default=0)
+    error_count = mongoengine.IntField(default=0)
+    cancel_requested = mongoengine.BooleanField(default=False)
+    started_date = mongoengine.DateTimeField()
+    finished_date = mongoengine.DateTimeField()
+    message = mongoengine.StringField()
+
+    # The process running the job (see job_service.mark_interrupted_jobs), which updates heartbeat_date while it runs
+    owner_host = mongoengine.StringField()
+    owner_pid = mongoengine.IntField()
+    owner_instance = mongoengine.StringField()
+    heartbeat_date = mongoengine.DateTimeField()
+
+    meta = {
+        'db_alias': 'core',
+        'collection': 'import_jobs',
+        'ordering': ['-created_date'],
+        'indexes': ['status', '-created_date']
+    }
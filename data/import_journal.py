@@ -0,0 +1,34 @@
+import datetime
+import mongoengine
+from data.users import User
+
+journal_status_choice = ('In progress',
+                         'Completed')
+
+
+class ImportJournal(mongoengine.Document):
+    created_by = mongoengine.ReferenceField(User, required=True)
+    created_date = mongoengine.DateTimeField(required=True)
+    last_modified_by = mongoengine.ReferenceField(User, required=True)
+    last_modified_date = mongoengine.DateTimeField(default=datetime.datetime.now)
+
+    # An import is identified by the file name, a hash of the file, and the type of data being imported
+    data_file_name = mongoengine.StringField(required=True)
+    content_hash = mongoengine.StringField(required=True)
+    document_name = mongoengine.StringField(required=True)
+
+    status = mongoengine.StringField(required=True, choices=journal_status_choice, default='In progress')
+    total_rows = mongoengine.IntField(required=True)
+    committed_rows = mongoengine.IntField(default=0)  # Rows before this offset have been imported
+    failed_row = mongoengine.IntField()  # First row that failed to import in the latest run (None if none did)
+    batch_size = mongoengine.IntField()
+    run_count = mongoengine.IntField(default=0)
+    completed_date = mongoengine.DateTimeField()
+
+    meta = {
+        'db_alias': 'core',
+        'collection': 'import_journal',
+        'indexes': [
+            {'fields': ['data_file_name', 'content_hash', 'document_name'], 'unique': True}
+        ]
+    }
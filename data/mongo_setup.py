@@ -1,23 +1,308 @@
 import os
+import time
+from typing import Optional
+from collections import defaultdict
+
 import mongoengine
+from pymongo import monitoring
+from pymongo.read_preferences import ReadPreference, SecondaryPreferred
+
+# Connection settings read from the environment: environment variable -> (MongoClient option, type, default).
+# Settings with a default of None are left to pymongo unless the variable is set.
+connectionSettings = {
+    'MONGO_MAX_POOL_SIZE': ('maxPoolSize', int, 100),
+    'MONGO_MIN_POOL_SIZE': ('minPoolSize', int, 0),
+    'MONGO_MAX_IDLE_TIME_MS': ('maxIdleTimeMS', int, None),
+    'MONGO_WAIT_QUEUE_TIMEOUT_MS': ('waitQueueTimeoutMS', int, None),
+    'MONGO_SERVER_SELECTION_TIMEOUT_MS': ('serverSelectionTimeoutMS', int, 10000),
+    'MONGO_CONNECT_TIMEOUT_MS': ('connectTimeoutMS', int, 10000),
+    'MONGO_SOCKET_TIMEOUT_MS': ('socketTimeoutMS', int, None),
+    'MONGO_RETRY_WRITES': ('retryWrites', bool, True),
+    'MONGO_RETRY_READS': ('retryReads', bool, True),
+    'MONGO_ZLIB_COMPRESSION_LEVEL': ('zlibCompressionLevel', int, None),
+    'MONGO_REPLICA_SET': ('replicaSet', str, None),
+}
+
+# Wire compressors to offer the server, in order of preference, and the package each one needs
+defaultCompressors = 'zstd,snappy,zlib'
+compressorPackages = {'zstd': 'zstandard', 'snappy': 'snappy', 'zlib': 'zlib'}
+
+readPreferences = {'primary': ReadPreference.PRIMARY,
+                   'primarypreferred': ReadPreference.PRIMARY_PREFERRED,
+                   'secondary': ReadPreference.SECONDARY,
+                   'secondarypreferred': ReadPreference.SECONDARY_PREFERRED,
+                   'nearest': ReadPreference.NEAREST}
+
+# Optional second connection for heavy read-only work (exports, summaries, listings), so it can be served by
+# secondaries and has its own connection pool (see register_analytics_connection). Enabled by MONGO_ANALYTICS_READS.
+analyticsAlias = 'analytics'
+
+
+class PoolMonitor(monitoring.ConnectionPoolListener):
+    """
+    Counts connection pool events for each server, for the pool statistics diagnostic.
+    """
+
+    def __init__(self):
+        self.servers = defaultdict(lambda: defaultdict(int))
+
+    def _count(self, event, name, change=1):
+        self.servers[event.address][name] += change
+
+    def pool_created(self, event):
+        self._count(event, 'pools_created')
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        self._count(event, 'pools_cleared')
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        self._count(event, 'created')
+        self._count(event, 'open')
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        self._count(event, 'closed')
+        self._count(event, 'open', -1)
+
+    def connection_check_out_started(self, event):
+        self._count(event, 'check_outs_started')
+
+    def connection_check_out_failed(self, event):
+        self._count(event, 'check_out_failures')
+
+    def connection_checked_out(self, event):
+        self._count(event, 'checked_out')
+        self._count(event, 'in_use')
 
+    def connection_checked_in(self, event):
+        self._count(event, 'in_use', -1)
 
-def global_init(database_name: str, host: str = None):
+    def statistics(self) -> dict:
+        return {f'{host}:{port}': dict(counts) for (host, port), counts in self.servers.items()}
+
+
+_poolMonitors = {}  # Connection alias -> pool event counts
+_compressors = {}  # Connection alias -> wire compressors offered to the server
+_registeredAliases = set()
+
+
+def _setting(variable, valueType, default):
+    value = os.environ.get(variable)
+    if value is None or value.strip() == '':
+        return default
+    if valueType is bool:
+        return value.strip().lower() in ('1', 'true', 'yes', 'on')
+    return valueType(value)
+
+
+def available_compressors(names) -> list:
+    """
+    Return the wire compressors in names (a comma-separated string) whose packages are installed.
+    """
+    compressors = []
+    for name in [n.strip().lower() for n in names.split(',') if n.strip()]:
+        if name not in compressorPackages:
+            print(f'Ignoring unknown MongoDB wire compressor {name}')
+            continue
+        try:
+            __import__(compressorPackages[name])
+        except ImportError:
+            continue
+        compressors.append(name)
+    return compressors
+
+
+def connection_options() -> dict:
+    """
+    Return the MongoClient options set by the MONGO_* environment variables (see connectionSettings).
+    """
+    options = {}
+    for variable, (option, valueType, default) in connectionSettings.items():
+        value = _setting(variable, valueType, default)
+        if value is not None:
+            options[option] = value
+
+    compressors = available_compressors(os.environ.get('MONGO_COMPRESSORS', defaultCompressors))
+    if compressors:
+        options['compressors'] = ','.join(compressors)
+
+    readPreference = os.environ.get('MONGO_READ_PREFERENCE', 'primary').strip().lower()
+    if readPreference not in readPreferences:
+        raise ValueError(f'MONGO_READ_PREFERENCE must be one of {", ".join(readPreferences)}, not {readPreference}')
+    options['read_preference'] = readPreferences[readPreference]
+
+    return options
+
+
+def global_init(database_name: str, host: str = None, warm_up: bool = True):
     """
     Initialize MongoDB connection.
 
     Args:
         database_name: Name of the database to connect to
         host: MongoDB host. If None, uses MONGO_HOST env var or defaults to localhost
+        warm_up: Connect and run a health check now (see health_check), rather than on the first query
     """
     if host is None:
         host = os.environ.get('MONGO_HOST', 'localhost')
 
     port = int(os.environ.get('MONGO_PORT', '27017'))
 
+    _register('core', database_name, host, port, connection_options())
+    if _setting('MONGO_ANALYTICS_READS', bool, False):
+        register_analytics_connection(database_name, host, port)
+
+    if warm_up:
+        for alias in sorted(_registeredAliases):
+            health = health_check(alias)
+            if health['ok']:
+                print(f"Connected to MongoDB {health['version']} at {host}:{port} for {alias} reads "
+                      f"({health['read_preference']}, {health['latency_ms']:.0f} ms, "
+                      f"compression: {health['compression'] or 'none'}).")
+            else:
+                print(f"Unable to reach MongoDB at {host}:{port} for {alias} reads: {health['error']}")
+
+
+def _register(alias, database_name, host, port, options, **connection_kwargs):
+    _poolMonitors[alias] = PoolMonitor()
+    _compressors[alias] = options.get('compressors', '')
     mongoengine.register_connection(
-        alias='core',
+        alias=alias,
         name=database_name,
         host=host,
-        port=port
+        port=port,
+        event_listeners=[_poolMonitors[alias]],
+        **options,
+        **connection_kwargs
     )
+    _registeredAliases.add(alias)
+
+
+def register_analytics_connection(database_name: str, host: str = None, port: int = None, **connection_kwargs):
+    """
+    Register the analytics connection: the same database as the core connection, read from secondaries when there
+    are any (secondaryPreferred), with its own pool.
+
+    Args:
+        database_name: Name of the database to connect to
+        host: MongoDB host. If None, uses MONGO_HOST env var or defaults to localhost
+        port: MongoDB port. If None, uses MONGO_PORT env var or defaults to 27017
+        connection_kwargs: Other arguments for mongoengine.register_connection (e.g. mongo_client_class for a
+            stand-in client in tests)
+
+    Reads may be up to MONGO_ANALYTICS_MAX_STALENESS_SECONDS (default 120, at least 90) behind the primary, and the
+    pool holds up to MONGO_ANALYTICS_MAX_POOL_SIZE connections (default as for the core connection).
+    """
+    if host is None:
+        host = os.environ.get('MONGO_HOST', 'localhost')
+    if port is None:
+        port = int(os.environ.get('MONGO_PORT', '27017'))
+
+    options = connection_options()
+    maxStalenessSeconds = max(90, _setting('MONGO_ANALYTICS_MAX_STALENESS_SECONDS', int, 120))
+    options['read_preference'] = SecondaryPreferred(max_staleness=maxStalenessSeconds)
+    maxPoolSize = _setting('MONGO_ANALYTICS_MAX_POOL_SIZE', int, None)
+    if maxPoolSize is not None:
+        options['maxPoolSize'] = maxPoolSize
+
+    _register(analyticsAlias, database_name, host, port, options, **connection_kwargs)
+
+
+def analytics_alias() -> str:
+    """
+    Return the connection alias for read-only analytics queries: the analytics connection if it's registered,
+    otherwise the core connection.
+    """
+    return analyticsAlias if analyticsAlias in _registeredAliases else 'core'
+
+
+def analytics_collection(document_class):
+    """
+    Return the pymongo collection of a document class on the analytics connection (see analytics_alias), e.g. for an
+    aggregation.
+    """
+    return mongoengine.get_db(analytics_alias())[document_class._get_collection_name()]
+
+
+def max_staleness_seconds(alias: str = None) -> Optional[int]:
+    """
+    Return how far (in seconds) reads on a connection may be behind the primary: 0 for primary reads, the
+    maxStalenessSeconds of secondary reads, or None if secondary reads have no limit.
+
+    Args:
+        alias: Connection alias. If None, the analytics alias (see analytics_alias)
+    """
+    readPreference = mongoengine.get_connection(alias or analytics_alias()).read_preference
+    if readPreference.mode == ReadPreference.PRIMARY.mode:
+        return 0
+    return readPreference.max_staleness if readPreference.max_staleness > 0 else None
+
+
+def health_check(alias: str = 'core') -> dict:
+    """
+    Ping the server (opening the first pooled connection, and up to minPoolSize more in the background).
+
+    Returns:
+        Dictionary with ok, latency_ms, version, read_preference, and compression (the compressors offered to the
+        server), or ok and error if the server couldn't be reached
+    """
+    client = mongoengine.get_connection(alias)
+    startTime = time.perf_counter()
+    try:
+        client.admin.command('ping')
+        version = client.server_info().get('version')
+    except Exception as e:
+        return {'ok': False, 'error': str(e)}
+
+    return {'ok': True,
+            'latency_ms': (time.perf_counter() - startTime) * 1000,
+            'version': version,
+            'read_preference': read_preference_text(client.read_preference),
+            'compression': _compressors.get(alias, '')}
+
+
+def read_preference_text(read_preference) -> str:
+    text = read_preference.mongos_mode
+    if getattr(read_preference, 'max_staleness', -1) > 0:
+        text += f', max staleness {read_preference.max_staleness} s'
+    return text
+
+
+def pool_statistics(alias: str = 'core') -> dict:
+    """
+    Return connection pool statistics: the pool options, the pool events counted for each server since startup,
+    and the server's own connection counts (if the user may run serverStatus).
+    """
+    client = mongoengine.get_connection(alias)
+    poolOptions = client.options.pool_options
+    statistics = {'options': {'maxPoolSize': poolOptions.max_pool_size,
+                              'minPoolSize': poolOptions.min_pool_size,
+                              'maxIdleTimeMS': poolOptions.max_idle_time_seconds and
+                              poolOptions.max_idle_time_seconds * 1000,
+                              'connectTimeoutMS': poolOptions.connect_timeout and poolOptions.connect_timeout * 1000,
+                              'socketTimeoutMS': poolOptions.socket_timeout and poolOptions.socket_timeout * 1000,
+                              'serverSelectionTimeoutMS': client.options.server_selection_timeout * 1000,
+                              'retryWrites': client.options.retry_writes,
+                              'retryReads': client.options.retry_reads,
+                              'readPreference': read_preference_text(client.read_preference)},
+                  'pools': _poolMonitors[alias].statistics() if alias in _poolMonitors else {},
+                  'server': None}
+
+    try:
+        statistics['server'] = client.admin.command('serverStatus').get('connections')
+    except Exception as e:
+        statistics['server_error'] = str(e)
+
+    return statistics
+
+
+def registered_aliases() -> list:
+    return sorted(_registeredAliases)
@@ -0,0 +1,32 @@
+import mongoengine
+from data.users import User
+
+document_type_choice = ('ClinicalData',
+                        'Biospecimen')
+
+
+class VersionDelta(mongoengine.Document):
+    # Compact version history: one record per superseded version of a document. A record holds the changes
+    # that turn the next version back into this one (see services/version_history_service.py), and every
+    # few versions a keyframe holding the complete document, so reconstructing a version never has to replay
+    # more than a handful of deltas.
+    created_by = mongoengine.ReferenceField(User, required=True)
+    created_date = mongoengine.DateTimeField(required=True)
+    last_modified_date = mongoengine.DateTimeField()  # last_modified_date of the version this record describes
+
+    document_type = mongoengine.StringField(required=True, choices=document_type_choice)
+    study_id = mongoengine.IntField()
+    specimen_id = mongoengine.StringField()
+    version_number = mongoengine.IntField(required=True)
+    is_keyframe = mongoengine.BooleanField(default=False)
+    keyframe = mongoengine.DictField()
+    delta = mongoengine.DictField()
+    migrated = mongoengine.BooleanField(default=False)  # Converted from a full version history snapshot
+
+    meta = {
+        'db_alias': 'core',
+        'collection': 'version_deltas',
+        'indexes': [('document_type', 'study_id', '-version_number'),
+                    ('document_type', 'specimen_id', '-version_number'),
+                    ('document_type', 'study_id', 'last_modified_date')]
+    }
@@ -21,6 +21,13 @@ import data.mongo_setup as mongo_setup
 from infrastructure.switchlang import switch
 import infrastructure.state as state
 import services.data_service as svc
+import services.cohort_service as cohort_svc
+import services.version_history_service as history_svc
+import services.import_pipeline as import_pipeline
+import services.import_journal_service as journal_svc
+import services.assay_matrix_cache as matrix_cache
+import services.assay_matrix_service as matrix_svc
+from services.custom_columns import modify_df_column_names
 from data.assay_classes import AssayMetaData
 # from data.assay_classes import Proteomic
 # from data.assay_classes import Cytokine
@@ -70,7 +77,10 @@ def main():
                 s.case('compids', import_compound_ids)
                 s.case('pathways', import_pathway_data)
                 s.case('cps', calculate_pathway_summaries)
-                s.case('bins', export_binned_summary)
+                s.case('bins', lambda: export_binned_summary(as_of_date=input_as_of_date()))
+                s.case('check', check_import_file)
+                s.case('cohorts', import_cohort_data)
+                s.case('defcohorts', register_default_cohorts)
                 s.case('pseudo', export_pseudobulk_for_rti)
                 s.case('seahorse', export_seahorse_for_rti)
                 s.case('cpetrecovery', export_CPET_recovery_for_rti)
@@ -82,6 +92,10 @@ def main():
                 s.case('tp', test_pathway_mapping)
                 s.case('vc', list_clinical_data)
                 s.case('vb', list_biospecimen_data_for_study_id)
+                s.case('asof', list_clinical_data_as_of_version)
+                s.case('migratehistory', migrate_version_history)
+                s.case('dbstats', show_connection_statistics)
+                s.case('matrixcache', build_assay_matrix_cache)
                 s.case('vsc', list_biospecimen_data_for_scrnaseq_summary)
                 s.case('vosc', list_only_scrnaseq_summary)
                 s.case('demo', generate_demo_data)
@@ -103,12 +117,15 @@ def show_commands():
     # print(f'[E] Import {set_up_globals.enid_document_name} data')
     print(f'[D] Import {set_up_globals.clinical_document_name} data')
     print('[A] Import assay data (Proteomics, Cytokines, Metabolomics, etc.)')
+    print('[Check] Check a clinical, biospecimen, or assay file for errors without importing it (dry run)')
     # print('[scRNA] Import scRNA-seq summary data')
     # print('[dlt] Import data label types')
     # print('[compids] Import compound IDs')
     # print('[pathways] Import pathway data')
     # print('[cps] Calculate gene pathway summaries')
     print('[Bins] Export a binned summary of demographic data')
+    print('[Cohorts] Import cohort definitions')
+    print('[DefCohorts] Register the default cohorts')
     # print('[pseudo] Export pseudobulk data in format for import into mapMECFS')
     # print('[seahorse] Export seahorse data in format for import into mapMECFS')
     # print('[cpetrecovery] Export CPET recovery data in format for import into mapMECFS')
@@ -120,6 +137,10 @@ def show_commands():
     # print('[tp] Test pathway mapping across two assays')
     print(f'[vc] View {set_up_globals.clinical_document_name} data')
     print('[vb] View biospecimen data for a study ID')
+    print(f'[AsOf] View {set_up_globals.clinical_document_name} data for a study ID as of a version or date')
+    print('[MigrateHistory] Convert full version history snapshots to the compact delta format')
+    print('[DBStats] Show database connection health and pool statistics')
+    print('[MatrixCache] Build or refresh the cached assay matrices used by analyses')
     # print('[vsc] View biospecimen data for each scRNA-seq summary')
     # print('[vosc] View only scRNA-seq summary data')
     # print('[demo] Generate random demo data')
@@ -183,148 +204,8 @@ def log_into_account():
     success_msg('Logged in successfully.')
 
 
-def modify_df_column_names(column_names, classColumnList=None):
-    renamed_columns = []
-    for i in range(len(column_names)):
-        original_col = str(column_names[i]).strip()
-        col = utilities.modify_string(original_col)
-
-        # If classColumnsList exists then restrict column names to only those in the class
-        # This prevents the changing of gene symbols that are included as columns in th Excel spreadsheet
-        if (classColumnList is not None) and (col not in classColumnList):
-            renamed_columns.append(original_col)
-        else:
-            renamed_columns.append(col)
-
-    return renamed_columns
-
-
-def create_custom_columns(df, documentName, data_file_name, index_column=None):
-    #  Acts like pass by reference if I add data to df, rather than
-    #  assigning a new value to df, so no need to return a value
-    # print('Document name:', documentName)
-    df['data_file_name'] = data_file_name
-
-    if documentName == set_up_globals.scrnaseq_summary_document_name:
-        df['study_id'] = df['enid']
-
-    if documentName == set_up_globals.proteomics_document_name or \
-            documentName == set_up_globals.cytokines_document_name or \
-            documentName == set_up_globals.metabolomics_document_name or \
-            documentName == set_up_globals.mirnaseq_document_name or \
-            documentName == set_up_globals.scrnaseq_document_name or \
-            documentName == 'CPET' or \
-            documentName == set_up_globals.cpet_recovery_document_name or \
-            documentName == 'Other':
-        df['study_id'] = df['ENID']
-
-        validTimePoints = ['D1-PRE', 'D1-POST', 'D2-PRE', 'D2-POST', 'Other', '0h', '15min', '24h', 'D1', 'D2']
-        timepoint_list = []
-        for val in df['timepoint']:
-            # print('Val:', val)
-            if val in validTimePoints:
-                timepoint_list.append(val)
-            elif val.lower() == 'pre-day1':
-                timepoint_list.append('D1-PRE')
-            elif val.lower() == 'post-day1':
-                timepoint_list.append('D1-POST')
-            elif val.lower() == 'pre-day2':
-                timepoint_list.append('D2-PRE')
-            elif val.lower() == 'post-day2':
-                timepoint_list.append('D2-POST')
-            else:
-                timepoint_list.append('')
-        df['timepoint'] = timepoint_list
-
-        # Set up unique_id column
-        print('index column:', index_column)
-        # print('row:', row)
-        if index_column == 'AnalysisID':
-            # df.dropna(axis=0, subset=[index_column], inplace=True)  # Remove nulls from index
-            # //--- flag null value in the event log
-            index_names = df[df[index_column] == ''].index
-            df.drop(index_names, inplace=True)
-            df['unique_id'] = df[index_column]
-        elif index_column == 'ENID+Timepoint':
-            # //--- flag null values in the event log
-            # //--- I'm sure there's a way of doing this in one line, but this way is more readable : )
-            unique_id_list = []
-            for index, row in df.iterrows():
-                unique_id_list.append(svc.convert_to_string(row.study_id) + '-' + row.timepoint + '-' + data_file_name)
-            df['unique_id'] = unique_id_list
-        elif index_column == 'ENID+Timepoint+Annot-1':
-            # This assumes that Annot-1 contains a value that will make the ID unique
-            # e.g. 'Cluster' in the case of scRNAseq data
-            # //--- flag null values in the event log
-            # //--- I'm sure there's a way of doing this in one line, but this way is more readable : )
-            unique_id_list = []
-            for index, row in df.iterrows():
-                unique_id_list.append(svc.convert_to_string(row.study_id) + '-' + row.timepoint + '-' + str(
-                    row.annot_1) + '-' + data_file_name)
-            # print('unique_id_list:', unique_id_list)
-            df['unique_id'] = unique_id_list
-        elif index_column == 'ENID+Timepoint+Annot-1+Annot-2':
-            # This assumes that Annot-1 + Annot-2 contain values that will make the ID unique
-            unique_id_list = []
-            for index, row in df.iterrows():
-                unique_id_list.append(svc.convert_to_string(row.study_id) + '-' + row.timepoint + '-' +
-                                      str(row.annot_1) + '-' + str(row.annot_2) + '-' + data_file_name)
-            df['unique_id'] = unique_id_list
-        # else:
-        #     error_msg(f'Error: {index_column} is not a valid sample identifier type')
-        #     error_msg('Exiting data load')
-        #     return  # None, None
-
-    if documentName == set_up_globals.biospecimen_document_name:
-        df['sample_id'] = df['id']
-        # Set Specimen ID to ENID, CPET Day, Pre/Post, and Specimen type
-        # //--- this may not be needed in biospecimen spread sheet removes tube number from specimen id column
-        # //--- I'm sure there's a way of doing this in one line, but this way is more readable : )
-        specimen_id_list = []
-        for val in df['specimen_id']:
-            valMinusTubeNumberList = val.split('-')[0:4]
-            specimen_id_list.append('-'.join(valMinusTubeNumberList))
-        df['specimen_id'] = specimen_id_list
-
-    if documentName == set_up_globals.clinical_document_name:
-        # Make sure study ID is numeric (i.e. strip off 'ENID' if it exists)
-        study_id_list = [int(val.strip('ENID')) for val in df['study_id']]
-        df['study_id'] = study_id_list
-
-        # Create columns for binned values
-        for binColumn in set_up_globals.binnedColumnsDict:
-            df[binColumn + '_binned'] = ''
-
-    if documentName == set_up_globals.data_label_type_document_name:
-        df['unique_id'] = df.index
-        if 'comp_id' not in df.columns:
-            df['comp_id'] = ''
-            df['biochemical'] = ''
-        if 'gene_name' not in df.columns:
-            df['gene_name'] = ''
-        if 'gene_stable_id' not in df.columns:
-            df['gene_stable_id'] = ''
-        if 'cytokine_label' not in df.columns:
-            df['cytokine_label'] = ''
-        # //--- set up remaining data labels - let's do this without the hardcoding
-
-    if documentName == set_up_globals.seahorse_document_name:
-        df['unique_id'] = df[index_column]
-
-    if documentName == set_up_globals.cpet_recovery_document_name:
-        df['pub_id'] = df['ENID']
-        # unique_id_list = []
-        # for index, row in df.iterrows():
-        #     unique_id_list.append(svc.convert_to_string(row.pub_id) + '-' + svc.convert_to_string(row.timepoint) + '-' + data_file_name)
-        # df['unique_id'] = unique_id_list
-
-    if documentName == set_up_globals.ev_pilot_study_document_name:
-        df['unique_id'] = df['ENID']
-
-
-def import_data(documentName, index_column, verifyIntegrityFlag=True, sheet_name=0, skiprows=None):
-    print(f' ******************** Import {documentName} data ******************** ')
-
+# List the workbooks in the data folder and return the name of the one the user selects (None if no valid selection)
+def select_data_file():
     # Look up file
     items = os.listdir(data_folder)
     fileList = []
@@ -341,34 +222,35 @@ def import_data(documentName, index_column, verifyIntegrityFlag=True, sheet_name
     message = f"\nPlease select a file number between 1 and {str(len(fileList))}: "
     response = input(message)
     # if response in set_up_globals.exitResponseList:
-    #     return None, None
+    #     return None
 
     try:
-        data_file_name = fileList[int(response) - 1]
+        return fileList[int(response) - 1]
     except (IndexError, ValueError):
         error_msg('\nError: You did not make a valid file selection \n')
-        return None, None
+        return None
 
-    engine = 'openpyxl'  # Support for xlxs file format
-    if data_file_name.split('.')[1] == 'xls':
-        engine = 'xlrd'  # Support for xls file format
-    df = pd.read_excel(data_folder + data_file_name,
-                       sheet_name=sheet_name, skiprows=skiprows, engine=engine, keep_default_na=False)
 
-    df.columns = modify_df_column_names(df.columns)
-    index_names = df[df[index_column] == ''].index
-    df.drop(index_names, inplace=True)
-    # df.dropna(axis=0, subset=[index_column], inplace=True)  # Remove nulls from index
+def import_data(documentName, index_column, verifyIntegrityFlag=True, sheet_name=0, skiprows=None):
+    print(f' ******************** Import {documentName} data ******************** ')
+
+    data_file_name = select_data_file()
+    if data_file_name is None:
+        return None, None
 
-    # Create custom columns
-    create_custom_columns(df, documentName, data_file_name)
-    df.set_index(index_column, drop=False, inplace=True, verify_integrity=verifyIntegrityFlag)
+    # Read, normalize, and index the sheet (the first stages of the import pipeline)
+    context = import_pipeline.prepare_file('Sheet', data_folder + data_file_name, document_name=documentName,
+                                           data_file_name=data_file_name, index_column=index_column,
+                                           verify_integrity=verifyIntegrityFlag, sheet_name=sheet_name,
+                                           skiprows=skiprows)
 
-    return df, data_file_name
+    return context.df, data_file_name
 
 
 def import_assay_data():
-    df, data_file_name, metaDataDict, documentName, fastLoad = import_custom_assay_data()
+    context = select_custom_assay_file()
+    if context is None:
+        return
 
     # # Look up file
     # items = os.listdir(data_folder)
@@ -510,8 +392,9 @@ def import_assay_data():
     # fastLoad = False
     # if documentName == set_up_globals.scrnaseq_document_name: fastLoad = True
 
-    # Save assay meta data
-    svc.add_assay_meta_data(state.active_account, df, data_file_name, metaDataDict, documentName, fastLoad=fastLoad)
+    # Save assay meta data (the remaining stages of the import pipeline)
+    context.resume = ask_to_resume(context, context.document_name)
+    import_pipeline.complete_import(state.active_account, context)
 
     return
 
@@ -567,15 +450,99 @@ def import_enid_data():
 
 
 def import_clinical_data():
-    documentName = set_up_globals.clinical_document_name
-    df, data_file_name = import_data(documentName, 'study_id')
-    svc.add_clinical_data(state.active_account, df, data_file_name)
+    import_sheet_through_pipeline('Clinical')
 
 
 def import_biospecimen_data():
-    documentName = set_up_globals.biospecimen_document_name
-    df, data_file_name = import_data(documentName, 'specimen_id', verifyIntegrityFlag=False)
-    svc.add_biospecimen_data(state.active_account, df, data_file_name)
+    import_sheet_through_pipeline('Biospecimen')
+
+
+# Import a clinical or biospecimen workbook through every stage of its import pipeline
+def import_sheet_through_pipeline(import_type):
+    print(f' ******************** Import {import_type} data ******************** ')
+
+    data_file_name = select_data_file()
+    if data_file_name is None:
+        return
+
+    try:
+        context = import_pipeline.prepare_file(import_type, data_folder + data_file_name,
+                                               data_file_name=data_file_name)
+    except ValueError as e:
+        error_msg(f'Error: {e}')
+        error_msg('No data saved')
+        return
+
+    if import_type == 'Clinical':
+        context.resume = ask_to_resume(context, set_up_globals.clinical_document_name)
+    import_pipeline.complete_import(state.active_account, context)
+
+    print_validation_report(context.validation)
+
+
+# If an earlier import of the same file stopped part way through, ask whether to carry on from where it stopped
+# (otherwise the whole file is imported again)
+def ask_to_resume(context, documentName) -> bool:
+    journal = journal_svc.find_unfinished_import_journal(context.data_file_name, context.content_hash, documentName)
+    if journal is None:
+        return False
+    message = f"\nAn earlier import of {context.data_file_name} stopped after {journal.committed_rows} of " \
+              f"{journal.total_rows} rows. Resume it? (y/n): "
+    response = input(message)
+    return response[:1].lower() == 'y'
+
+
+# Print the issues found by the validate stage of an import
+def print_validation_report(report):
+    if len(report.issues.index) == 0:
+        return
+    message = f'Validation of {report.data_file_name}: {report.summary()}'
+    if len(report.errors.index):
+        error_msg(message)
+        error_msg('Rows with errors are not saved')
+    else:
+        print(message)
+    print(report.format())
+
+
+# Dry run: read and validate a clinical, biospecimen, or assay file, and write every issue to a CSV file next to
+# it, without saving anything
+def check_import_file():
+    print(' ******************** Check an import file (dry run) ******************** ')
+    importTypes = {'d': 'Clinical', 'b': 'Biospecimen', 'a': 'Assay'}
+    response = input(f'Type of data ([D] {set_up_globals.clinical_document_name}, [B] biospecimen, [A] assay): ')
+    import_type = importTypes.get(response.strip().lower()[:1])
+    if import_type is None:
+        error_msg('\nError: You did not make a valid selection \n')
+        return
+
+    data_file_name = select_data_file()
+    if data_file_name is None:
+        return
+
+    file_path = data_folder + data_file_name
+    try:
+        if import_type == 'Assay':
+            metaDataDict, documentName, externalFileName = read_custom_assay_metadata(file_path)
+            skiprows = range(0, 1)
+            context = import_pipeline.dry_run('Assay', file_path, document_name=documentName, meta_data=metaDataDict,
+                                              data_table_path=externalFileName, skiprows=skiprows)
+        else:
+            context = import_pipeline.dry_run(import_type, file_path, data_file_name=data_file_name)
+    except ValueError as e:
+        error_msg(f'Error: {e}')
+        return
+
+    report = context.validation
+    print(f'{len(context.df.index)} rows read, {len(context.valid_rows().index)} would be saved.')
+    if len(report.issues.index) == 0:
+        success_msg(f'No errors or warnings in {data_file_name}.')
+        return
+
+    print_validation_report(report)
+    reportFileName = os.path.splitext(data_file_name)[0] + '_validation.csv'
+    report.to_csv(data_folder + reportFileName)
+    print(f'All {len(report.issues.index)} issues written to {reportFileName}.')
 
 
 def import_scrnaseq_summary_data():
@@ -584,11 +551,28 @@ def import_scrnaseq_summary_data():
     svc.add_scrnaseq_summary_data(state.active_account, df, data_file_name)
 
 
+def import_cohort_data():
+    documentName = set_up_globals.cohort_document_name
+    df, data_file_name = import_data(documentName, 'cohort_name', verifyIntegrityFlag=False)
+    cohort_svc.add_cohort_data(state.active_account, df, data_file_name)
+
+
+def register_default_cohorts():
+    cohort_svc.register_default_cohorts(state.active_account)
+
+
 # Export demographic info for mapMECFS with data from certain fields reported as bins
-def export_binned_summary():
+# Bin counts are reported for cases and controls, and for each of the named case and control cohorts.
+# If restrictToCohortNames is set, only members of those cohorts are exported.
+def export_binned_summary(caseCohortNames=None, controlCohortNames=None, restrictToCohortNames=None,
+                          as_of_date=None):
     print(' ********************     Export binned demographic summary     ******************** ')
 
-    useSingleCellENIDsOnly = False
+    if caseCohortNames is None: caseCohortNames = set_up_globals.binnedSummaryCaseCohorts
+    if controlCohortNames is None: controlCohortNames = set_up_globals.binnedSummaryControlCohorts
+    cohortNames = list(caseCohortNames) + list(controlCohortNames)
+    countColumns = 2 + len(cohortNames)  # Case and control counts, followed by a count for each cohort
+    useSingleCellENIDsOnly = bool(restrictToCohortNames)
 
     # Sex, age, BMI, SF36 domains (GH, PCS), MFI, whether onset was sudden or gradual, Bell score
     # columns = set_up_globals.exportDemographicColumnsForSCpaper
@@ -633,7 +617,7 @@ def export_binned_summary():
             for binRange in binRangeTuples:
                 binStart = float(binRange[0])
                 binEnd = float(binRange[1])
-                binCountsDict[modifiedBinnedColumns[i]][binNumber] = [0, binStart, binEnd, 0, 0, 0, 0, 0, 0]
+                binCountsDict[modifiedBinnedColumns[i]][binNumber] = [0, binStart, binEnd] + [0] * countColumns
                 binNumber += 1
             # if modifiedBinnedColumns[i] == 'age':
             #     binCountsDict[modifiedBinnedColumns[i]][1] = [0, 0, 35, 0, 0, 0, 0, 0, 0]
@@ -661,7 +645,7 @@ def export_binned_summary():
     # Get a list of all the subjects in the database
     # documentName = set_up_globals.clinical_document_name
     # df, data_file_name = import_data(documentName, 'study_id')
-    clinicalDataObjectList = svc.find_clinical_data()
+    clinicalDataObjectList = svc.find_clinical_data(as_of_date, analytics=True)
 
     # Get list of unique assay names
     uniqueAssayList = svc.find_unique_assay_names()
@@ -674,25 +658,15 @@ def export_binned_summary():
                                                                   assayResultsFlag=True,
                                                                   assaySummaryFlag=False)
 
-    # Set up lists of patients and controls with single-cell and metabolomics data
-    patientENIDs = [101, 171, 483, 287, 416, 408, 588, 115, 199, 329, 191, 128, 344, 135, 196, 112, 380, 160, 440, 316,
-                    463, 447, 235, 299, 369, 473, 405, 554, 500, 730]
-    controlENIDs = [181, 241, 467, 375, 656, 723, 637, 715, 711, 145, 164, 197, 119, 143, 359, 261, 297, 406, 276, 210,
-                    338, 333, 481, 724, 791, 788, 727, 760]
-    metabolomicsPatientENIDs = [101, 112, 115, 128, 135, 136, 160, 171, 191, 196, 199, 204, 205, 223, 228, 230, 235,
-                                240, 264, 284, 287, 290, 299, 311, 316, 350, 358, 369, 372, 380, 396, 403, 405, 408,
-                                416, 420, 440, 447, 463, 473, 483, 500, 521, 523, 524, 526, 551, 554, 558, 576, 583,
-                                588, 594, 600, 678, 679, 698, 701, 702, 730]
-    metabolomicsControlENIDs = [119, 143, 145, 164, 181, 197, 210, 241, 261, 276, 297, 333, 338, 347, 375, 406, 410,
-                                413, 467, 481, 488, 506, 563, 606, 607, 622, 637, 656, 685, 711, 712, 715, 722, 723,
-                                724, 727, 732, 759, 760, 771, 774, 784, 788, 791, 811]
-    populationToConsider = patientENIDs
-    if useSingleCellENIDsOnly: desiredNumberOfBins = desiredNumberOfBins - 1
-
     # Set up dataframe to export
     df = df[df.phenotype.notnull()]
     df = df[df.phenotype.isin(['HC', 'ME/CFS'])]
-    if useSingleCellENIDsOnly: df = df[df.study_id.isin(patientENIDs + controlENIDs)]
+    populationToConsider = set()
+    if useSingleCellENIDsOnly:
+        desiredNumberOfBins = desiredNumberOfBins - 1
+        restrictMasks = cohort_svc.cohort_membership(df.study_id.to_numpy(), restrictToCohortNames)
+        df = df[np.logical_or.reduce(list(restrictMasks.values()))]
+        populationToConsider = set(df.study_id[df.phenotype == 'ME/CFS'])
 
     # Build custom summary columns
     df['pem_change_d1_to_d2'] = df['sss_cpet2_pre_9'] - df['sss_cpet1_pre_9']
@@ -764,7 +738,7 @@ def export_binned_summary():
                 if not keepGoing: break
             for binNumber in countDict:
                 binCountsDict[binName][binNumber] = [0, (binNumber - 1) * binSize + binMinDict[binName],
-                                                     binNumber * binSize - 1 + binMinDict[binName], 0, 0, 0, 0, 0, 0]
+                                                     binNumber * binSize - 1 + binMinDict[binName]] + [0] * countColumns
         # print(binSizeDict)
     else:
         for binName in modifiedBinnedColumns:
@@ -782,7 +756,7 @@ def export_binned_summary():
                 # if useSingleCellENIDsOnly and row['study_id'] not in populationToConsider: continue
 
                 if binNumber not in sorted(binCountsDict[binName]):
-                    binCountsDict[binName][binNumber] = [0, float(row[binName]), float(row[binName]), 0, 0, 0, 0, 0, 0]
+                    binCountsDict[binName][binNumber] = [0, float(row[binName]), float(row[binName])] + [0] * countColumns
                     countDict[binNumber] = 0
                     if useSingleCellENIDsOnly:
                         if row['study_id'] in populationToConsider: countDict[binNumber] += 1
@@ -796,7 +770,7 @@ def export_binned_summary():
                     binCountsDict[binName][binNumber][2] = float(row[binName])
                 if countDict[binNumber] >= numberOfPeoplePerBin:
                     binNumber += 1
-                    binCountsDict[binName][binNumber] = [0, float(row[binName]), float(row[binName]), 0, 0, 0, 0, 0, 0]
+                    binCountsDict[binName][binNumber] = [0, float(row[binName]), float(row[binName])] + [0] * countColumns
                     countDict[binNumber] = 0
 
     # Reset lower and upper limits on first and last bins
@@ -815,33 +789,25 @@ def export_binned_summary():
     for binNumber in sorted(binCountsDict['bmi']):
         print('binCountsDict:', str(binNumber), binCountsDict['bmi'][binNumber])
 
-    # Calculate bins
+    # Calculate bins (one vectorized pass per binned column, counting every cohort at once)
+    isCase = (exportSummaryDF['phenotype'] == 'ME/CFS').to_numpy()
+    cohortMasks = cohort_svc.cohort_membership(exportSummaryDF['study_id'].to_numpy(), cohortNames)
+    for name in caseCohortNames: cohortMasks[name] = cohortMasks[name] & isCase
+    for name in controlCohortNames: cohortMasks[name] = cohortMasks[name] & ~isCase
+    cohortMasks = {'case': isCase, 'control': ~isCase, **cohortMasks}
+
     for binName in binCountsDict:
-        exportSummaryDF[binName + '_binned'] = ''
-
-    for idx, row in exportSummaryDF.iterrows():
-        # print(' {}. {}: {}'.format(idx + 1, row.study_id, row.age))
-
-        for binName in binCountsDict:
-            if not utilities.isNumber(row[binName]): continue
-            for binNumber in sorted(binCountsDict[binName]):
-                binList = binCountsDict[binName][binNumber]
-                binStart = float(binList[1])
-                binEnd = float(binList[2])
-                if (binNumber == 1 and float(row[binName]) >= binStart and float(row[binName]) <= binEnd) or \
-                        (float(row[binName]) > binStart and float(row[binName]) <= binEnd):
-                    exportSummaryDF.loc[idx, binName + '_binned'] = binNumber
-                    binCountsDict[binName][binNumber][0] += 1
-                    # Update case and control counts
-                    if row['phenotype'] == 'ME/CFS':
-                        binCountsDict[binName][binNumber][3] += 1
-                        if row['study_id'] in patientENIDs: binCountsDict[binName][binNumber][5] += 1
-                        if row['study_id'] in metabolomicsPatientENIDs: binCountsDict[binName][binNumber][7] += 1
-                    else:
-                        binCountsDict[binName][binNumber][4] += 1
-                        if row['study_id'] in controlENIDs: binCountsDict[binName][binNumber][6] += 1
-                        if row['study_id'] in metabolomicsControlENIDs: binCountsDict[binName][binNumber][8] += 1
-                    break
+        binNumbers = assign_bin_numbers(exportSummaryDF[binName], binCountsDict[binName])
+        exportSummaryDF[binName + '_binned'] = pd.Series(binNumbers, index=exportSummaryDF.index,
+                                                         dtype=object).where(binNumbers > 0, '')
+
+        numberOfBins = max(binCountsDict[binName], key=int)
+        totalCounts = np.bincount(binNumbers, minlength=numberOfBins + 1)
+        cohortCounts = cohort_svc.count_cohorts_by_bin(binNumbers, cohortMasks, numberOfBins)
+        for binNumber in binCountsDict[binName]:
+            binCountsDict[binName][binNumber][0] = int(totalCounts[binNumber])
+            for c, name in enumerate(cohortMasks):
+                binCountsDict[binName][binNumber][3 + c] = int(cohortCounts[name][binNumber])
 
     # Export
     print('df:', df[['study_id', 'cor_id', 'sex', 'phenotype', 'age']].head(10))
@@ -864,23 +830,20 @@ def export_binned_summary():
             binEnd = binList[2]
             binCountCase = binList[3]
             binCountControl = binList[4]
-            binCountCaseSC = binList[5]
-            binCountControlSC = binList[6]
-            binCountCaseMetabolomics = binList[7]
-            binCountControlMetabolomics = binList[8]
+            cohortCountText = ''.join([', %s: %d' % (name, count) for name, count in zip(cohortNames, binList[5:])])
             # binStart = (binNumber - 1) * binSize + binMinDict[bin]
             # binEnd = binNumber * binSize - 1 + binMinDict[bin]
             print(
-                '     Count for %s bin %d (>%3.3f to <=%4.3f): Total: %d (Case all: %d, Control all: %d, Case single-cell: %d, Control single-cell: %d, Case metabolomics: %d, Control metabolomics: %d)' %
-                (binName, binNumber, binStart, binEnd, binCount, binCountCase, binCountControl, binCountCaseSC,
-                 binCountControlSC, binCountCaseMetabolomics, binCountControlMetabolomics))
+                '     Count for %s bin %d (>%3.3f to <=%4.3f): Total: %d (Case all: %d, Control all: %d%s)' %
+                (binName, binNumber, binStart, binEnd, binCount, binCountCase, binCountControl, cohortCountText))
 
     exportSummaryDF.set_index('cor_id', inplace=True)
     for binName in modifiedBinnedColumns:
         exportSummaryDF.drop(binName, axis=1, inplace=True)
-    exportSummaryDF.to_excel("binned_demographics_with_study_id_2023-11-10.xlsx")
+    exportSummaryDF.to_excel(history_svc.as_of_file_name("binned_demographics_with_study_id_2023-11-10.xlsx",
+                                                         as_of_date))
     exportSummaryDF.drop('study_id', axis=1, inplace=True)
-    exportSummaryDF.to_excel("binned_demographics_2023-11-10.xlsx")
+    exportSummaryDF.to_excel(history_svc.as_of_file_name("binned_demographics_2023-11-10.xlsx", as_of_date))
 
     # # Save data for export to RTI
     # # Drop all but minimum cols, add CPET day pre and post to COR id
@@ -902,6 +865,19 @@ def export_binned_summary():
     # exportSummaryForRTIDF.to_csv("binned_demographics_for_RTI_2023-11-10.tsv", sep="\t")
 
 
+# Return the bin number of each value (0 if the value is not numeric or falls outside every bin).
+# The first bin includes its lower limit, all other bins are (start, end].
+def assign_bin_numbers(values, binDict):
+    values = pd.to_numeric(pd.Series(values), errors='coerce').to_numpy(dtype=float)
+    binNumbers = np.zeros(len(values), dtype=np.int64)
+    for binNumber in sorted(binDict):
+        binStart = float(binDict[binNumber][1])
+        binEnd = float(binDict[binNumber][2])
+        inBin = (values <= binEnd) & ((values > binStart) | ((binNumber == 1) & (values >= binStart)))
+        binNumbers[(binNumbers == 0) & inBin] = binNumber
+    return binNumbers
+
+
 def export_pseudobulk_for_rti():
     documentName = set_up_globals.scrnaseq_document_name
     print(f' ***************     Export {documentName} pseudo bulk data for import into mapMECFS     *************** ')
@@ -949,28 +925,24 @@ def export_pseudobulk_for_rti():
     pseudobulkDF.rename(columns={'Annot-2': 'annot_2'}, inplace=True)
     pseudobulkDF.rename(columns={'Annot-3': 'annot_3'}, inplace=True)
 
-    for index, row in pseudobulkDF.iterrows():
-        study_id = row['ENID']
-        clinical_data_list = svc.find_clinical_data_by_study_id(int(study_id))
-        pseudobulkDF.loc[index, 'cor_id'] = clinical_data_list.cor_id
-        if row['timepoint'] == 'Pre-Day1':
-            pseudobulkDF.loc[index, 'timepoint'] = 'D1-PRE'
-        else:
-            pseudobulkDF.loc[index, 'timepoint'] = 'D2-PRE'
+    # Look up every participant at once (iterating over the rows would copy each row's counts)
+    clinicalDataDict = svc.find_clinical_data_by_study_ids(pseudobulkDF['ENID'], include_assay_data=False,
+                                                           analytics=True)
+    pseudobulkDF = drop_rows_without_clinical_data(pseudobulkDF, clinicalDataDict)
+    pseudobulkDF['cor_id'] = [clinicalDataDict[int(study_id)].cor_id for study_id in pseudobulkDF['ENID']]
+    pseudobulkDF['timepoint'] = np.where(pseudobulkDF['timepoint'] == 'Pre-Day1', 'D1-PRE', 'D2-PRE')
 
     pseudobulkDF.drop('AnalysisID', axis=1, inplace=True)
     pseudobulkDF.drop('ENID', axis=1, inplace=True)
 
     print('pseudobulkDF:', pseudobulkDF.head(5))
     for cluster in pseudobulkDF['annot_1'].unique():
-        df = pseudobulkDF[pseudobulkDF["annot_1"] == cluster].copy()
-        rtiDF_transposed, outputAssayDataFileName = svc.set_up_data_export_for_rti(df,
-                                                                                   'cluster_' + str(
-                                                                                       cluster) + '_' + documentName + '_pseudobulk',
-                                                                                   dataLabelList)
-
-        print(f"Saving {outputAssayDataFileName} file.")
-        rtiDF_transposed.to_csv(data_folder + 'supplementary_data/' + outputAssayDataFileName, sep="\t", header=False)
+        df = pseudobulkDF[pseudobulkDF["annot_1"] == cluster]
+        # Written one gene at a time, formatting only the non-zero counts (see svc.write_data_export_for_rti)
+        outputAssayDataFileName = svc.write_data_export_for_rti(df, 'cluster_' + str(cluster) + '_' + documentName +
+                                                                '_pseudobulk', dataLabelList,
+                                                                data_folder + 'supplementary_data/')
+        print(f"Saved {outputAssayDataFileName} file.")
 
 
 def export_for_single_cell_paper():
@@ -1151,11 +1123,17 @@ def export_data_for_rti():
     dataTableDF.drop('unique_id', axis=1, inplace=True)
     dataTableDF.drop('data_file_name', axis=1, inplace=True)
     dataTableDF['timepoint'] = dataTableDF['timepoint'].astype(str)
+    as_of_date = input_as_of_date()
 
     # print('metaDataDict:', metaDataDict)
     # print('dataTableDF:', dataTableDF.head())
     # print('dataTableDF.columns:', dataTableDF.columns)
 
+    # Look up the clinical data of every participant in the file at once
+    clinicalDataDict = svc.find_clinical_data_by_study_ids(dataTableDF['ENID'], as_of_date, include_assay_data=False,
+                                                           analytics=True)
+    dataTableDF = drop_rows_without_clinical_data(dataTableDF, clinicalDataDict, as_of_date)
+
     # Set up summary phenotype dataframe
     columns = ['phenotype', 'biospecimen_type'] + set_up_globals.exportAssayColumnsForRTI
     modifiedColumns = modify_df_column_names(columns)
@@ -1164,7 +1142,7 @@ def export_data_for_rti():
     for index, row in dataTableDF.iterrows():
         study_id = row['ENID']
         # print('index, row:', index, row)
-        clinical_data_list = svc.find_clinical_data_by_study_id(study_id)
+        clinical_data_list = clinicalDataDict[int(study_id)]
         # print('clinical_data_list:', clinical_data_list.phenotype)
         df.loc[len(df.index)] = [clinical_data_list.phenotype,
                                 metaDataDict['biospecimen_type'],
@@ -1173,6 +1151,7 @@ def export_data_for_rti():
                                 metaDataDict['sample_identifier_type'], '', '', '']
 
     rti_phenotype_DF, outputPhenotypeFileName = svc.set_up_phenotype_export_for_rti(df, documentName.replace(' ', '_'))
+    outputPhenotypeFileName = history_svc.as_of_file_name(outputPhenotypeFileName, as_of_date)
 
     print(f"There are {len(rti_phenotype_DF)} summary rows.")
     # print(rti_phenotype_DF.head(5))
@@ -1190,11 +1169,7 @@ def export_data_for_rti():
     dataTableDF['annot_2'] = ''
     dataTableDF['annot_3'] = ''
 
-    for index, row in dataTableDF.iterrows():
-        study_id = row['ENID']
-        clinical_data_list = svc.find_clinical_data_by_study_id(study_id)
-        # print('clinical_data_list:', clinical_data_list.phenotype)
-        dataTableDF.loc[index, 'cor_id'] = clinical_data_list.cor_id
+    dataTableDF['cor_id'] = [clinicalDataDict[int(study_id)].cor_id for study_id in dataTableDF['ENID']]
 
     # dataTableDF.drop('AnalysisID', axis=1, inplace=True)
     # dataTableDF.drop('ENID', axis=1, inplace=True)
@@ -1207,6 +1182,7 @@ def export_data_for_rti():
     # print('is_unique:', dataTableDF.index.is_unique)
 
     rtiDF_transposed, outputAssayDataFileName = svc.set_up_data_export_for_rti(dataTableDF, 'ev_proteomics_brc', dataLabelList)
+    outputAssayDataFileName = history_svc.as_of_file_name(outputAssayDataFileName, as_of_date)
     rtiDF_transposed.drop(rtiDF_transposed.tail(1).index, inplace=True)
 
     print(f"Saving {outputAssayDataFileName} file.")
@@ -1346,106 +1322,32 @@ def export_ev_pilot_study_for_rti():
 
 
 def import_custom_assay_data(custom_sheet_name='Data Table', personIdentifierColumn='ENID'):
-    # Look up file
-    items = os.listdir(data_folder)
-    fileList = []
-    for names in items:
-        if (names.endswith('.xlsx') or names.endswith('.xls')) and not names.startswith('~'):
-            fileList.append(names)
+    context = select_custom_assay_file(custom_sheet_name, personIdentifierColumn)
+    if context is None:
+        return  # None, None
 
-    for idx, fileName in enumerate(fileList):
-        print('{}. {}'.format(
-            idx + 1,
-            fileName
-        ))
+    return context.df, context.data_file_name, context.meta_data, context.document_name, context.fast_load
 
-    message = f"\nPlease select a file number between 1 and {str(len(fileList))}: "
-    response = input(message)
-    # //--- need some error checking here
-    # if response in set_up_globals.exitResponseList:
-    #     return  # None, None
 
-    try:
-        data_file_name = fileList[int(response) - 1]
-    except (IndexError, ValueError):
-        error_msg('\nError: You did not make a valid file selection \n')
+# Select an assay workbook, confirm its metadata, and read its data (the read, normalize, and validate stages of
+# the assay import pipeline). Returns the import context, or None if there's nothing to import.
+def select_custom_assay_file(custom_sheet_name='Data Table', personIdentifierColumn='ENID'):
+    data_file_name = select_data_file()
+    if data_file_name is None:
         return  # None, None
 
-    # Start by reading metadata sheet
-    # Need to know: documentName, index_column, sheet_name, and skiprows before reading data sheet
-    metaDataDict = {'submitter_name': None,
-                    'submitter_netid': None,
-                    'pi_name': None,
-                    'unique_assay_name': None,
-                    'assay_type': None,
-                    'assay_method': None,
-                    'biospecimen_type': None,
-                    'sample_identifier_type': None,
-                    'dataset_name': None,
-                    'dataset_annotation': None,
-                    'data_label_type': None,
-                    'comment': None,
-                    'units': None,
-                    'normalization_method': None,
-                    'pipeline': None,
-                    'title': None,
-                    'description': None,
-                    'tags': None,
-                    'organization': None,
-                    'current_visibility': None,
-                    'data_type': None,
-                    'organism': None,
-                    'assay': None,
-                    'measurement': None,
-                    'study_type': None,
-                    'sample': None,
-                    'file_name_location': None,
-                    }
-    engine = 'openpyxl'  # Support for xlxs file format
-    if data_file_name.split('.')[1] == 'xls':
-        engine = 'xlrd'  # Support for xls file format
-    skiprows = range(0, 3)
-    metaDataDF = pd.read_excel(data_folder + data_file_name,
-                               sheet_name='Metadata', skiprows=skiprows, engine=engine, keep_default_na=False)
-    for i, row in metaDataDF.iterrows():
-        metaDataType = modify_df_column_names([str(row[0]).lower()])[0]
-        response = str(row[1])
-        if metaDataType in metaDataDict and len(response.strip()) > 0 and response.strip().lower() != 'nan':
-            metaDataDict[metaDataType] = response.strip()
+    try:
+        metaDataDict, documentName, externalFileName = read_custom_assay_metadata(data_folder + data_file_name)
+    except ValueError as e:
+        error_msg(f'Error: {e}')
+        error_msg('Exiting data load')
+        return  # None, None
 
     # Display what was just read
     print('')
     for key, val in metaDataDict.items():
         print(key, ':', val)
 
-    # Check assay type
-    # //--- replace all these with global references
-    validAssayTypes = [set_up_globals.proteomics_document_name,
-                       set_up_globals.cytokines_document_name,
-                       set_up_globals.metabolomics_document_name,
-                       set_up_globals.mirnaseq_document_name,
-                       set_up_globals.scrnaseq_document_name,
-                       set_up_globals.seahorse_document_name,
-                       set_up_globals.cpet_recovery_document_name,
-                       'BDNF',
-                       'CPET',
-                       'LPS',
-                       'Other']
-    documentName = metaDataDict['assay_type']
-    if documentName not in validAssayTypes:
-        error_msg(f'Error: {documentName} is not a valid assay type')
-        error_msg('Exiting data load')
-        return  # None, None
-
-    # If separate file specified, check that it exists
-    externalFileName = ''
-    if metaDataDict['file_name_location'] is not None:
-        externalFileName = data_folder + metaDataDict['file_name_location']
-        if not exists(externalFileName):
-            error_msg(f'Error: {externalFileName} does not exist')
-            error_msg('Exiting data load')
-            return  # None, None
-
     message = f"\nIs this correct? (y/n): "
     response = input(message)
     if response[0].lower() != 'y':
@@ -1453,44 +1355,39 @@ def import_custom_assay_data(custom_sheet_name='Data Table', personIdentifierCol
 
     print(f' ******************** Import {documentName} data ******************** ')
 
-    # If link to file exists, read data from there, otherwise read data from 'Data Table' tab of spreadsheet
-    if len(externalFileName) == 0:  # Read data from 'Data Table' tab
-        skiprows = range(0, 1)  # //--- for now, define skiprows as the top row - can adjust this later
-        df = pd.read_excel(data_folder + data_file_name,
-                           sheet_name=custom_sheet_name, skiprows=skiprows, engine=engine, keep_default_na=False)
-    else:  # Read data from external file
-        df = pd.read_csv(externalFileName, sep='\t', header=0, keep_default_na=False)
+    try:
+        context = prepare_custom_assay_file(data_folder + data_file_name, metaDataDict, documentName,
+                                            externalFileName, custom_sheet_name, personIdentifierColumn)
+    except ValueError as e:
+        error_msg(str(e))
+        error_msg('No data saved')
+        return  # Skip the rest of this function
 
-    # Remove nulls from ENID
-    print('df:', df.head())
-    index_names = df[df[personIdentifierColumn] == ''].index
-    df.drop(index_names, inplace=True)
+    print_validation_report(context.validation)
+    return context
 
-    # Remove unnamed columns
-    unnamedColList = [colName for colName in df.columns if str(colName).startswith('Unnamed')]
-    df.drop(labels=unnamedColList, axis='columns', inplace=True)
 
-    # Get column names
-    classColumnList = utilities.attributes(AssayMetaData)
-    df.columns = modify_df_column_names(df.columns, classColumnList)
+# Read the Metadata sheet of an assay workbook, returning (metaDataDict, documentName, externalFileName).
+# Raises ValueError if the assay type is not valid or the external data file named in the metadata is missing.
+def read_custom_assay_metadata(file_path):
+    return import_pipeline.read_assay_metadata(file_path)
 
-    # Create custom columns
-    create_custom_columns(df, documentName, data_file_name, metaDataDict['sample_identifier_type'])
 
-    print('df:', df['unique_id'].head())
-    try:
-        df.set_index('unique_id', drop=False, inplace=True, verify_integrity=True)
-    except (ValueError, ValidationError) as e:
-        message = f'Create of index for {documentName} data resulted in exception: {e}'
-        error_msg(message)
-        error_msg('No data saved')
-        return  # Skip the rest of this function
+# Read the data of an assay workbook (from its Data Table sheet, or the external file named in its metadata),
+# returning (df, fastLoad) ready for svc.add_assay_meta_data. Raises ValueError if the unique IDs are not unique.
+def read_custom_assay_data_table(file_path, metaDataDict, documentName, externalFileName='',
+                                 custom_sheet_name='Data Table', personIdentifierColumn='ENID'):
+    context = prepare_custom_assay_file(file_path, metaDataDict, documentName, externalFileName, custom_sheet_name,
+                                        personIdentifierColumn)
+    return context.df, context.fast_load
 
-    # Fast load: assumes that all assay data in new and aso skips the reference to the biospecimen
-    fastLoad = False
-    if documentName == set_up_globals.scrnaseq_document_name: fastLoad = True
 
-    return df, data_file_name, metaDataDict, documentName, fastLoad
+def prepare_custom_assay_file(file_path, metaDataDict, documentName, externalFileName='',
+                              custom_sheet_name='Data Table', personIdentifierColumn='ENID'):
+    skiprows = range(0, 1)  # //--- for now, define skiprows as the top row - can adjust this later
+    return import_pipeline.prepare_file('Assay', file_path, document_name=documentName, meta_data=metaDataDict,
+                                        data_table_path=externalFileName, sheet_name=custom_sheet_name,
+                                        skiprows=skiprows, index_column=personIdentifierColumn)
 
 
 def generate_demo_data():
@@ -1646,21 +1543,18 @@ def calculate_pathway_summaries():
         for summaryType in set_up_globals.summary_type_choices:
             df[summaryType] = None
 
-        for idx, c in df.iterrows():
-
-            # print(' {}. {}: {}'.format(idx + 1, c.study_id,
-            #                            'ME/CFS patient' if c.phenotype == 'ME/CFS' else 'Healthy control'))
-            # print('      * Assay summary: {}, {}'.format(c.unique_assay_name, c.timepoint))
-            arList = []
-            for ar in dataGeneSymbolList:
-                # print('            * Results: {}, {}'.format(ar, c[ar]))
-                if not np.isnan(c[ar]):
-                    arList.append(c[ar])
-            # print(np.ma.average(arList))
-            if not np.isnan(np.ma.average(arList)):
-                df.loc[idx, 'Average'] = np.ma.average(arList)
+        # Average of the results each row has (NaN if it has none, which isn't saved), from the cached matrix of
+        # each assay. Rows stored without their results of 0 are missing those from the data frame, but in the
+        # matrix they are 0 (and a result that was missing from the imported file is NaN, so it stays missing).
+        df['Average'] = np.nan
+        for uniqueAssayName in df['unique_assay_name'].dropna().unique():
+            matrix = matrix_cache.load_assay_matrix(uniqueAssayName, labels=dataGeneSymbolList)
+            averages = pd.Series(matrix_svc.pathway_averages(matrix, dataGeneSymbolList), index=matrix.unique_ids)
+            averages = averages[~averages.index.duplicated()]
+            isAssay = df['unique_assay_name'] == uniqueAssayName
+            df.loc[isAssay, 'Average'] = df.loc[isAssay, 'unique_id'].map(averages)
 
-            # //--- Add other summaries here - GSEA next!
+        # //--- Add other summaries here - GSEA next!
 
         # Save summary values back to the clinical data object
         print(df.head(15))
@@ -1714,7 +1608,7 @@ def list_clinical_data(suppress_header=False):
         print(
             f' ********************     {set_up_globals.clinical_document_name.capitalize()} data     ******************** ')
 
-    clinical_data_list = svc.find_clinical_data()
+    clinical_data_list = svc.find_clinical_data(analytics=True)
     print(f"There are {len(clinical_data_list)} records.")
     for idx, c in enumerate(clinical_data_list):
         print(' {}. {}: {}'.format(idx + 1, c.study_id,
@@ -1750,6 +1644,106 @@ def list_biospecimen_data_for_study_id():
         #     ))
 
 
+# Leave out the rows of df whose participant (ENID) has no clinical data in clinicalDataDict, e.g. one not in the
+# database yet or (with as_of_date) added after that date
+def drop_rows_without_clinical_data(df, clinicalDataDict, as_of_date=None):
+    found = [int(study_id) in clinicalDataDict for study_id in df['ENID']]
+    if all(found):
+        return df
+    missingIDs = sorted({int(study_id) for study_id, ok in zip(df['ENID'], found) if not ok})
+    asOf = f' as of {as_of_date}' if as_of_date else ''
+    error_msg(f'No {set_up_globals.clinical_document_name} data{asOf} for ENIDs '
+              f'{", ".join(str(i) for i in missingIDs)}; leaving their {len(found) - sum(found)} rows out of the export')
+    return df[found].copy()
+
+
+# Prompt for the date to export data as of, returning None (current data) if nothing is entered
+def input_as_of_date():
+    while True:
+        response = input('Export data as of date (YYYY-MM-DD [HH:MM], blank for current data): ')
+        try:
+            return history_svc.parse_as_of_date(response)
+        except ValueError as e:
+            error_msg(str(e))
+
+
+def list_clinical_data_as_of_version():
+    study_id = input("Enter study ID: ")
+    if not study_id.strip():
+        error_msg('Cancelled')
+        print()
+        return
+    version_number = input("Enter version number or date (YYYY-MM-DD): ")
+    if not version_number.strip():
+        error_msg('Cancelled')
+        print()
+        return
+
+    study_id = int(study_id)
+    if version_number.strip().isdigit():
+        clinical_data = history_svc.as_of(study_id, int(version_number))
+    else:
+        try:
+            clinical_data = history_svc.clinical_data_as_of_date(study_id,
+                                                                 history_svc.parse_as_of_date(version_number))
+        except ValueError as e:
+            error_msg(str(e))
+            return
+    if not clinical_data:
+        error_msg(f'Version {version_number} of the {set_up_globals.clinical_document_name} data for study ID '
+                  f'{study_id} was not found.')
+        return
+
+    print('Version {} of study ID {} (last modified {} from {}):'.format(clinical_data.version_number, study_id,
+                                                                        clinical_data.last_modified_date,
+                                                                        clinical_data.data_file_name))
+    for attrib in ClinicalData.get_demographic_attributes():
+        if clinical_data[attrib] is not None:
+            print('    {}: {}'.format(attrib, clinical_data[attrib]))
+    print('    {} assay records'.format(len(clinical_data.assay_meta_data)))
+
+
+def migrate_version_history():
+    print(' ********************     Migrate version history     ******************** ')
+    dropLegacy = input('Drop the full snapshot history collections after migrating? [y/N] ').strip().lower() == 'y'
+    history_svc.migrate_version_history(state.active_account, dropLegacy=dropLegacy)
+
+
+def show_connection_statistics():
+    print(' ********************     Database connection     ******************** ')
+    for alias in mongo_setup.registered_aliases():
+        print(f'{alias.capitalize()} connection:')
+        health = mongo_setup.health_check(alias)
+        if health['ok']:
+            success_msg(f"MongoDB {health['version']} responded in {health['latency_ms']:.1f} ms "
+                        f"(compression: {health['compression'] or 'none'}).")
+        else:
+            error_msg(f"Unable to reach MongoDB: {health['error']}")
+
+        statistics = mongo_setup.pool_statistics(alias)
+        print('Connection options:')
+        for option, value in statistics['options'].items():
+            print(f'    {option}: {value}')
+
+        print('Connection pool (since startup):')
+        for server, counts in statistics['pools'].items():
+            print(f'    {server}: ' + ', '.join(f'{name} {count}' for name, count in sorted(counts.items())))
+
+        if statistics['server'] is not None:
+            print('Server connections: ' + ', '.join(f'{name} {count}' for name, count in statistics['server'].items()))
+        else:
+            print(f"Server connections: not available ({statistics.get('server_error')})")
+        print()
+
+
+def build_assay_matrix_cache():
+    print(' ********************     Assay matrix cache     ******************** ')
+    print(f'Cache directory: {matrix_cache.cacheDirectory}')
+    force = input('Rebuild every assay, not just the ones that changed? [y/N] ').strip().lower() == 'y'
+    for line in matrix_cache.build_assay_matrix_cache(force=force):
+        print('    ' + line)
+
+
 def list_biospecimen_data_for_scrnaseq_summary():
     print(' ********************     Biospecimen data for scRNA-seq summaries     ******************** ')
 
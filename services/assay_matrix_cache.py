@@ -0,0 +1,247 @@
+# On-disk cache of assay matrices (see assay_matrix_service), so analyses don't read the assay results from the
+# database each time. Each assay's sample x data label matrix is stored as a .npy file that is memory-mapped when
+# loaded (nothing is copied until it's used), with the sample and label index in a JSON sidecar. The sidecar
+# records the assay's change counter (AssayChangeCounter) when the matrix was built, and every write of the assay's
+# results bumps the counter, so a cached matrix is used only while it's current and is rebuilt otherwise.
+# Sparse matrices (see assay_matrix_service) are stored as the data, indices, and indptr arrays of the CSR matrix,
+# each memory-mapped, so they take space in proportion to their non-zero results.
+# The matrix files of a build are named after the counter and the sidecar is replaced last, so a reader never sees
+# a half written matrix. The cache is kept in a directory private to the user (see cache_directories); if that
+# can't be set up, matrices are read from the database without being cached.
+
+
+from collections import OrderedDict
+from typing import List, Optional, Sequence
+import datetime
+import hashlib
+import json
+import os
+import time
+import numpy as np
+import scipy.sparse
+
+from data.assay_change_counters import AssayChangeCounter
+import services.assay_matrix_service as matrix_svc
+from services.assay_matrix_service import AssayMatrix
+from services.cache_directories import cache_directory, make_private_directory
+
+# Directory and size limit for the cache (least recently loaded assays are evicted first)
+cacheDirectory = cache_directory('MECFS_MATRIX_CACHE_DIR', 'matrix_cache')
+cacheLimitBytes = int(float(os.environ.get('MECFS_MATRIX_CACHE_MB', '2048')) * 1024 * 1024)
+
+_sidecarMemo = OrderedDict()  # (sidecar path, inode, size) -> sidecar contents (a rebuilt sidecar is a new file)
+sidecarMemoSize = 64
+
+
+def _assay_key(unique_assay_name) -> str:
+    return hashlib.sha1(unique_assay_name.encode('utf-8')).hexdigest()[:16]
+
+
+def _sidecar_path(unique_assay_name) -> str:
+    return os.path.join(cacheDirectory, _assay_key(unique_assay_name) + '.json')
+
+
+def current_change_counter(unique_assay_name) -> int:
+    counter = AssayChangeCounter.objects(unique_assay_name=unique_assay_name).only('counter').as_pymongo().first()
+    return counter.get('counter', 0) if counter else 0
+
+
+def _read_sidecar(unique_assay_name) -> Optional[dict]:
+    path = _sidecar_path(unique_assay_name)
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    memoKey = (path, stat.st_ino, stat.st_size)
+    if memoKey in _sidecarMemo:
+        _sidecarMemo.move_to_end(memoKey)
+        return _sidecarMemo[memoKey]
+    try:
+        with open(path, encoding='utf-8') as f:
+            _sidecarMemo[memoKey] = json.load(f)
+    except (OSError, ValueError):
+        return None
+    while len(_sidecarMemo) > sidecarMemoSize:
+        _sidecarMemo.popitem(last=False)
+    return _sidecarMemo[memoKey]
+
+
+# Change counter of a build from the name of one of its files ('<key>-<counter>-<pid>.<array>.npy'), or None
+def _build_counter(key, name) -> Optional[int]:
+    if not name.startswith(key + '-'):
+        return None
+    counterText = name[len(key) + 1:].split('-', 1)[0]
+    return int(counterText) if counterText.isdigit() else None
+
+
+# Write a matrix and its sidecar, and remove the files of the assay's builds with an older change counter (builds of
+# the same counter may belong to another process that is about to replace the sidecar with its own)
+def _write(unique_assay_name, counter, matrix: AssayMatrix) -> dict:
+    if not make_private_directory(cacheDirectory):
+        raise OSError(f'the cache directory {cacheDirectory} is not private to this user')
+    key = _assay_key(unique_assay_name)
+    buildTag = f'{key}-{counter}-{os.getpid()}'
+    if scipy.sparse.issparse(matrix.values):
+        arrays = {'data': matrix.values.data, 'indices': matrix.values.indices, 'indptr': matrix.values.indptr}
+    else:
+        arrays = {'values': matrix.values}
+    arrays['study_ids'] = matrix.study_ids
+    files = {}
+    for name, array in arrays.items():
+        files[name] = f'{buildTag}.{name}.npy'
+        np.save(os.path.join(cacheDirectory, files[name]), array)
+
+    sidecar = {'unique_assay_name': unique_assay_name,
+               'counter': counter,
+               'built_date': datetime.datetime.now().isoformat(timespec='seconds'),
+               'format': 'csr' if 'indptr' in files else 'dense',
+               'shape': list(matrix.values.shape),
+               'files': files,
+               'labels': matrix.labels.tolist(),
+               'timepoints': matrix.timepoints.tolist(),
+               'unique_ids': matrix.unique_ids.tolist()}
+    sidecarPath = _sidecar_path(unique_assay_name)
+    temporaryPath = sidecarPath + f'.{os.getpid()}.tmp'
+    with open(temporaryPath, 'w', encoding='utf-8') as f:
+        json.dump(sidecar, f)
+    os.replace(temporaryPath, sidecarPath)
+
+    for name in os.listdir(cacheDirectory):
+        buildCounter = _build_counter(key, name)
+        if buildCounter is not None and buildCounter < counter:
+            try:
+                os.remove(os.path.join(cacheDirectory, name))
+            except OSError:
+                pass
+    return sidecar
+
+
+# Remove least recently loaded assays until the cache directory fits within its size limit
+def _evict():
+    assays = {}  # Assay key -> [last loaded, total bytes, paths]
+    for name in os.listdir(cacheDirectory):
+        path = os.path.join(cacheDirectory, name)
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            continue
+        entry = assays.setdefault(name[:16], [0, 0, []])  # Every file of an assay starts with its key
+        if name.endswith('.json'):
+            entry[0] = stat.st_mtime
+        entry[1] += stat.st_size
+        entry[2].append(path)
+
+    totalBytes = sum(entry[1] for entry in assays.values())
+    for lastLoaded, size, paths in sorted(assays.values()):
+        if totalBytes <= cacheLimitBytes:
+            break
+        for path in sorted(paths, key=lambda p: not p.endswith('.json')):  # Sidecar first
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        totalBytes -= size
+
+
+def _load(sidecar) -> AssayMatrix:
+    arrays = {name: np.load(os.path.join(cacheDirectory, file), mmap_mode='r')
+              for name, file in sidecar['files'].items()}
+    if sidecar.get('format') == 'csr':
+        values = scipy.sparse.csr_matrix((arrays['data'], arrays['indices'], arrays['indptr']),
+                                         shape=tuple(sidecar['shape']), copy=False)
+    else:
+        values = arrays['values']
+    return AssayMatrix(values=values,
+                       study_ids=arrays['study_ids'],
+                       timepoints=np.array(sidecar['timepoints'], dtype=object),
+                       unique_ids=np.array(sidecar['unique_ids'], dtype=object),
+                       labels=np.array(sidecar['labels'], dtype=object))
+
+
+# Return the rows of the given timepoints and the columns of the given labels (in that order, NaN for labels the
+# assay doesn't have, or 0 in a sparse matrix). The result is a copy, unlike the memory-mapped whole matrix.
+def select(matrix: AssayMatrix, labels: Optional[Sequence[str]] = None,
+           timepoints: Optional[Sequence[str]] = None) -> AssayMatrix:
+    rows = slice(None) if timepoints is None else np.flatnonzero(np.isin(matrix.timepoints, list(timepoints)))
+    isSparse = scipy.sparse.issparse(matrix.values)
+    values = matrix.values[rows]
+    if labels is not None:
+        labels = list(dict.fromkeys(labels))
+        labelIndex = {label: column for column, label in enumerate(matrix.labels)}
+        columns = np.array([labelIndex.get(label, -1) for label in labels], dtype=np.intp)
+        found = columns >= 0
+        if isSparse:
+            # Multiply by a 0/1 matrix that picks each found label's column into its place (only stored results
+            # are visited, and labels that weren't found are empty columns)
+            picker = scipy.sparse.csr_matrix((np.ones(found.sum()), (columns[found], np.flatnonzero(found))),
+                                             shape=(values.shape[1], len(labels)))
+            values = values @ picker
+        else:
+            selected = np.full((values.shape[0], len(labels)), np.nan, dtype=np.float64)
+            selected[:, found] = values[:, columns[found]]
+            values = selected
+    return AssayMatrix(values=scipy.sparse.csr_matrix(values) if isSparse else np.array(values, dtype=np.float64),
+                       study_ids=np.array(matrix.study_ids[rows]),
+                       timepoints=matrix.timepoints[rows],
+                       unique_ids=matrix.unique_ids[rows],
+                       labels=matrix.labels if labels is None else np.array(labels, dtype=object))
+
+
+# Return an assay's matrix from the cache, building it first if it's missing or out of date. The whole matrix is
+# memory-mapped (read-only); with labels or timepoints, the selected part is returned (see select).
+def load_assay_matrix(unique_assay_name: str, labels: Optional[Sequence[str]] = None,
+                      timepoints: Optional[Sequence[str]] = None) -> AssayMatrix:
+    counter = current_change_counter(unique_assay_name)
+    useCache = make_private_directory(cacheDirectory)
+    sidecar = _read_sidecar(unique_assay_name) if useCache else None
+    matrix = None
+    if sidecar is not None and sidecar.get('counter') == counter:
+        try:
+            matrix = _load(sidecar)
+            os.utime(_sidecar_path(unique_assay_name))  # Mark as recently loaded
+        except (OSError, ValueError):
+            matrix = None  # Files removed or corrupt, so rebuild
+
+    if matrix is None:
+        matrix = matrix_svc.get_assay_matrix(unique_assay_name)
+        if useCache:
+            try:
+                matrix = _load(_write(unique_assay_name, counter, matrix))
+                _evict()
+            except OSError as e:
+                print(f'Unable to write assay matrix cache files for {unique_assay_name}: {e}')
+
+    if labels is None and timepoints is None:
+        return matrix
+    return select(matrix, labels, timepoints)
+
+
+# Build the cached matrices of the given assays (default: every assay) that are missing or out of date, or of all
+# of them if force is set. Returns a line of text for each assay.
+def build_assay_matrix_cache(unique_assay_names: Optional[List[str]] = None, force=False) -> List[str]:
+    if unique_assay_names is None:
+        import services.data_service as svc
+        unique_assay_names = svc.find_unique_assay_names()
+
+    report = []
+    for uniqueAssayName in unique_assay_names:
+        counter = current_change_counter(uniqueAssayName)
+        sidecar = _read_sidecar(uniqueAssayName) if make_private_directory(cacheDirectory) else None
+        if not force and sidecar is not None and sidecar.get('counter') == counter:
+            report.append(f'{uniqueAssayName}: current ({len(sidecar["unique_ids"])} samples x '
+                          f'{len(sidecar["labels"])} labels, built {sidecar["built_date"]})')
+            continue
+
+        startTime = time.perf_counter()
+        matrix = matrix_svc.get_assay_matrix(uniqueAssayName)
+        try:
+            _write(uniqueAssayName, counter, matrix)
+        except OSError as e:
+            report.append(f'{uniqueAssayName}: unable to write the cache files ({e})')
+            continue
+        report.append(f'{uniqueAssayName}: built {matrix.values.shape[0]} samples x {matrix.values.shape[1]} labels '
+                      f'in {time.perf_counter() - startTime:.2f} s')
+
+    if make_private_directory(cacheDirectory):
+        _evict()
+    return report
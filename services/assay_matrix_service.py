@@ -0,0 +1,204 @@
+# Sample x data label matrices of assay results, read straight from the database.
+# The results of an assay are read with one aggregation that projects each sample (participant, timepoint, and
+# unique ID) to two parallel arrays, its data labels and its results (None where a result has no value), so no
+# Documents (or per-row dicts) are built. Samples without a study ID and results without a data label are left out.
+# The matrix is a preallocated float64 NumPy array (NaN where a sample has no result for a label), filled one
+# sample at a time through a label -> column index. Reads go to the analytics connection (see mongo_setup).
+# Assays stored without their results of 0 (set_up_globals.sparseAssayDocumentNames, e.g. scRNA-seq pseudobulk
+# counts) are returned as scipy.sparse CSR matrices built straight from the stored results, so memory and time grow
+# with the number of non-zero results rather than samples x labels.
+# Run this module to compare it with building the matrix from Documents
+# (python -m services.assay_matrix_service "<unique assay name>").
+
+
+from typing import NamedTuple, Optional, Sequence
+import numpy as np
+import pandas as pd
+import scipy.sparse
+
+from data.clinical_data import ClinicalData
+import data.mongo_setup as mongo_setup
+
+
+class AssayMatrix(NamedTuple):
+    values: np.ndarray  # float64, samples x labels (scipy.sparse CSR for sparse assays: results not stored are 0)
+    study_ids: np.ndarray  # Sample index: participant,
+    timepoints: np.ndarray  # timepoint,
+    unique_ids: np.ndarray  # and unique ID of each row
+    labels: np.ndarray  # Label index: data label of each column
+
+    # Return the matrix as a DataFrame indexed by (study_id, timepoint, unique_id) with a column per data label
+    # (with sparse columns for a sparse matrix)
+    def as_frame(self) -> pd.DataFrame:
+        index = pd.MultiIndex.from_arrays([self.study_ids, self.timepoints, self.unique_ids],
+                                          names=['study_id', 'timepoint', 'unique_id'])
+        columns = pd.Index(self.labels, name='data_label')
+        if scipy.sparse.issparse(self.values):
+            frame = pd.DataFrame.sparse.from_spmatrix(self.values, index=index, columns=columns)
+            # The columns are filled with NaN (pandas 3), but results that aren't stored are 0
+            return pd.DataFrame({label: pd.arrays.SparseArray(column.array.sp_values,
+                                                              sparse_index=column.array.sp_index, fill_value=0.0)
+                                 for label, column in frame.items()}, index=index, columns=columns)
+        return pd.DataFrame(self.values, index=index, columns=columns, copy=False)
+
+
+# Aggregation returning {study_id, timepoint, unique_id, labels, results} for each sample of an assay. labels and
+# results are mapped from the same list of results, so they stay parallel (a result without a value is None).
+def _assay_matrix_pipeline(unique_assay_name, labels=None, timepoints=None) -> list:
+    sampleCondition = {'$eq': ['$$m.unique_assay_name', unique_assay_name]}
+    if timepoints is not None:
+        sampleCondition = {'$and': [sampleCondition, {'$in': ['$$m.timepoint', list(timepoints)]}]}
+
+    if labels is not None:
+        resultCondition = {'$in': ['$$r.data_label', list(labels)]}
+    else:
+        resultCondition = {'$gt': ['$$r.data_label', None]}  # Has a data label (missing and null sort before null)
+    results = {'$filter': {'input': '$assay_meta_data.assay_results', 'as': 'r', 'cond': resultCondition}}
+
+    match = {'study_id': {'$ne': None}, 'assay_meta_data.unique_assay_name': unique_assay_name}
+    if timepoints is not None:
+        match = {'study_id': {'$ne': None},
+                 'assay_meta_data': {'$elemMatch': {'unique_assay_name': unique_assay_name,
+                                                    'timepoint': {'$in': list(timepoints)}}}}
+
+    return [{'$match': match},
+            {'$project': {'_id': 0, 'study_id': 1,
+                          'assay_meta_data': {'$filter': {'input': '$assay_meta_data', 'as': 'm',
+                                                          'cond': sampleCondition}}}},
+            {'$unwind': '$assay_meta_data'},
+            {'$project': {'study_id': 1,
+                          'timepoint': '$assay_meta_data.timepoint',
+                          'unique_id': '$assay_meta_data.unique_id',
+                          'sparse': '$assay_meta_data.zero_results_omitted',
+                          'results': results}},
+            {'$project': {'study_id': 1, 'timepoint': 1, 'unique_id': 1, 'sparse': 1,
+                          'labels': {'$map': {'input': '$results', 'as': 'r', 'in': '$$r.data_label'}},
+                          'results': {'$map': {'input': '$results', 'as': 'r',
+                                               'in': {'$ifNull': ['$$r.result', None]}}}}},
+            {'$sort': {'study_id': 1, 'timepoint': 1, 'unique_id': 1}}]
+
+
+# Return the results of an assay as a sample x data label matrix. If labels is given, the columns are those labels
+# in that order (labels without results are all NaN, or 0 in a sparse assay); otherwise they are every label with a
+# result, sorted. timepoints limits the samples to those timepoints.
+# The matrix is sparse if every sample was stored without its results of 0, unless sparse is False.
+# (e.g. get_assay_matrix('Cytokine Plasma MFI', timepoints=['D1-PRE', 'D2-PRE']).as_frame())
+def get_assay_matrix(unique_assay_name: str, labels: Optional[Sequence[str]] = None,
+                     timepoints: Optional[Sequence[str]] = None, sparse: Optional[bool] = None) -> AssayMatrix:
+    collection = mongo_setup.analytics_collection(ClinicalData)
+    samples = list(collection.aggregate(_assay_matrix_pipeline(unique_assay_name, labels, timepoints),
+                                        allowDiskUse=True))
+
+    if labels is None:
+        labelSet = set()
+        for sample in samples:
+            labelSet.update(sample.get('labels') or [])
+        labels = sorted(labelSet)
+    else:
+        labels = list(dict.fromkeys(labels))  # Without duplicates, keeping the order
+    labelIndex = {label: column for column, label in enumerate(labels)}
+
+    sparseRows = np.fromiter((bool(s.get('sparse')) for s in samples), dtype=bool, count=len(samples))
+    if sparse is not False and len(samples) > 0 and sparseRows.all():
+        values = _sparse_values(samples, labelIndex)
+    else:
+        values = np.full((len(samples), len(labels)), np.nan, dtype=np.float64)
+        values[sparseRows] = 0.0  # Results of 0 weren't stored
+        for row, sample in enumerate(samples):
+            sampleLabels = sample.get('labels')
+            if sampleLabels:
+                columns = np.fromiter(map(labelIndex.__getitem__, sampleLabels), dtype=np.intp,
+                                      count=len(sampleLabels))
+                values[row, columns] = np.array(sample['results'], dtype=np.float64)  # A missing result is NaN
+
+    return AssayMatrix(values=values,
+                       study_ids=np.fromiter((s['study_id'] for s in samples), dtype=np.int64, count=len(samples)),
+                       timepoints=np.array([s.get('timepoint') for s in samples], dtype=object),
+                       unique_ids=np.array([s.get('unique_id') for s in samples], dtype=object),
+                       labels=np.array(labels, dtype=object))
+
+
+# Build a CSR matrix from the stored results of each sample (the arrays of a CSR matrix, row by row)
+def _sparse_values(samples, labelIndex) -> scipy.sparse.csr_matrix:
+    rowLengths = np.fromiter((len(s.get('labels') or ()) for s in samples), dtype=np.int64, count=len(samples))
+    indptr = np.zeros(len(samples) + 1, dtype=np.int64)
+    np.cumsum(rowLengths, out=indptr[1:])
+    indices = np.empty(indptr[-1], dtype=np.int64)
+    data = np.empty(indptr[-1], dtype=np.float64)
+    for row, sample in enumerate(samples):
+        if rowLengths[row]:
+            start, end = indptr[row], indptr[row + 1]
+            indices[start:end] = np.fromiter(map(labelIndex.__getitem__, sample['labels']), dtype=np.int64,
+                                             count=end - start)
+            data[start:end] = np.array(sample['results'], dtype=np.float64)  # A missing result is NaN
+    values = scipy.sparse.csr_matrix((data, indices, indptr), shape=(len(samples), len(labelIndex)))
+    values.sort_indices()
+    return values
+
+
+# Return the average of the results of the given labels for each sample (as the pathway summaries are calculated:
+# missing results are left out, and a sample with none of the labels is NaN). In a sparse matrix a result that isn't
+# stored is 0, so every label counts (including labels that are not columns of the matrix).
+def pathway_averages(matrix: AssayMatrix, labels: Sequence[str]) -> np.ndarray:
+    labels = list(dict.fromkeys(labels))
+    labelIndex = {label: column for column, label in enumerate(matrix.labels)}
+    columns = np.array([labelIndex[label] for label in labels if label in labelIndex], dtype=np.intp)
+
+    if scipy.sparse.issparse(matrix.values):
+        selected = matrix.values[:, columns].tocsr()
+        isMissing = np.isnan(selected.data)
+        entryRows = np.repeat(np.arange(selected.shape[0]), np.diff(selected.indptr))
+        missingCounts = np.bincount(entryRows[isMissing], minlength=selected.shape[0])
+        selected.data[isMissing] = 0.0
+        counts = len(labels) - missingCounts
+        sums = np.asarray(selected.sum(axis=1)).ravel()
+    else:
+        selected = np.asarray(matrix.values[:, columns])
+        counts = np.count_nonzero(~np.isnan(selected), axis=1)
+        sums = np.nansum(selected, axis=1)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(counts > 0, sums / np.maximum(counts, 1), np.nan)
+
+
+# Build the same matrix from ClinicalData Documents, as a DataFrame from a dict per sample (for benchmark)
+def _assay_frame_from_documents(unique_assay_name) -> pd.DataFrame:
+    rows = []
+    for c in ClinicalData.objects(assay_meta_data__unique_assay_name=unique_assay_name).order_by('study_id'):
+        for amd in c.assay_meta_data:
+            if amd.unique_assay_name != unique_assay_name:
+                continue
+            row = {'study_id': c.study_id, 'timepoint': amd.timepoint, 'unique_id': amd.unique_id}
+            for ar in amd.assay_results:
+                row[ar.data_label] = ar.result
+            rows.append(row)
+    return pd.DataFrame(rows)
+
+
+# Time get_assay_matrix against building the matrix from Documents
+def benchmark(unique_assay_name, repeats=3):
+    import time
+    import tracemalloc
+
+    for label, build in [('Documents -> DataFrame', lambda: _assay_frame_from_documents(unique_assay_name)),
+                         ('get_assay_matrix', lambda: get_assay_matrix(unique_assay_name))]:
+        timings = []
+        for _ in range(repeats):
+            startTime = time.perf_counter()
+            build()
+            timings.append(time.perf_counter() - startTime)
+        tracemalloc.start()
+        result = build()
+        peakBytes = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        shape = result.values.shape if isinstance(result, AssayMatrix) else (len(result), len(result.columns) - 3)
+        print(f'  {label:<28}{min(timings) * 1000:>10.1f} ms{peakBytes / 2 ** 20:>10.1f} MB peak  {shape}')
+
+
+if __name__ == '__main__':
+    import sys
+    import set_up_globals
+
+    mongo_setup.global_init(set_up_globals.database_name)
+    print(f'{sys.argv[1]} matrix (best of 3):')
+    benchmark(sys.argv[1])
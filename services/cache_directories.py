@@ -0,0 +1,45 @@
+# Directories of the on-disk caches (parsed workbooks, assay matrices). Cached files are loaded back without being
+# checked (the parse cache unpickles them), so each cache lives in a directory only its user can write: by default
+# under the user's own cache directory rather than the shared system temp directory, created with mode 0700, and
+# not used if another user owns it or can write to it.
+
+
+import os
+import stat
+
+_checkedDirectories = set()
+
+
+# Return the directory set by an environment variable, or mecfs/<name> under the user's cache directory
+# ($XDG_CACHE_HOME, otherwise ~/.cache)
+def cache_directory(variable, name) -> str:
+    directory = os.environ.get(variable)
+    if directory:
+        return directory
+    userCacheDirectory = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(userCacheDirectory, 'mecfs', name)
+
+
+# Create a directory (and its parents) readable and writable by the current user only, and return whether it is
+# safe to load files from it: a real directory (not a symbolic link) owned by the current user that no other user
+# can write to. Group/other permissions of an existing directory of the user's are removed.
+def make_private_directory(directory) -> bool:
+    if directory in _checkedDirectories:
+        return True
+    try:
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+        info = os.lstat(directory)
+        if not stat.S_ISDIR(info.st_mode):
+            print(f'Not using cache directory {directory}: it is not a directory')
+            return False
+        if hasattr(os, 'getuid'):  # POSIX (on Windows the user's profile directory is already private)
+            if info.st_uid != os.getuid():
+                print(f'Not using cache directory {directory}: it belongs to another user')
+                return False
+            if info.st_mode & 0o077:
+                os.chmod(directory, 0o700)
+    except OSError as e:
+        print(f'Unable to set up cache directory {directory}: {e}')
+        return False
+    _checkedDirectories.add(directory)
+    return True
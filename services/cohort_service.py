@@ -0,0 +1,172 @@
+# Named, versioned participant cohorts (e.g. the ME/CFS and healthy control participants with scRNA-seq data).
+# Cohorts are stored as sorted lists of study IDs, so membership tests for a whole column of study IDs
+# can be done in a single vectorized pass (bitmap lookup for compact ID ranges, np.isin otherwise).
+
+
+from typing import Dict, List
+import datetime
+import numpy as np
+import pandas as pd
+
+from mongoengine import ValidationError
+
+from data.cohorts import Cohort, CohortVersionHistory
+from data.users import User
+import services.data_service as svc
+
+import set_up_globals
+
+# Largest study ID for which a boolean bitmap is used for membership tests (beyond this, fall back to np.isin)
+bitmapLimit = 10000000
+
+
+def find_cohort(cohort_name: str) -> Cohort:
+    return Cohort.objects(cohort_name=cohort_name).first()
+
+
+# Return list of cohort names
+def find_cohort_names() -> List[str]:
+    return sorted(Cohort.objects().distinct('cohort_name'))
+
+
+# Return a sorted, de-duplicated int64 array of study IDs
+def normalize_study_ids(study_ids) -> np.ndarray:
+    values = pd.Series(list(study_ids), dtype=object).astype(str).str.strip().str.replace('ENID', '', regex=False)
+    values = pd.to_numeric(values, errors='coerce').dropna()
+    return np.unique(values.to_numpy(dtype=np.int64))
+
+
+# Return the (sorted) study IDs of a cohort. A default cohort (set_up_globals.defaultCohortsDict) that has not been
+# registered yet falls back to its default study IDs; any other missing cohort returns an empty array.
+def get_cohort_study_ids(cohort_name: str) -> np.ndarray:
+    cohort = Cohort.objects(cohort_name=cohort_name).only('study_ids').first()
+    if not cohort:
+        if cohort_name in set_up_globals.defaultCohortsDict:
+            return normalize_study_ids(set_up_globals.defaultCohortsDict[cohort_name])
+        svc.error_msg(f'Cohort {cohort_name} does not exist.')
+        return np.empty(0, dtype=np.int64)
+    return np.asarray(cohort.study_ids, dtype=np.int64)
+
+
+# Boolean mask of which study IDs belong to the cohort (cohort_ids must be sorted and unique)
+def membership_mask(cohort_ids: np.ndarray, study_ids) -> np.ndarray:
+    numericIDs = pd.to_numeric(pd.Series(np.asarray(study_ids, dtype=object)), errors='coerce').to_numpy(dtype=float)
+    valid = ~np.isnan(numericIDs)
+    mask = np.zeros(len(numericIDs), dtype=bool)
+    if len(cohort_ids) == 0 or not valid.any():
+        return mask
+
+    ids = numericIDs[valid].astype(np.int64)
+    maxID = int(cohort_ids[-1])
+    if int(cohort_ids[0]) >= 0 and maxID <= bitmapLimit:
+        bitmap = np.zeros(maxID + 1, dtype=bool)
+        bitmap[cohort_ids] = True
+        inRange = (ids >= 0) & (ids <= maxID)
+        hits = np.zeros(len(ids), dtype=bool)
+        hits[inRange] = bitmap[ids[inRange]]
+    else:
+        hits = np.isin(ids, cohort_ids)
+    mask[valid] = hits
+
+    return mask
+
+
+# Return a dictionary of cohort name -> boolean membership mask for a column of study IDs
+def cohort_membership(study_ids, cohort_names) -> Dict[str, np.ndarray]:
+    return {name: membership_mask(get_cohort_study_ids(name), study_ids) for name in cohort_names}
+
+
+# Count the number of members of each cohort in each bin.
+# bin_numbers holds the (1-based) bin of each row, with 0 meaning the row is not in any bin.
+def count_cohorts_by_bin(bin_numbers, cohort_masks: Dict[str, np.ndarray], number_of_bins) -> Dict[str, np.ndarray]:
+    bin_numbers = np.asarray(bin_numbers, dtype=np.int64)
+    counts = {}
+    for name, mask in cohort_masks.items():
+        counts[name] = np.bincount(bin_numbers[mask], minlength=number_of_bins + 1)
+    return counts
+
+
+# Add or update a cohort. A new version is only written if the membership or description changed.
+def save_cohort(active_account: User, cohort_name, study_ids, description=None, data_file_name=None) -> Cohort:
+    documentName = set_up_globals.cohort_document_name
+    studyIDArray = normalize_study_ids(study_ids)
+
+    currentVersion = 0
+    cohort = find_cohort(cohort_name)
+
+    if cohort:
+        if np.array_equal(np.asarray(cohort.study_ids, dtype=np.int64), studyIDArray) and \
+                (description is None or description == cohort.description):
+            return cohort  # Nothing changed
+
+        # Update version history before current version
+        currentVersion = cohort.version_number
+        cohort_version_history = CohortVersionHistory()
+        for attrib in ['created_by', 'created_date', 'last_modified_by', 'last_modified_date', 'data_file_name',
+                       'cohort_name', 'version_number', 'description', 'study_ids']:
+            cohort_version_history[attrib] = cohort[attrib]
+        cohort_version_history.save()
+    else:
+        cohort = Cohort()
+        cohort.created_by = active_account
+        cohort.created_date = datetime.datetime.now()
+
+    cohort.last_modified_by = active_account
+    cohort.last_modified_date = datetime.datetime.now()
+    cohort.cohort_name = cohort_name
+    cohort.version_number = currentVersion + 1
+    cohort.study_ids = [int(i) for i in studyIDArray]
+    if description is not None:
+        cohort.description = description
+    if data_file_name is not None:
+        cohort.data_file_name = data_file_name
+
+    try:
+        cohort.save()
+    except (ValueError, ValidationError) as e:
+        message = f'Save of {documentName} data with name={cohort_name} resulted in exception: {e}'
+        svc.add_event_log(active_account,
+                          message,
+                          success=False,
+                          event_type='Import',
+                          exception_type=e.__class__.__name__,
+                          file_name=data_file_name,
+                          document_id=str(cohort_name))
+        svc.error_msg(message)
+        return None
+
+    message = f'Added / updated {documentName} {cohort_name} (version {cohort.version_number}, ' \
+              f'{len(studyIDArray)} participants) with id {cohort.id}.'
+    svc.add_event_log(active_account,
+                      message,
+                      success=True,
+                      event_type='Import',
+                      file_name=data_file_name,
+                      document_id=str(cohort.id))
+    svc.success_msg(message)
+
+    return cohort
+
+
+# Import cohorts from a spreadsheet with one row per (cohort_name, study_id) pair
+def add_cohort_data(active_account: User, df, data_file_name):
+    for cohort_name, cohortDF in df.groupby('cohort_name', sort=True):
+        description = None
+        if 'description' in cohortDF.columns:
+            descriptions = [str(d).strip() for d in cohortDF['description'] if len(str(d).strip()) > 0]
+            if descriptions:
+                description = descriptions[0]
+        save_cohort(active_account, cohort_name, cohortDF['study_id'], description, data_file_name)
+
+    return
+
+
+# Register the default cohorts defined in set_up_globals (existing cohorts are left untouched)
+def register_default_cohorts(active_account: User):
+    for cohort_name, study_ids in set_up_globals.defaultCohortsDict.items():
+        if find_cohort(cohort_name):
+            print(f'Cohort {cohort_name} already exists.')
+            continue
+        save_cohort(active_account, cohort_name, study_ids, data_file_name='set_up_globals.py')
+
+    return
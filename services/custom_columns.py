@@ -0,0 +1,180 @@
+# Column names and custom columns added to a sheet before it is loaded (study IDs, normalized timepoints, unique
+# IDs, specimen IDs, ...). Shared by the text interface and the web UI. Every column is built with whole-column pandas operations
+# (Series.str methods and a timepoint mapping table) rather than a loop over the rows, so the cost grows with the
+# number of columns built, not the number of rows.
+# Run this module to time it on generated sheets (python -m services.custom_columns [rows]).
+
+
+import numpy as np
+import pandas as pd
+
+import set_up_globals
+import utilities
+
+# Timepoints kept as they are, and the other spellings that are mapped to them (matched ignoring case).
+# Any other timepoint is blanked.
+validTimePoints = ['D1-PRE', 'D1-POST', 'D2-PRE', 'D2-POST', 'Other', '0h', '15min', '24h', 'D1', 'D2']
+timepointAliases = {'pre-day1': 'D1-PRE',
+                    'post-day1': 'D1-POST',
+                    'pre-day2': 'D2-PRE',
+                    'post-day2': 'D2-POST'}
+
+# Assay types whose rows are identified by ENID and timepoint
+timepointDocumentNames = [set_up_globals.proteomics_document_name,
+                          set_up_globals.cytokines_document_name,
+                          set_up_globals.metabolomics_document_name,
+                          set_up_globals.mirnaseq_document_name,
+                          set_up_globals.scrnaseq_document_name,
+                          'CPET',
+                          set_up_globals.cpet_recovery_document_name,
+                          'Other']
+
+# Annotation columns appended to ENID and timepoint in the unique ID, by sample identifier type
+uniqueIDAnnotations = {'ENID+Timepoint': [],
+                       'ENID+Timepoint+Annot-1': ['annot_1'],
+                       'ENID+Timepoint+Annot-1+Annot-2': ['annot_1', 'annot_2']}
+
+
+# Normalize column names with utilities.modify_string. If classColumnList is given, only the names that then match
+# an attribute of the class are changed (so gene symbols used as column names are left as they are).
+def modify_df_column_names(column_names, classColumnList=None):
+    renamed_columns = []
+    for i in range(len(column_names)):
+        original_col = str(column_names[i]).strip()
+        col = utilities.modify_string(original_col)
+
+        if (classColumnList is not None) and (col not in classColumnList):
+            renamed_columns.append(original_col)
+        else:
+            renamed_columns.append(col)
+
+    return renamed_columns
+
+
+# Whole-column version of data_service.convert_to_string: numbers are written as integers (truncated),
+# anything else as its text
+def id_text(values: pd.Series) -> pd.Series:
+    text = values.astype(str)
+    numbers = pd.to_numeric(text.str.strip(), errors='coerce').astype('float64')
+    isNumber = np.isfinite(numbers) & (numbers.abs() < 2 ** 63)
+    result = text.astype(object)
+    result[isNumber] = np.trunc(numbers[isNumber]).astype('int64').astype(str)
+    return result
+
+
+# Normalize timepoints with the mapping table above ('' for timepoints that aren't recognized)
+def normalize_timepoints(values: pd.Series) -> pd.Series:
+    text = values.astype(str)
+    normalized = text.where(text.isin(validTimePoints))
+    normalized = normalized.fillna(text.str.lower().map(timepointAliases))
+    return normalized.fillna('').astype(object)
+
+
+# Specimen ID without the tube number, i.e. the first four '-' separated parts (ENID, CPET day, pre/post, type)
+def specimen_id_without_tube(values: pd.Series) -> pd.Series:
+    return values.astype(str).str.extract(r'^((?:[^-]*-){0,3}[^-]*)', expand=False).astype(object)
+
+
+# Build the unique ID of each row: ENID, timepoint, annotations, and data file name joined by '-'
+def unique_ids(df, index_column, data_file_name) -> pd.Series:
+    uniqueID = id_text(df['study_id']) + '-' + df['timepoint'].astype(str)
+    for column in uniqueIDAnnotations[index_column]:
+        uniqueID = uniqueID + '-' + df[column].astype(str)
+    return (uniqueID + '-' + data_file_name).astype(object)
+
+
+# Add the custom columns for a document type. df is changed in place (rows may also be dropped), so there's no
+# need to return it.
+def create_custom_columns(df, documentName, data_file_name, index_column=None):
+    df['data_file_name'] = data_file_name
+
+    if documentName == set_up_globals.scrnaseq_summary_document_name:
+        df['study_id'] = df['enid']
+
+    if documentName in timepointDocumentNames:
+        df['study_id'] = df['ENID']
+        df['timepoint'] = normalize_timepoints(df['timepoint'])
+
+        # Set up unique_id column
+        if index_column == 'AnalysisID':
+            # //--- flag null value in the event log
+            index_names = df[df[index_column] == ''].index
+            df.drop(index_names, inplace=True)
+            df['unique_id'] = df[index_column]
+        elif index_column in uniqueIDAnnotations:
+            # Annotations are assumed to make the ID unique (e.g. 'Cluster' in Annot-1 for scRNA-seq data)
+            # //--- flag null values in the event log
+            df['unique_id'] = unique_ids(df, index_column, data_file_name)
+
+    if documentName == set_up_globals.biospecimen_document_name:
+        df['sample_id'] = df['id']
+        # Set Specimen ID to ENID, CPET Day, Pre/Post, and Specimen type
+        df['specimen_id'] = specimen_id_without_tube(df['specimen_id'])
+
+    if documentName == set_up_globals.clinical_document_name:
+        # Make sure study ID is numeric (i.e. strip off 'ENID' if it exists)
+        df['study_id'] = df['study_id'].astype(str).str.strip('ENID').astype('int64')
+
+        # Create columns for binned values
+        for binColumn in set_up_globals.binnedColumnsDict:
+            df[binColumn + '_binned'] = ''
+
+    if documentName == set_up_globals.data_label_type_document_name:
+        df['unique_id'] = df.index
+        if 'comp_id' not in df.columns:
+            df['comp_id'] = ''
+            df['biochemical'] = ''
+        if 'gene_name' not in df.columns:
+            df['gene_name'] = ''
+        if 'gene_stable_id' not in df.columns:
+            df['gene_stable_id'] = ''
+        if 'cytokine_label' not in df.columns:
+            df['cytokine_label'] = ''
+        # //--- set up remaining data labels - let's do this without the hardcoding
+
+    if documentName == set_up_globals.seahorse_document_name:
+        df['unique_id'] = df[index_column]
+
+    if documentName == set_up_globals.cpet_recovery_document_name:
+        df['pub_id'] = df['ENID']
+
+    if documentName == set_up_globals.ev_pilot_study_document_name:
+        df['unique_id'] = df['ENID']
+
+
+# Time create_custom_columns on generated assay, biospecimen, and clinical sheets
+def benchmark(rowCount=100000, repeats=3):
+    import time
+
+    rng = np.random.default_rng(0)
+    timepoints = np.array(validTimePoints + list(timepointAliases) + ['Pre-Day1', 'unknown'])
+    assayDF = pd.DataFrame({'ENID': rng.integers(100, 999, rowCount),
+                            'timepoint': rng.choice(timepoints, rowCount),
+                            'annot_1': rng.integers(0, 30, rowCount).astype(str),
+                            'annot_2': rng.choice(['batch1', 'batch2', 'batch3'], rowCount),
+                            'annot_3': '',
+                            'result': rng.random(rowCount)})
+    biospecimenDF = pd.DataFrame({'id': np.arange(rowCount),
+                                  'specimen_id': [f'{100 + i % 900}-D{1 + i % 2}-PRE-SER-{i % 10}'
+                                                  for i in range(rowCount)]})
+    clinicalDF = pd.DataFrame({'study_id': [f'ENID{100 + i}' for i in range(rowCount)]})
+
+    cases = [(f'{set_up_globals.proteomics_document_name} ({sampleType})', assayDF,
+              set_up_globals.proteomics_document_name, sampleType) for sampleType in uniqueIDAnnotations]
+    cases += [('Biospecimen', biospecimenDF, set_up_globals.biospecimen_document_name, None),
+              ('Clinical', clinicalDF, set_up_globals.clinical_document_name, None)]
+
+    print(f'create_custom_columns on {rowCount} rows (best of {repeats}):')
+    for label, df, documentName, sampleType in cases:
+        timings = []
+        for _ in range(repeats):
+            sheet = df.copy()
+            startTime = time.perf_counter()
+            create_custom_columns(sheet, documentName, 'benchmark.xlsx', sampleType)
+            timings.append(time.perf_counter() - startTime)
+        print(f'  {label:<48}{min(timings) * 1000:>10.1f} ms')
+
+
+if __name__ == '__main__':
+    import sys
+    benchmark(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
@@ -9,28 +9,40 @@
 
 
 from typing import List, Optional
+import csv
 import datetime
+import os
+import random
+import time
 import numpy as np
 import pandas as pd
 
 from colorama import Fore
 from mongoengine import ValidationError
+from mongoengine.errors import SaveConditionError
+from pymongo import InsertOne, ReplaceOne, UpdateOne
+from pymongo.errors import BulkWriteError
 
-from data.clinical_data import ClinicalData, ClinicalDataVersionHistory
+from data.clinical_data import ClinicalData
 from data.redcap import Redcap
 from data.assay_classes import AssayMetaData
+from data.assay_change_counters import AssayChangeCounter
 # from data.assay_classes import Proteomic
 # from data.assay_classes import Cytokine
 # from data.assay_classes import Metabolomic
 # from data.assay_classes import scRNAseq
 from data.scrnaseq_summary import ScRNAseqSummary
-from data.biospecimens import Biospecimen, BiospecimenVersionHistory, BiospecimenTubeInfo
+from data.biospecimens import Biospecimen, BiospecimenTubeInfo
 from data.users import User
 from data.event_log import Event_log
 from data.assay_results import AssayResults
 from data.assay_results import AssaySummary
 from data.data_label_types import DataLabels
 from data.data_label_types import DataLabelPathways
+import services.import_journal_service as journal_svc
+import services.version_history_service as history_svc
+import services.read_models as read_models
+import data.mongo_setup as mongo_setup
 # from data.data_label_types import GeneSymbols
 # from data.data_label_types import EnsemblTranscriptIDs
 # from data.data_label_types import EnsemblGeneIDs
@@ -75,6 +87,14 @@ def find_biospecimen_data_by_specimen_id(specimen_id: str) -> Biospecimen:
     return Biospecimen.objects(specimen_id=specimen_id).first()
 
 
+# Return {specimen ID: biospecimen} for a list of specimen IDs with a single query (IDs that aren't found are left out)
+def find_biospecimen_data_by_specimen_ids(specimen_ids) -> dict:
+    biospecimens = {}
+    for b in Biospecimen.objects(specimen_id__in=list(set(specimen_ids))):
+        biospecimens.setdefault(b.specimen_id, b)
+    return biospecimens
+
+
 # def find_biospecimen_data_by_sample_id(sample_id: int) -> Biospecimen:
 #     # return Biospecimen.objects(__raw__={biospecimen_tube_info: {sample_id: sample_id}}).first()
 #     # return Biospecimen.objects(biospecimen_tube_info.sample_id=sample_id).first()
@@ -91,6 +111,15 @@ def find_biospecimen_data_by_study_id(study_id: int) -> List[Biospecimen]:
     return list(Biospecimen.objects(study_id=study_id).all())
 
 
+# Return {study ID: list of biospecimens} for a column of study IDs with a single query
+def find_biospecimen_data_by_study_ids(study_ids) -> dict:
+    studyIDs = [int(i) for i in pd.to_numeric(pd.Series(list(study_ids)), errors='coerce').dropna().unique()]
+    biospecimens = {}
+    for b in Biospecimen.objects(study_id__in=studyIDs):
+        biospecimens.setdefault(b.study_id, []).append(b)
+    return biospecimens
+
+
 def find_clinical_data_for_user(account: User) -> List[ClinicalData]:
     query = ClinicalData.objects(id__in=account.id).all().order_by('phenotype')
     clinical_data = list(query)
@@ -98,32 +127,66 @@ def find_clinical_data_for_user(account: User) -> List[ClinicalData]:
     return clinical_data
 
 
-def find_clinical_data() -> List[ClinicalData]:
+# Query set of a document class on the analytics connection (secondary reads, if MONGO_ANALYTICS_READS is set).
+# Only for read-only work: the data may be a little behind the primary, so it mustn't be modified and saved.
+def analytics_objects(documentClass, **query):
+    return documentClass.objects(**query).using(mongo_setup.analytics_alias())
+
+
+# Return all clinical data, or (if as_of_date is given) the clinical data as it was at that date.
+# Exports and listings set analytics to read from the analytics connection, as read-only views of the documents
+# (see read_models).
+def find_clinical_data(as_of_date: Optional[datetime.datetime] = None,
+                       include_assay_data=True, analytics=False) -> List[ClinicalData]:
+    if as_of_date is not None:
+        return history_svc.find_clinical_data_as_of_date(as_of_date, include_assay_data=include_assay_data,
+                                                         analytics=analytics)
+    if analytics:
+        query = analytics_objects(ClinicalData).order_by('phenotype')
+        if not include_assay_data:
+            query = query.exclude('assay_meta_data')
+        return read_models.views(query)
     return list(ClinicalData.objects().all().order_by('phenotype'))
 
 
+# Return {study ID: clinical data} for a column of study IDs with a single query (IDs that aren't found are left out)
+def find_clinical_data_by_study_ids(study_ids, as_of_date: Optional[datetime.datetime] = None,
+                                    include_assay_data=True, analytics=False) -> dict:
+    studyIDs = sorted({int(i) for i in pd.to_numeric(pd.Series(list(study_ids), dtype=object),
+                                                       errors='coerce').dropna()})
+    if as_of_date is not None:
+        clinicalDataList = history_svc.find_clinical_data_as_of_date(as_of_date, studyIDs, include_assay_data,
+                                                                     analytics=analytics)
+    elif analytics:
+        clinicalDataList = analytics_objects(ClinicalData, study_id__in=studyIDs)
+        if not include_assay_data:
+            clinicalDataList = clinicalDataList.exclude('assay_meta_data')
+        clinicalDataList = read_models.views(clinicalDataList)
+    else:
+        clinicalDataList = ClinicalData.objects(study_id__in=studyIDs)
+        if not include_assay_data:
+            clinicalDataList = clinicalDataList.exclude('assay_meta_data')
+    return {c.study_id: c for c in clinicalDataList}
+
+
 def find_demographic_data_only() -> List[ClinicalData]:
-    return list(ClinicalData.demographic_data_only().all().order_by('phenotype'))
+    return read_models.views(ClinicalData.demographic_data_only().using(mongo_setup.analytics_alias()))
 
 
 # Return list of unique assay names
 def find_unique_assay_names() -> List[str]:
     # query = ClinicalData.objects(assay_meta_data__unique_assay_name=unique_assay_name)
     # return list(query)
-    object_list = list(ClinicalData.assay_data_only().all().order_by('phenotype'))
-    uniqueNameSet = set()
-    for c in object_list:
-        for sd in c['assay_meta_data']:
-            uniqueNameSet.add(sd['unique_assay_name'])
-    return sorted(uniqueNameSet)
+    uniqueNames = analytics_objects(ClinicalData).distinct('assay_meta_data.unique_assay_name')
+    return sorted(name for name in uniqueNames if name is not None)
 
 
 # Return assay data filtered by unique assay name
 def find_assay_data_only(unique_assay_name: str) -> List[ClinicalData]:
     # return list(ClinicalData.assay_data_only().all().order_by('phenotype'))
-    query = ClinicalData.objects(assay_meta_data__unique_assay_name=unique_assay_name).exclude(
+    query = analytics_objects(ClinicalData, assay_meta_data__unique_assay_name=unique_assay_name).exclude(
         'biospecimen_data_references').order_by('phenotype')
-    return list(query)
+    return read_models.views(query)
 
 
 # Find assay data for specific study_id, unique assay name, and timepoint
@@ -134,7 +197,7 @@ def find_specific_assay_meta_data(study_id, unique_assay_name: str, timepoint) -
 
 
 def find_scrnaseq_summary_data_only() -> List[ClinicalData]:
-    return list(ClinicalData.scrnaseq_summary_data_only().all().order_by('phenotype'))
+    return read_models.views(ClinicalData.scrnaseq_summary_data_only().using(mongo_setup.analytics_alias()))
     # return list(
     #     ClinicalData.objects(scrnaseq_summary__sampleid__exists=True).only('study_id', 'phenotype', 'site', 'sex',
     #                                                               'age', 'scrnaseq_summary').order_by('phenotype'))
@@ -178,7 +241,8 @@ def test_pathway_mapping() -> List[ClinicalData]:
     # query = ClinicalData.objects(study_id=101).only('study_id').only('phenotype').only('proteomic').only('cytokine').order_by('study_id')
     # query = ClinicalData.objects(study_id=101).fields(proteomic__assay_results__data_label_reference=pathway.data_label_references)
     # query = ClinicalData.objects(study_id=101).fields(elemMatch__proteomic__assay_results__data_label='A2M')
-    return list(ClinicalData.objects().exclude('biospecimen_data_references').order_by('phenotype'))
+    return read_models.views(analytics_objects(ClinicalData).exclude('biospecimen_data_references')
+                             .order_by('phenotype'))
 
 
 def test_pathway_average(pathway):
@@ -196,49 +260,338 @@ def convert_to_string(val):
         return str(val)
 
 
-# Set up all ENID numbers in advance
-def add_enid_data(active_account: User, df, data_file_name):
+# Set the ENID fields of a participant from a row of the ENID sheet
+def set_enid_fields(active_account: User, clinical_data: ClinicalData, study_id, row):
+    clinical_data.last_modified_by = active_account
+    clinical_data.last_modified_date = datetime.datetime.now()
+    clinical_data.study_id = study_id
+    clinical_data.cu_id = row.cu_id
+    clinical_data.cor_id = row.cor_id
+    clinical_data.pub_id = row.pub_id
+    clinical_data.data_file_name = row.data_file_name
+    clinical_data.version_number = (clinical_data.version_number or 0) + 1
+    clinical_data.content_hash = None  # IDs changed, so the next clinical data import must rewrite this record
+
+
+# Set up all ENID numbers in advance. The existing participants are fetched with one query and those whose IDs
+# (cu_id, cor_id, pub_id) haven't changed are skipped. The rest are written with one bulk write: new participants
+# are upserted on their study ID, and changed ones are updated with a compare-and-swap on their revision (with the
+# superseded versions recorded in the version history with one insert). A participant saved by another import in
+# the meantime is then updated on its own with update_clinical_data.
+# Returns the number of participants inserted, updated, and unchanged, and the number of errors.
+def add_enid_data(active_account: User, df, data_file_name) -> dict:
     documentName = set_up_globals.enid_document_name
+    enidFields = ['cu_id', 'cor_id', 'pub_id']
+    writtenFields = enidFields + ['data_file_name', 'last_modified_by', 'last_modified_date', 'version_number',
+                                  'content_hash', 'revision']
 
-    for index, row in df.iterrows():
-        currentVersion = 0
-        clinical_data = find_clinical_data_by_study_id(index)
+    def log_enid_error(study_id, row, e):
+        message = f'Save of {documentName} data with id={study_id} resulted in exception: {e}'
+        add_event_log(active_account,
+                      message,
+                      success=False,
+                      event_type='Import',
+                      exception_type=e.__class__.__name__,
+                      file_name=row.data_file_name,
+                      study_id=str(study_id))
+        error_msg(message)
 
-        if clinical_data:
-            # If data exists, save in version history
-            #     Update version history before current version
-            #     In the case of a failure during save, this will will result in a duplicate record
-            #     in the history collection (which is acceptable), rather than a lost record in the
-            #     history collection (which is not acceptable).
-
-            currentVersion = clinical_data.version_number
-            clinical_data_version_history = ClinicalDataVersionHistory()
-
-            attributeList = utilities.attributes(ClinicalData)
-            # print(attributeList)
-            for attrib in attributeList:
-                # print(attrib)
-                clinical_data_version_history[attrib] = clinical_data[attrib]
-
-            clinical_data_version_history.save()
+    enidRows = {int(row.Index): row for row in df.itertuples()}
+    storedIDs = {c['study_id']: c for c in ClinicalData.objects(study_id__in=list(enidRows))
+                 .only('study_id', *enidFields).as_pymongo()}
+    newIDs = [s for s in enidRows if s not in storedIDs]
+    changedIDs = [s for s in enidRows if s in storedIDs and
+                  any(storedIDs[s].get(f) != getattr(enidRows[s], f) for f in enidFields)]
+    counts = {'inserted': 0, 'updated': 0, 'unchanged': len(enidRows) - len(newIDs) - len(changedIDs), 'errors': 0}
+
+    # The whole documents of the changed participants are needed for the version history
+    existing = find_clinical_data_by_study_ids(changedIDs) if changedIDs else {}
+
+    inserts = {}  # Study ID -> new participant
+    updates = {}  # Study ID -> updated participant
+    loadedRevisions = {}
+    versionRecords = {}
+    for study_id in newIDs + changedIDs:
+        clinical_data = existing.get(study_id)
+        previousVersion = None
+        if clinical_data is not None:
+            previousVersion = history_svc.document_snapshot(clinical_data)
+            loadedRevisions[study_id] = clinical_data.revision or 0
         else:
             # If no data exists for this study id, set created info
             clinical_data = ClinicalData()
+            clinical_data.id = bson.ObjectId()
             clinical_data.created_by = active_account
             clinical_data.created_date = datetime.datetime.now()
 
-        clinical_data.last_modified_by = active_account
-        clinical_data.last_modified_date = datetime.datetime.now()
-        clinical_data.study_id = index
-        clinical_data.cu_id = row.cu_id
-        clinical_data.cor_id = row.cor_id
-        clinical_data.pub_id = row.pub_id
-        clinical_data.data_file_name = row.data_file_name
-        clinical_data.version_number = currentVersion + 1
+        set_enid_fields(active_account, clinical_data, study_id, enidRows[study_id])
+        # Kept to the millisecond (as stored), so a saved participant can be told apart from another import's save
+        now = clinical_data.last_modified_date
+        clinical_data.last_modified_date = now.replace(microsecond=now.microsecond // 1000 * 1000)
+        clinical_data.revision = loadedRevisions.get(study_id, 0) + 1
+        try:
+            clinical_data.validate()
+        except ValidationError as e:
+            log_enid_error(study_id, enidRows[study_id], e)
+            counts['errors'] += 1
+            continue
+
+        if previousVersion is None:
+            inserts[study_id] = clinical_data
+        else:
+            updates[study_id] = clinical_data
+            versionRecords[study_id] = history_svc.new_version_delta(active_account, clinical_data, previousVersion,
+                                                                     'ClinicalData')
+
+    # Record the superseded versions in the version history before saving (see update_clinical_data)
+    recordIDs = dict(zip(versionRecords, history_svc.save_version_deltas(list(versionRecords.values()))))
+
+    operations = []
+    for study_id, clinical_data in inserts.items():
+        operations.append(UpdateOne({'study_id': study_id}, {'$setOnInsert': clinical_data.to_mongo()}, upsert=True))
+    for study_id, clinical_data in updates.items():
+        document = clinical_data.to_mongo()
+        loadedRevision = loadedRevisions[study_id]
+        operations.append(UpdateOne({'_id': clinical_data.id, 'revision': loadedRevision or {'$in': [0, None]}},
+                                    {'$set': {f: document.get(f) for f in writtenFields}}))
+
+    conflicts = []
+    if operations:
+        result = ClinicalData._get_collection().bulk_write(operations, ordered=False)
+
+        # An upsert that matched was inserted by another import in the meantime, and an update that didn't match was
+        # saved by another import. Only if some updates didn't match are the saved participants checked, to find which.
+        insertIDs = list(inserts)
+        conflicts = [insertIDs[i] for i in range(len(insertIDs)) if i not in result.upserted_ids]
+        updateMatchedCount = result.matched_count - len(conflicts)
+        if updateMatchedCount < len(updates):
+            saved = {c['study_id']: (c.get('revision'), c.get('last_modified_date')) for c in
+                     ClinicalData.objects(study_id__in=list(updates))
+                     .only('study_id', 'revision', 'last_modified_date').as_pymongo()}
+            conflicts += [s for s, c in updates.items() if saved.get(s) != (c.revision, c.last_modified_date)]
+
+    staleRecords = [recordIDs[s] for s in conflicts if s in recordIDs]
+    if staleRecords:
+        history_svc.delete_version_deltas(staleRecords)
+
+    events = []
+    for study_id, clinical_data in list(inserts.items()) + list(updates.items()):
+        if study_id in conflicts:
+            continue
+        counts['inserted' if study_id in inserts else 'updated'] += 1
+        events.append(new_event_log(active_account,
+                                    f'Added / updated {documentName} data for ENID: {study_id} with id '
+                                    f'{clinical_data.id}.',
+                                    success=True,
+                                    event_type='Import',
+                                    file_name=data_file_name,
+                                    study_id=study_id,
+                                    document_id=str(clinical_data.id)))
+    if events:
+        Event_log.objects.insert(events, load_bulk=False)
+
+    # Participants another import saved first are updated one at a time (reloading and retrying as needed)
+    for study_id in conflicts:
+        row = enidRows[study_id]
+        try:
+            clinical_data = update_clinical_data(active_account, study_id,
+                                                 lambda c: set_enid_fields(active_account, c, study_id, row),
+                                                 create=True, versioned=True)
+        except (ValueError, ValidationError, ConcurrentUpdateError) as e:
+            log_enid_error(study_id, row, e)
+            counts['errors'] += 1
+            continue
+
+        counts['updated'] += 1
+        add_event_log(active_account,
+                      f'Added / updated {documentName} data for ENID: {study_id} with id {clinical_data.id}.',
+                      success=True,
+                      event_type='Import',
+                      file_name=data_file_name,
+                      study_id=study_id,
+                      document_id=str(clinical_data.id))
+
+    message = f'Imported {documentName} data from {data_file_name}: {counts["inserted"]} added, ' \
+              f'{counts["updated"]} updated, {counts["unchanged"]} unchanged, {counts["errors"]} errors.'
+    add_event_log(active_account,
+                  message,
+                  success=counts['errors'] == 0,
+                  event_type='Import',
+                  file_name=data_file_name)
+    success_msg(message)
+
+    return counts
+
+
+# def add_clinical_data(active_account: User, biospecimen_data_list, index, row) -> ClinicalData:
+# progress_callback (optional) is called as progress_callback(rows_processed, total_rows, error_count) before
+# each row and once at the end, and may raise an exception to stop the import (e.g. when a job is cancelled)
+# The import is checkpointed in the import journal (see open_journal). With resume set, it starts after the last
+# committed batch of rows (or the first row that failed), and a file that was already imported completely is skipped.
+# If changedRowsOnly is set, rows whose content hash matches the stored record are skipped, so only the
+# participants that actually changed are written and get a new version (and version history snapshot).
+# rowHashes (one per row of df), existingHashes (see find_clinical_data_content_hashes), and biospecimenReferences
+# (see find_biospecimen_data_by_study_ids) can be passed in if they have already been looked up.
+def add_clinical_data(active_account: User, df, data_file_name, progress_callback=None, resume=False,
+                      changedRowsOnly=True, rowHashes=None, existingHashes=None, biospecimenReferences=None,
+                      contentHash=None, rowOffset=0, completesFile=True):
+    documentName = set_up_globals.clinical_document_name
+
+    # Set up numeric fields and remove those set manually
+    integerFieldList, floatFieldList, decimalFieldList, longFieldList = utilities.get_numeric_attributes(ClinicalData)
+    integerFieldList.remove('version_number')
+    integerFieldList.remove('study_id')
+    integerFieldList.remove('revision')
+
+    totalRows = len(df.index)
+    errorCount = 0
+    journal, startRow = open_journal(active_account, data_file_name, documentName, df, resume, contentHash, rowOffset)
+    if startRow >= totalRows:
+        if progress_callback is not None:
+            progress_callback(totalRows, totalRows, errorCount)
+        return
+
+    if rowHashes is None:
+        rowHashes = clinical_row_hashes(df)
+    if not changedRowsOnly:
+        existingHashes = {}
+    elif existingHashes is None:
+        existingHashes = find_clinical_data_content_hashes(df['study_id'].iloc[startRow:])
+    unchangedCount = 0
+
+    for rowNumber, (index, row) in enumerate(df.iloc[startRow:].iterrows(), start=startRow):
+        if progress_callback is not None:
+            progress_callback(rowNumber, totalRows, errorCount)
+        if rowNumber > startRow and (rowOffset + rowNumber) % journal.batch_size == 0:
+            journal_svc.commit_import_batch(journal, rowOffset + rowNumber)
+
+        rowHash = rowHashes.iat[rowNumber]
+        if changedRowsOnly and existingHashes.get(int(row.study_id)) == rowHash:
+            unchangedCount += 1
+            continue  # Nothing changed for this participant
+
+        # Set the participant's fields from the row. If another import saves this participant first, the document is
+        # reloaded and this is called again, so the other import's changes are kept.
+        def set_clinical_data_fields(clinical_data):
+            # Get list of biospecimens for this clinical record
+            if biospecimenReferences is None:
+                biospecimen_data_list = find_biospecimen_data_by_study_id(index)
+            else:
+                biospecimen_data_list = biospecimenReferences.get(int(index), [])
+
+            clinical_data.last_modified_by = active_account
+            clinical_data.last_modified_date = datetime.datetime.now()
+            clinical_data.study_id = index
+            clinical_data.cu_id = row.cu_id
+            clinical_data.cor_id = row.cor_id
+            clinical_data.pub_id = row.pub_id
+            clinical_data.data_file_name = row.data_file_name
+            clinical_data.version_number = (clinical_data.version_number or 0) + 1
+            clinical_data.content_hash = rowHash
+            clinical_data.biospecimen_data_references = biospecimen_data_list
+            clinical_data.site = str(row.site)
+            clinical_data.sex = row.sex
+            clinical_data.phenotype = row.phenotype
+            # clinical_data.age = int(row.age)
+            # clinical_data.height_in = float(row.height_in)
+            # clinical_data.weight_lbs = float(row.weight_lbs)
+            # clinical_data.bmi = float(row.bmi)
+            clinical_data.ethnicity = convert_to_string(row.ethnicity)
+            clinical_data.race = convert_to_string(row.race)
+            clinical_data.mecfs_sudden_gradual = convert_to_string(row.mecfs_sudden_gradual)
+            clinical_data.qmep_sudevent = convert_to_string(row.qmep_sudevent)
+            # clinical_data.mecfs_duration = convert_to_string(row.mecfs_duration)
+            if str(row.qmep_mediagnosis).lower() != 'na' and str(row.qmep_mediagnosis).lower() != '' and str(row.qmep_mediagnosis).lower() != 'pending' and row.qmep_mediagnosis is not None:
+                clinical_data.qmep_mediagnosis = datetime.datetime.strptime(str(row.qmep_mediagnosis),
+                                                                            '%Y-%m-%d %H:%M:%S').date()
+            if str(row.qmep_mesymptoms).lower() != 'na' and str(row.qmep_mesymptoms).lower() != '' and str(row.qmep_mesymptoms).lower() != 'pending' and row.qmep_mesymptoms is not None:
+                clinical_data.qmep_mesymptoms = datetime.datetime.strptime(str(row.qmep_mesymptoms),
+                                                                           '%Y-%m-%d %H:%M:%S').date()
+            clinical_data.qmep_metimediagnosis = convert_to_string(row.qmep_metimediagnosis)
+            if str(row.cpet_d1).lower() != 'na' and str(row.cpet_d1).lower() != '' and str(row.cpet_d1).lower() != 'pending' and row.cpet_d1 is not None:
+                clinical_data.cpet_d1 = datetime.datetime.strptime(str(row.cpet_d1), '%Y-%m-%d %H:%M:%S').date()
+            if str(row.cpet_d2).lower() != 'na' and str(row.cpet_d2).lower() != '' and str(row.cpet_d2).lower() != 'pending' and row.cpet_d2 is not None:
+                clinical_data.cpet_d2 = datetime.datetime.strptime(str(row.cpet_d2), '%Y-%m-%d %H:%M:%S').date()
+            # clinical_data.vo2peak1 = convert_to_string(row.vo2peak1)
+            # clinical_data.vo2peak2 = convert_to_string(row.vo2peak2)
+            clinical_data.vo2change = convert_to_string(row.vo2change)
+            # clinical_data.at1 = convert_to_string(row.at1)
+            # clinical_data.at2 = convert_to_string(row.at2)
+            clinical_data.atchange = convert_to_string(row.atchange)
+
+            clinical_data.qmep_lived = convert_to_string(row.qmep_lived)
+            clinical_data.q_medications = convert_to_string(row.q_medications)
+            if str(row.q_lastantibiotic).lower() != 'na' and str(row.q_lastantibiotic).lower() != '' and str(row.q_lastantibiotic).lower() != 'pending' and row.q_lastantibiotic is not None:
+                clinical_data.q_lastantibiotic = datetime.datetime.strptime(str(row.q_lastantibiotic),
+                                                                            '%Y-%m-%d %H:%M:%S').date()
+            clinical_data.q_lastantibiotic_details = convert_to_string(row.q_lastantibiotic_details)
+            clinical_data.q_supplements = convert_to_string(row.q_supplements)
+            clinical_data.pahq_activitylist = convert_to_string(row.pahq_activitylist)
+            clinical_data.hh24hr_eaten_d1 = convert_to_string(row.hh24hr_eaten_d1)
+            clinical_data.hh24hr_coffeetea_d1 = convert_to_string(row.hh24hr_coffeetea_d1)
+            clinical_data.hh24hr_smoke_d1 = convert_to_string(row.hh24hr_smoke_d1)
+            clinical_data.hh24hr_alcohol_d1 = convert_to_string(row.hh24hr_alcohol_d1)
+            clinical_data.hh24hr_blood_d1 = convert_to_string(row.hh24hr_blood_d1)
+            clinical_data.hh24hr_illness_d1 = convert_to_string(row.hh24hr_illness_d1)
+            clinical_data.hh24hr_respiratory_d1 = convert_to_string(row.hh24hr_respiratory_d1)
+            clinical_data.hh24hr_medication_d1 = convert_to_string(row.hh24hr_medication_d1)
+            clinical_data.hh24hr_peyesterday_d1 = convert_to_string(row.hh24hr_peyesterday_d1)
+            clinical_data.hh24hr_petoday_d1 = convert_to_string(row.hh24hr_petoday_d1)
+            clinical_data.hh24hr_eaten_d2 = convert_to_string(row.hh24hr_eaten_d2)
+            clinical_data.hh24hr_coffeetea_d2 = convert_to_string(row.hh24hr_coffeetea_d2)
+            clinical_data.hh24hr_smoke_d2 = convert_to_string(row.hh24hr_smoke_d2)
+            clinical_data.hh24hr_alcohol_d2 = convert_to_string(row.hh24hr_alcohol_d2)
+            clinical_data.hh24hr_blood_d2 = convert_to_string(row.hh24hr_blood_d2)
+            clinical_data.hh24hr_illness_d2 = convert_to_string(row.hh24hr_illness_d2)
+            clinical_data.hh24hr_respiratory_d2 = convert_to_string(row.hh24hr_respiratory_d2)
+            clinical_data.hh24hr_medication_d2 = convert_to_string(row.hh24hr_medication_d2)
+            clinical_data.hh24hr_peyesterday_d2 = convert_to_string(row.hh24hr_peyesterday_d2)
+            clinical_data.hh24hr_petoday_d2 = convert_to_string(row.hh24hr_petoday_d2)
+
+            # Set numeric fields according to type
+            # print('IntegerList:', integerFieldList)
+            # print('FloatList:', floatFieldList)
+            # print('Row:', row)
+            for f in integerFieldList:
+                # print('Key:', f)
+                if str(row[f]).strip().lower() == 'nan': continue
+                if str(row[f]).strip().lower() == 'na': continue
+                if str(row[f]).strip().lower() == 'nd': continue
+                if str(row[f]).strip().lower() == '': continue
+                if str(row[f]).strip().lower() == 'pending': continue
+                if row[f] is None: continue
+                clinical_data[f] = int(row[f])
+
+            for f in floatFieldList:
+                if str(row[f]).strip().lower() == 'nan': continue
+                if str(row[f]).strip().lower() == 'na': continue
+                if str(row[f]).strip().lower() == 'nd': continue
+                if str(row[f]).strip().lower() == '': continue
+                if str(row[f]).strip().lower() == 'pending': continue
+                if row[f] is None: continue
+                clinical_data[f] = float(row[f])
+
+            # Set up bin numbers for binned columns
+            for f in set_up_globals.binnedColumnsDict:
+                if str(row[f]).strip().lower() == 'nan': continue
+                if str(row[f]).strip().lower() == 'na': continue
+                if str(row[f]).strip().lower() == 'nd': continue
+                if str(row[f]).strip().lower() == '': continue
+                if str(row[f]).strip().lower() == 'pending': continue
+                if row[f] is None: continue
+                value = float(row[f])
+                binRangeTuples = set_up_globals.binnedColumnsDict[f]
+                binNumber = 1
+                for binRange in binRangeTuples:
+                    if (binNumber == 1 and value >= binRange[0] and value <= binRange[1]) or (value > binRange[0] and value <= binRange[1]):
+                        clinical_data[f + '_binned'] = binNumber
+                        break
+                    binNumber += 1
 
         try:
-            clinical_data.save()
-        except (ValueError, ValidationError) as e:
+            clinical_data = update_clinical_data(active_account, row.study_id, set_clinical_data_fields,
+                                                 create=True, versioned=True)
+        except (ValueError, ValidationError, ConcurrentUpdateError) as e:
             message = f'Save of {documentName} data with id={index} resulted in exception: {e}'
             add_event_log(active_account,
                           message,
@@ -248,6 +601,8 @@ def add_enid_data(active_account: User, df, data_file_name):
                           file_name=row.data_file_name,
                           study_id=str(index))
             error_msg(message)
+            errorCount += 1
+            journal_svc.record_failed_row(journal, rowOffset + rowNumber)
             continue  # Skip the rest of this loop
 
         message = f'Added / updated {documentName} data for ENID: {clinical_data.study_id} with id {clinical_data.id}.'
@@ -260,188 +615,161 @@ def add_enid_data(active_account: User, df, data_file_name):
                       document_id=str(clinical_data.id))
         success_msg(message)
 
+    finish_journal(journal, rowOffset + totalRows, completesFile)
+    if progress_callback is not None:
+        progress_callback(totalRows, totalRows, errorCount)
+
+    if changedRowsOnly:
+        changedCount = totalRows - startRow - unchangedCount - errorCount
+        message = f'Imported {documentName} data from {data_file_name}: {changedCount} added / updated, ' \
+                  f'{unchangedCount} unchanged, {errorCount} errors.'
+        add_event_log(active_account,
+                      message,
+                      success=errorCount == 0,
+                      event_type='Import',
+                      file_name=data_file_name)
+        success_msg(message)
+
     return  # clinical_data
 
 
-# def add_clinical_data(active_account: User, biospecimen_data_list, index, row) -> ClinicalData:
-def add_clinical_data(active_account: User, df, data_file_name):  # -> ClinicalData:
-    documentName = set_up_globals.clinical_document_name
+# Hash each clinical data row for change detection. The hash covers the imported columns (not the file name)
+# and the participant's biospecimens, since the biospecimen references are refreshed when a record is written.
+def clinical_row_hashes(df) -> pd.Series:
+    columns = [c for c in df.columns if c != 'data_file_name' and not str(c).endswith('_binned')]
+    hashDF = df[columns].copy()
 
-    # Set up numeric fields and remove those set manually
-    integerFieldList, floatFieldList, decimalFieldList, longFieldList = utilities.get_numeric_attributes(ClinicalData)
-    integerFieldList.remove('version_number')
-    integerFieldList.remove('study_id')
+    biospecimenIDs = {}
+    studyIDs = [int(i) for i in pd.to_numeric(df['study_id'], errors='coerce').dropna().unique()]
+    for b in Biospecimen.objects(study_id__in=studyIDs).only('id', 'study_id').as_pymongo():
+        biospecimenIDs.setdefault(b['study_id'], []).append(str(b['_id']))
+    hashDF['biospecimen_data_references'] = [','.join(sorted(biospecimenIDs.get(i, []))) if pd.notna(i) else ''
+                                             for i in pd.to_numeric(df['study_id'], errors='coerce')]
 
-    for index, row in df.iterrows():
-        currentVersion = 0
-        clinical_data = find_clinical_data_by_study_id(row.study_id)
+    return journal_svc.row_content_hashes(hashDF)
 
-        if clinical_data:
-            # If data exists, save in version history
-            #     Update version history before current version
-            #     In the case of a failure during save, this will will result in a duplicate record
-            #     in the history collection (which is acceptable), rather than a lost record in the
-            #     history collection (which is not acceptable).
 
-            # //--- stop after history update to simulate a failure, then
-            # //--- run full flow to make sure clean up works correctly
+# Return a dictionary of study ID -> stored content hash for the given study IDs (one query)
+def find_clinical_data_content_hashes(study_ids) -> dict:
+    studyIDs = [int(i) for i in pd.to_numeric(pd.Series(list(study_ids)), errors='coerce').dropna().unique()]
+    query = ClinicalData.objects(study_id__in=studyIDs).only('study_id', 'content_hash').as_pymongo()
+    return {d['study_id']: d.get('content_hash') for d in query}
 
-            currentVersion = clinical_data.version_number
-            clinical_data_version_history = ClinicalDataVersionHistory()
 
-            attributeList = utilities.attributes(ClinicalData)
-            # print(attributeList)
-            for attrib in attributeList:
-                # print(attrib)
-                clinical_data_version_history[attrib] = clinical_data[attrib]
+# Return the set of the given study IDs that have clinical data (one query)
+def find_existing_study_ids(study_ids) -> set:
+    studyIDs = [int(i) for i in pd.to_numeric(pd.Series(list(study_ids)), errors='coerce').dropna().unique()]
+    return set(ClinicalData.objects(study_id__in=studyIDs).distinct('study_id'))
 
-            clinical_data_version_history.save()
-        else:
-            # If no data exists for this study id, set created info
-            clinical_data = ClinicalData()
-            clinical_data.created_by = active_account
-            clinical_data.created_date = datetime.datetime.now()
 
-        # Get list of biospecimens for this clinical record
-        biospecimen_data_list = find_biospecimen_data_by_study_id(index)
-
-        clinical_data.last_modified_by = active_account
-        clinical_data.last_modified_date = datetime.datetime.now()
-        clinical_data.study_id = index
-        clinical_data.cu_id = row.cu_id
-        clinical_data.cor_id = row.cor_id
-        clinical_data.pub_id = row.pub_id
-        clinical_data.data_file_name = row.data_file_name
-        clinical_data.version_number = currentVersion + 1
-        clinical_data.biospecimen_data_references = biospecimen_data_list
-        clinical_data.site = str(row.site)
-        clinical_data.sex = row.sex
-        clinical_data.phenotype = row.phenotype
-        # clinical_data.age = int(row.age)
-        # clinical_data.height_in = float(row.height_in)
-        # clinical_data.weight_lbs = float(row.weight_lbs)
-        # clinical_data.bmi = float(row.bmi)
-        clinical_data.ethnicity = convert_to_string(row.ethnicity)
-        clinical_data.race = convert_to_string(row.race)
-        clinical_data.mecfs_sudden_gradual = convert_to_string(row.mecfs_sudden_gradual)
-        clinical_data.qmep_sudevent = convert_to_string(row.qmep_sudevent)
-        # clinical_data.mecfs_duration = convert_to_string(row.mecfs_duration)
-        if str(row.qmep_mediagnosis).lower() != 'na' and str(row.qmep_mediagnosis).lower() != '' and str(row.qmep_mediagnosis).lower() != 'pending' and row.qmep_mediagnosis is not None:
-            clinical_data.qmep_mediagnosis = datetime.datetime.strptime(str(row.qmep_mediagnosis),
-                                                                        '%Y-%m-%d %H:%M:%S').date()
-        if str(row.qmep_mesymptoms).lower() != 'na' and str(row.qmep_mesymptoms).lower() != '' and str(row.qmep_mesymptoms).lower() != 'pending' and row.qmep_mesymptoms is not None:
-            clinical_data.qmep_mesymptoms = datetime.datetime.strptime(str(row.qmep_mesymptoms),
-                                                                       '%Y-%m-%d %H:%M:%S').date()
-        clinical_data.qmep_metimediagnosis = convert_to_string(row.qmep_metimediagnosis)
-        if str(row.cpet_d1).lower() != 'na' and str(row.cpet_d1).lower() != '' and str(row.cpet_d1).lower() != 'pending' and row.cpet_d1 is not None:
-            clinical_data.cpet_d1 = datetime.datetime.strptime(str(row.cpet_d1), '%Y-%m-%d %H:%M:%S').date()
-        if str(row.cpet_d2).lower() != 'na' and str(row.cpet_d2).lower() != '' and str(row.cpet_d2).lower() != 'pending' and row.cpet_d2 is not None:
-            clinical_data.cpet_d2 = datetime.datetime.strptime(str(row.cpet_d2), '%Y-%m-%d %H:%M:%S').date()
-        # clinical_data.vo2peak1 = convert_to_string(row.vo2peak1)
-        # clinical_data.vo2peak2 = convert_to_string(row.vo2peak2)
-        clinical_data.vo2change = convert_to_string(row.vo2change)
-        # clinical_data.at1 = convert_to_string(row.at1)
-        # clinical_data.at2 = convert_to_string(row.at2)
-        clinical_data.atchange = convert_to_string(row.atchange)
-
-        clinical_data.qmep_lived = convert_to_string(row.qmep_lived)
-        clinical_data.q_medications = convert_to_string(row.q_medications)
-        if str(row.q_lastantibiotic).lower() != 'na' and str(row.q_lastantibiotic).lower() != '' and str(row.q_lastantibiotic).lower() != 'pending' and row.q_lastantibiotic is not None:
-            clinical_data.q_lastantibiotic = datetime.datetime.strptime(str(row.q_lastantibiotic),
-                                                                        '%Y-%m-%d %H:%M:%S').date()
-        clinical_data.q_lastantibiotic_details = convert_to_string(row.q_lastantibiotic_details)
-        clinical_data.q_supplements = convert_to_string(row.q_supplements)
-        clinical_data.pahq_activitylist = convert_to_string(row.pahq_activitylist)
-        clinical_data.hh24hr_eaten_d1 = convert_to_string(row.hh24hr_eaten_d1)
-        clinical_data.hh24hr_coffeetea_d1 = convert_to_string(row.hh24hr_coffeetea_d1)
-        clinical_data.hh24hr_smoke_d1 = convert_to_string(row.hh24hr_smoke_d1)
-        clinical_data.hh24hr_alcohol_d1 = convert_to_string(row.hh24hr_alcohol_d1)
-        clinical_data.hh24hr_blood_d1 = convert_to_string(row.hh24hr_blood_d1)
-        clinical_data.hh24hr_illness_d1 = convert_to_string(row.hh24hr_illness_d1)
-        clinical_data.hh24hr_respiratory_d1 = convert_to_string(row.hh24hr_respiratory_d1)
-        clinical_data.hh24hr_medication_d1 = convert_to_string(row.hh24hr_medication_d1)
-        clinical_data.hh24hr_peyesterday_d1 = convert_to_string(row.hh24hr_peyesterday_d1)
-        clinical_data.hh24hr_petoday_d1 = convert_to_string(row.hh24hr_petoday_d1)
-        clinical_data.hh24hr_eaten_d2 = convert_to_string(row.hh24hr_eaten_d2)
-        clinical_data.hh24hr_coffeetea_d2 = convert_to_string(row.hh24hr_coffeetea_d2)
-        clinical_data.hh24hr_smoke_d2 = convert_to_string(row.hh24hr_smoke_d2)
-        clinical_data.hh24hr_alcohol_d2 = convert_to_string(row.hh24hr_alcohol_d2)
-        clinical_data.hh24hr_blood_d2 = convert_to_string(row.hh24hr_blood_d2)
-        clinical_data.hh24hr_illness_d2 = convert_to_string(row.hh24hr_illness_d2)
-        clinical_data.hh24hr_respiratory_d2 = convert_to_string(row.hh24hr_respiratory_d2)
-        clinical_data.hh24hr_medication_d2 = convert_to_string(row.hh24hr_medication_d2)
-        clinical_data.hh24hr_peyesterday_d2 = convert_to_string(row.hh24hr_peyesterday_d2)
-        clinical_data.hh24hr_petoday_d2 = convert_to_string(row.hh24hr_petoday_d2)
-
-        # Set numeric fields according to type
-        # print('IntegerList:', integerFieldList)
-        # print('FloatList:', floatFieldList)
-        # print('Row:', row)
-        for f in integerFieldList:
-            # print('Key:', f)
-            if str(row[f]).strip().lower() == 'nan': continue
-            if str(row[f]).strip().lower() == 'na': continue
-            if str(row[f]).strip().lower() == 'nd': continue
-            if str(row[f]).strip().lower() == '': continue
-            if str(row[f]).strip().lower() == 'pending': continue
-            if row[f] is None: continue
-            clinical_data[f] = int(row[f])
-
-        for f in floatFieldList:
-            if str(row[f]).strip().lower() == 'nan': continue
-            if str(row[f]).strip().lower() == 'na': continue
-            if str(row[f]).strip().lower() == 'nd': continue
-            if str(row[f]).strip().lower() == '': continue
-            if str(row[f]).strip().lower() == 'pending': continue
-            if row[f] is None: continue
-            clinical_data[f] = float(row[f])
-
-        # Set up bin numbers for binned columns
-        for f in set_up_globals.binnedColumnsDict:
-            if str(row[f]).strip().lower() == 'nan': continue
-            if str(row[f]).strip().lower() == 'na': continue
-            if str(row[f]).strip().lower() == 'nd': continue
-            if str(row[f]).strip().lower() == '': continue
-            if str(row[f]).strip().lower() == 'pending': continue
-            if row[f] is None: continue
-            value = float(row[f])
-            binRangeTuples = set_up_globals.binnedColumnsDict[f]
-            binNumber = 1
-            for binRange in binRangeTuples:
-                if (binNumber == 1 and value >= binRange[0] and value <= binRange[1]) or (value > binRange[0] and value <= binRange[1]):
-                    clinical_data[f + '_binned'] = binNumber
-                    break
-                binNumber += 1
+# Return the set of the given specimen IDs that have biospecimen data (one query)
+def find_existing_specimen_ids(specimen_ids) -> set:
+    return set(Biospecimen.objects(specimen_id__in=list(set(specimen_ids))).distinct('specimen_id'))
 
-        try:
-            clinical_data.save()
-        except (ValueError, ValidationError) as e:
-            message = f'Save of {documentName} data with id={index} resulted in exception: {e}'
-            add_event_log(active_account,
-                          message,
-                          success=False,
-                          event_type='Import',
-                          exception_type=e.__class__.__name__,
-                          file_name=row.data_file_name,
-                          study_id=str(index))
-            error_msg(message)
-            continue  # Skip the rest of this loop
 
-        message = f'Added / updated {documentName} data for ENID: {clinical_data.study_id} with id {clinical_data.id}.'
+# Open the import journal for a file and return it with the row of df to start from: 0 unless resume is set, in which
+# case it's the number of rows already imported (the total number of rows if the file was imported completely).
+# contentHash identifies the file (see journal_svc.open_import_journal) and rowOffset is the position of df's first
+# row in the file, for a file imported in parts.
+def open_journal(active_account: User, data_file_name, documentName, df, resume=False, contentHash=None, rowOffset=0):
+    journal = journal_svc.open_import_journal(active_account, data_file_name, documentName, df, resume,
+                                              contentHash, rowOffset)
+    totalRows = len(df.index)
+    if not resume:
+        return journal, 0
+
+    if journal.status == 'Completed':
+        message = f'{documentName} data in {data_file_name} has already been imported completely; ' \
+                  f'skipping {totalRows} rows (import it again without resuming to re-import it).'
         add_event_log(active_account,
                       message,
                       success=True,
                       event_type='Import',
                       file_name=data_file_name,
-                      study_id=index,
-                      document_id=str(clinical_data.id))
+                      document_id=str(journal.id))
         success_msg(message)
+        return journal, totalRows
 
-    return  # clinical_data
+    startRow = min(max(0, (journal.committed_rows or 0) - rowOffset), totalRows)
+    if 0 < startRow < totalRows:
+        message = f'Resuming import of {documentName} data in {data_file_name} at row {rowOffset + startRow + 1}.'
+        add_event_log(active_account,
+                      message,
+                      success=True,
+                      event_type='Import',
+                      file_name=data_file_name,
+                      document_id=str(journal.id))
+        success_msg(message)
+
+    return journal, startRow
+
+
+# Record the end of an import in its journal, with a message if rows failed (a resume retries from the first one)
+def finish_journal(journal, committedRows, completesFile=True):
+    journal_svc.finish_import_journal(journal, committedRows, completesFile)
+    if completesFile and journal.failed_row is not None:
+        error_msg(f'Row {journal.failed_row + 1} of {journal.data_file_name} failed to import; resuming the import '
+                  f'will retry from it.')
 
 
 # Add data that is common to each assay (proteomic, cytokines, etc.)
-def add_common_data(active_account: User, row, dataClass, metaDataDict, fastLoad=False):
+# In-memory indexes of the embedded lists of a loaded document (e.g. a participant's assay rows by unique ID), so rows,
+# results, and tubes are found with a dict lookup rather than a scan of the list. An index is built the first time
+# it's used on a document and kept with that object; add items with index_append so every index of the list stays
+# current. A document loaded again (e.g. after another import saved it) is a new object with new indexes.
+def embedded_index(document, listName, key) -> dict:
+    indexes = document.__dict__.setdefault('_embeddedIndexes', {})
+    if (listName, key) not in indexes:
+        index = {}
+        for item in document[listName]:
+            index.setdefault(key(item), item)  # The first match, as a scan of the list would find
+        indexes[(listName, key)] = index
+    return indexes[(listName, key)]
+
+
+# Append an item to an embedded list of a document, adding it to the indexes of the list that have been built
+def index_append(document, listName, item):
+    document[listName].append(item)
+    for (indexedList, key), index in document.__dict__.get('_embeddedIndexes', {}).items():
+        if indexedList == listName:
+            index.setdefault(key(item), item)
+
+
+# Remove items from an embedded list of a document, and from the indexes of the list that have been built
+def index_remove(document, listName, items):
+    removedIDs = {id(item) for item in items}
+    document[listName] = [item for item in document[listName] if id(item) not in removedIDs]
+    for (indexedList, key), index in document.__dict__.get('_embeddedIndexes', {}).items():
+        if indexedList == listName:
+            for indexKey in [k for k, item in index.items() if id(item) in removedIDs]:
+                del index[indexKey]
+
+
+# Keys of the embedded list indexes
+def assay_row_key(assay_meta_data):
+    return assay_meta_data.unique_id
+
+
+def assay_result_key(assay_results):
+    return assay_results.data_label, assay_results.data_label_type
+
+
+def assay_summary_key(assay_summary):
+    return assay_summary.pathway_name, assay_summary.assay_summary_type
+
+
+def tube_info_key(biospecimen_tube_info):
+    return biospecimen_tube_info.sample_id
+
+
+def scrnaseq_summary_key(scrnaseq_summary):
+    return scrnaseq_summary.sampleid
+
+
+# dataLabelReferences is an optional dictionary of data label -> DataLabels (see find_data_label_references);
+# labels not in it are looked up one at a time. If sparse is set, results of 0 are not stored (and a stored result
+# that is now 0 is removed), so only the non-zero results of the row are visited.
+def add_common_data(active_account: User, row, dataClass, metaDataDict, dataLabelReferences=None, sparse=False):
     dataClass.last_modified_by = active_account
     dataClass.last_modified_date = datetime.datetime.now()
     dataClass.data_file_name = row.data_file_name
@@ -514,43 +842,49 @@ def add_common_data(active_account: User, row, dataClass, metaDataDict, fastLoad
     # Add assay results to data as a subdocument
     # Data labels (e.g. gene symbols) start at column 6.
     # Subtract 3 from end to account for data_file_name, study_id, and unique_id
-    for i in range(6, len(row) - 3):
-        if str(row[i]).strip().lower() == 'nan': continue
-        if str(row[i]).strip().lower() == 'na': continue
-        if str(row[i]).strip().lower() == 'nd': continue
-        if str(row[i]).strip().lower() == '': continue
-        if str(row[i]).strip().lower() == 'pending': continue
-        if row[i] is None: continue
+    dataLabelType = metaDataDict['data_label_type'].strip()
+    resultIndex = embedded_index(dataClass, 'assay_results', assay_result_key)
+    labelPositions = range(6, len(row) - 3)
+    if sparse:
+        dataClass.zero_results_omitted = True
+        results = pd.to_numeric(row.iloc[6:len(row) - 3], errors='coerce').to_numpy(dtype=np.float64)
+        isZero = results == 0
+        if resultIndex:
+            zeroLabels = set(row.index[6:len(row) - 3][isZero])
+            index_remove(dataClass, 'assay_results', [r for (label, labelType), r in resultIndex.items()
+                                                      if labelType == dataLabelType and label in zeroLabels])
+        labelPositions = np.flatnonzero(~isZero) + 6
+    for i in labelPositions:
+        result = row.iloc[i]
+        if result is None or str(result).strip().lower() in ('nan', 'na', 'nd', '', 'pending'):
+            # A result that isn't stored reads as 0 in a sparse assay, so store a missing result as NaN
+            if not sparse: continue
+            result = np.nan
 
         data_label = row.index[i]
-        result = row[i]
         # if set_up_globals.testMode:
         #     print(data_label, result)
 
         # Is this a new or existing assay result for this gene symbol?
-        assay_results: Optional[AssayResults] = None
-        newAssayResults = True
+        assay_results: Optional[AssayResults] = resultIndex.get((data_label, dataLabelType))
+        newAssayResults = assay_results is None
 
-        if not fastLoad:  # fastLoad assumes this is a new record
-            for a in dataClass.assay_results:
-                if a.data_label == data_label and a.data_label_type == metaDataDict['data_label_type'].strip():
-                    assay_results = a
-                    newAssayResults = False
-                    break
-
-        if not assay_results:
+        if newAssayResults:
             assay_results = AssayResults()
-            assay_results.data_label_type = metaDataDict['data_label_type'].strip()
+            assay_results.data_label_type = dataLabelType
             assay_results.data_label = data_label
 
         assay_results.result = result
 
-        data_label_ref = find_data_label_reference(data_label, metaDataDict['data_label_type'].strip())
+        if dataLabelReferences is not None and data_label in dataLabelReferences:
+            data_label_ref = dataLabelReferences[data_label]
+        else:
+            data_label_ref = find_data_label_reference(data_label, dataLabelType)
         if data_label_ref:
             assay_results.data_label_reference = data_label_ref
         else:
             # Flag error if gene symbol does not exist
-            message = f"Error in save of assay data: {metaDataDict['data_label_type'].strip()} {data_label} not found"
+            message = f"Error in save of assay data: {dataLabelType} {data_label} not found"
             add_event_log(active_account,
                           message,
                           success=False,
@@ -561,72 +895,182 @@ def add_common_data(active_account: User, row, dataClass, metaDataDict, fastLoad
             # //--- error_msg(message)
 
         if newAssayResults:
-            dataClass.assay_results.append(assay_results)
+            index_append(dataClass, 'assay_results', assay_results)
 
     return dataClass
 
 
-# Save assay summaries
-def save_assay_summary_data(active_account: User, pathway_name, df):
-    progressCounter = 0
-    totalRows = len(df.index)
-    for index, row in df.iterrows():
+# Save the pathway summaries of df (one column per summary type in set_up_globals.summary_type_choices) to the
+# assay row of each row of df: the one with its unique_id, or (if df has no unique_id column) the participant's first
+# assay row with its unique assay name and timepoint. Each row is one targeted update of the participant: arrayFilters
+# pick the assay row by unique ID and its summaries by pathway name and summary type, so the participant document is
+# never loaded or rewritten. Summaries that don't exist yet are pushed onto the
+# assay row's list (with a second update if the row also has existing summaries). The existing summaries of all the
+# participants are looked up with one query, the updates are sent bulkWriteBatchSize at a time, and one event is
+# logged for the run. Returns the number of rows updated and the number of rows with no matching assay row.
+def save_assay_summary_data(active_account: User, pathway_name, df) -> dict:
+    summaryTypes = [t for t in set_up_globals.summary_type_choices if t in df.columns]
+    studyIDs = sorted({int(i) for i in pd.to_numeric(df['study_id'], errors='coerce').dropna()})
+
+    # (study ID, assay row unique ID) -> summary types of this pathway that are already saved, and
+    # (study ID, unique assay name, timepoint) -> unique ID of the first assay row with them
+    existingSummaries = {}
+    firstAssayRows = {}
+    for c in ClinicalData.objects(study_id__in=studyIDs).only('study_id', 'assay_meta_data.unique_id',
+                                                               'assay_meta_data.unique_assay_name',
+                                                               'assay_meta_data.timepoint',
+                                                               'assay_meta_data.assay_summary').as_pymongo():
+        for a in c.get('assay_meta_data', []):
+            existingSummaries[(c['study_id'], a.get('unique_id'))] = \
+                {s.get('assay_summary_type') for s in a.get('assay_summary', []) if s.get('pathway_name') == pathway_name}
+            firstAssayRows.setdefault((c['study_id'], a.get('unique_assay_name'), a.get('timepoint')),
+                                      a.get('unique_id'))
+
+    # Each update increments the revision (so imports that loaded a participant before it don't overwrite the
+    # summaries), which needs a number to increment
+    ClinicalData._get_collection().update_many({'study_id': {'$in': studyIDs}, 'revision': None},
+                                               {'$set': {'revision': 0}})
+
+    keyColumns = ['study_id', 'unique_id'] if 'unique_id' in df.columns else \
+        ['study_id', 'unique_assay_name', 'timepoint']
+    counts = {'updated': 0, 'missing': 0}
+    operations = []
+    for row in df[keyColumns + summaryTypes].itertuples(index=False):
+        studyID = int(row.study_id)
+        if 'unique_id' in keyColumns:
+            key = (studyID, row.unique_id)
+        else:
+            key = (studyID, firstAssayRows.get((studyID, row.unique_assay_name, row.timepoint)))
 
-        progressCounter += 1
-        if progressCounter % 10 == 0:
-            print('Percentage loaded: %d\n' % int((progressCounter * 100) / totalRows))
-            print(' {}. {}: {} {} {}'.format(index + 1, row.study_id, row.unique_assay_name, row.timepoint, pathway_name))
+        # If no data exists for this id, continue to the next id
+        if key[1] is None or key not in existingSummaries:
+            counts['missing'] += 1
+            continue
+
+        values = {}
+        for summaryType in summaryTypes:
+            summaryValue = getattr(row, summaryType)
+            if summaryValue is None: continue
+            summaryValue = float(summaryValue)
+            if np.isnan(summaryValue): continue
+            values[summaryType] = summaryValue
+        if not values:
+            continue
+
+        assayRowFilter = {'m.unique_id': key[1]}
+        existingTypes = [t for t in values if t in existingSummaries[key]]
+        newTypes = [t for t in values if t not in existingSummaries[key]]
+        if existingTypes:
+            operations.append(UpdateOne(
+                {'study_id': key[0]},
+                {'$set': {f'assay_meta_data.$[m].assay_summary.$[s{i}].summary': values[t]
+                          for i, t in enumerate(existingTypes)},
+                 '$inc': {'revision': 1}},
+                array_filters=[assayRowFilter] + [{f's{i}.pathway_name': pathway_name,
+                                                   f's{i}.assay_summary_type': t} for i, t in enumerate(existingTypes)]))
+        if newTypes:
+            newSummaries = [AssaySummary(pathway_name=pathway_name, assay_summary_type=t, summary=values[t])
+                            for t in newTypes]
+            operations.append(UpdateOne(
+                {'study_id': key[0]},
+                {'$push': {'assay_meta_data.$[m].assay_summary': {'$each': [s.to_mongo() for s in newSummaries]}},
+                 '$inc': {'revision': 1}},
+                array_filters=[assayRowFilter]))
+            existingSummaries[key].update(newTypes)  # A later row for the same assay row updates them
+        counts['updated'] += 1
+
+    # Sent in order, so a later row for the same assay row is applied after the one that added its summaries
+    for batchStart in range(0, len(operations), set_up_globals.bulkWriteBatchSize):
+        ClinicalData._get_collection().bulk_write(
+            operations[batchStart:batchStart + set_up_globals.bulkWriteBatchSize], ordered=True)
+        print('Percentage loaded: %d' % int(min(batchStart + set_up_globals.bulkWriteBatchSize, len(operations)) *
+                                            100 / len(operations)))
+
+    message = f'Saved {pathway_name} assay summaries for {counts["updated"]} of {len(df.index)} assay rows ' \
+              f'({counts["missing"]} rows with no matching assay data).'
+    add_event_log(active_account,
+                  message,
+                  success=True,
+                  event_type='Import')
+    success_msg(message)
 
-        # Get clinical data reference
-        clinical_data = find_clinical_data_by_study_id(row.study_id)
+    return counts
 
-        # Get reference to assay meta data
-        for b in clinical_data.assay_meta_data:
-            if b.unique_assay_name == row.unique_assay_name and b.timepoint == row.timepoint:
-                assay_meta_data = b
-                break
 
-        # If no data exists for this id, continue to the next id
-        if not assay_meta_data: continue
-
-        # Add assay summary to meta data as a subdocument
-        for summaryType in set_up_globals.summary_type_choices:
-            # print('summary type:', summaryType, ', index:', str(index))
-            # print('row:', row)
-            # if df.at[index, summaryType] is None: continue
-            if row[summaryType] is None: continue
-            # summaryValue = float(df.at[index, summaryType])
-            summaryValue = float(row[summaryType])
-            if np.isnan(summaryValue): continue
+class ConcurrentUpdateError(Exception):
+    pass
+
+
+def _revision_condition(revision) -> dict:
+    if not revision:
+        return {'revision__in': [0, None]}  # Also matches documents saved before revisions were added
+    return {'revision': revision}
 
-            # Is this a new or existing assay summary?
-            assay_summary: Optional[AssaySummary] = None
-            newAssaySummary = True
 
-            for rec in assay_meta_data.assay_summary:
-                if rec.pathway_name == pathway_name and rec.assay_summary_type == summaryType:
-                    assay_summary = rec
-                    newAssaySummary = False
-                    break
+# Save a clinical data document only if no one else saved it since it was loaded (compare-and-swap on its revision,
+# which every save increments). Returns False, leaving the document unsaved, if it was changed in the meantime.
+def save_clinical_data_revision(clinical_data: ClinicalData) -> bool:
+    loadedRevision = clinical_data.revision or 0
+    clinical_data.revision = loadedRevision + 1
+    try:
+        if clinical_data.id is None:
+            clinical_data.save()
+        else:
+            clinical_data.save(save_condition=_revision_condition(loadedRevision))
+    except SaveConditionError:
+        clinical_data.revision = loadedRevision
+        return False
+    return True
+
+
+# Read-modify-write of a participant's clinical data with optimistic concurrency control, so imports can run in
+# parallel without losing each other's updates. mutate(clinical_data) makes the changes to the loaded document.
+# If another import saved the participant first, the document is reloaded and mutate is called again (up to
+# clinicalDataSaveRetries times, with an increasing random delay), then ConcurrentUpdateError is raised.
+# If create is set, a new document is created when the participant doesn't exist (otherwise None is returned).
+# If versioned is set, the superseded version is recorded in the version history.
+# clinical_data (optional) is the already loaded document to use for the first attempt.
+def update_clinical_data(active_account: User, study_id, mutate, create=False, versioned=False,
+                         clinical_data: ClinicalData = None) -> Optional[ClinicalData]:
+    for attempt in range(set_up_globals.clinicalDataSaveRetries + 1):
+        if attempt > 0:
+            time.sleep(random.uniform(0.5, 1.5) * set_up_globals.clinicalDataRetryDelay * 2 ** (attempt - 1))
+            clinical_data = None
+        if clinical_data is None:
+            clinical_data = find_clinical_data_by_study_id(study_id)
+
+        previousVersion = None
+        if clinical_data:
+            if versioned:
+                previousVersion = history_svc.document_snapshot(clinical_data)
+        elif create:
+            # If no data exists for this study id, set created info
+            clinical_data = ClinicalData()
+            clinical_data.created_by = active_account
+            clinical_data.created_date = datetime.datetime.now()
+        else:
+            return None
 
-            if not assay_summary:
-                assay_summary = AssaySummary()
-                assay_summary.pathway_name = pathway_name
-                assay_summary.assay_summary_type = summaryType
+        mutate(clinical_data)
 
-            assay_summary.summary = summaryValue
+        # Record the changes from the previous version in the version history before saving. In the case of a
+        # failure during save, this will result in a duplicate record in the history collection (which is
+        # acceptable), rather than a lost record in the history collection (which is not acceptable).
+        versionRecord = None
+        if previousVersion is not None:
+            versionRecord = history_svc.save_version_delta(active_account, clinical_data, previousVersion,
+                                                           'ClinicalData')
 
-            if newAssaySummary:
-                assay_meta_data.assay_summary.append(assay_summary)
+        if save_clinical_data_revision(clinical_data):
+            return clinical_data
 
-        # Save sub document data
-        save_clinical_data(active_account,
-                           clinical_data,
-                           set_up_globals.clinical_document_name,
-                           row.study_id,
-                           assay_meta_data.data_file_name,
-                           assay_meta_data.unique_id,
-                           printSuccessMessage=False)
+        # Someone else saved a new version first, so this record describes changes that were never saved
+        if versionRecord is not None:
+            versionRecord.delete()
+
+    raise ConcurrentUpdateError(f'{set_up_globals.clinical_document_name} data for study ID {study_id} was changed '
+                                f'by another import on each of {set_up_globals.clinicalDataSaveRetries + 1} '
+                                f'attempts.')
 
 
 def get_clinical_data_reference(active_account: User, documentName, study_id, data_file_name):
@@ -644,11 +1088,22 @@ def get_clinical_data_reference(active_account: User, documentName, study_id, da
     return clinical_data
 
 
+# Save a participant's clinical data. If mutate is given, it's applied to clinical_data before saving and, if another
+# import saved the participant in the meantime, to a freshly loaded copy (see update_clinical_data). Without mutate,
+# the save fails if the participant was saved by another import since clinical_data was loaded.
 def save_clinical_data(active_account: User, clinical_data: ClinicalData, documentName, study_id, data_file_name,
-                       sub_document_id, printSuccessMessage=True):
+                       sub_document_id, printSuccessMessage=True, mutate=None):
     try:
-        clinical_data.save()
-    except (ValueError, ValidationError) as e:
+        if mutate is not None:
+            savedClinicalData = update_clinical_data(active_account, study_id, mutate, clinical_data=clinical_data)
+            if savedClinicalData is None:
+                raise ConcurrentUpdateError(f'{set_up_globals.clinical_document_name} data for study ID {study_id} '
+                                            f'was deleted by another import.')
+            clinical_data = savedClinicalData
+        elif not save_clinical_data_revision(clinical_data):
+            raise ConcurrentUpdateError(f'{set_up_globals.clinical_document_name} data for study ID {study_id} was '
+                                        f'changed by another import.')
+    except (ValueError, ValidationError, ConcurrentUpdateError) as e:
         message = f'Save of {documentName} data with id={sub_document_id} resulted in exception: {e}'
         add_event_log(active_account,
                       message,
@@ -660,7 +1115,7 @@ def save_clinical_data(active_account: User, clinical_data: ClinicalData, docume
                       document_id=str(clinical_data.id),
                       sub_document_id=str(sub_document_id))
         error_msg(message)
-        return  # Skip the rest of this function
+        return False  # Skip the rest of this function
 
     message = f'Added / updated {documentName} data for ENID: {clinical_data.study_id} with id {sub_document_id}.'
     add_event_log(active_account,
@@ -673,13 +1128,44 @@ def save_clinical_data(active_account: User, clinical_data: ClinicalData, docume
                   sub_document_id=str(sub_document_id))
     if printSuccessMessage: success_msg(message)
 
-    return
+    return True
 
 
-def add_assay_meta_data(active_account: User, df, data_file_name, metaDataDict, documentName, fastLoad=False):
-    progressCounter = 0
+# Count a change to the results of an assay, which invalidates its cached matrix (see assay_matrix_cache)
+def bump_assay_change_counter(unique_assay_name):
+    AssayChangeCounter.objects(unique_assay_name=unique_assay_name).update_one(
+        inc__counter=1, set__last_modified_date=datetime.datetime.now(), upsert=True)
+
+
+# See add_clinical_data for progress_callback, resume, and the journal arguments. biospecimenReferences (optional) is the result of
+# find_biospecimen_data_by_specimen_ids for the rows' specimen IDs, if they have already been looked up.
+# The assay's change counter is bumped before the first write and after the last, so a matrix cached while the
+# import was running is out of date once it ends (an import that fails part way through bumps it when resumed).
+def add_assay_meta_data(active_account: User, df, data_file_name, metaDataDict, documentName, fastLoad=False,
+                        progress_callback=None, resume=False, biospecimenReferences=None, contentHash=None,
+                        rowOffset=0, completesFile=True):
     totalRows = len(df.index)
-    for index, row in df.iterrows():
+    errorCount = 0
+    journal, progressCounter = open_journal(active_account, data_file_name, documentName, df, resume, contentHash,
+                                            rowOffset)
+    if progressCounter >= totalRows:
+        if progress_callback is not None:
+            progress_callback(totalRows, totalRows, errorCount)
+        return
+
+    # Look up the references of every data label column once, rather than for each row
+    dataLabelReferences = find_data_label_references(df.columns[6:len(df.columns) - 3],
+                                                     metaDataDict['data_label_type'].strip())
+
+    bump_assay_change_counter(metaDataDict['unique_assay_name'])
+    sparse = documentName in set_up_globals.sparseAssayDocumentNames
+
+    startRow = progressCounter
+    for index, row in df.iloc[startRow:].iterrows():
+        if progress_callback is not None:
+            progress_callback(progressCounter, totalRows, errorCount)
+        if progressCounter > startRow and (rowOffset + progressCounter) % journal.batch_size == 0:
+            journal_svc.commit_import_batch(journal, rowOffset + progressCounter)
 
         progressCounter += 1
         if progressCounter % 10 == 0:
@@ -687,43 +1173,55 @@ def add_assay_meta_data(active_account: User, df, data_file_name, metaDataDict,
 
         clinical_data = get_clinical_data_reference(active_account, documentName, row.study_id, data_file_name)
         if not clinical_data:
+            errorCount += 1
+            journal_svc.record_failed_row(journal, rowOffset + progressCounter - 1)
             continue  # Skip the rest of this loop
 
-        assay_meta_data: Optional[AssayMetaData] = None
-        newRow = True
-
-        if not fastLoad:  # fastLoad assumes this is a new record
-            for b in clinical_data.assay_meta_data:
-                if b.unique_id == index:
-                    assay_meta_data = b
-                    newRow = False
-                    break
-
-        # If no data exists for this id, set created info
-        if not assay_meta_data:
-            assay_meta_data = AssayMetaData()
-            assay_meta_data.created_by = active_account
-            assay_meta_data.created_date = datetime.datetime.now()
-
-        assay_meta_data.unique_id = index
-
         # Find associated biospecimens
+        biospecimen_data = None
         if not fastLoad:  # fastLoad bypasses the biospecimen reference
             specimen_id = str(int(float(row.study_id))) + '-' + row.timepoint + '-' + metaDataDict['biospecimen_type']
-            biospecimen_data = find_biospecimen_data_by_specimen_id(specimen_id)
+            if biospecimenReferences is None:
+                biospecimen_data = find_biospecimen_data_by_specimen_id(specimen_id)
+            else:
+                biospecimen_data = biospecimenReferences.get(specimen_id)
+
+        # Add or update the assay row (called again on a freshly loaded document if another import saves this
+        # participant first)
+        def set_assay_meta_data(clinical_data):
+            assay_meta_data: Optional[AssayMetaData] = embedded_index(clinical_data, 'assay_meta_data',
+                                                                      assay_row_key).get(index)
+            newRow = assay_meta_data is None
+
+            # If no data exists for this id, set created info
+            if newRow:
+                assay_meta_data = AssayMetaData()
+                assay_meta_data.created_by = active_account
+                assay_meta_data.created_date = datetime.datetime.now()
+
+            assay_meta_data.unique_id = index
             if biospecimen_data:
                 assay_meta_data.biospecimen_data_reference = biospecimen_data
 
-        assay_meta_data = add_common_data(active_account, row, assay_meta_data, metaDataDict, fastLoad)
+            assay_meta_data = add_common_data(active_account, row, assay_meta_data, metaDataDict, dataLabelReferences,
+                                              sparse=sparse)
 
-        # If this a new row, append it to the clinical data (otherwise, the
-        # existing row will be updated upon saving of the clinical data)
-        if newRow:
-            clinical_data.assay_meta_data.append(assay_meta_data)
+            # If this a new row, append it to the clinical data (otherwise, the
+            # existing row will be updated upon saving of the clinical data)
+            if newRow:
+                index_append(clinical_data, 'assay_meta_data', assay_meta_data)
 
         # Save sub document data
-        save_clinical_data(active_account, clinical_data, documentName,
-                           row.study_id, row.data_file_name, index, printSuccessMessage=False)
+        if not save_clinical_data(active_account, clinical_data, documentName,
+                                  row.study_id, row.data_file_name, index, printSuccessMessage=False,
+                                  mutate=set_assay_meta_data):
+            errorCount += 1
+            journal_svc.record_failed_row(journal, rowOffset + progressCounter - 1)
+
+    bump_assay_change_counter(metaDataDict['unique_assay_name'])
+    finish_journal(journal, rowOffset + totalRows, completesFile)
+    if progress_callback is not None:
+        progress_callback(totalRows, totalRows, errorCount)
 
     return
 
@@ -796,6 +1294,31 @@ def set_up_data_export_for_rti(df, assay_name, dataLabelList):
     return rtiDF_transposed, outputAssayDataFileName
 
 
+# Write the same file as set_up_data_export_for_rti (saved with to_csv(sep='\t', header=False)) to folder, one data
+# label at a time and without transposing the data labels, so mostly-zero assays (e.g. scRNA-seq pseudobulk counts)
+# only format their non-zero results. Returns the file name.
+def write_data_export_for_rti(df, assay_name, dataLabelList, folder):
+    moleculeDF, outputAssayDataFileName = set_up_data_export_for_rti(df, assay_name, [])
+    with open(folder + outputAssayDataFileName, 'w', newline='') as f:
+        moleculeDF.to_csv(f, sep='\t', header=False)
+        writer = csv.writer(f, delimiter='\t', lineterminator=os.linesep)
+        for dataLabel in dataLabelList:
+            values = df[dataLabel].to_numpy()
+            if values.dtype.kind in 'iu':
+                fields = ['0'] * len(values)
+                for position in np.flatnonzero(values):
+                    fields[position] = str(values[position])
+            elif values.dtype.kind == 'f':
+                fields = ['0.0'] * len(values)
+                for position in np.flatnonzero((values != 0) | np.signbit(values)):  # NaN and -0.0 aren't zero
+                    fields[position] = '' if np.isnan(values[position]) else str(float(values[position]))
+            else:
+                fields = ['' if pd.isna(value) else str(value) for value in values]
+            writer.writerow([dataLabel] + fields)
+
+    return outputAssayDataFileName
+
+
 # def add_proteomic_data(active_account: User, df, data_file_name, metaDataDict):  # -> Proteomic:
 #     documentName = set_up_globals.proteomics_document_name
 #     add_assay_meta_data(active_account, df, data_file_name, metaDataDict, documentName)
@@ -984,232 +1507,435 @@ def set_up_data_export_for_rti(df, assay_name, dataLabelList):
 #     # return  # scrnaseq_data
 
 
-# def add_scrnaseq_summary_data(active_account: User, clinical_data: ClinicalData, biospecimen_data: Biospecimen,
-# index, row) -> ScRNAseqSummary:
+# Values of a 10x sample's scRNA-seq summary from a row of the metrics summary sheet (raises ValueError if a value
+# can't be converted). Notes are only included if the row has some, so existing notes aren't cleared.
+def scrnaseq_summary_values(row) -> dict:
+    values = {'data_file_name': row.data_file_name,
+              'estimated_number_of_cells': int(row.estimated_number_of_cells),
+              'mean_reads_per_cell': int(row.mean_reads_per_cell),
+              'median_genes_per_cell': int(row.median_genes_per_cell),
+              'number_of_reads': int(row.number_of_reads),
+              'valid_barcodes': float(row.valid_barcodes),
+              'sequencing_saturation': float(row.sequencing_saturation),
+              'q30_bases_in_barcode': float(row.q30_bases_in_barcode),
+              'q30_bases_in_rna_read': float(row.q30_bases_in_rna_read),
+              'q30_bases_in_sample_index': float(row.q30_bases_in_sample_index),
+              'q30_bases_in_umi': float(row.q30_bases_in_umi),
+              'reads_mapped_to_genome': float(row.reads_mapped_to_genome),
+              'reads_mapped_confidently_to_genome': float(row.reads_mapped_confidently_to_genome),
+              'reads_mapped_confidently_to_intergenic_regions': float(row.reads_mapped_confidently_to_intergenic_regions),
+              'reads_mapped_confidently_to_intronic_regions': float(row.reads_mapped_confidently_to_intronic_regions),
+              'reads_mapped_confidently_to_exonic_regions': float(row.reads_mapped_confidently_to_exonic_regions),
+              'reads_mapped_confidently_to_transcriptome': float(row.reads_mapped_confidently_to_transcriptome),
+              'reads_mapped_antisense_to_gene': float(row.reads_mapped_antisense_to_gene),
+              'fraction_reads_in_cells': float(row.fraction_reads_in_cells),
+              'total_genes_detected': float(row.total_genes_detected),
+              'median_umi_counts_per_cell': float(row.median_umi_counts_per_cell),
+              'ten_x_batch': int(row.ten_x_batch),
+              'firstpass_nextseq': int(row.firstpass_nextseq),
+              'secondpass_nextseq': int(row.secondpass_nextseq),
+              'hiseq_x5': int(row.hiseq_x5),
+              'novaseq_s4': int(row.novaseq_s4),
+              'nextseq2k': int(row.nextseq2k),
+              'brc_id': row.brc_id,
+              'enid': int(row.enid),
+              'sample_name': row.sample_name,
+              'bc': row.bc}
+
+    if len(str(row.notes).strip()) > 0 and str(row.notes).strip().lower() != 'nan':
+        values['notes'] = str(row.notes).strip()
+
+    return values
+
+
+# Specimen ID of a 10x sample (its sample name without the tube number)
+def scrnaseq_specimen_id(sample_name) -> str:
+    return '-'.join(str(sample_name).split('-')[0:4])
+
+
+# Samples are grouped by participant and merged into the participant's scrnaseq_summary list in memory. The
+# participants and the samples' biospecimens are fetched with one query each, and each participant's list is
+# written with one targeted update ($set of the list, compare-and-swap on the revision), all in one bulk write.
+# A participant saved by another import since it was fetched is fetched and merged again, as in
+# update_clinical_data.
 def add_scrnaseq_summary_data(active_account: User, df, data_file_name):  # -> ScRNAseqSummary:
     documentName = set_up_globals.scrnaseq_summary_document_name
 
-    for index, row in df.iterrows():
-        clinical_data = find_clinical_data_by_study_id(row.study_id)
-        if not clinical_data:
-            message = f'You must import {set_up_globals.clinical_document_name} data for study ID {row.study_id} before importing {documentName} data.'
-            add_event_log(active_account,
-                          message,
-                          success=False,
-                          event_type='Import',
-                          file_name=data_file_name,
-                          study_id=row.study_id)
-            error_msg(message)
-            continue  # Skip the rest of this loop
-
-        scrnaseq_summary_data: Optional[ScRNAseqSummary] = None
-        newRow = True
-
-        for b in clinical_data.scrnaseq_summary:
-            if b.sampleid == index:
-                scrnaseq_summary_data = b
-                newRow = False
-                break
+    errorCount = 0
+    sampleCount = 0
 
-        # If no data exists for this id, set created info
-        if not scrnaseq_summary_data:
-            scrnaseq_summary_data = ScRNAseqSummary()
-            scrnaseq_summary_data.created_by = active_account
-            scrnaseq_summary_data.created_date = datetime.datetime.now()
-
-        # Find associated biospecimens (first strip tube number off of the sample name)
-        valMinusTubeNumberList = row.sample_name.split('-')[0:4]
-        specimen_id = '-'.join(valMinusTubeNumberList)
-        biospecimen_data = find_biospecimen_data_by_specimen_id(specimen_id)
-
-        scrnaseq_summary_data.last_modified_by = active_account
-        scrnaseq_summary_data.last_modified_date = datetime.datetime.now()
-        scrnaseq_summary_data.sampleid = index
-        scrnaseq_summary_data.data_file_name = row.data_file_name
-        scrnaseq_summary_data.biospecimen_data_reference = biospecimen_data
-        scrnaseq_summary_data.estimated_number_of_cells = int(row.estimated_number_of_cells)
-        scrnaseq_summary_data.mean_reads_per_cell = int(row.mean_reads_per_cell)
-        scrnaseq_summary_data.median_genes_per_cell = int(row.median_genes_per_cell)
-        scrnaseq_summary_data.number_of_reads = int(row.number_of_reads)
-        scrnaseq_summary_data.valid_barcodes = float(row.valid_barcodes)
-        scrnaseq_summary_data.sequencing_saturation = float(row.sequencing_saturation)
-        scrnaseq_summary_data.q30_bases_in_barcode = float(row.q30_bases_in_barcode)
-        scrnaseq_summary_data.q30_bases_in_rna_read = float(row.q30_bases_in_rna_read)
-        scrnaseq_summary_data.q30_bases_in_sample_index = float(row.q30_bases_in_sample_index)
-        scrnaseq_summary_data.q30_bases_in_umi = float(row.q30_bases_in_umi)
-        scrnaseq_summary_data.reads_mapped_to_genome = float(row.reads_mapped_to_genome)
-        scrnaseq_summary_data.reads_mapped_confidently_to_genome = float(row.reads_mapped_confidently_to_genome)
-        scrnaseq_summary_data.reads_mapped_confidently_to_intergenic_regions = float(
-            row.reads_mapped_confidently_to_intergenic_regions)
-        scrnaseq_summary_data.reads_mapped_confidently_to_intronic_regions = float(
-            row.reads_mapped_confidently_to_intronic_regions)
-        scrnaseq_summary_data.reads_mapped_confidently_to_exonic_regions = float(
-            row.reads_mapped_confidently_to_exonic_regions)
-        scrnaseq_summary_data.reads_mapped_confidently_to_transcriptome = float(
-            row.reads_mapped_confidently_to_transcriptome)
-        scrnaseq_summary_data.reads_mapped_antisense_to_gene = float(row.reads_mapped_antisense_to_gene)
-        scrnaseq_summary_data.fraction_reads_in_cells = float(row.fraction_reads_in_cells)
-        scrnaseq_summary_data.total_genes_detected = float(row.total_genes_detected)
-        scrnaseq_summary_data.median_umi_counts_per_cell = float(row.median_umi_counts_per_cell)
-        scrnaseq_summary_data.ten_x_batch = int(row.ten_x_batch)
-        scrnaseq_summary_data.firstpass_nextseq = int(row.firstpass_nextseq)
-        scrnaseq_summary_data.secondpass_nextseq = int(row.secondpass_nextseq)
-        scrnaseq_summary_data.hiseq_x5 = int(row.hiseq_x5)
-        scrnaseq_summary_data.novaseq_s4 = int(row.novaseq_s4)
-        scrnaseq_summary_data.nextseq2k = int(row.nextseq2k)
-        scrnaseq_summary_data.brc_id = row.brc_id
-        scrnaseq_summary_data.enid = int(row.enid)
-        scrnaseq_summary_data.sample_name = row.sample_name
-        scrnaseq_summary_data.bc = row.bc
-
-        if len(str(row.notes).strip()) > 0 and str(row.notes).strip().lower() != 'nan':
-            scrnaseq_summary_data.notes = str(row.notes).strip()
-
-        # If this a new row, append it to the clinical data (otherwise, the
-        # existing row will be updated upon saving of the clinical data)
-        if newRow:
-            clinical_data.scrnaseq_summary.append(scrnaseq_summary_data)
+    participantRows = {}  # Study ID -> its samples' rows, in sheet order
+    for row in df.itertuples():
+        participantRows.setdefault(int(row.study_id), []).append(row)
 
-        try:
-            clinical_data.save()
-        except (ValueError, ValidationError) as e:
-            message = f'Save of {documentName} data with id={index} resulted in exception: {e}'
-            add_event_log(active_account,
-                          message,
-                          success=False,
-                          event_type='Import',
-                          exception_type=e.__class__.__name__,
-                          file_name=row.data_file_name,
-                          study_id=row.study_id,
-                          document_id=str(clinical_data.id),
-                          sub_document_id=str(index))
-            error_msg(message)
-            continue  # Skip the rest of this loop
+    biospecimens = find_biospecimen_data_by_specimen_ids([scrnaseq_specimen_id(name) for name in df['sample_name']])
 
-        message = f'Added / updated {documentName} data for ENID: {clinical_data.study_id} with id {index}.'
+    def log_sample_error(row, message, e=None, clinical_data=None):
         add_event_log(active_account,
                       message,
-                      success=True,
+                      success=False,
                       event_type='Import',
-                      file_name=data_file_name,
+                      exception_type=None if e is None else e.__class__.__name__,
+                      file_name=row.data_file_name,
                       study_id=row.study_id,
-                      document_id=str(clinical_data.id),
-                      sub_document_id=str(index))
-        success_msg(message)
+                      document_id=None if clinical_data is None else str(clinical_data.id),
+                      sub_document_id=str(row.Index))
+        error_msg(message)
 
-    return  # scrnaseq_summary_data
+    def fetch_participants(study_ids):
+        return {c.study_id: c for c in ClinicalData.objects(study_id__in=list(study_ids))
+                .only('id', 'study_id', 'revision', 'last_modified_date', 'scrnaseq_summary')}
+
+    pending = list(participantRows)
+    participants = fetch_participants(pending)
+    for attempt in range(set_up_globals.clinicalDataSaveRetries + 1):
+        if attempt > 0:
+            time.sleep(random.uniform(0.5, 1.5) * set_up_globals.clinicalDataRetryDelay * 2 ** (attempt - 1))
+            participants = fetch_participants(pending)
+
+        operations = []
+        updated = {}  # Study ID -> merged participant
+        for study_id in pending:
+            clinical_data = participants.get(study_id)
+            if not clinical_data:
+                for row in participantRows[study_id]:
+                    log_sample_error(row, f'You must import {set_up_globals.clinical_document_name} data for study '
+                                          f'ID {study_id} before importing {documentName} data.')
+                errorCount += len(participantRows[study_id])
+                continue
 
+            samples = embedded_index(clinical_data, 'scrnaseq_summary', scrnaseq_summary_key)
+            savedRows = []
+            for row in participantRows[study_id]:
+                # Check the row's values on a new sample before changing an existing one
+                try:
+                    values = scrnaseq_summary_values(row)
+                    values['sampleid'] = int(row.Index)
+                    values['biospecimen_data_reference'] = biospecimens.get(scrnaseq_specimen_id(row.sample_name))
+                    values['last_modified_by'] = active_account
+                    values['last_modified_date'] = datetime.datetime.now()
+                    ScRNAseqSummary(created_by=active_account, created_date=datetime.datetime.now(),
+                                    **values).validate()
+                except (ValueError, TypeError, ValidationError) as e:
+                    if attempt == 0:
+                        log_sample_error(row, f'Save of {documentName} data with id={row.Index} resulted in '
+                                              f'exception: {e}', e, clinical_data)
+                        errorCount += 1
+                    continue
+
+                scrnaseq_summary_data: Optional[ScRNAseqSummary] = samples.get(values['sampleid'])
+                if scrnaseq_summary_data is None:
+                    # If no data exists for this id, set created info
+                    index_append(clinical_data, 'scrnaseq_summary',
+                                 ScRNAseqSummary(created_by=active_account, created_date=datetime.datetime.now(),
+                                                 **values))
+                else:
+                    for field, value in values.items():
+                        scrnaseq_summary_data[field] = value
+                savedRows.append(row)
+
+            participantRows[study_id] = savedRows
+            if not savedRows:
+                continue
 
-# def add_biospecimen_data(active_account: User, index, row) -> Biospecimen:
-def add_biospecimen_data(active_account: User, df, data_file_name):  # -> Biospecimen:
-    documentName = set_up_globals.biospecimen_document_name
+            # Kept to the millisecond (as stored), so a saved participant can be told apart from another import's save
+            now = datetime.datetime.now()
+            clinical_data.last_modified_by = active_account
+            clinical_data.last_modified_date = now.replace(microsecond=now.microsecond // 1000 * 1000)
+            loadedRevision = clinical_data.revision or 0
+            clinical_data.revision = loadedRevision + 1
+            operations.append(UpdateOne({'_id': clinical_data.id, 'revision': loadedRevision or {'$in': [0, None]}},
+                                        {'$set': {'scrnaseq_summary': [s.to_mongo() for s in
+                                                                       clinical_data.scrnaseq_summary],
+                                                  'last_modified_by': active_account.id,
+                                                  'last_modified_date': clinical_data.last_modified_date,
+                                                  'revision': clinical_data.revision}}))
+            updated[study_id] = clinical_data
+
+        matchedCount = 0
+        if operations:
+            matchedCount = ClinicalData._get_collection().bulk_write(operations, ordered=False).matched_count
+
+        # Updates that didn't match were saved by another import in the meantime. Only if some didn't are the saved
+        # participants checked, to find which.
+        conflicts = []
+        if matchedCount < len(updated):
+            saved = {c['study_id']: (c.get('revision'), c.get('last_modified_date')) for c in
+                     ClinicalData.objects(study_id__in=list(updated))
+                     .only('study_id', 'revision', 'last_modified_date').as_pymongo()}
+            conflicts = [s for s, c in updated.items() if saved.get(s) != (c.revision, c.last_modified_date)]
+
+        events = []
+        for study_id, clinical_data in updated.items():
+            if study_id in conflicts:
+                continue
+            for row in participantRows[study_id]:
+                events.append(new_event_log(active_account,
+                                            f'Added / updated {documentName} data for ENID: {study_id} with id '
+                                            f'{row.Index}.',
+                                            success=True,
+                                            event_type='Import',
+                                            file_name=data_file_name,
+                                            study_id=study_id,
+                                            document_id=str(clinical_data.id),
+                                            sub_document_id=str(row.Index)))
+        if events:
+            Event_log.objects.insert(events, load_bulk=False)
+        sampleCount += len(events)
+
+        pending = conflicts
+        if not pending:
+            break
+
+    for study_id in pending:
+        for row in participantRows[study_id]:
+            log_sample_error(row, f'Save of {documentName} data with id={row.Index} resulted in exception: '
+                                  f'{set_up_globals.clinical_document_name} data for study ID {study_id} was changed '
+                                  f'by another import on each of {set_up_globals.clinicalDataSaveRetries + 1} '
+                                  f'attempts.', ConcurrentUpdateError())
+        errorCount += len(participantRows[study_id])
+
+    message = f'Imported {documentName} data from {data_file_name}: {sampleCount} samples added / updated for ' \
+              f'{len(participantRows)} participants, {errorCount} errors.'
+    add_event_log(active_account,
+                  message,
+                  success=errorCount == 0,
+                  event_type='Import',
+                  file_name=data_file_name)
+    success_msg(message)
 
-    for index, row in df.iterrows():
-        currentVersion = 0
-        biospecimen_data = find_biospecimen_data_by_specimen_id(index)
+    return  # scrnaseq_summary_data
 
-        if biospecimen_data:
-            # If data exists, save in version history
-            currentVersion = biospecimen_data.version_number
-            biospecimen_data_version_history = BiospecimenVersionHistory()
 
-            attributeList = utilities.attributes(Biospecimen)
-            # print(attributeList)
-            for attrib in attributeList:
-                # print(attrib)
-                biospecimen_data_version_history[attrib] = biospecimen_data[attrib]
+# Values of a biospecimen tube from a row of the biospecimen sheet (raises ValueError if a value can't be converted).
+# Comments are only included if the row has some, so existing comments aren't cleared.
+def biospecimen_tube_values(row) -> dict:
+    values = {'sample_id': int(row.sample_id),
+              'date_received': datetime.datetime.strptime(str(row.date_received), '%Y-%m-%d %H:%M:%S').date(),
+              'data_file_name': row.data_file_name,
+              'tube_number': int(row.tube_number),
+              'freezer_id': row.freezer_id,
+              'box_number': int(row.box_number),
+              'box_position': int(row.box_position),
+              'analysis_id': row.analysis_id,
+              'is_removed': row.is_removed == 'TRUE'}
+
+    if len(str(row.comments).strip()) > 0 and str(row.comments).strip().lower() != 'nan':
+        values['comments'] = str(row.comments).strip()
+
+    return values
+
+
+# Merge a specimen's rows (one per tube) into its document, creating the document if biospecimen_data is None.
+# Returns the document and a list of (row, exception) for the rows that couldn't be converted (and were left out).
+def merge_biospecimen_rows(active_account: User, biospecimen_data: Optional[Biospecimen], specimen_id, rows):
+    if biospecimen_data is None:
+        biospecimen_data = Biospecimen()
+        biospecimen_data.id = bson.ObjectId()
+        biospecimen_data.created_by = active_account
+        biospecimen_data.created_date = datetime.datetime.now()
+        biospecimen_data.version_number = 0
+
+    rowErrors = []
+    tubes = embedded_index(biospecimen_data, 'biospecimen_tube_info', tube_info_key)
+    for row in rows:
+        try:
+            values = biospecimen_tube_values(row)
+        except (ValueError, TypeError) as e:
+            rowErrors.append((row, e))
+            continue
 
-            biospecimen_data_version_history.save()
+        # Is this a new or existing sample for this biospecimen?
+        biospecimen_tube_info: Optional[BiospecimenTubeInfo] = tubes.get(values['sample_id'])
+        if biospecimen_tube_info is None:
+            index_append(biospecimen_data, 'biospecimen_tube_info', BiospecimenTubeInfo(**values))
         else:
-            # If no data exists for this id, set created info
-            biospecimen_data = Biospecimen()
-            biospecimen_data.created_by = active_account
-            biospecimen_data.created_date = datetime.datetime.now()
-
-        biospecimen_data.specimen_id = index  # row.specimen_id
-        biospecimen_data.last_modified_by = active_account
-        biospecimen_data.last_modified_date = datetime.datetime.now()
-        biospecimen_data.version_number = currentVersion + 1
+            for field, value in values.items():
+                biospecimen_tube_info[field] = value
+
+        # The specimen's fields are taken from its last row
         biospecimen_data.study_id = int(row.study_id)
-        # biospecimen_data.clinical_data_reference = clinical_data
         biospecimen_data.cpet_day = row.cpet_day
         biospecimen_data.pre_post_cpet = row.pre_post_cpet
         biospecimen_data.specimen_type = row.specimen_type
 
-        # Add biospecimen tube info to data as a subdocument
-        # Is this a new or existing sample for this biospecimen?
-        biospecimen_tube_info: Optional[BiospecimenTubeInfo] = None
-        newBiospecimenTubeInfo = True
-        for a in biospecimen_data.biospecimen_tube_info:
-            if a.sample_id == int(row.sample_id):
-                biospecimen_tube_info = a
-                newBiospecimenTubeInfo = False
-                break
+    biospecimen_data.specimen_id = specimen_id
+    biospecimen_data.last_modified_by = active_account
+    # Kept to the millisecond (as stored), so a saved document can be told apart from another import's save
+    now = datetime.datetime.now()
+    biospecimen_data.last_modified_date = now.replace(microsecond=now.microsecond // 1000 * 1000)
+    biospecimen_data.version_number = (biospecimen_data.version_number or 0) + 1
+
+    return biospecimen_data, rowErrors
+
+
+# Rows are grouped by specimen ID (the index of df) and each specimen's tubes are merged into its document in
+# memory, so a specimen is written once however many tubes it has. Specimens are written bulkWriteBatchSize
+# at a time: the existing documents of a batch are fetched with one query, and the documents, their version
+# history records, and the import events are written with bulk operations. A specimen saved by another import
+# since it was fetched (its version number changed) is fetched and merged again, as in update_clinical_data.
+# See add_clinical_data for progress_callback. existingBiospecimens (optional) is the result of
+# find_biospecimen_data_by_specimen_ids for the sheet's specimen IDs, if it has already been looked up.
+def add_biospecimen_data(active_account: User, df, data_file_name, progress_callback=None,
+                         existingBiospecimens=None):  # -> Biospecimen:
+    documentName = set_up_globals.biospecimen_document_name
 
-        if not biospecimen_tube_info:
-            biospecimen_tube_info = BiospecimenTubeInfo()
-
-        biospecimen_tube_info.sample_id = int(row.sample_id)
-        biospecimen_tube_info.date_received = datetime.datetime.strptime(str(row.date_received),
-                                                                         '%Y-%m-%d %H:%M:%S').date()
-        biospecimen_tube_info.data_file_name = row.data_file_name
-        biospecimen_tube_info.tube_number = int(row.tube_number)
-        biospecimen_tube_info.freezer_id = row.freezer_id
-        biospecimen_tube_info.box_number = int(row.box_number)
-        biospecimen_tube_info.box_position = int(row.box_position)
-        biospecimen_tube_info.analysis_id = row.analysis_id
-
-        if row.is_removed == 'TRUE':
-            biospecimen_tube_info.is_removed = True
-        else:
-            biospecimen_tube_info.is_removed = False
-
-        if len(str(row.comments).strip()) > 0 and str(row.comments).strip().lower() != 'nan':
-            biospecimen_tube_info.comments = str(row.comments).strip()
-
-        if newBiospecimenTubeInfo:
-            biospecimen_data.biospecimen_tube_info.append(biospecimen_tube_info)
-
-        # biospecimen_data.sample_id = int(row.sample_id)
-        # biospecimen_data.date_received = datetime.datetime.strptime(str(row.date_received), '%Y-%m-%d %H:%M:%S').date()
-        # biospecimen_data.data_file_name = row.data_file_name
-        # biospecimen_data.tube_number = int(row.tube_number)
-        # biospecimen_data.freezer_id = row.freezer_id
-        # biospecimen_data.box_number = int(row.box_number)
-        # biospecimen_data.box_position = int(row.box_position)
-        # biospecimen_data.analysis_id = row.analysis_id
-
-        # if row.is_removed == 'TRUE':
-        #     biospecimen_data.is_removed = True
-        # else:
-        #     biospecimen_data.is_removed = False
-        #
-        # if len(str(row.comments).strip()) > 0 and str(row.comments).strip().lower() != 'nan':
-        #     biospecimen_data.comments = str(row.comments).strip()
+    totalRows = len(df.index)
+    errorCount = 0
+    rowsDone = 0
+    specimenCount = 0
 
-        try:
-            biospecimen_data.save()
-        except (ValueError, ValidationError) as e:
-            message = f'Save of {documentName} data with id={index} resulted in exception: {e}'
-            add_event_log(active_account,
-                          message,
-                          success=False,
-                          event_type='Import',
-                          exception_type=e.__class__.__name__,
-                          file_name=row.data_file_name,
-                          document_id=str(index))
-            error_msg(message)
-            continue  # Skip the rest of this loop
+    specimenRows = {}  # Specimen ID -> its rows, in sheet order
+    for row in df.itertuples():
+        specimenRows.setdefault(row.Index, []).append(row)
+    specimenIDs = list(specimenRows)
 
-        message = f'Added / updated {documentName} data for Specimen ID: {index} with id {biospecimen_data.id}.'
+    def log_specimen_error(specimen_id, e, row=None):
+        message = f'Save of {documentName} data with id={specimen_id} resulted in exception: {e}'
         add_event_log(active_account,
                       message,
-                      success=True,
+                      success=False,
                       event_type='Import',
-                      file_name=data_file_name,
-                      sample_id=row.sample_id,
-                      document_id=str(index))
-        success_msg(message)
+                      exception_type=e.__class__.__name__,
+                      file_name=data_file_name if row is None else row.data_file_name,
+                      document_id=str(specimen_id))
+        error_msg(message)
+
+    for batchStart in range(0, len(specimenIDs), set_up_globals.bulkWriteBatchSize):
+        if progress_callback is not None:
+            progress_callback(rowsDone, totalRows, errorCount)
+
+        pending = specimenIDs[batchStart:batchStart + set_up_globals.bulkWriteBatchSize]
+        if existingBiospecimens is not None:
+            existing = {specimen_id: existingBiospecimens.get(specimen_id) for specimen_id in pending}
+        else:
+            existing = find_biospecimen_data_by_specimen_ids(pending)
+
+        for attempt in range(set_up_globals.clinicalDataSaveRetries + 1):
+            if attempt > 0:
+                time.sleep(random.uniform(0.5, 1.5) * set_up_globals.clinicalDataRetryDelay * 2 ** (attempt - 1))
+                existing = find_biospecimen_data_by_specimen_ids(pending)
+
+            documents = {}  # Specimen ID -> merged document
+            loadedVersions = {}  # Specimen ID -> version number when fetched (None for new specimens)
+            versionRecords = {}  # Specimen ID -> version history record of the superseded version
+            for specimen_id in pending:
+                biospecimen_data = existing.get(specimen_id)
+                previousVersion = None
+                if biospecimen_data is not None:
+                    # If data exists, save in version history
+                    previousVersion = history_svc.document_snapshot(biospecimen_data)
+                    loadedVersions[specimen_id] = biospecimen_data.version_number
+                else:
+                    loadedVersions[specimen_id] = None
+
+                biospecimen_data, rowErrors = merge_biospecimen_rows(active_account, biospecimen_data, specimen_id,
+                                                                     specimenRows[specimen_id])
+                if attempt == 0:
+                    for row, e in rowErrors:
+                        log_specimen_error(specimen_id, e, row)
+                    errorCount += len(rowErrors)
+                    rowsDone += len(specimenRows[specimen_id])
+                    errorRows = {id(errorRow) for errorRow, e in rowErrors}
+                    specimenRows[specimen_id] = [r for r in specimenRows[specimen_id] if id(r) not in errorRows]
+                if not specimenRows[specimen_id]:
+                    continue
+
+                try:
+                    biospecimen_data.validate()
+                except ValidationError as e:
+                    log_specimen_error(specimen_id, e)
+                    errorCount += len(specimenRows[specimen_id])
+                    specimenRows[specimen_id] = []
+                    continue
+
+                documents[specimen_id] = biospecimen_data
+                if previousVersion is not None:
+                    versionRecords[specimen_id] = history_svc.new_version_delta(active_account, biospecimen_data,
+                                                                                previousVersion, 'Biospecimen')
+
+            # Record the superseded versions in the version history before saving (see update_clinical_data)
+            recordIDs = history_svc.save_version_deltas(list(versionRecords.values()))
+            recordIDs = dict(zip(versionRecords, recordIDs))
+
+            operations = []
+            for specimen_id, biospecimen_data in documents.items():
+                if loadedVersions[specimen_id] is None:
+                    operations.append(InsertOne(biospecimen_data.to_mongo()))
+                else:
+                    operations.append(ReplaceOne({'_id': biospecimen_data.id,
+                                                  'version_number': loadedVersions[specimen_id]},
+                                                 biospecimen_data.to_mongo()))
+
+            failed = {}  # Specimen ID -> write error
+            matchedCount = 0
+            if operations:
+                try:
+                    matchedCount = Biospecimen._get_collection().bulk_write(operations, ordered=False).matched_count
+                except BulkWriteError as e:
+                    matchedCount = e.details.get('nMatched', 0)
+                    specimenOrder = list(documents)
+                    for writeError in e.details.get('writeErrors', []):
+                        failed[specimenOrder[writeError['index']]] = writeError.get('errmsg')
+
+            # Replacements that didn't match were saved by another import in the meantime. Only if some didn't are
+            # the saved documents checked, to find which.
+            replaced = [s for s in documents if loadedVersions[s] is not None and s not in failed]
+            conflicts = []
+            if matchedCount < len(replaced):
+                saved = {b['_id']: (b.get('version_number'), b.get('last_modified_date')) for b in
+                         Biospecimen.objects(id__in=[documents[s].id for s in replaced])
+                         .only('id', 'version_number', 'last_modified_date').as_pymongo()}
+                conflicts = [s for s in replaced if saved.get(documents[s].id) !=
+                             (documents[s].version_number, documents[s].last_modified_date)]
+
+            staleRecords = [recordIDs[s] for s in list(failed) + conflicts if s in recordIDs]
+            if staleRecords:
+                history_svc.delete_version_deltas(staleRecords)
+
+            for specimen_id, errorMessage in failed.items():
+                log_specimen_error(specimen_id, ValueError(errorMessage))
+                errorCount += len(specimenRows[specimen_id])
+
+            events = []
+            for specimen_id, biospecimen_data in documents.items():
+                if specimen_id in failed or specimen_id in conflicts:
+                    continue
+                tubeCount = len(specimenRows[specimen_id])
+                message = f'Added / updated {documentName} data for Specimen ID: {specimen_id} with id ' \
+                          f'{biospecimen_data.id} ({tubeCount} tube{"s" if tubeCount != 1 else ""}).'
+                events.append(new_event_log(active_account,
+                                            message,
+                                            success=True,
+                                            event_type='Import',
+                                            file_name=data_file_name,
+                                            sample_id=specimenRows[specimen_id][-1].sample_id,
+                                            document_id=str(specimen_id)))
+            if events:
+                Event_log.objects.insert(events, load_bulk=False)
+            specimenCount += len(events)
+
+            pending = conflicts
+            if not pending:
+                break
+
+        for specimen_id in pending:
+            log_specimen_error(specimen_id, ConcurrentUpdateError(
+                f'{documentName} data for specimen ID {specimen_id} was changed by another import on each of '
+                f'{set_up_globals.clinicalDataSaveRetries + 1} attempts.'))
+            errorCount += len(specimenRows[specimen_id])
+
+    if progress_callback is not None:
+        progress_callback(totalRows, totalRows, errorCount)
+
+    message = f'Imported {documentName} data from {data_file_name}: {specimenCount} specimens added / updated ' \
+              f'from {totalRows} rows, {errorCount} errors.'
+    add_event_log(active_account,
+                  message,
+                  success=errorCount == 0,
+                  event_type='Import',
+                  file_name=data_file_name)
+    success_msg(message)
 
     # //--- this would be a good place to check / update references in each sub-document in the clinical data
 
@@ -1236,6 +1962,23 @@ def find_data_label_reference(data_label, data_label_type) -> DataLabels:
     return DataLabels.objects(Q(data_label=data_label) & Q(data_label_type=data_label_type)).first()
 
 
+# Return {data label: DataLabels} for the given data labels of a data label type with a single query (labels that
+# aren't found map to None, so they aren't looked up again)
+def find_data_label_references(data_labels, data_label_type) -> dict:
+    references = {data_label: None for data_label in data_labels}
+    for d in DataLabels.objects(Q(data_label__in=[str(d) for d in references]) &
+                                  Q(data_label_type=data_label_type)):
+        if references.get(d.data_label) is None:
+            references[d.data_label] = d
+    return references
+
+
+# Return the set of the given data labels that exist for a data label type (one query)
+def find_existing_data_labels(data_labels, data_label_type) -> set:
+    return set(DataLabels.objects(Q(data_label__in=list(set(data_labels))) &
+                                  Q(data_label_type=data_label_type)).distinct('data_label'))
+
+
 def add_data_label_types(active_account: User, df, data_file_name):
     documentName = set_up_globals.data_label_type_document_name
     data_label_type_list = set_up_globals.data_label_type_list
@@ -1649,6 +2392,25 @@ def add_event_log(active_account: User,
                   document_id=None,
                   sub_document_id=None,
                   comment=None) -> Event_log:
+    event_log_data = new_event_log(active_account, message, event_type, exception_type, success, file_name, study_id,
+                                   sample_id, document_id, sub_document_id, comment)
+    event_log_data.save()
+
+    return event_log_data
+
+
+# Build an event log record without saving it (for writing many at once with Event_log.objects.insert)
+def new_event_log(active_account: User,
+                  message,
+                  event_type='Import',
+                  exception_type=None,
+                  success=False,
+                  file_name=None,
+                  study_id=None,
+                  sample_id=None,
+                  document_id=None,
+                  sub_document_id=None,
+                  comment=None) -> Event_log:
     # If no data exists for this id, set created info
     event_log_data = Event_log()
     event_log_data.created_by = active_account
@@ -1674,8 +2436,6 @@ def add_event_log(active_account: User,
         if len(str(comment).strip()) > 0 and str(comment).strip().lower() != 'nan':
             event_log_data.comment = str(comment).strip()
 
-    event_log_data.save()
-
     return event_log_data
 
 
@@ -0,0 +1,153 @@
+# Import journal, so that an import that dies part way through (e.g. a dropped connection or a container restart)
+# can be resumed without redoing the rows already imported. Each import of a file is identified by the file name
+# and a hash of the whole file (or, for rows that aren't a whole file, of the rows), and the offset of the last
+# committed batch of rows is recorded as the import runs. The offset never passes a row that failed to import, so
+# a resume retries it. Resuming is opt-in (a resumed job, or the text interface when asked): an import that resumes
+# starts from that offset, and skips a file that was imported completely; any other import starts over.
+# Individual rows are also hashed, so a re-import of a mostly unchanged file only writes the rows that changed.
+
+
+import datetime
+import hashlib
+import numpy as np
+import pandas as pd
+
+from data.import_journal import ImportJournal
+from data.users import User
+
+import set_up_globals
+
+
+# Return a SHA-256 hash of the content of a DataFrame (column names, index, and values)
+def dataframe_content_hash(df) -> str:
+    sha = hashlib.sha256()
+    sha.update('\x1f'.join(str(c) for c in df.columns).encode('utf-8'))
+    try:
+        sha.update(pd.util.hash_pandas_object(df, index=True).to_numpy().tobytes())
+    except TypeError:
+        # Unhashable cell values (e.g. lists), so fall back to hashing the text of the rows
+        sha.update(df.to_csv().encode('utf-8'))
+    return sha.hexdigest()
+
+
+# Text of a cell as used for row hashes: missing values are blank and integral floats are written as integers,
+# so a value hashes the same whether its column was read as numbers or as text
+def _normalized_cell_text(val) -> str:
+    if val is None:
+        return ''
+    if isinstance(val, (float, np.floating)):
+        if np.isnan(val):
+            return ''
+        if float(val).is_integer():
+            return str(int(val))
+    return str(val).strip()
+
+
+def _normalized_column_text(series) -> pd.Series:
+    if pd.api.types.is_bool_dtype(series) or pd.api.types.is_integer_dtype(series):
+        return series.astype(str)
+    if pd.api.types.is_float_dtype(series):
+        values = series.to_numpy(dtype=float)
+        text = series.astype(str)
+        finite = np.isfinite(values)
+        integral = finite & (values == np.floor(np.where(finite, values, 0)))
+        text[integral] = values[integral].astype(np.int64).astype(str)
+        text[np.isnan(values)] = ''
+        return text
+    return series.map(_normalized_cell_text)
+
+
+# Return a hash of each row of df (over the given columns, in name order), as a Series aligned with df
+def row_content_hashes(df, columns=None) -> pd.Series:
+    columns = sorted(df.columns if columns is None else columns, key=str)
+    if len(df.index) == 0 or len(columns) == 0:
+        return pd.Series([''] * len(df.index), index=df.index, dtype=object)
+
+    text = [_normalized_column_text(df[c]) for c in columns]
+    joined = text[0].str.cat(text[1:], sep='\x1f') if len(text) > 1 else text[0]
+    header = '\x1f'.join(str(c) for c in columns) + '\x1e'
+    return joined.map(lambda rowText: hashlib.sha1((header + rowText).encode('utf-8')).hexdigest())
+
+
+def find_import_journal(data_file_name, content_hash, document_name) -> ImportJournal:
+    return ImportJournal.objects(data_file_name=data_file_name, content_hash=content_hash,
+                                 document_name=document_name).first()
+
+
+# Return the journal of an import that stopped before it finished (None if there isn't one)
+def find_unfinished_import_journal(data_file_name, content_hash, document_name) -> ImportJournal:
+    return ImportJournal.objects(data_file_name=data_file_name, content_hash=content_hash,
+                                 document_name=document_name, status='In progress', committed_rows__gt=0).first()
+
+
+# Return the journal for an import of df, creating it if this file has not been imported before.
+# content_hash identifies the file (the hash of df by default), and row_offset is the position of df's first row
+# in the file's rows (for a file imported in parts, e.g. chunks). Offsets in the journal count from the start of the
+# file. If resume is False, an import starting at the first row resets the journal so the whole file is imported
+# again; if it's True, rows that failed to import are retried.
+def open_import_journal(active_account: User, data_file_name, document_name, df, resume=False, content_hash=None,
+                        row_offset=0) -> ImportJournal:
+    contentHash = content_hash or dataframe_content_hash(df)
+    journal = find_import_journal(data_file_name, contentHash, document_name)
+
+    if not journal:
+        journal = ImportJournal()
+        journal.created_by = active_account
+        journal.created_date = datetime.datetime.now()
+        journal.data_file_name = data_file_name
+        journal.content_hash = contentHash
+        journal.document_name = document_name
+    elif row_offset == 0:
+        if not resume:
+            journal.status = 'In progress'
+            journal.committed_rows = 0
+            journal.completed_date = None
+        journal.failed_row = None
+
+    journal.last_modified_by = active_account
+    journal.last_modified_date = datetime.datetime.now()
+    journal.total_rows = max(journal.total_rows or 0, row_offset + len(df.index)) if row_offset else len(df.index)
+    journal.batch_size = set_up_globals.importJournalBatchSize
+    if row_offset == 0:
+        journal.run_count = (journal.run_count or 0) + 1
+    journal.save()
+
+    return journal
+
+
+# Record that the rows before committed_rows have been imported (only up to the first row that failed, if any).
+# Returns the committed offset.
+def commit_import_batch(journal: ImportJournal, committed_rows) -> int:
+    if journal.failed_row is not None:
+        committed_rows = min(committed_rows, journal.failed_row)
+    ImportJournal.objects(id=journal.id).update(set__committed_rows=committed_rows,
+                                                set__last_modified_date=datetime.datetime.now())
+    journal.committed_rows = committed_rows
+    return committed_rows
+
+
+# Record a row that failed to import, so the committed offset stays before it
+def record_failed_row(journal: ImportJournal, row):
+    if journal.failed_row is None or row < journal.failed_row:
+        ImportJournal.objects(id=journal.id).update(min__failed_row=row)
+        journal.failed_row = row
+
+
+# Record the end of an import of the rows before committed_rows: the file is complete if no row failed and these
+# were its last rows (completes_file), otherwise the rows are committed. Returns the committed offset.
+def finish_import_journal(journal: ImportJournal, committed_rows, completes_file=True) -> int:
+    if journal.failed_row is None and completes_file:
+        complete_import_journal(journal)
+        return journal.committed_rows
+    return commit_import_batch(journal, committed_rows)
+
+
+def complete_import_journal(journal: ImportJournal):
+    now = datetime.datetime.now()
+    ImportJournal.objects(id=journal.id).update(set__status='Completed',
+                                                set__committed_rows=journal.total_rows,
+                                                set__completed_date=now,
+                                                set__last_modified_date=now)
+    journal.status = 'Completed'
+    journal.committed_rows = journal.total_rows
+    journal.completed_date = now
@@ -0,0 +1,460 @@
+# Import pipeline shared by the text interface, the web UI, and the batch importer. An import runs as a fixed
+# sequence of stages:
+#   read -> normalize -> validate -> resolve (references) -> diff -> write -> log
+# Each stage is a function that takes the ImportContext and updates it (e.g. read sets context.df), and is timed,
+# so the cost of every stage of every import is recorded in its event log entry. The stages of a document type's
+# pipeline can be replaced (e.g. a bulk writer for the row-at-a-time loader) in one place for every frontend.
+# A stage that doesn't apply to a document type is None and is skipped.
+# The validate stage checks the whole sheet against the model schemas (see validation_service.py); rows with errors
+# aren't written, and a dry run stops after it, so a file can be checked without writing anything.
+
+
+from collections import OrderedDict
+from os.path import exists
+from typing import Callable, Dict, Optional
+import os
+import time
+
+import pandas as pd
+from mongoengine import ValidationError
+
+from data.assay_classes import AssayMetaData
+from data.users import User
+import services.data_service as svc
+import services.table_reader as table_reader
+import services.validation_service as validation_svc
+import services.workbook_cache as workbook_cache
+from services.custom_columns import create_custom_columns, id_text, modify_df_column_names
+
+import set_up_globals
+import utilities
+
+stageNames = ('read', 'normalize', 'validate', 'resolve', 'diff', 'write', 'log')
+prepareStageNames = ('read', 'normalize', 'validate')  # Enough to return a DataFrame ready to load
+
+validAssayTypes = [set_up_globals.proteomics_document_name,
+                   set_up_globals.cytokines_document_name,
+                   set_up_globals.metabolomics_document_name,
+                   set_up_globals.mirnaseq_document_name,
+                   set_up_globals.scrnaseq_document_name,
+                   set_up_globals.seahorse_document_name,
+                   set_up_globals.cpet_recovery_document_name,
+                   'BDNF',
+                   'CPET',
+                   'LPS',
+                   'Other']
+
+# Metadata sheet fields of an assay workbook (fields that aren't filled in are None)
+assayMetaDataFields = ['submitter_name', 'submitter_netid', 'pi_name', 'unique_assay_name', 'assay_type',
+                       'assay_method', 'biospecimen_type', 'sample_identifier_type', 'dataset_name',
+                       'dataset_annotation', 'data_label_type', 'comment', 'units', 'normalization_method', 'pipeline',
+                       'title', 'description', 'tags', 'organization', 'current_visibility', 'data_type', 'organism',
+                       'assay', 'measurement', 'study_type', 'sample', 'file_name_location']
+
+# Columns the clinical data loader reads, added (blank) if a sheet doesn't have them
+clinicalDataColumns = ['cu_id', 'cor_id', 'pub_id', 'site', 'sex', 'phenotype',
+                       'ethnicity', 'race', 'mecfs_sudden_gradual', 'qmep_sudevent',
+                       'qmep_mediagnosis', 'qmep_mesymptoms', 'qmep_metimediagnosis',
+                       'cpet_d1', 'cpet_d2', 'vo2change', 'atchange',
+                       'qmep_lived', 'q_medications', 'q_lastantibiotic',
+                       'q_lastantibiotic_details', 'q_supplements', 'pahq_activitylist',
+                       'hh24hr_eaten_d1', 'hh24hr_coffeetea_d1', 'hh24hr_smoke_d1',
+                       'hh24hr_alcohol_d1', 'hh24hr_blood_d1', 'hh24hr_illness_d1',
+                       'hh24hr_respiratory_d1', 'hh24hr_medication_d1',
+                       'hh24hr_peyesterday_d1', 'hh24hr_petoday_d1',
+                       'hh24hr_eaten_d2', 'hh24hr_coffeetea_d2', 'hh24hr_smoke_d2',
+                       'hh24hr_alcohol_d2', 'hh24hr_blood_d2', 'hh24hr_illness_d2',
+                       'hh24hr_respiratory_d2', 'hh24hr_medication_d2',
+                       'hh24hr_peyesterday_d2', 'hh24hr_petoday_d2']
+
+
+# Everything an import knows about the file being imported, built up by the stages as the import runs
+class ImportContext:
+    def __init__(self, active_account: Optional[User], import_type, file_path, document_name=None,
+                 data_file_name=None, meta_data=None, index_column=None, verify_integrity=True, sheet_name=0,
+                 skiprows=None, data_table_path='', start_row=0, progress_callback=None, fast_load=False,
+                 check_references=True, resume=False):
+        self.active_account = active_account
+        self.import_type = import_type  # Pipeline to run ('Clinical', 'Biospecimen', 'Assay', or 'Sheet')
+        self.file_path = file_path
+        self.document_name = document_name or import_type
+        self.data_file_name = data_file_name or os.path.basename(str(file_path))
+        self.meta_data = meta_data or {}
+        self.index_column = index_column
+        self.verify_integrity = verify_integrity
+        self.sheet_name = sheet_name
+        self.skiprows = skiprows  # For assay data tables, None means skip a 'Required:' row if there is one
+        self.data_table_path = data_table_path  # TSV, CSV, or Parquet file to read instead of the data sheet
+        self.start_row = start_row  # Rows already imported (e.g. by a cancelled job), which aren't written again
+        self.first_row = 0  # Position in the file of the first row of df (for a file read in chunks)
+        self.row_offset = 0  # Valid rows in the file before those of df (for a file read in chunks)
+        self.completes_file = True  # Whether the rows of df run to the end of the file
+        self.resume = resume  # Resume from the import journal (see svc.open_journal) rather than starting over
+        self.content_hash = None  # Hash of the file read, which identifies the import in the journal
+        self.progress_callback = progress_callback
+        self.fast_load = fast_load  # Set by the assay normalize stage
+        self.check_references = check_references  # Whether validation looks up study IDs, biospecimens, and labels
+
+        self.df: Optional[pd.DataFrame] = None
+        self.validation: Optional[validation_svc.ValidationReport] = None  # Built by the validate stage
+        self.references = {}  # Reference name -> lookup table built by the resolve stage
+        self.row_hashes = None  # Built by the diff stage
+        self.existing_hashes = None
+        self.unchanged_rows = None
+        self.dropped_rows = 0  # Rows dropped for a blank identifier
+        self.rows_processed = 0
+        self.error_count = 0
+        self.timings = OrderedDict()  # Stage name -> seconds
+
+    # The rows without validation errors
+    def valid_rows(self) -> pd.DataFrame:
+        if self.validation is None or len(self.validation.errors.index) == 0:
+            return self.df
+        return self.df[self.validation.valid_row_mask()]
+
+    # The rows to write (the valid rows after start_row)
+    def rows(self) -> pd.DataFrame:
+        rows = self.valid_rows()
+        return rows.iloc[self.start_row:] if self.start_row else rows
+
+    # Position in the file's valid rows of the first row to write, for the import journal
+    def journal_offset(self) -> int:
+        return self.row_offset + self.start_row
+
+    def report_progress(self, rows_processed, total_rows, error_count):
+        self.rows_processed = rows_processed
+        self.error_count = error_count
+        if self.progress_callback is not None:
+            self.progress_callback(rows_processed, total_rows, error_count)
+
+
+class ImportPipeline:
+    def __init__(self, import_type, stages: Dict[str, Optional[Callable]]):
+        unknownStages = set(stages) - set(stageNames)
+        if unknownStages:
+            raise ValueError(f'Unknown import stages: {", ".join(sorted(unknownStages))}')
+        self.import_type = import_type
+        self.stages = OrderedDict((name, stages.get(name)) for name in stageNames)
+
+    # Replace (or, with None, remove) a stage, returning the stage it replaced
+    def replace_stage(self, stage_name, stage: Optional[Callable]) -> Optional[Callable]:
+        if stage_name not in self.stages:
+            raise ValueError(f'Unknown import stage: {stage_name}')
+        previousStage = self.stages[stage_name]
+        self.stages[stage_name] = stage
+        return previousStage
+
+    # Run the stages in order (only those in stage_names, if given), timing each one
+    def run(self, context: ImportContext, stage_names=None) -> ImportContext:
+        for name, stage in self.stages.items():
+            if stage is None or (stage_names is not None and name not in stage_names):
+                continue
+            startTime = time.perf_counter()
+            try:
+                stage(context)
+            finally:
+                context.timings[name] = context.timings.get(name, 0.0) + time.perf_counter() - startTime
+        return context
+
+
+# Read the sheet (or a TSV, CSV, or Parquet file) as is
+def read_sheet(context: ImportContext):
+    context.content_hash = workbook_cache.file_content_hash(context.file_path)
+    if table_reader.is_data_table_file(context.file_path):
+        context.df = table_reader.read_data_table(context.file_path)
+    else:
+        context.df = workbook_cache.read_sheet(context.file_path, sheet_name=context.sheet_name,
+                                               skiprows=context.skiprows)
+
+
+# Number of rows to skip at the top of an assay Data Table sheet: 1 if it starts with a 'Required:' row, else 0
+def assay_sheet_skiprows(file_path, sheet_name='Data Table') -> int:
+    firstRow = workbook_cache.read_sheet(file_path, sheet_name=sheet_name, header=None, nrows=1)
+    if len(firstRow.index) and str(firstRow.iat[0, 0]).strip().startswith('Required'):
+        return 1
+    return 0
+
+
+# Read an assay data table: the external file if there is one, otherwise the data sheet of the workbook.
+# External files other than TSV, CSV, or Parquet are read as tab-separated text.
+def read_assay_data_table(context: ImportContext):
+    dataTablePath = context.data_table_path or context.file_path
+    if table_reader.is_data_table_file(dataTablePath):
+        context.content_hash = workbook_cache.file_content_hash(dataTablePath)
+        context.df = table_reader.read_data_table(dataTablePath)
+        return
+    if context.data_table_path:
+        context.content_hash = workbook_cache.file_content_hash(context.data_table_path)
+        context.df = pd.read_csv(context.data_table_path, sep='\t', header=0, keep_default_na=False)
+        return
+    if context.skiprows is None:
+        context.skiprows = assay_sheet_skiprows(context.file_path, context.sheet_name)
+    read_sheet(context)
+
+
+# Normalize the column names, drop rows without an identifier, and add the custom columns
+def normalize_sheet(context: ImportContext):
+    df = context.df
+    df.columns = modify_df_column_names(df.columns)
+    if context.index_column is not None:
+        if context.index_column not in df.columns:
+            raise ValueError(f"Required column '{context.index_column}' not found in {context.data_file_name}")
+        blankRows = df[df[context.index_column] == ''].index
+        df.drop(blankRows, inplace=True)
+        context.dropped_rows += len(blankRows)
+
+    if context.import_type == 'Clinical':
+        for column in clinicalDataColumns + list(set_up_globals.binnedColumnsDict):
+            if column not in df.columns:
+                df[column] = ''
+
+    create_custom_columns(df, context.document_name, context.data_file_name)
+
+
+def normalize_assay_data(context: ImportContext):
+    df = context.df
+    identifierColumn = context.index_column or 'ENID'
+    if identifierColumn not in df.columns:
+        raise ValueError(f"Required column '{identifierColumn}' not found in {context.data_file_name}")
+
+    # Remove rows without a participant identifier, and unnamed columns
+    blankRows = df[df[identifierColumn] == ''].index
+    df.drop(blankRows, inplace=True)
+    context.dropped_rows += len(blankRows)
+    unnamedColList = [colName for colName in df.columns if str(colName).startswith('Unnamed')]
+    df.drop(labels=unnamedColList, axis='columns', inplace=True)
+
+    # Only rename the columns that are assay attributes (data labels such as gene symbols are kept as they are)
+    df.columns = modify_df_column_names(df.columns, utilities.attributes(AssayMetaData))
+
+    create_custom_columns(df, context.document_name, context.data_file_name,
+                          context.meta_data['sample_identifier_type'] or 'ENID+Timepoint')
+
+    # Fast load: skips the reference to the biospecimen (existing rows and results are still found and updated)
+    context.fast_load = context.document_name == set_up_globals.scrnaseq_document_name
+
+
+# Index the rows by their identifier (checking that it's unique, unless verify_integrity is off)
+def validate_index(context: ImportContext):
+    if context.index_column is not None:
+        context.df.set_index(context.index_column, drop=False, inplace=True,
+                             verify_integrity=context.verify_integrity)
+
+
+# Check every row against the model schema of the import type, building context.validation
+def check_rows(context: ImportContext):
+    context.validation = validation_svc.validate_dataframe(context.import_type, context.df, context.document_name,
+                                                           context.data_file_name, context.meta_data,
+                                                           context.fast_load, context.check_references)
+
+
+def validate_sheet(context: ImportContext):
+    validate_index(context)
+    check_rows(context)
+
+
+def validate_assay_data(context: ImportContext):
+    if context.document_name not in validAssayTypes:
+        raise ValueError(f'{context.document_name} is not a valid assay type')
+    try:
+        context.df.set_index('unique_id', drop=False, inplace=True, verify_integrity=True)
+    except (ValueError, ValidationError) as e:
+        raise ValueError(f'Create of index for {context.document_name} data resulted in exception: {e}')
+    check_rows(context)
+
+
+# Look up the biospecimens of every participant in the sheet with one query
+def resolve_clinical_references(context: ImportContext):
+    context.references['biospecimens'] = svc.find_biospecimen_data_by_study_ids(context.rows()['study_id'])
+
+
+# Look up the biospecimen of every assay row with one query (fast loads don't reference biospecimens)
+def resolve_assay_references(context: ImportContext):
+    if context.fast_load:
+        return
+    rows = context.rows()
+    specimenIDs = id_text(rows['study_id']) + '-' + rows['timepoint'].astype(str) + '-' + \
+        str(context.meta_data['biospecimen_type'])
+    context.references['biospecimens'] = svc.find_biospecimen_data_by_specimen_ids(specimenIDs)
+
+
+# Look up the existing biospecimens of every specimen in the sheet with one query
+def resolve_biospecimen_references(context: ImportContext):
+    context.references['biospecimens'] = svc.find_biospecimen_data_by_specimen_ids(context.rows().index)
+
+
+# Hash each row and look up the stored hashes, so participants that haven't changed aren't written
+def diff_clinical_data(context: ImportContext):
+    rows = context.rows()
+    context.row_hashes = svc.clinical_row_hashes(rows)
+    context.existing_hashes = svc.find_clinical_data_content_hashes(rows['study_id'])
+    storedHashes = pd.to_numeric(rows['study_id'], errors='coerce').map(context.existing_hashes)
+    context.unchanged_rows = int((storedHashes.to_numpy() == context.row_hashes.to_numpy()).sum())
+
+
+def write_clinical_data(context: ImportContext):
+    svc.add_clinical_data(context.active_account, context.rows(), context.data_file_name,
+                          progress_callback=context.report_progress,
+                          resume=context.resume,
+                          rowHashes=context.row_hashes,
+                          existingHashes=context.existing_hashes,
+                          biospecimenReferences=context.references.get('biospecimens'),
+                          contentHash=context.content_hash,
+                          rowOffset=context.journal_offset(),
+                          completesFile=context.completes_file)
+
+
+def write_biospecimen_data(context: ImportContext):
+    svc.add_biospecimen_data(context.active_account, context.rows(), context.data_file_name,
+                             progress_callback=context.report_progress,
+                             existingBiospecimens=context.references.get('biospecimens'))
+
+
+def write_assay_data(context: ImportContext):
+    svc.add_assay_meta_data(context.active_account, context.rows(), context.data_file_name, context.meta_data,
+                            context.document_name, fastLoad=context.fast_load,
+                            progress_callback=context.report_progress,
+                            resume=context.resume,
+                            biospecimenReferences=context.references.get('biospecimens'),
+                            contentHash=context.content_hash,
+                            rowOffset=context.journal_offset(),
+                            completesFile=context.completes_file)
+
+
+# Text of the stage timings, e.g. 'read 1.20 s, normalize 0.05 s, ...'
+def timing_summary(timings) -> str:
+    return ', '.join(f'{name} {seconds:.2f} s' for name, seconds in timings.items())
+
+
+# Record the import, with the time taken by each stage, in the event log
+def log_import(context: ImportContext):
+    rowCount = len(context.rows().index) if context.df is not None else context.rows_processed
+    message = f'Import pipeline for {context.document_name} data in {context.data_file_name}: {rowCount} rows'
+    if context.dropped_rows:
+        message += f' ({context.dropped_rows} without an identifier dropped)'
+    if context.unchanged_rows is not None:
+        message += f', {context.unchanged_rows} unchanged'
+    message += f', {context.error_count} errors.'
+    validationErrors = 0
+    if context.validation is not None:
+        validationErrors = len(context.validation.errors.index)
+        message += f' Validation: {context.validation.summary()}.'
+    message += f' Stage times: {timing_summary(context.timings)}.'
+    svc.add_event_log(context.active_account,
+                      message,
+                      success=context.error_count == 0 and validationErrors == 0,
+                      event_type='Import',
+                      file_name=context.data_file_name)
+    print(message)
+
+
+_pipelines: Dict[str, ImportPipeline] = {
+    'Sheet': ImportPipeline('Sheet', {'read': read_sheet,
+                                      'normalize': normalize_sheet,
+                                      'validate': validate_index}),
+    'Clinical': ImportPipeline('Clinical', {'read': read_sheet,
+                                            'normalize': normalize_sheet,
+                                            'validate': validate_sheet,
+                                            'resolve': resolve_clinical_references,
+                                            'diff': diff_clinical_data,
+                                            'write': write_clinical_data,
+                                            'log': log_import}),
+    'Biospecimen': ImportPipeline('Biospecimen', {'read': read_sheet,
+                                                  'normalize': normalize_sheet,
+                                                  'validate': validate_sheet,
+                                                  'resolve': resolve_biospecimen_references,
+                                                  'write': write_biospecimen_data,
+                                                  'log': log_import}),
+    'Assay': ImportPipeline('Assay', {'read': read_assay_data_table,
+                                      'normalize': normalize_assay_data,
+                                      'validate': validate_assay_data,
+                                      'resolve': resolve_assay_references,
+                                      'write': write_assay_data,
+                                      'log': log_import}),
+}
+
+# Identifier column and whether it must be unique, by import type
+_indexColumns = {'Clinical': ('study_id', True),
+                 'Biospecimen': ('specimen_id', False)}
+
+
+def get_pipeline(import_type) -> ImportPipeline:
+    if import_type not in _pipelines:
+        raise ValueError(f'There is no import pipeline for {import_type} data')
+    return _pipelines[import_type]
+
+
+# Register (or replace) the pipeline for a type of import
+def register_pipeline(pipeline: ImportPipeline):
+    _pipelines[pipeline.import_type] = pipeline
+
+
+def new_context(active_account, import_type, file_path, **kwargs) -> ImportContext:
+    if import_type in _indexColumns:
+        indexColumn, verifyIntegrity = _indexColumns[import_type]
+        kwargs.setdefault('index_column', indexColumn)
+        kwargs.setdefault('verify_integrity', verifyIntegrity)
+    if import_type == 'Clinical':
+        kwargs.setdefault('document_name', set_up_globals.clinical_document_name)
+    elif import_type == 'Biospecimen':
+        kwargs.setdefault('document_name', set_up_globals.biospecimen_document_name)
+    elif import_type == 'Assay':
+        # Every metadata field is stored with the assay, so fields missing from the dictionary are None
+        metaData = {field: None for field in assayMetaDataFields}
+        metaData.update(kwargs.get('meta_data') or {})
+        kwargs['meta_data'] = metaData
+        kwargs.setdefault('document_name', metaData['assay_type'])
+        kwargs.setdefault('sheet_name', 'Data Table')  # The first sheet of an assay workbook is the Metadata
+    return ImportContext(active_account, import_type, file_path, **kwargs)
+
+
+# Read a file and return the context with context.df ready to load (read, normalize, and validate stages only)
+def prepare_file(import_type, file_path, **kwargs) -> ImportContext:
+    context = new_context(None, import_type, file_path, **kwargs)
+    return get_pipeline(import_type).run(context, prepareStageNames)
+
+
+# Import a file through every stage of its pipeline, returning the context (with the stage timings)
+def run_import(active_account: User, import_type, file_path, **kwargs) -> ImportContext:
+    context = new_context(active_account, import_type, file_path, **kwargs)
+    return get_pipeline(import_type).run(context)
+
+
+# Read and validate a file without writing anything, returning the context (context.validation has the issues).
+# With check_references=False, the database isn't read either.
+def dry_run(import_type, file_path, **kwargs) -> ImportContext:
+    return prepare_file(import_type, file_path, **kwargs)
+
+
+# Run the stages after validate (resolve, diff, write, and log) for a prepared context, e.g. one returned by
+# prepare_file once the user has confirmed the import
+def complete_import(active_account: User, context: ImportContext) -> ImportContext:
+    context.active_account = active_account
+    return get_pipeline(context.import_type).run(context, stageNames[len(prepareStageNames):])
+
+
+# Read the Metadata sheet of an assay workbook, returning (metaDataDict, documentName, externalFileName).
+# Raises ValueError if the assay type is not valid or (if check_external_file is set) the external data file named
+# in the metadata is missing. The external file is looked up in the same folder as the workbook.
+def read_assay_metadata(file_path, check_external_file=True):
+    metaDataDict = {field: None for field in assayMetaDataFields}
+    metaDataDF = workbook_cache.read_sheet(file_path, sheet_name='Metadata', skiprows=range(0, 3))
+    for i, row in metaDataDF.iterrows():
+        metaDataType = modify_df_column_names([str(row.iloc[0]).lower()])[0]
+        response = str(row.iloc[1])
+        if metaDataType in metaDataDict and len(response.strip()) > 0 and response.strip().lower() != 'nan':
+            metaDataDict[metaDataType] = response.strip()
+
+    documentName = metaDataDict['assay_type']
+    if documentName not in validAssayTypes:
+        raise ValueError(f'{documentName} is not a valid assay type')
+
+    externalFileName = ''
+    if metaDataDict['file_name_location'] is not None:
+        externalFileName = os.path.join(os.path.dirname(file_path), metaDataDict['file_name_location'])
+        if not exists(externalFileName):
+            if check_external_file:
+                raise ValueError(f'{externalFileName} does not exist')
+            externalFileName = ''
+
+    return metaDataDict, documentName, externalFileName
@@ -0,0 +1,339 @@
+# Background import jobs. Imports are queued as ImportJob documents and run on a pool of worker threads, so the
+# Gradio request handlers can return immediately and stream progress (rows processed, rows/sec, ETA, and error
+# counts) by polling the job document. Jobs can be cancelled, and cancelled, failed, or interrupted jobs can be
+# resumed: the import journal records the rows already imported, and a resumed job carries on from there.
+
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional
+import datetime
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import traceback
+import uuid
+
+from data.import_jobs import ImportJob
+from data.users import User
+import services.data_service as svc
+import set_up_globals
+
+# Number of imports run at once, and where jobs keep their copy of the uploaded file
+importWorkers = int(os.environ.get('MECFS_IMPORT_WORKERS', '2'))
+jobDirectory = os.environ.get('MECFS_JOB_DIR', os.path.join(tempfile.gettempdir(), 'mecfs_import_jobs'))
+
+# Minimum number of seconds between progress updates written to the job document
+progressInterval = 1.0
+
+activeStatuses = ('Queued', 'Running')
+resumableStatuses = ('Cancelled', 'Failed', 'Interrupted')
+
+# Seconds between heartbeats of the jobs owned by this process, and after which a job without one is stale
+heartbeatInterval = 30.0
+staleJobSeconds = int(os.environ.get('MECFS_STALE_JOB_SECONDS', '120'))
+
+# Identifies the jobs of this process (the pid alone may be reused after a restart)
+instanceId = uuid.uuid4().hex
+hostName = socket.gethostname()
+
+_executor: Optional[ThreadPoolExecutor] = None
+_heartbeatThread: Optional[threading.Thread] = None
+_executorLock = threading.Lock()
+_jobRunners: Dict[str, Callable] = {}  # Job type -> function(job, resume, progress_callback) -> ValidationReport
+_cancelRequests = set()  # IDs of jobs to cancel (checked on every progress callback)
+
+
+class JobCancelled(Exception):
+    pass
+
+
+# Register the function that runs a type of job. The function is called as runner(job, resume, progress_callback),
+# and must pass resume and progress_callback on to the data service loader. resume is set when the job has run
+# before, so the loader carries on from its import journal rather than importing the file from the start.
+# The runner returns the validation report of the file (or None): its errors are counted in the job's error count,
+# and a report that blocks the import (so nothing was written) fails the job.
+def register_job_type(job_type, runner: Callable):
+    _jobRunners[job_type] = runner
+
+
+def get_executor() -> ThreadPoolExecutor:
+    global _executor, _heartbeatThread
+    with _executorLock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=importWorkers, thread_name_prefix='mecfs-import')
+            _heartbeatThread = threading.Thread(target=_send_heartbeats, name='mecfs-import-heartbeat', daemon=True)
+            _heartbeatThread.start()
+    return _executor
+
+
+# Mark a job as owned by this process
+def _claim_job(job: ImportJob):
+    job.owner_host = hostName
+    job.owner_pid = os.getpid()
+    job.owner_instance = instanceId
+    job.heartbeat_date = datetime.datetime.now()
+
+
+# Update the heartbeat of this process's queued and running jobs, so other processes can tell they are still alive
+def _send_heartbeats():
+    while True:
+        try:
+            ImportJob.objects(owner_instance=instanceId, status__in=activeStatuses).update(
+                set__heartbeat_date=datetime.datetime.now())
+        except Exception as e:
+            print(f'Unable to update the heartbeat of import jobs: {e}')
+        time.sleep(heartbeatInterval)
+
+
+def find_job(job_id) -> Optional[ImportJob]:
+    try:
+        return ImportJob.objects(id=job_id).first()
+    except Exception:
+        return None  # Not a valid job ID
+
+
+def find_recent_jobs(limit=20) -> List[ImportJob]:
+    return list(ImportJob.objects().order_by('-created_date').limit(limit))
+
+
+# Queue an import of a file. The file is copied, so the job can be resumed after the upload is cleaned up.
+# file_name is the name recorded as data_file_name (the name of file_path by default).
+def submit_job(active_account: User, job_type, file_path, meta_data=None, file_name=None) -> ImportJob:
+    if job_type not in _jobRunners:
+        raise ValueError(f'No runner registered for import jobs of type {job_type}')
+
+    if file_name is None:
+        file_name = os.path.basename(file_path)
+    os.makedirs(jobDirectory, exist_ok=True)
+    jobFilePath = os.path.join(jobDirectory, f'{uuid.uuid4().hex}-{os.path.basename(file_path)}')
+    shutil.copyfile(file_path, jobFilePath)
+
+    job = ImportJob()
+    job.created_by = active_account
+    job.created_date = datetime.datetime.now()
+    job.job_type = job_type
+    job.status = 'Queued'
+    job.file_name = file_name
+    job.file_path = jobFilePath
+    job.meta_data = meta_data or {}
+    _claim_job(job)
+    job.save()
+
+    get_executor().submit(_run_job, str(job.id))
+
+    return job
+
+
+# Resume a cancelled, failed, or interrupted job from the rows committed in its import journal
+def resume_job(job_id) -> Optional[ImportJob]:
+    job = find_job(job_id)
+    if not job:
+        svc.error_msg(f'Import job {job_id} does not exist.')
+        return None
+    if job.status not in resumableStatuses:
+        svc.error_msg(f'Import job {job_id} is {job.status.lower()} and cannot be resumed.')
+        return None
+    if not os.path.exists(job.file_path):
+        svc.error_msg(f'The file for import job {job_id} ({job.file_name}) is no longer available.')
+        return None
+
+    _cancelRequests.discard(str(job.id))
+    job.status = 'Queued'
+    job.cancel_requested = False
+    job.finished_date = None
+    job.message = None
+    job.last_modified_date = datetime.datetime.now()
+    _claim_job(job)
+    job.save()
+
+    get_executor().submit(_run_job, str(job.id))
+
+    return job
+
+
+# Request cancellation of a queued or running job (it stops at the next row)
+def cancel_job(job_id) -> bool:
+    job = find_job(job_id)
+    if not job or job.status not in activeStatuses:
+        return False
+    _cancelRequests.add(str(job.id))
+    ImportJob.objects(id=job.id).update(set__cancel_requested=True,
+                                        set__last_modified_date=datetime.datetime.now())
+    return True
+
+
+# Return whether a process on this host is still running (always True where that can't be checked)
+def _process_is_running(pid) -> bool:
+    if os.name != 'posix':
+        return True  # os.kill would terminate the process on Windows
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        return True  # e.g. it belongs to another user
+    return True
+
+
+# Called at start up: jobs left queued or running by a process that has stopped will never finish, so mark them
+# resumable. Only stale jobs are marked: those of a process on this host that is no longer running, those whose
+# heartbeat is older than staleJobSeconds (e.g. the other host went down), and those recorded without an owner.
+# Jobs still being run by another server process are left alone.
+def mark_interrupted_jobs() -> int:
+    staleDate = datetime.datetime.now() - datetime.timedelta(seconds=staleJobSeconds)
+    interruptedIds = []
+    for job in ImportJob.objects(status__in=activeStatuses, owner_instance__ne=instanceId).only(
+            'owner_host', 'owner_pid', 'heartbeat_date'):
+        if job.owner_pid is None or job.heartbeat_date is None or job.heartbeat_date < staleDate:
+            interruptedIds.append(job.id)
+        elif job.owner_host == hostName and job.owner_pid != os.getpid() and not _process_is_running(job.owner_pid):
+            interruptedIds.append(job.id)
+    if not interruptedIds:
+        return 0
+
+    return ImportJob.objects(id__in=interruptedIds, status__in=activeStatuses).update(
+        set__status='Interrupted',
+        set__message='The server stopped before this import finished.',
+        set__last_modified_date=datetime.datetime.now())
+
+
+# Progress callback handed to the data service loaders. The loaders count rows from the start of the file, including
+# those skipped on resume; the first count is recorded as the row the job resumed from. Writes to the job document
+# are throttled to one per progressInterval, except at the loader's import journal batch boundaries (so the job
+# records each batch as it is committed) and the final count. Cancellation is checked on every call.
+class ProgressReporter:
+    def __init__(self, job_id, start_row=0, start_error_count=0):
+        self.job_id = job_id
+        self.start_row = start_row
+        self.start_error_count = start_error_count
+        self.rows_processed = start_row
+        self.total_rows = start_row
+        self.error_count = start_error_count
+        self.last_write = 0.0
+        self.started = False
+
+    def __call__(self, rows_processed, total_rows, error_count):
+        if not self.started:
+            self.started = True
+            ImportJob.objects(id=self.job_id).update(set__resumed_from_row=self.start_row + rows_processed)
+        self.rows_processed = self.start_row + rows_processed
+        self.total_rows = self.start_row + total_rows
+        self.error_count = self.start_error_count + error_count
+
+        cancelled = self.job_id in _cancelRequests
+        batchBoundary = rows_processed > 0 and rows_processed % set_up_globals.importJournalBatchSize == 0
+        if cancelled or batchBoundary or rows_processed >= total_rows or \
+                time.monotonic() - self.last_write >= progressInterval:
+            self.flush()
+            if not cancelled:
+                # Also pick up cancellations requested by another process
+                cancelled = bool(ImportJob.objects(id=self.job_id, cancel_requested=True).count())
+
+        if cancelled:
+            raise JobCancelled()
+
+    def flush(self):
+        ImportJob.objects(id=self.job_id).update(set__rows_processed=self.rows_processed,
+                                                 set__total_rows=self.total_rows,
+                                                 set__error_count=self.error_count,
+                                                 set__last_modified_date=datetime.datetime.now())
+        self.last_write = time.monotonic()
+
+
+def _finish_job(job_id, status, message):
+    ImportJob.objects(id=job_id).update(set__status=status,
+                                        set__message=message,
+                                        set__finished_date=datetime.datetime.now(),
+                                        set__last_modified_date=datetime.datetime.now())
+
+
+def _run_job(job_id):
+    job = find_job(job_id)
+    if not job:
+        return
+
+    if job.cancel_requested or job_id in _cancelRequests:
+        _cancelRequests.discard(job_id)
+        _finish_job(job_id, 'Cancelled', 'Cancelled before the import started.')
+        return
+
+    resume = job.started_date is not None  # Started before, so resume from the journal
+    job.status = 'Running'
+    job.started_date = datetime.datetime.now()
+    job.resumed_from_row = 0
+    job.last_modified_date = datetime.datetime.now()
+    job.save()
+
+    reporter = ProgressReporter(job_id)
+    try:
+        validation = _jobRunners[job.job_type](job, resume, reporter)
+        if validation is not None:
+            reporter.error_count += len(validation.errors.index)
+        reporter.flush()
+        if validation is not None and validation.blocks_import:
+            status = 'Failed'
+            message = f'Nothing imported from {job.file_name}: {validation.summary()}.'
+        else:
+            status = 'Completed'
+            message = f'Imported {reporter.total_rows} rows from {job.file_name} with {reporter.error_count} errors.'
+    except JobCancelled:
+        status = 'Cancelled'
+        message = f'Cancelled after {reporter.rows_processed} of {reporter.total_rows} rows.'
+    except Exception as e:
+        status = 'Failed'
+        message = f'{e.__class__.__name__}: {e}'
+        traceback.print_exc()
+        svc.add_event_log(job.created_by,
+                          f'Import job {job_id} failed: {message}',
+                          success=False,
+                          event_type='Import',
+                          exception_type=e.__class__.__name__,
+                          file_name=job.file_name)
+    finally:
+        _cancelRequests.discard(job_id)
+
+    _finish_job(job_id, status, message)
+
+    if status == 'Completed':
+        try:
+            os.remove(job.file_path)
+        except OSError:
+            pass
+
+
+# Return the progress of a job, with the rate and ETA based on the rows processed since it was (re)started
+def job_progress(job: ImportJob) -> dict:
+    rowsPerSecond = 0.0
+    etaSeconds = None
+    if job.started_date:
+        elapsed = ((job.finished_date or datetime.datetime.now()) - job.started_date).total_seconds()
+        processedThisRun = (job.rows_processed or 0) - (job.resumed_from_row or 0)
+        if elapsed > 0 and processedThisRun > 0:
+            rowsPerSecond = processedThisRun / elapsed
+            etaSeconds = max(0, (job.total_rows or 0) - (job.rows_processed or 0)) / rowsPerSecond
+
+    return {'job_id': str(job.id),
+            'job_type': job.job_type,
+            'file_name': job.file_name,
+            'status': job.status,
+            'rows_processed': job.rows_processed or 0,
+            'total_rows': job.total_rows or 0,
+            'rows_per_second': rowsPerSecond,
+            'eta_seconds': etaSeconds,
+            'error_count': job.error_count or 0,
+            'message': job.message or ''}
+
+
+# Yield the progress of a job every poll_interval seconds until it is no longer queued or running
+def watch_job(job_id, poll_interval=1.0):
+    while True:
+        job = find_job(job_id)
+        if not job:
+            return
+        yield job_progress(job)
+        if job.status not in activeStatuses:
+            return
+        time.sleep(poll_interval)
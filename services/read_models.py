@@ -0,0 +1,142 @@
+# Lightweight read models for bulk read-only queries (exports, listings, pathway mapping).
+# mongoengine builds a full Document for every record it reads: each field is validated and converted, lists and
+# dicts are wrapped in BaseList/BaseDict, and every embedded document (e.g. one AssayResults per measured value) is
+# a Document of its own. A DocumentView instead wraps the raw dictionary read with as_pymongo() and only converts
+# the fields that are actually read. It answers the same attribute and item lookups as the Document (c.study_id,
+# c['assay_meta_data'], iterating over the field names, missing fields read as their defaults), so it can be
+# passed to code written for Documents, such as utilities.create_df_from_object_list. Views are read-only and
+# can't be saved. References are ReferenceViews, which compare equal to the referenced Document and are only
+# fetched from the database if one of their fields is read.
+
+
+from typing import Dict, List, Tuple
+from bson import DBRef
+import mongoengine
+
+_missing = object()
+
+_fieldMaps = {}  # Document class -> {attribute name: (database field name, field)}
+
+
+def _field_map(documentClass) -> Dict[str, Tuple[str, mongoengine.fields.BaseField]]:
+    fieldMap = _fieldMaps.get(documentClass)
+    if fieldMap is None:
+        fieldMap = {name: (field.db_field, field) for name, field in documentClass._fields.items()}
+        _fieldMaps[documentClass] = fieldMap
+    return fieldMap
+
+
+def _default(field):
+    return field.default() if callable(field.default) else field.default
+
+
+# Convert a stored value of a field to what a view returns for it
+def _view_value(field, value):
+    if value is None:
+        return None
+    if isinstance(field, mongoengine.EmbeddedDocumentField):
+        return DocumentView(value, field.document_type)
+    if isinstance(field, mongoengine.ReferenceField):
+        return ReferenceView(field.document_type, value.id if isinstance(value, DBRef) else value)
+    if isinstance(field, mongoengine.ListField):
+        if field.field is None:
+            return list(value)
+        return [_view_value(field.field, v) for v in value]
+    if isinstance(value, dict):
+        return dict(value)
+    return value
+
+
+class DocumentView:
+    """
+    Read-only view of a document read with as_pymongo(), with the attribute and item lookups of the document class.
+    """
+
+    __slots__ = ('_document', '_documentClass', '_values')
+
+    def __init__(self, document: dict, documentClass):
+        self._document = document
+        self._documentClass = documentClass
+        self._values = {}
+
+    def __getitem__(self, name):
+        if name in self._values:
+            return self._values[name]
+        if name == 'pk':
+            name = 'id'
+        fieldMap = _field_map(self._documentClass)
+        if name not in fieldMap:
+            raise KeyError(name)
+
+        dbField, field = fieldMap[name]
+        value = self._document.get(dbField, _missing)
+        value = _default(field) if value is _missing else _view_value(field, value)
+        self._values[name] = value
+        return value
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(f"'{self._documentClass.__name__}' view has no attribute '{name}'") from None
+
+    def __contains__(self, name) -> bool:
+        return name in _field_map(self._documentClass)
+
+    def __iter__(self):
+        return iter(self._documentClass._fields_ordered)
+
+    def get(self, name, default=None):
+        try:
+            return self[name]
+        except KeyError:
+            return default
+
+    def to_mongo(self) -> dict:
+        return self._document
+
+    def __repr__(self) -> str:
+        return f'<{self._documentClass.__name__} view: {self._document.get("_id")}>'
+
+
+class ReferenceView(DBRef):
+    """
+    Reference read by a DocumentView. It compares equal to the referenced Document (and to other references to it),
+    and the document is only fetched (as a DocumentView) when one of its fields is read.
+    """
+
+    __slots__ = ('_documentClass', '_view')
+
+    def __init__(self, documentClass, id):
+        super().__init__(documentClass._get_collection_name(), id)
+        self._documentClass = documentClass
+        self._view = _missing
+
+    @property
+    def pk(self):
+        return self.id
+
+    def fetch(self):
+        if self._view is _missing:
+            document = self._documentClass.objects(pk=self.id).as_pymongo().first()
+            self._view = None if document is None else DocumentView(document, self._documentClass)
+        return self._view
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        view = self.fetch()
+        if view is None:
+            raise AttributeError(f'{self.collection} {self.id} no longer exists')
+        return getattr(view, name)
+
+    def __repr__(self) -> str:
+        return f'<{self._documentClass.__name__} reference: {self.id}>'
+
+
+# Read the documents of a query set as views
+def views(queryset) -> List[DocumentView]:
+    documentClass = queryset._document
+    return [DocumentView(document, documentClass) for document in queryset.as_pymongo()]
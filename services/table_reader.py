@@ -0,0 +1,128 @@
+# Columnar reader for assay data tables kept outside the workbook (TSV, CSV, or Parquet files named by
+# file_name_location in the Metadata sheet). The identifier and annotation columns are typed as pd.read_csv infers
+# them with keep_default_na=False (blank cells are ''), and the data label columns are read as float64, with the
+# placeholders the loader skips (NA, ND, pending, ...) read as NaN. Tables can be read whole or in chunks of rows.
+# Delimited files are parsed by pandas' C parser with the label column types given up front, so the bulk of the
+# table is never inferred or held as Python objects. Parquet files need pyarrow.
+
+
+from typing import Iterator
+import os
+import numpy as np
+import pandas as pd
+
+try:
+    import pyarrow.parquet as pq
+except ImportError:
+    pq = None
+
+delimitedExtensions = {'.tsv': '\t', '.tab': '\t', '.txt': '\t', '.csv': ','}
+parquetExtensions = ('.parquet', '.pq')
+
+# Data labels start at column 6 of a data table (as in add_common_data); the columns before it are not results
+labelColumnStart = 6
+
+# Values the loader treats as missing results
+missingValues = ['', 'nan', 'NaN', 'NA', 'na', 'ND', 'nd', 'pending', 'Pending', 'PENDING']
+
+defaultChunkRows = int(os.environ.get('MECFS_STREAM_CHUNK_ROWS', '5000'))
+
+
+def is_data_table_file(file_path) -> bool:
+    extension = os.path.splitext(str(file_path))[1].lower()
+    return extension in delimitedExtensions or extension in parquetExtensions
+
+
+def _extension(file_path) -> str:
+    extension = os.path.splitext(str(file_path))[1].lower()
+    if not is_data_table_file(file_path):
+        raise ValueError(f'{os.path.basename(file_path)} is not a TSV, CSV, or Parquet data table')
+    if extension in parquetExtensions and pq is None:
+        raise ValueError(f'Reading Parquet data tables ({os.path.basename(file_path)}) requires pyarrow')
+    return extension
+
+
+# Convert the label columns of a frame read as text to float64 where every value is a number or a missing value.
+# Columns with other text are left as they are, so the loader reports them as it would for a workbook.
+def _infer_label_columns(df) -> pd.DataFrame:
+    for column in df.columns[labelColumnStart:]:
+        values = df[column]
+        if pd.api.types.is_float_dtype(values):
+            continue
+        missing = values.isna() | values.astype(str).str.strip().isin(missingValues)
+        numbers = pd.to_numeric(values.where(~missing, np.nan), errors='coerce')
+        if not (numbers.isna() & ~missing).any():
+            df[column] = numbers.astype('float64')
+    return df
+
+
+# Blank the missing cells of the identifier and annotation columns (Parquet nulls), as keep_default_na=False would
+def _blank_identifiers(df) -> pd.DataFrame:
+    for column in df.columns[:labelColumnStart]:
+        if df[column].isna().any():
+            df[column] = df[column].astype(object).where(df[column].notna(), '')
+    return df
+
+
+# Read a delimited file, or a reader of chunks of it when chunk_rows is given
+def _read_delimited(file_path, sep, chunk_rows=None):
+    labelColumns = list(pd.read_csv(file_path, sep=sep, nrows=0).columns[labelColumnStart:])
+    options = {'sep': sep, 'header': 0, 'engine': 'c', 'keep_default_na': False, 'memory_map': True,
+               'na_values': {column: missingValues for column in labelColumns}}
+    if chunk_rows is not None:
+        options['chunksize'] = chunk_rows
+
+    if chunk_rows is None:
+        try:
+            return pd.read_csv(file_path, dtype={column: 'float64' for column in labelColumns}, **options)
+        except ValueError:
+            pass  # Text in a label column, so read the labels as text and convert the columns that are numeric
+        return _infer_label_columns(pd.read_csv(file_path, dtype={column: str for column in labelColumns},
+                                                **options))
+
+    # A chunk can't be re-read if it fails to parse, so chunks are always read as text and then converted
+    return (_infer_label_columns(chunk)
+            for chunk in pd.read_csv(file_path, dtype={column: str for column in labelColumns}, **options))
+
+
+# Read a whole data table, with the columns typed as described above
+def read_data_table(file_path) -> pd.DataFrame:
+    extension = _extension(file_path)
+    if extension in parquetExtensions:
+        return _infer_label_columns(_blank_identifiers(pq.read_table(file_path).to_pandas()))
+    return _read_delimited(file_path, delimitedExtensions[extension])
+
+
+# Read a data table in DataFrames of at most chunk_rows rows (the index numbers the rows across the whole table)
+def iter_data_table_chunks(file_path, chunk_rows=None) -> Iterator[pd.DataFrame]:
+    if chunk_rows is None:
+        chunk_rows = defaultChunkRows
+    extension = _extension(file_path)
+
+    if extension in parquetExtensions:
+        startRow = 0
+        for batch in pq.ParquetFile(file_path).iter_batches(batch_size=chunk_rows):
+            df = batch.to_pandas()
+            df.index = pd.RangeIndex(startRow, startRow + len(df))
+            startRow += len(df)
+            yield _infer_label_columns(_blank_identifiers(df))
+        return
+
+    yield from _read_delimited(file_path, delimitedExtensions[extension], chunk_rows)
+
+
+# Number of data rows in a table (from the Parquet metadata, or by counting the lines of a delimited file)
+def data_table_row_count(file_path) -> int:
+    extension = _extension(file_path)
+    if extension in parquetExtensions:
+        return pq.ParquetFile(file_path).metadata.num_rows
+
+    lineCount = 0
+    lastByte = b'\n'
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            lineCount += block.count(b'\n')
+            lastByte = block[-1:]
+    if lastByte != b'\n':
+        lineCount += 1
+    return max(0, lineCount - 1)  # Less the header row
@@ -0,0 +1,282 @@
+# Validation of a whole sheet against the data/ model schemas before any of it is written. Every check is made on
+# whole columns (isin against the choices of a field or against key sets fetched with one query, to_numeric and
+# to_datetime for the conversions the loaders make), rather than by saving one row at a time and catching the
+# ValidationError. The checks return one table of issues for the whole sheet:
+#   row       position of the row in the sheet as loaded (None for an issue with the whole sheet or a column)
+#   id        the row's identifier (study ID, specimen ID, or unique ID)
+#   column    the column (or metadata field) with the issue
+#   value     the value with the issue
+#   severity  'error' (the row can't be saved, so it isn't written) or 'warning' (the row is saved without it)
+#   rule      the check that failed ('required', 'choices', 'integer', 'number', 'date', 'column', 'reference')
+#   message   a description of the issue
+# A dry run (import_pipeline.dry_run) reads and checks a file and returns this table without writing anything.
+
+
+from typing import Optional
+import mongoengine
+import numpy as np
+import pandas as pd
+
+from data.assay_classes import AssayMetaData
+from data.assay_results import AssayResults
+from data.biospecimens import Biospecimen, BiospecimenTubeInfo
+from data.clinical_data import ClinicalData
+import services.data_service as svc
+from services.custom_columns import id_text
+from services.table_reader import labelColumnStart
+
+reportColumns = ['row', 'id', 'column', 'value', 'severity', 'rule', 'message']
+
+# Values the loaders skip when converting a numeric or date field (compared ignoring case)
+skippedValues = ['nan', 'na', 'nd', '', 'pending']
+skippedDateValues = ['na', '', 'pending', 'none']  # Dates are skipped for fewer values (not 'nan' or 'nd')
+dateFormat = '%Y-%m-%d %H:%M:%S'  # Format the loaders parse dates with
+
+# Number of columns added after the data labels of an assay sheet (data_file_name, study_id, unique_id)
+assayTrailingColumns = 3
+
+# Fields the loaders set from each row, by import type: (document class, fields). Blank cells of the fields in
+# convertedFields are converted without being skipped (e.g. int(row.tube_number)), so a blank cell is an error.
+# Numeric fields the clinical loader sets are read from the class, as the loader does.
+loaderFields = {'Clinical': [(ClinicalData, ['cu_id', 'cor_id', 'pub_id', 'qmep_mediagnosis', 'qmep_mesymptoms',
+                                             'cpet_d1', 'cpet_d2', 'q_lastantibiotic'])],
+                'Biospecimen': [(Biospecimen, ['study_id', 'cpet_day', 'pre_post_cpet', 'specimen_type']),
+                                (BiospecimenTubeInfo, ['sample_id', 'date_received', 'tube_number', 'freezer_id',
+                                                       'box_number', 'box_position', 'analysis_id'])],
+                'Assay': [(AssayMetaData, ['timepoint'])]}
+convertedFields = {'Biospecimen': ['study_id', 'sample_id', 'date_received', 'tube_number', 'box_number',
+                                   'box_position']}
+clinicalManagedFields = ['version_number', 'study_id', 'revision']  # Numeric fields set by the loader itself
+
+
+class ValidationReport:
+    def __init__(self, document_name, data_file_name, issues: pd.DataFrame, row_count):
+        self.document_name = document_name
+        self.data_file_name = data_file_name
+        self.issues = issues
+        self.row_count = row_count
+        self._validRowMask = None
+
+    @property
+    def errors(self) -> pd.DataFrame:
+        return self.issues[self.issues['severity'] == 'error']
+
+    @property
+    def warnings(self) -> pd.DataFrame:
+        return self.issues[self.issues['severity'] == 'warning']
+
+    # Whether an error applies to the whole sheet (e.g. a missing column), so no row can be saved
+    @property
+    def blocks_import(self) -> bool:
+        return bool(self.errors['row'].isna().any())
+
+    # Boolean mask (by row position) of the rows that can be saved
+    def valid_row_mask(self) -> np.ndarray:
+        if self._validRowMask is None:
+            if self.blocks_import:
+                self._validRowMask = np.zeros(self.row_count, dtype=bool)
+            else:
+                self._validRowMask = np.ones(self.row_count, dtype=bool)
+                self._validRowMask[self.errors['row'].dropna().astype('int64').unique()] = False
+        return self._validRowMask
+
+    @property
+    def invalid_row_count(self) -> int:
+        return int(self.row_count - self.valid_row_mask().sum())
+
+    # e.g. '3 errors in 2 rows (choices 2, required 1), 5 warnings (reference 5)'
+    def summary(self) -> str:
+        def counts(issues):
+            return ', '.join(f'{rule} {count}' for rule, count in issues['rule'].value_counts().items())
+
+        errors = self.errors
+        warnings = self.warnings
+        if len(errors.index) == 0 and len(warnings.index) == 0:
+            return 'no errors or warnings'
+        text = f'{len(errors.index)} errors'
+        if len(errors.index):
+            rowText = 'all rows' if self.blocks_import else f'{self.invalid_row_count} rows'
+            text += f' in {rowText} ({counts(errors)})'
+        text += f', {len(warnings.index)} warnings'
+        if len(warnings.index):
+            text += f' ({counts(warnings)})'
+        return text
+
+    # The issues as text, the errors first (at most max_rows of them)
+    def format(self, max_rows=20) -> str:
+        issues = pd.concat([self.errors, self.warnings])
+        text = issues.head(max_rows).to_string(index=False)
+        if len(issues.index) > max_rows:
+            text += f'\n... {len(issues.index) - max_rows} more'
+        return text
+
+    def to_csv(self, file_path):
+        self.issues.to_csv(file_path, index=False)
+
+
+def _empty_issues() -> pd.DataFrame:
+    return pd.DataFrame({column: pd.Series(dtype=object) for column in reportColumns})
+
+
+# Issues for the rows of df where mask is set
+def _row_issues(df, mask, column, severity, rule, message) -> pd.DataFrame:
+    mask = np.asarray(mask, dtype=bool)
+    if not mask.any():
+        return _empty_issues()
+    positions = np.flatnonzero(mask)
+    values = df[column].iloc[positions].astype(str).to_numpy() if column in df.columns else ''
+    return pd.DataFrame({'row': positions.astype(object),
+                         'id': df.index[positions].astype(str).to_numpy(),
+                         'column': column,
+                         'value': values,
+                         'severity': severity,
+                         'rule': rule,
+                         'message': message})
+
+
+# An issue with the whole sheet, a column, or a metadata field
+def _sheet_issue(column, value, severity, rule, message) -> pd.DataFrame:
+    return pd.DataFrame([{'row': None, 'id': '', 'column': column, 'value': str(value), 'severity': severity,
+                          'rule': rule, 'message': message}], columns=reportColumns)
+
+
+def _is_blank(values) -> pd.Series:
+    return values.isna() | (values.astype(str).str.strip() == '')
+
+
+def _is_skipped(values) -> pd.Series:
+    return values.isna() | values.astype(str).str.strip().str.lower().isin(skippedValues)
+
+
+def _choice_values(field) -> list:
+    return [c[0] if isinstance(c, (tuple, list)) else c for c in field.choices]
+
+
+# Check one column against its field in a model class
+def check_field(df, documentClass, fieldName, converted=False) -> list:
+    field = documentClass._fields[fieldName]
+    if fieldName not in df.columns:
+        return [_sheet_issue(fieldName, '', 'error', 'column', f'Column {fieldName} is missing')]
+
+    values = df[fieldName]
+    isDate = isinstance(field, (mongoengine.DateTimeField, mongoengine.DateField))
+    if converted:
+        isSkipped = _is_blank(values)
+    elif isDate:
+        isSkipped = values.astype(str).str.lower().isin(skippedDateValues)
+    else:
+        isSkipped = _is_skipped(values)
+
+    issues = []
+    if converted:
+        issues.append(_row_issues(df, isSkipped, fieldName, 'error', 'required', f'{fieldName} is required'))
+    elif field.required:
+        issues.append(_row_issues(df, values.isna(), fieldName, 'error', 'required', f'{fieldName} is required'))
+
+    if field.choices:
+        choices = _choice_values(field)
+        issues.append(_row_issues(df, values.notna() & ~values.astype(str).isin(choices), fieldName, 'error',
+                                  'choices', f'{fieldName} must be one of {", ".join(map(str, choices))}'))
+
+    if isinstance(field, (mongoengine.IntField, mongoengine.FloatField)):
+        rule = 'integer' if isinstance(field, mongoengine.IntField) else 'number'
+        numbers = pd.to_numeric(values.where(~isSkipped).astype(object), errors='coerce')
+        issues.append(_row_issues(df, ~isSkipped & numbers.isna(), fieldName, 'error', rule,
+                                  f'{fieldName} must be a number'))
+    elif isDate:
+        dates = pd.to_datetime(values.where(~isSkipped).astype(str), format=dateFormat, errors='coerce')
+        issues.append(_row_issues(df, ~isSkipped & dates.isna(), fieldName, 'error', 'date',
+                                  f'{fieldName} must be a date'))
+    return issues
+
+
+# Numeric fields of the clinical data class that the loader sets from the row (every one must be a column)
+def clinical_numeric_fields() -> list:
+    return [name for name, field in ClinicalData._fields.items()
+            if isinstance(field, (mongoengine.IntField, mongoengine.FloatField))
+            and name not in clinicalManagedFields]
+
+
+def check_schema(import_type, df) -> list:
+    issues = []
+    converted = convertedFields.get(import_type, [])
+    for documentClass, fieldNames in loaderFields.get(import_type, []):
+        for fieldName in fieldNames:
+            issues += check_field(df, documentClass, fieldName, fieldName in converted)
+    if import_type == 'Clinical':
+        for fieldName in clinical_numeric_fields():
+            issues += check_field(df, ClinicalData, fieldName)
+    return issues
+
+
+# Study IDs without clinical data (an error for assay data, which is added to the participant's clinical data,
+# and a warning for biospecimens)
+def check_study_ids(df, severity) -> list:
+    studyIDs = pd.to_numeric(df['study_id'], errors='coerce')
+    existingIDs = svc.find_existing_study_ids(studyIDs)
+    return [_row_issues(df, studyIDs.isna() | ~studyIDs.isin(existingIDs), 'study_id', severity, 'reference',
+                        'There is no clinical data for this study ID')]
+
+
+# Biospecimens of assay rows that don't exist (the rows are saved without a biospecimen reference)
+def check_biospecimens(df, biospecimen_type) -> list:
+    specimenIDs = id_text(df['study_id']) + '-' + df['timepoint'].astype(str) + '-' + str(biospecimen_type)
+    existingIDs = svc.find_existing_specimen_ids(specimenIDs)
+    issues = _row_issues(df, ~specimenIDs.isin(existingIDs), 'timepoint', 'warning', 'reference',
+                         'There is no biospecimen for this study ID, timepoint, and biospecimen type')
+    issues['value'] = specimenIDs[~specimenIDs.isin(existingIDs)].to_numpy()
+    return [issues]
+
+
+# Metadata fields the assay loader needs, and the data labels of the sheet
+def check_assay_metadata(df, meta_data, check_references=True) -> list:
+    issues = []
+    for fieldName in ['unique_assay_name', 'data_label_type']:
+        if not meta_data.get(fieldName):
+            issues.append(_sheet_issue(fieldName, '', 'error', 'required', f'Metadata field {fieldName} is required'))
+
+    dataLabelType = str(meta_data.get('data_label_type') or '').strip()
+    choices = _choice_values(AssayResults._fields['data_label_type'])
+    if dataLabelType and dataLabelType not in choices:
+        issues.append(_sheet_issue('data_label_type', dataLabelType, 'error', 'choices',
+                                   f'data_label_type must be one of {", ".join(choices)}'))
+    elif dataLabelType and check_references:
+        dataLabels = [str(c) for c in df.columns[labelColumnStart:len(df.columns) - assayTrailingColumns]]
+        existingLabels = svc.find_existing_data_labels(dataLabels, dataLabelType)
+        for dataLabel in dataLabels:
+            if dataLabel not in existingLabels:
+                issues.append(_sheet_issue(dataLabel, dataLabel, 'warning', 'reference',
+                                           f'{dataLabelType} {dataLabel} not found'))
+    return issues
+
+
+# Combine the reports of the chunks of a file into one report (row positions are made relative to the whole file)
+def combine_reports(reports, first_rows, document_name=None, data_file_name=None) -> ValidationReport:
+    issues = []
+    for report, firstRow in zip(reports, first_rows):
+        chunkIssues = report.issues.copy()
+        chunkIssues['row'] = chunkIssues['row'].map(lambda row: None if pd.isna(row) else int(row) + firstRow)
+        issues.append(chunkIssues)
+    issues = [i for i in issues if len(i.index)]
+    combined = pd.concat(issues, ignore_index=True) if issues else _empty_issues()
+    return ValidationReport(document_name, data_file_name, combined, sum(r.row_count for r in reports))
+
+
+# Validate a sheet prepared for an import (after the normalize stage), returning a report of every issue.
+# With check_references off, the database isn't read.
+def validate_dataframe(import_type, df, document_name=None, data_file_name=None, meta_data: Optional[dict] = None,
+                       fast_load=False, check_references=True) -> ValidationReport:
+    issues = check_schema(import_type, df)
+
+    if import_type == 'Assay':
+        issues += check_assay_metadata(df, meta_data or {}, check_references)
+        if check_references:
+            issues += check_study_ids(df, 'error')
+            if not fast_load:
+                issues += check_biospecimens(df, (meta_data or {}).get('biospecimen_type'))
+    elif import_type == 'Biospecimen' and check_references:
+        issues += check_study_ids(df, 'warning')
+
+    issues = [i for i in issues if len(i.index)]
+    report = pd.concat(issues, ignore_index=True) if issues else _empty_issues()
+    return ValidationReport(document_name or import_type, data_file_name, report, len(df.index))
@@ -0,0 +1,508 @@
+# Compact version history for clinical data and biospecimen documents.
+# Instead of copying every attribute of a document (including the whole assay_meta_data array) into the version
+# history each time it is updated, a VersionDelta record stores the field-level changes that turn the new version
+# back into the superseded one. Arrays of embedded documents (assay_meta_data, assay_results, biospecimen_tube_info,
+# scrnaseq_summary) are diffed element by element, keyed on their ID field (or fields), so updating one assay result
+# only stores that result. Every versionHistoryKeyframeInterval versions a full keyframe is stored instead.
+# A past version is rebuilt by starting from the nearest keyframe above it (or the live document) and applying
+# the deltas in descending version order.
+# Snapshots of the whole cohort as of a date (for reproducible exports) are rebuilt from a single aggregation that
+# joins each participant's live document to the version records needed to roll it back to that date.
+
+
+from collections import OrderedDict
+from typing import Dict, List, Optional
+import copy
+import datetime
+import os
+import pandas as pd
+
+from data.clinical_data import ClinicalData, ClinicalDataVersionHistory
+from data.biospecimens import Biospecimen, BiospecimenVersionHistory
+from data.version_history import VersionDelta
+from data.users import User
+import data.mongo_setup as mongo_setup
+import services.read_models as read_models
+
+import set_up_globals
+
+# Arrays of embedded documents that are diffed element by element, with the field (or fields) that identify each
+# element. Assay results are keyed like data_service.assay_result_key, since a label can have more than one type.
+arrayKeyFields = {'assay_meta_data': 'unique_id',
+                  'assay_results': ('data_label', 'data_label_type'),
+                  'biospecimen_tube_info': 'sample_id',
+                  'scrnaseq_summary': '_id'}  # sampleid is the primary key of ScRNAseqSummary
+
+# Document type -> (document class, key field, full snapshot version history class)
+documentTypes = {'ClinicalData': (ClinicalData, 'study_id', ClinicalDataVersionHistory),
+                 'Biospecimen': (Biospecimen, 'specimen_id', BiospecimenVersionHistory)}
+
+# Number of as-of-date cohort snapshots kept in memory. Only dates at least frozenAfterSeconds in the past are
+# cached, since later saves can't change what the data looked like then.
+asOfCacheSize = 4
+frozenAfterSeconds = 60
+
+_asOfCache = OrderedDict()  # (as of date, study IDs, include assay data) -> {study ID: snapshot}
+
+
+def _plain(value):
+    if isinstance(value, dict):
+        return {k: _plain(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_plain(v) for v in value]
+    return value
+
+
+# Return the document as stored in the database (plain dictionaries and lists)
+def document_snapshot(document) -> dict:
+    return _plain(document.to_mongo())
+
+
+# The key of an embedded document: the value of keyField, or a tuple of values if keyField is a list of fields
+def _element_key(element: dict, keyField):
+    if isinstance(keyField, (list, tuple)):
+        return tuple(element.get(field) for field in keyField)
+    return element.get(keyField)
+
+
+# A key read back from a stored delta (a composite key is stored as a list)
+def _stored_key(key):
+    return tuple(key) if isinstance(key, list) else key
+
+
+# Index a list of embedded documents by key, or return None if any element has no key or a duplicate key
+def _keyed_index(elements, keyField) -> Optional[dict]:
+    keyFields = keyField if isinstance(keyField, (list, tuple)) else [keyField]
+    index = {}
+    for element in elements:
+        if not isinstance(element, dict) or any(field not in element for field in keyFields):
+            return None
+        key = _element_key(element, keyField)
+        try:
+            if key in index:
+                return None
+        except TypeError:
+            return None  # Unhashable key
+        index[key] = element
+    return index
+
+
+# Return the changes that turn the document new into the document old
+def diff_documents(new: dict, old: dict) -> dict:
+    setFields = {}
+    arrays = {}
+    for field, oldValue in old.items():
+        if field not in new:
+            setFields[field] = oldValue
+            continue
+        newValue = new[field]
+        if newValue == oldValue:
+            continue
+        if field in arrayKeyFields and isinstance(newValue, list) and isinstance(oldValue, list):
+            arrayDelta = _diff_array(newValue, oldValue, arrayKeyFields[field])
+            if arrayDelta is not None:
+                arrays[field] = arrayDelta
+                continue
+        setFields[field] = oldValue
+
+    delta = {}
+    if setFields:
+        delta['set'] = setFields
+    unsetFields = [field for field in new if field not in old]
+    if unsetFields:
+        delta['unset'] = unsetFields
+    if arrays:
+        delta['arrays'] = arrays
+    return delta
+
+
+# Element level changes that turn the array newList into oldList (None if the elements can't be keyed)
+def _diff_array(newList, oldList, keyField) -> Optional[dict]:
+    newIndex = _keyed_index(newList, keyField)
+    oldIndex = _keyed_index(oldList, keyField)
+    if newIndex is None or oldIndex is None:
+        return None
+
+    arrayDelta = {'key': list(keyField) if isinstance(keyField, tuple) else keyField}
+    removed = [key for key in newIndex if key not in oldIndex]
+    added = [element for key, element in oldIndex.items() if key not in newIndex]
+    changed = [[key, diff_documents(newIndex[key], element)] for key, element in oldIndex.items()
+               if key in newIndex and newIndex[key] != element]
+    if removed:
+        arrayDelta['removed'] = removed
+    if added:
+        arrayDelta['added'] = added
+    if changed:
+        arrayDelta['changed'] = changed
+
+    resultingOrder = [key for key in newIndex if key in oldIndex] + [_element_key(element, keyField)
+                                                                     for element in added]
+    if resultingOrder != list(oldIndex):
+        arrayDelta['order'] = list(oldIndex)
+
+    return arrayDelta
+
+
+# Apply the changes returned by diff_documents(new, old) to new, returning old (new itself is not modified)
+def apply_delta(document: dict, delta: dict) -> dict:
+    result = dict(document)
+    for field in delta.get('unset', []):
+        result.pop(field, None)
+    for field, value in delta.get('set', {}).items():
+        result[field] = copy.deepcopy(value)
+    for field, arrayDelta in delta.get('arrays', {}).items():
+        result[field] = _apply_array_delta(result.get(field) or [], arrayDelta)
+    return result
+
+
+def _apply_array_delta(elements, arrayDelta) -> list:
+    keyField = arrayDelta['key']
+    removed = {_stored_key(key) for key in arrayDelta.get('removed', [])}
+    changed = {_stored_key(key): elementDelta for key, elementDelta in arrayDelta.get('changed', [])}
+
+    result = []
+    for element in elements:
+        key = _element_key(element, keyField)
+        if key in removed:
+            continue
+        if key in changed:
+            element = apply_delta(element, changed[key])
+        result.append(element)
+    result.extend(copy.deepcopy(arrayDelta.get('added', [])))
+
+    if 'order' in arrayDelta:
+        position = {_stored_key(key): i for i, key in enumerate(arrayDelta['order'])}
+        result.sort(key=lambda e: position.get(_element_key(e, keyField), len(position)))
+
+    return result
+
+
+def _is_keyframe_version(version_number) -> bool:
+    return version_number % set_up_globals.versionHistoryKeyframeInterval == 0
+
+
+def _new_version_delta(active_account: User, document_type, old_snapshot: dict, new_snapshot: Optional[dict],
+                       migrated=False) -> VersionDelta:
+    documentClass, keyField, historyClass = documentTypes[document_type]
+
+    record = VersionDelta()
+    record.created_by = active_account
+    record.created_date = datetime.datetime.now()
+    record.last_modified_date = old_snapshot.get('last_modified_date')
+    record.document_type = document_type
+    record.study_id = old_snapshot.get('study_id')
+    if keyField != 'study_id':
+        record[keyField] = old_snapshot.get(keyField)
+    record.version_number = old_snapshot['version_number']
+    record.migrated = migrated
+
+    if new_snapshot is None or _is_keyframe_version(record.version_number):
+        record.is_keyframe = True
+        record.keyframe = old_snapshot
+    else:
+        record.delta = diff_documents(new_snapshot, old_snapshot)
+
+    return record
+
+
+# Record the version being superseded: old_snapshot is document_snapshot() of the document as it was loaded,
+# and document is the updated (not yet saved) document
+def save_version_delta(active_account: User, document, old_snapshot: dict, document_type='ClinicalData'):
+    record = new_version_delta(active_account, document, old_snapshot, document_type)
+    record.save()
+    return record
+
+
+# As save_version_delta, but the record isn't saved (see save_version_deltas)
+def new_version_delta(active_account: User, document, old_snapshot: dict, document_type='ClinicalData') -> VersionDelta:
+    return _new_version_delta(active_account, document_type, old_snapshot, document_snapshot(document))
+
+
+# Save version records built with new_version_delta in one insert, returning their IDs (in the same order)
+def save_version_deltas(records: List[VersionDelta]) -> list:
+    if not records:
+        return []
+    return VersionDelta.objects.insert(records, load_bulk=False)
+
+
+# Delete version records that describe changes that were never saved (e.g. when another import saved first)
+def delete_version_deltas(record_ids):
+    VersionDelta.objects(id__in=list(record_ids)).delete()
+
+
+# Apply version records (in descending version order) to state, returning the resulting state and its version.
+# A delta only applies to the version after it, so if a version is missing the state can't be rebuilt (None).
+def _replay(state, stateVersion, records):
+    for record in records:
+        if record['version_number'] == stateVersion:
+            continue  # Duplicate record for a version (e.g. written before a failed save)
+        if record.get('is_keyframe'):
+            state = record['keyframe']
+        elif state is None:
+            break  # Nothing to apply the delta to
+        elif record['version_number'] != stateVersion - 1:
+            state = None  # Gap in the history
+            break
+        else:
+            state = apply_delta(state, record.get('delta') or {})
+        stateVersion = record['version_number']
+    return state, stateVersion
+
+
+# Return a version of a document as stored in the database (a dictionary), or None if it can't be rebuilt
+def snapshot_as_of(key, version_number, document_type='ClinicalData') -> Optional[dict]:
+    documentClass, keyField, historyClass = documentTypes[document_type]
+    version_number = int(version_number)
+
+    current = documentClass.objects(**{keyField: key}).as_pymongo().first()
+    if current and current['version_number'] == version_number:
+        return current
+    if current and version_number > current['version_number']:
+        return None
+
+    records = VersionDelta.objects(document_type=document_type, version_number__gte=version_number,
+                                   **{keyField: key})
+    if current:
+        records = records.filter(version_number__lt=current['version_number'])
+
+    # Start from the nearest keyframe at or above the requested version, rather than the live document
+    keyframe = records.filter(is_keyframe=True).order_by('version_number').only('version_number').first()
+    if keyframe:
+        records = records.filter(version_number__lte=keyframe.version_number)
+
+    state, stateVersion = _replay(current, current['version_number'] if current else None,
+                                  records.order_by('-version_number', '-created_date').as_pymongo())
+
+    if state is not None and stateVersion == version_number:
+        return state
+
+    # Not (yet) migrated from the full snapshot version history
+    snapshot = historyClass.objects(version_number=version_number, **{keyField: key}).as_pymongo().first()
+    if snapshot and current:
+        snapshot['_id'] = current['_id']
+    return snapshot
+
+
+# Return the document as it was at the given version (e.g. as_of(101, 3) is version 3 of ENID 101's clinical data)
+def as_of(key, version_number, document_type='ClinicalData'):
+    snapshot = snapshot_as_of(key, version_number, document_type)
+    if snapshot is None:
+        return None
+    return documentTypes[document_type][0]._from_son(snapshot)
+
+
+# Parse a date entered by a user ('2026-01-31', '2026-01-31 14:30', ...), returning None if it's blank
+def parse_as_of_date(text) -> Optional[datetime.datetime]:
+    if text is None or (isinstance(text, str) and not text.strip()):
+        return None
+    if isinstance(text, datetime.datetime):
+        return text
+    try:
+        return pd.Timestamp(str(text).strip()).to_pydatetime()
+    except ValueError:
+        raise ValueError(f'{text} is not a valid date (expected YYYY-MM-DD or YYYY-MM-DD HH:MM)')
+
+
+# Tag added to export file names, so exports of the same point in time get the same name
+def as_of_date_tag(as_of_date: Optional[datetime.datetime]) -> str:
+    if as_of_date is None:
+        return ''
+    return '_as_of_' + as_of_date.strftime('%Y-%m-%d_%H%M%S')
+
+
+def as_of_file_name(file_name, as_of_date: Optional[datetime.datetime]) -> str:
+    root, extension = os.path.splitext(file_name)
+    return root + as_of_date_tag(as_of_date) + extension
+
+
+# Aggregation that returns each participant's live clinical data document (of those added by as_of_date) with the
+# version records needed to roll it back to that date: the version current at that date (as_of_version, None if
+# there is no version record on or before the date, e.g. the history hasn't been migrated yet), and in 'history'
+# the records from the newest down to that version, stopping at the nearest keyframe
+def _clinical_as_of_pipeline(as_of_date, study_ids=None, include_assay_data=True) -> list:
+    excludedFields = {'_id': 0, 'created_by': 0, 'migrated': 0}
+    if not include_assay_data:
+        excludedFields.update({'keyframe.assay_meta_data': 0,
+                               'delta.set.assay_meta_data': 0,
+                               'delta.arrays.assay_meta_data': 0})
+
+    def history_lookup(dateCondition, output, limit=None):
+        lookupPipeline = [{'$match': {'$expr': {'$and': [{'$gt': ['$$lastModified', as_of_date]},
+                                                         {'$eq': ['$document_type', 'ClinicalData']},
+                                                         {'$eq': ['$study_id', '$$studyID']},
+                                                         {dateCondition: ['$last_modified_date', as_of_date]}]}}},
+                          {'$sort': {'version_number': -1, 'created_date': -1}}]
+        if limit:
+            lookupPipeline.append({'$limit': limit})
+        lookupPipeline.append({'$project': excludedFields})
+        return {'$lookup': {'from': VersionDelta._get_collection_name(),
+                            'let': {'studyID': '$study_id', 'lastModified': '$last_modified_date'},
+                            'pipeline': lookupPipeline,
+                            'as': output}}
+
+    participantFilter = {'created_date': {'$lte': as_of_date}}  # Leave out participants added after the date
+    if study_ids is not None:
+        participantFilter['study_id'] = {'$in': [int(i) for i in study_ids]}
+    pipeline = [{'$match': participantFilter}]
+    if not include_assay_data:
+        pipeline.append({'$project': {'assay_meta_data': 0}})
+
+    # Records of versions saved after the date, and the newest record of a version saved on or before it
+    pipeline.append(history_lookup('$gt', 'history'))
+    pipeline.append(history_lookup('$lte', 'as_of_record', limit=1))
+    pipeline.append({'$addFields': {
+        'as_of_version': {'$cond': [{'$lte': ['$last_modified_date', as_of_date]},
+                                    '$version_number',
+                                    {'$max': '$as_of_record.version_number'}]},
+        'history': {'$concatArrays': ['$history', '$as_of_record']}}})
+
+    # Drop the records above the nearest keyframe (replay starts there instead of at the live document)
+    pipeline.append({'$addFields': {'keyframe_version': {'$min': {'$map': {
+        'input': {'$filter': {'input': '$history', 'cond': {'$eq': ['$$this.is_keyframe', True]}}},
+        'in': '$$this.version_number'}}}}})
+    pipeline.append({'$addFields': {'history': {'$filter': {
+        'input': '$history',
+        'cond': {'$or': [{'$eq': ['$keyframe_version', None]},
+                         {'$lte': ['$$this.version_number', '$keyframe_version']}]}}}}})
+    pipeline.append({'$project': {'as_of_record': 0, 'keyframe_version': 0}})
+
+    return pipeline
+
+
+# Return the version of a participant's clinical data that was current at a date according to the full snapshot
+# version history (None if it has no snapshot saved on or before the date)
+def _legacy_version_as_of(study_id, as_of_date) -> Optional[int]:
+    snapshot = ClinicalDataVersionHistory.objects(study_id=study_id, last_modified_date__lte=as_of_date) \
+        .order_by('-version_number').only('version_number').first()
+    return None if snapshot is None else snapshot.version_number
+
+
+# Return {study ID: clinical data document as stored in the database} as of a date. Participants added after the
+# date are left out. If include_assay_data is not set, assay_meta_data is left out of the snapshots (much
+# less to read and replay for demographic exports). If analytics is set, the live documents are read from the
+# analytics connection (see mongo_setup.analytics_alias).
+def clinical_snapshots_as_of_date(as_of_date: datetime.datetime, study_ids=None,
+                                  include_assay_data=True, analytics=False) -> Dict[int, dict]:
+    cacheKey = (as_of_date, None if study_ids is None else tuple(sorted({int(i) for i in study_ids})),
+                include_assay_data)
+    if cacheKey in _asOfCache:
+        _asOfCache.move_to_end(cacheKey)
+        return _asOfCache[cacheKey]
+
+    snapshots = {}
+    missingCount = 0
+    collection = mongo_setup.analytics_collection(ClinicalData) if analytics else ClinicalData._get_collection()
+    for document in collection.aggregate(_clinical_as_of_pipeline(as_of_date, cacheKey[1], include_assay_data),
+                                         allowDiskUse=True):
+        history = document.pop('history')
+        asOfVersion = document.pop('as_of_version')
+        studyID = document['study_id']
+
+        state, stateVersion = _replay(document, document['version_number'], history)
+        if state is None or asOfVersion is None or stateVersion != asOfVersion:
+            # Not (yet) migrated from the full snapshot version history
+            if asOfVersion is None:
+                asOfVersion = _legacy_version_as_of(studyID, as_of_date)
+            state = None if asOfVersion is None else snapshot_as_of(studyID, asOfVersion)
+            if state is None:
+                missingCount += 1
+                continue
+            if not include_assay_data:
+                state.pop('assay_meta_data', None)
+        snapshots[studyID] = state
+
+    if missingCount:
+        print(f'Unable to rebuild the {set_up_globals.clinical_document_name} data of {missingCount} participants '
+              f'as of {as_of_date} (run migratehistory to convert the full snapshot version history).')
+
+    # A secondary can be behind the primary, so the date also has to be older than its maximum staleness
+    staleSeconds = mongo_setup.max_staleness_seconds() if analytics else 0
+    if staleSeconds is not None and \
+            (datetime.datetime.now() - as_of_date).total_seconds() >= frozenAfterSeconds + staleSeconds:
+        _asOfCache[cacheKey] = snapshots
+        while len(_asOfCache) > asOfCacheSize:
+            _asOfCache.popitem(last=False)
+
+    return snapshots
+
+
+# Return the clinical data of every participant (or of the given study IDs) as it was at a date, ordered by
+# phenotype like data_service.find_clinical_data() (read-only views of the snapshots if analytics is set)
+def find_clinical_data_as_of_date(as_of_date: datetime.datetime, study_ids=None,
+                                  include_assay_data=True, analytics=False) -> List[ClinicalData]:
+    snapshots = clinical_snapshots_as_of_date(as_of_date, study_ids, include_assay_data, analytics)
+    if analytics:
+        clinicalDataList = [read_models.DocumentView(snapshot, ClinicalData) for snapshot in snapshots.values()]
+    else:
+        clinicalDataList = [ClinicalData._from_son(copy.deepcopy(snapshot)) for snapshot in snapshots.values()]
+    clinicalDataList.sort(key=lambda c: (c.phenotype is None, c.phenotype or ''))
+    return clinicalDataList
+
+
+# Return one participant's clinical data as it was at a date
+# (e.g. clinical_data_as_of_date(101, datetime.datetime(2026, 1, 31)))
+def clinical_data_as_of_date(study_id, as_of_date: datetime.datetime,
+                             include_assay_data=True) -> Optional[ClinicalData]:
+    clinicalDataList = find_clinical_data_as_of_date(as_of_date, [study_id], include_assay_data)
+    return clinicalDataList[0] if clinicalDataList else None
+
+
+def clear_as_of_cache():
+    _asOfCache.clear()
+
+
+# Convert the full snapshot version history into delta records. Documents that were already migrated are skipped,
+# so this can be re-run. If dropLegacy is set, the full snapshot collections are dropped afterwards.
+def migrate_version_history(active_account: User, document_types=None, dropLegacy=False) -> dict:
+    if document_types is None:
+        document_types = list(documentTypes)
+
+    counts = {}
+    for document_type in document_types:
+        documentClass, keyField, historyClass = documentTypes[document_type]
+        migratedKeys = set(VersionDelta.objects(document_type=document_type, migrated=True).distinct(keyField))
+        keyCount = 0
+        recordCount = 0
+
+        for key in historyClass.objects().distinct(keyField):
+            if key in migratedKeys:
+                continue
+
+            # One snapshot per version (the history may hold duplicates left by failed saves)
+            snapshots = {}
+            for snapshot in historyClass.objects(**{keyField: key}).order_by('created_date').as_pymongo():
+                snapshots[snapshot['version_number']] = snapshot
+
+            existingVersions = set(VersionDelta.objects(document_type=document_type, **{keyField: key})
+                                   .distinct('version_number'))
+            current = documentClass.objects(**{keyField: key}).as_pymongo().first()
+            versions = sorted((v for v in snapshots if v not in existingVersions and
+                               (not current or v < current['version_number'])), reverse=True)
+            if not versions:
+                continue
+
+            # Deltas are taken against the next version up, which is rebuilt if it's newer than the snapshots
+            nextSnapshot = snapshot_as_of(key, versions[0] + 1, document_type) if current else None
+            records = []
+            for version in versions:
+                snapshot = dict(snapshots[version])
+                if current:
+                    snapshot['_id'] = current['_id']
+                else:
+                    snapshot.pop('_id', None)
+                records.append(_new_version_delta(active_account, document_type, snapshot, nextSnapshot,
+                                                  migrated=True))
+                nextSnapshot = snapshot
+
+            VersionDelta.objects.insert(records, load_bulk=False)
+            keyCount += 1
+            recordCount += len(records)
+
+        counts[document_type] = recordCount
+        print(f'Migrated {recordCount} {document_type} versions for {keyCount} documents to the delta version history.')
+
+        if dropLegacy:
+            historyClass.drop_collection()
+            print(f'Dropped the {historyClass._get_collection_name()} collection.')
+
+    return counts
@@ -0,0 +1,282 @@
+# Parse cache for Excel workbooks, so that each uploaded workbook is read from Excel at most once per session.
+# Sheets are cached by a hash of the file content (upload paths change, content doesn't), as raw header-less
+# DataFrames pickled to a size-bounded directory that only the user can write (see cache_directories). Views with a header row, skipped rows, or a row limit
+# are derived from the cached sheet in memory, so a preview, the import confirmation, and the import itself
+# all share one openpyxl parse.
+# Very large workbooks are not parsed whole: their sheets can be streamed in fixed-size chunks of rows with
+# openpyxl in read-only mode, so memory use is bounded by the chunk size rather than the sheet size.
+
+
+from collections import OrderedDict
+from typing import Iterator, Optional
+import hashlib
+import os
+import openpyxl
+import pandas as pd
+
+from services.cache_directories import cache_directory, make_private_directory
+
+# Directory and size limit for the on-disk cache (least recently used sheets are evicted first)
+cacheDirectory = cache_directory('MECFS_PARSE_CACHE_DIR', 'parse_cache')
+cacheLimitBytes = int(float(os.environ.get('MECFS_PARSE_CACHE_MB', '512')) * 1024 * 1024)
+
+# Number of parsed sheets also kept in memory (avoids unpickling on the preview -> confirm -> import path)
+memoryCacheSize = 4
+
+# Workbooks at least this large are streamed rather than parsed whole, in chunks of streamChunkRows rows
+streamThresholdBytes = int(float(os.environ.get('MECFS_STREAM_THRESHOLD_MB', '25')) * 1024 * 1024)
+streamChunkRows = int(os.environ.get('MECFS_STREAM_CHUNK_ROWS', '5000'))
+
+_memoryCache = OrderedDict()  # (content hash, sheet name) -> raw DataFrame
+_hashMemo = OrderedDict()  # (path, mtime, size) -> content hash
+hashMemoSize = 64
+
+
+# Return the SHA-256 hash of a file's content (memoized on path, modification time, and size)
+def file_content_hash(file_path) -> str:
+    stat = os.stat(file_path)
+    memoKey = (os.path.abspath(file_path), stat.st_mtime_ns, stat.st_size)
+    if memoKey in _hashMemo:
+        _hashMemo.move_to_end(memoKey)
+        return _hashMemo[memoKey]
+
+    sha = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            sha.update(block)
+    _hashMemo[memoKey] = sha.hexdigest()
+    while len(_hashMemo) > hashMemoSize:
+        _hashMemo.popitem(last=False)
+    return _hashMemo[memoKey]
+
+
+def excel_engine(file_path) -> str:
+    return 'xlrd' if os.path.splitext(str(file_path))[1].lower() == '.xls' else 'openpyxl'
+
+
+def _cache_file_path(content_hash, sheet_name) -> str:
+    sheetTag = hashlib.sha1(str(sheet_name).encode('utf-8')).hexdigest()[:12]
+    return os.path.join(cacheDirectory, f'{content_hash}-{sheetTag}.pkl')
+
+
+def _remember(key, df):
+    _memoryCache[key] = df
+    _memoryCache.move_to_end(key)
+    while len(_memoryCache) > memoryCacheSize:
+        _memoryCache.popitem(last=False)
+
+
+# Remove least recently used cache files until the cache directory fits within its size limit
+def _evict():
+    try:
+        entries = [os.path.join(cacheDirectory, name) for name in os.listdir(cacheDirectory) if name.endswith('.pkl')]
+    except FileNotFoundError:
+        return
+    files = []
+    for path in entries:
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            continue
+        files.append((stat.st_mtime, stat.st_size, path))
+    totalBytes = sum(f[1] for f in files)
+    for mtime, size, path in sorted(files):
+        if totalBytes <= cacheLimitBytes:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        totalBytes -= size
+
+
+# Return a whole sheet as read with header=None and keep_default_na=False, parsing the workbook only on a cache miss
+def read_raw_sheet(file_path, sheet_name=0) -> pd.DataFrame:
+    key = (file_content_hash(file_path), str(sheet_name))
+    if key in _memoryCache:
+        _memoryCache.move_to_end(key)
+        return _memoryCache[key]
+
+    useDiskCache = make_private_directory(cacheDirectory)
+    cachePath = _cache_file_path(*key)
+    if useDiskCache and os.path.exists(cachePath):
+        try:
+            df = pd.read_pickle(cachePath)
+            os.utime(cachePath)  # Mark as recently used
+            _remember(key, df)
+            return df
+        except Exception:
+            pass  # Corrupt or incompatible pickle, so parse again
+
+    df = pd.read_excel(file_path, sheet_name=sheet_name, engine=excel_engine(file_path), header=None,
+                       keep_default_na=False)
+    _remember(key, df)
+    if not useDiskCache:
+        return df
+
+    try:
+        temporaryPath = cachePath + f'.{os.getpid()}.tmp'
+        df.to_pickle(temporaryPath)
+        os.replace(temporaryPath, cachePath)
+        _evict()
+    except OSError as e:
+        print(f'Unable to write workbook parse cache file {cachePath}: {e}')
+
+    return df
+
+
+# Column names as pandas would build them from a header row (blank -> 'Unnamed: N', duplicates -> 'name.1', ...)
+def _header_names(values) -> list:
+    names = []
+    counts = {}
+    for i, name in enumerate(values):
+        if name is None or (isinstance(name, float) and pd.isna(name)) or (isinstance(name, str) and name.strip() == ''):
+            name = f'Unnamed: {i}'
+        currentCount = counts.get(name, 0)
+        while currentCount > 0:
+            counts[name] = currentCount + 1
+            name = f'{name}.{currentCount}'
+            currentCount = counts.get(name, 0)
+        counts[name] = currentCount + 1
+        names.append(name)
+    return names
+
+
+def _leading_rows(skiprows) -> int:
+    if skiprows is None:
+        return 0
+    if isinstance(skiprows, int):
+        return skiprows
+    skipped = sorted(skiprows)
+    if skipped != list(range(len(skipped))):
+        raise ValueError('Only leading rows can be skipped when reading from the workbook parse cache')
+    return len(skipped)
+
+
+# Drop-in replacement for pd.read_excel(file_path, sheet_name, header, skiprows, nrows, keep_default_na=False),
+# served from the parse cache. skiprows may be an int or a range of leading rows.
+# The first rows of a workbook that is too large to parse whole (e.g. for a preview) are streamed instead.
+def read_sheet(file_path, sheet_name=0, header=0, skiprows=None, nrows=None) -> pd.DataFrame:
+    firstRow = _leading_rows(skiprows)
+
+    if nrows is not None and should_stream(file_path) and \
+            (file_content_hash(file_path), str(sheet_name)) not in _memoryCache:
+        chunks = iter_sheet_chunks(file_path, sheet_name, header, firstRow, chunk_rows=nrows)
+        try:
+            return next(chunks, pd.DataFrame())
+        finally:
+            chunks.close()
+
+    raw = read_raw_sheet(file_path, sheet_name)
+
+    if header is None:
+        columns = list(range(raw.shape[1]))
+    else:
+        columns = _header_names(raw.iloc[firstRow + header].tolist()) if firstRow + header < len(raw) else \
+            [f'Unnamed: {i}' for i in range(raw.shape[1])]
+        firstRow += header + 1
+
+    lastRow = len(raw) if nrows is None else min(len(raw), firstRow + nrows)
+    df = raw.iloc[firstRow:lastRow].copy()
+    df.columns = columns
+    df.reset_index(drop=True, inplace=True)
+
+    # Header-less parsing leaves mixed header/value columns as objects, so re-type the data rows
+    return df.infer_objects()
+
+
+# Whether a workbook is large enough to be streamed rather than parsed whole (.xls files can't be streamed)
+def should_stream(file_path) -> bool:
+    return excel_engine(file_path) == 'openpyxl' and os.path.getsize(file_path) >= streamThresholdBytes
+
+
+def _worksheet(workbook, sheet_name):
+    return workbook.worksheets[sheet_name] if isinstance(sheet_name, int) else workbook[sheet_name]
+
+
+# Return the number of data rows in a sheet as recorded in the workbook (may include trailing blank rows),
+# or None if the workbook doesn't record its dimensions
+def sheet_row_count(file_path, sheet_name=0, header=0, skiprows=None) -> Optional[int]:
+    workbook = openpyxl.load_workbook(file_path, read_only=True, data_only=True)
+    try:
+        maxRow = _worksheet(workbook, sheet_name).max_row
+    finally:
+        workbook.close()
+    if maxRow is None:
+        return None
+    return max(0, maxRow - _leading_rows(skiprows) - (0 if header is None else header + 1))
+
+
+# Cell value as pandas' openpyxl reader returns it (empty cells are '', whole numbers stored as floats are ints)
+def _cell_value(value):
+    if value is None:
+        return ''
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    return value
+
+
+def _chunk_frame(rows, columns, start_row) -> pd.DataFrame:
+    width = len(columns)
+    values = [[_cell_value(v) for v in row[:width]] + [''] * (width - len(row)) for row in rows]
+    df = pd.DataFrame(values, columns=columns, index=range(start_row, start_row + len(values)))
+    return df.infer_objects()
+
+
+# Stream a sheet as DataFrames of at most chunk_rows rows (openpyxl read-only mode, so only one chunk is in memory
+# at a time). header and skiprows are as in read_sheet, empty cells are '' (as with keep_default_na=False), and
+# the index numbers the data rows across the whole sheet. Trailing blank rows are dropped, and cells to the right
+# of the header row are ignored. Column types are inferred per chunk (e.g. a chunk of a mixed int/float column
+# with no blank cells is float64).
+def iter_sheet_chunks(file_path, sheet_name=0, header=0, skiprows=None, chunk_rows=None) -> Iterator[pd.DataFrame]:
+    if chunk_rows is None:
+        chunk_rows = streamChunkRows
+
+    workbook = openpyxl.load_workbook(file_path, read_only=True, data_only=True)
+    try:
+        rows = _worksheet(workbook, sheet_name).iter_rows(values_only=True)
+        for _ in range(_leading_rows(skiprows) + (header or 0)):
+            next(rows, None)
+
+        if header is None:
+            columns = None
+        else:
+            headerValues = list(next(rows, None) or [])
+            while headerValues and headerValues[-1] is None:
+                headerValues.pop()
+            columns = _header_names(headerValues)
+
+        chunk = []
+        blankRows = []  # Blank rows are only kept if a row with data follows them
+        startRow = 0
+        for values in rows:
+            if columns is None:
+                columns = list(range(len(values)))
+            if all(v is None or (isinstance(v, str) and v == '') for v in values):
+                blankRows.append(values)
+                continue
+            for row in blankRows + [values]:
+                chunk.append(row)
+                if len(chunk) >= chunk_rows:
+                    yield _chunk_frame(chunk, columns, startRow)
+                    startRow += len(chunk)
+                    chunk = []
+            blankRows = []
+
+        if chunk:
+            yield _chunk_frame(chunk, columns, startRow)
+    finally:
+        workbook.close()
+
+
+# Remove every cached sheet (in memory and on disk)
+def clear_cache():
+    _memoryCache.clear()
+    _hashMemo.clear()
+    if os.path.isdir(cacheDirectory):
+        for name in os.listdir(cacheDirectory):
+            if name.endswith('.pkl'):
+                try:
+                    os.remove(os.path.join(cacheDirectory, name))
+                except OSError:
+                    pass
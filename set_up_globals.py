@@ -28,6 +28,20 @@ exitResponseList = ['x', 'bye', 'exit', 'exit()', 'quit', 'q', 'q()']
 
 import_log_file = 'data_import.log'
 
+# Number of rows imported between import journal checkpoints (an interrupted import resumes from the last one)
+importJournalBatchSize = 100
+
+# Every nth superseded version is stored in full in the version history (the rest are stored as deltas)
+versionHistoryKeyframeInterval = 10
+
+# Number of times an update of a participant's clinical data is retried when another import saved it first,
+# and the initial delay between retries in seconds (doubled, with random jitter, on each retry)
+clinicalDataSaveRetries = 5
+clinicalDataRetryDelay = 0.05
+
+# Number of documents fetched or updates sent per bulk operation by the bulk importers (biospecimens, assay summaries)
+bulkWriteBatchSize = 1000
+
 enid_document_name = 'demographic ENIDs'
 clinical_document_name = 'demographic'
 biospecimen_document_name = 'biospecimens'
@@ -42,6 +56,11 @@ data_label_pathway_document_name = 'data label pathway'
 seahorse_document_name = 'Flux and flow cytometry assays'
 cpet_recovery_document_name = 'Survey'
 ev_pilot_study_document_name = 'Cytokines'
+cohort_document_name = 'cohort'
+
+# Assay types whose results of 0 are not stored (mostly zero, e.g. scRNA-seq pseudobulk counts). A result that
+# isn't stored reads as 0 for these assays, rather than as missing (see add_common_data and assay_matrix_service).
+sparseAssayDocumentNames = [scrnaseq_document_name]
 
 gene_symbol_data_label_type = 'Gene Symbol'
 ensembl_gene_id_data_label_type = 'Ensembl Gene ID'
@@ -114,6 +133,25 @@ exportDemographicColumnsForRTIFull = ['study_id', 'cor_id', 'pub_id', 'site', 's
 
 exportAssayColumnsForRTI = ['cor_id', 'timepoint', 'sample_identifier_type', 'annot_1', 'annot_2', 'annot_3']
 
+# Default cohorts, registered in the cohorts collection with the 'defcohorts' command (until then, these study IDs
+# are used directly)
+defaultCohortsDict = {
+    'scRNA-seq ME/CFS': [101, 171, 483, 287, 416, 408, 588, 115, 199, 329, 191, 128, 344, 135, 196, 112, 380, 160, 440,
+                         316, 463, 447, 235, 299, 369, 473, 405, 554, 500, 730],
+    'scRNA-seq HC': [181, 241, 467, 375, 656, 723, 637, 715, 711, 145, 164, 197, 119, 143, 359, 261, 297, 406, 276, 210,
+                     338, 333, 481, 724, 791, 788, 727, 760],
+    'Metabolomics ME/CFS': [101, 112, 115, 128, 135, 136, 160, 171, 191, 196, 199, 204, 205, 223, 228, 230, 235, 240,
+                            264, 284, 287, 290, 299, 311, 316, 350, 358, 369, 372, 380, 396, 403, 405, 408, 416, 420,
+                            440, 447, 463, 473, 483, 500, 521, 523, 524, 526, 551, 554, 558, 576, 583, 588, 594, 600,
+                            678, 679, 698, 701, 702, 730],
+    'Metabolomics HC': [119, 143, 145, 164, 181, 197, 210, 241, 261, 276, 297, 333, 338, 347, 375, 406, 410, 413, 467,
+                        481, 488, 506, 563, 606, 607, 622, 637, 656, 685, 711, 712, 715, 722, 723, 724, 727, 732, 759,
+                        760, 771, 774, 784, 788, 791, 811]}
+
+# Cohorts counted in the binned summary (case cohorts are counted among ME/CFS participants, control cohorts among HCs)
+binnedSummaryCaseCohorts = ['scRNA-seq ME/CFS', 'Metabolomics ME/CFS']
+binnedSummaryControlCohorts = ['scRNA-seq HC', 'Metabolomics HC']
+
 # PF, RP, BP, GH, VT, SF, RE, MH, PCS, and MCS are the 10 subscales of the SF-36v2 Health Survey
 exportDemographicColumnsForSCpaper = ['study_id', 'cor_id', 'sex', 'phenotype', 'age', 'bmi', 'mecfs_sudden_gradual',
                                       'mecfs_duration', 'GH', 'PCS', 'mfi20_total', 'pem_max_delta']
@@ -16,6 +16,7 @@ import data.mongo_setup as mongo_setup
 import set_up_globals
 import infrastructure.state as state
 import services.data_service as svc
+import services.job_service as job_svc
 
 from src.mecfs_ui.components.auth import create_auth_component, handle_login, get_user_choices
 from src.mecfs_ui.components.import_tabs import create_import_tabs
@@ -29,6 +30,11 @@ def build_app() -> gr.Blocks:
     # Initialize MongoDB connection
     mongo_setup.global_init(set_up_globals.database_name)
 
+    # Imports left running by a server process that has since stopped can no longer finish, so make them resumable
+    interrupted_jobs = job_svc.mark_interrupted_jobs()
+    if interrupted_jobs:
+        print(f"Marked {interrupted_jobs} unfinished import job(s) as interrupted")
+
     with gr.Blocks(
         title="ME/CFS Database Manager",
         theme=gr.themes.Soft(),
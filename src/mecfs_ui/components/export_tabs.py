@@ -9,9 +9,13 @@ import sys
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))))
 
 import services.data_service as svc
+import services.cohort_service as cohort_svc
+import services.workbook_cache as workbook_cache
+import services.version_history_service as history_svc
 import set_up_globals
 import utilities
-from src.mecfs_ui.components.file_handlers import modify_df_column_names, parse_assay_metadata
+from services.custom_columns import modify_df_column_names
+from src.mecfs_ui.components.file_handlers import parse_assay_metadata
 
 
 def create_export_tabs(current_user: gr.State):
@@ -33,6 +37,7 @@ This export tool generates TSV files compatible with the mapMECFS import format.
 Use this to export demographic data with binned values for age, BMI, and other fields.
 
 - Select an export format from the dropdown
+- Optionally select one or more cohorts - a membership column is added for each cohort
 - Click "Generate Export" to create the file
 - Preview the data and download the TSV file
 
@@ -62,7 +67,7 @@ Use this to convert assay data into the mapMECFS import format. This generates t
 """)
 
         # Binned Summary Export
-        with gr.TabItem("Binned Summary"):
+        with gr.TabItem("Binned Summary") as binned_tab:
             gr.Markdown("### Export Binned Demographic Summary")
             gr.Markdown("Export demographic data with configurable binning for age, BMI, and other fields.")
 
@@ -78,8 +83,24 @@ Use this to convert assay data into the mapMECFS import format. This generates t
                         value="Full (with study_id)",
                         label="Export Format"
                     )
+                with gr.Column():
+                    cohort_dropdown = gr.Dropdown(
+                        choices=[],
+                        value=[],
+                        multiselect=True,
+                        label="Cohorts",
+                        info="Add a membership column for each selected cohort"
+                    )
+                with gr.Column():
+                    binned_as_of_input = gr.Textbox(
+                        label="As of (optional)",
+                        placeholder="YYYY-MM-DD or YYYY-MM-DD HH:MM",
+                        info="Export the data as it was at this date (blank for current data)"
+                    )
 
-            binned_export_btn = gr.Button("Generate Export", variant="primary")
+            with gr.Row():
+                cohort_refresh_btn = gr.Button("Refresh Cohorts", variant="secondary")
+                binned_export_btn = gr.Button("Generate Export", variant="primary")
             binned_status = gr.HTML(value="")
             binned_preview = gr.Dataframe(
                 label="Export Preview (first 20 rows)",
@@ -91,7 +112,7 @@ Use this to convert assay data into the mapMECFS import format. This generates t
                 visible=False
             )
 
-            def generate_binned_export(export_format, user):
+            def generate_binned_export(export_format, cohort_names, as_of_text, user):
                 if not user:
                     return (
                         "<span class='error-msg'>Please login first</span>",
@@ -112,8 +133,10 @@ Use this to convert assay data into the mapMECFS import format. This generates t
 
                     modified_columns = modify_df_column_names(columns)
 
-                    # Get clinical data from database
-                    clinical_data_list = svc.find_clinical_data()
+                    # Get clinical data from database (current, or as of a date for a reproducible export)
+                    as_of_date = history_svc.parse_as_of_date(as_of_text)
+                    clinical_data_list = svc.find_clinical_data(as_of_date, include_assay_data=False,
+                                                                analytics=True)
 
                     if not clinical_data_list:
                         return (
@@ -136,6 +159,12 @@ Use this to convert assay data into the mapMECFS import format. This generates t
 
                     df = pd.DataFrame(data)
 
+                    # Add cohort membership columns (one vectorized membership test per cohort)
+                    study_ids = [c.study_id for c in clinical_data_list]
+                    cohort_masks = cohort_svc.cohort_membership(study_ids, cohort_names or [])
+                    for cohort_name, mask in cohort_masks.items():
+                        df['in_' + utilities.modify_string(cohort_name)] = mask
+
                     # Apply binning for age and BMI if columns exist
                     for bin_col in ['age', 'bmi']:
                         if bin_col in df.columns:
@@ -146,17 +175,23 @@ Use this to convert assay data into the mapMECFS import format. This generates t
                                     lambda x: get_bin_label(x, bin_ranges) if pd.notna(x) else ''
                                 )
 
-                    # Generate filename with timestamp
-                    timestamp = datetime.now().strftime("%Y-%m-%d_%H%M%S")
-                    filename = f"binned_demographics_{timestamp}.tsv"
+                    # Generate filename with timestamp (exports as of a date are named after that date)
+                    if as_of_date:
+                        filename = f"binned_demographics{history_svc.as_of_date_tag(as_of_date)}.tsv"
+                    else:
+                        timestamp = datetime.now().strftime("%Y-%m-%d_%H%M%S")
+                        filename = f"binned_demographics_{timestamp}.tsv"
 
                     # Save to temp file
                     temp_dir = tempfile.gettempdir()
                     filepath = os.path.join(temp_dir, filename)
                     df.to_csv(filepath, sep="\t", index=False)
 
+                    cohort_counts = ''.join(
+                        f", {cohort_name}: {int(mask.sum())}" for cohort_name, mask in cohort_masks.items()
+                    )
                     return (
-                        f"<span class='success-msg'>Generated {len(df)} records</span>",
+                        f"<span class='success-msg'>Generated {len(df)} records{cohort_counts}</span>",
                         gr.update(value=df.head(20), visible=True),
                         gr.update(value=filepath, visible=True)
                     )
@@ -169,9 +204,21 @@ Use this to convert assay data into the mapMECFS import format. This generates t
                         gr.update(visible=False)
                     )
 
+            # Cohorts are read when the tab is opened (not while the app is built), so new cohorts show up
+            def load_cohort_choices(selected):
+                try:
+                    cohort_names = cohort_svc.find_cohort_names()
+                except Exception:
+                    return gr.update()
+                return gr.update(choices=cohort_names,
+                                 value=[name for name in (selected or []) if name in cohort_names])
+
+            binned_tab.select(fn=load_cohort_choices, inputs=[cohort_dropdown], outputs=[cohort_dropdown])
+            cohort_refresh_btn.click(fn=load_cohort_choices, inputs=[cohort_dropdown], outputs=[cohort_dropdown])
+
             binned_export_btn.click(
                 fn=generate_binned_export,
-                inputs=[export_format_dropdown, current_user],
+                inputs=[export_format_dropdown, cohort_dropdown, binned_as_of_input, current_user],
                 outputs=[binned_status, binned_preview, binned_download]
             )
 
@@ -189,6 +236,12 @@ Use this to convert assay data into the mapMECFS import format. This generates t
             with gr.Accordion("Configuration Preview", open=True):
                 rti_metadata_display = gr.Markdown(value="*Upload a file to see configuration*", visible=True)
 
+            rti_as_of_input = gr.Textbox(
+                label="As of (optional)",
+                placeholder="YYYY-MM-DD or YYYY-MM-DD HH:MM",
+                info="Use the clinical data as it was at this date (blank for current data)"
+            )
+
             rti_export_btn = gr.Button("Generate mapMECFS Export", variant="primary")
             rti_status = gr.HTML(value="")
 
@@ -245,7 +298,7 @@ Use this to convert assay data into the mapMECFS import format. This generates t
                 outputs=[rti_metadata_display]
             )
 
-            def generate_rti_export(file_path, user):
+            def generate_rti_export(file_path, as_of_text, user):
                 if not user:
                     return (
                         "<span class='error-msg'>Please login first</span>",
@@ -269,43 +322,24 @@ Use this to convert assay data into the mapMECFS import format. This generates t
                             gr.update(visible=False)
                         )
 
+                    as_of_date = history_svc.parse_as_of_date(as_of_text)
+
                     unique_assay_name = metadata_dict.get('unique_assay_name', 'unknown')
                     document_name = metadata_dict.get('assay_type', 'unknown')
                     biospecimen_type = metadata_dict.get('biospecimen_type', '')
                     sample_identifier_type = metadata_dict.get('sample_identifier_type', 'ENID+Timepoint')
 
-                    # Read the data table from the Excel file
-                    ext = os.path.splitext(file_path)[1].lower()
-                    engine = 'xlrd' if ext == '.xls' else 'openpyxl'
-
-                    # First read without headers to check for "Required:" row
-                    dataTableDF_raw = pd.read_excel(
-                        file_path,
-                        sheet_name='Data Table',
-                        engine=engine,
-                        header=None,
-                        keep_default_na=False
-                    )
+                    # Read the data table (parsed once and shared with the preview through the workbook parse cache)
+                    dataTableDF_raw = workbook_cache.read_raw_sheet(file_path, sheet_name='Data Table')
 
                     # Check if first row starts with "Required:"
                     first_cell = str(dataTableDF_raw.iloc[0, 0]).strip()
                     if first_cell.startswith('Required:'):
                         # Skip the "Required:" row, use second row as headers
-                        dataTableDF = pd.read_excel(
-                            file_path,
-                            sheet_name='Data Table',
-                            engine=engine,
-                            skiprows=1,
-                            keep_default_na=False
-                        )
+                        dataTableDF = workbook_cache.read_sheet(file_path, sheet_name='Data Table', skiprows=1)
                     else:
                         # No "Required:" row, use first row as headers
-                        dataTableDF = pd.read_excel(
-                            file_path,
-                            sheet_name='Data Table',
-                            engine=engine,
-                            keep_default_na=False
-                        )
+                        dataTableDF = workbook_cache.read_sheet(file_path, sheet_name='Data Table')
 
                     # Normalize column names
                     dataTableDF.columns = modify_df_column_names(dataTableDF.columns)
@@ -335,9 +369,14 @@ Use this to convert assay data into the mapMECFS import format. This generates t
                             gr.update(visible=False)
                         )
 
+                    # Look up the clinical data of every participant in the file at once
+                    clinical_data_dict = svc.find_clinical_data_by_study_ids(dataTableDF[enid_col], as_of_date,
+                                                                             include_assay_data=False,
+                                                                             analytics=True)
+
                     for index, row in dataTableDF.iterrows():
                         study_id = row[enid_col]
-                        clinical_data = svc.find_clinical_data_by_study_id(int(study_id))
+                        clinical_data = clinical_data_dict.get(int(study_id))
                         if clinical_data:
                             timepoint = row.get('timepoint', '') if 'timepoint' in row else ''
                             phenotype_data.append({
@@ -366,8 +405,11 @@ Use this to convert assay data into the mapMECFS import format. This generates t
                         document_name.replace(' ', '_')
                     )
 
-                    # Generate filenames with timestamp
-                    timestamp = datetime.now().strftime("%Y-%m-%d_%H%M%S")
+                    # Generate filenames with timestamp (exports as of a date are named after that date)
+                    if as_of_date:
+                        timestamp = history_svc.as_of_date_tag(as_of_date).lstrip('_')
+                    else:
+                        timestamp = datetime.now().strftime("%Y-%m-%d_%H%M%S")
                     safe_name = unique_assay_name.replace(' ', '_').replace('/', '_')
 
                     temp_dir = tempfile.gettempdir()
@@ -399,13 +441,10 @@ Use this to convert assay data into the mapMECFS import format. This generates t
                         assay_export_df['annot_3'] = ''
 
                     # Add cor_id from clinical data lookup
-                    for idx, row in assay_export_df.iterrows():
-                        study_id = row[enid_col]
-                        clinical_data = svc.find_clinical_data_by_study_id(int(study_id))
-                        if clinical_data:
-                            assay_export_df.loc[idx, 'cor_id'] = clinical_data.cor_id
-                        else:
-                            assay_export_df.loc[idx, 'cor_id'] = ''
+                    assay_export_df['cor_id'] = [
+                        clinical_data_dict[int(study_id)].cor_id if int(study_id) in clinical_data_dict else ''
+                        for study_id in assay_export_df[enid_col]
+                    ]
 
                     # Check for duplicate sample identifiers and warn/handle
                     if sample_identifier_type == 'ENID+Timepoint':
@@ -455,7 +494,7 @@ Use this to convert assay data into the mapMECFS import format. This generates t
 
             rti_export_btn.click(
                 fn=generate_rti_export,
-                inputs=[rti_config_file, current_user],
+                inputs=[rti_config_file, rti_as_of_input, current_user],
                 outputs=[rti_status, rti_phenotype_download, rti_assay_download]
             )
 
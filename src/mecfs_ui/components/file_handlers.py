@@ -1,5 +1,6 @@
 import pandas as pd
 import os
+import time
 from typing import Tuple
 from io import StringIO
 
@@ -7,131 +8,36 @@ import sys
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))))
 
 import services.data_service as svc
-import set_up_globals
-import utilities
+import services.import_journal_service as journal_svc
+import services.import_pipeline as import_pipeline
+import services.validation_service as validation_svc
+import services.table_reader as table_reader
+import services.workbook_cache as workbook_cache
+import services.job_service as job_svc
 
 
-def modify_df_column_names(column_names, classColumnList=None):
+def write_validation_log(log: StringIO, context) -> None:
     """
-    Normalize column names using utilities.modify_string.
-    Matches logic from program_actions.py.
+    Write the validation result of an import (and the first issues, if there are any) to its log.
+    Rows with errors are not imported.
     """
-    renamed_columns = []
-    for i in range(len(column_names)):
-        original_col = str(column_names[i]).strip()
-        col = utilities.modify_string(original_col)
+    log.write(f"Validation: {context.validation.summary()}\n")
+    if len(context.validation.issues.index):
+        log.write(context.validation.format() + "\n")
 
-        # If classColumnsList exists then restrict column names to only those in the class
-        # This prevents the changing of gene symbols that are included as columns in the Excel spreadsheet
-        if (classColumnList is not None) and (col not in classColumnList):
-            renamed_columns.append(original_col)
-        else:
-            renamed_columns.append(col)
 
-    return renamed_columns
-
-
-def create_custom_columns(df, documentName, data_file_name, index_column=None):
+def read_clinical_data_file(file_path: str, data_file_name: str = None) -> pd.DataFrame:
     """
-    Create custom columns based on document type.
-    Matches logic from program_actions.py.
+    Read a clinical data Excel file into a DataFrame ready for svc.add_clinical_data
+    (the read, normalize, and validate stages of the clinical import pipeline).
+
+    Raises:
+        ValueError: If the file has no study_id column
     """
-    df['data_file_name'] = data_file_name
-
-    if documentName == set_up_globals.scrnaseq_summary_document_name:
-        df['study_id'] = df['enid']
-
-    if documentName in [set_up_globals.proteomics_document_name,
-                        set_up_globals.cytokines_document_name,
-                        set_up_globals.metabolomics_document_name,
-                        set_up_globals.mirnaseq_document_name,
-                        set_up_globals.scrnaseq_document_name,
-                        'CPET',
-                        set_up_globals.cpet_recovery_document_name,
-                        'Other']:
-        df['study_id'] = df['ENID']
-
-        validTimePoints = ['D1-PRE', 'D1-POST', 'D2-PRE', 'D2-POST', 'Other', '0h', '15min', '24h', 'D1', 'D2']
-        timepoint_list = []
-        for val in df['timepoint']:
-            if val in validTimePoints:
-                timepoint_list.append(val)
-            elif str(val).lower() == 'pre-day1':
-                timepoint_list.append('D1-PRE')
-            elif str(val).lower() == 'post-day1':
-                timepoint_list.append('D1-POST')
-            elif str(val).lower() == 'pre-day2':
-                timepoint_list.append('D2-PRE')
-            elif str(val).lower() == 'post-day2':
-                timepoint_list.append('D2-POST')
-            else:
-                timepoint_list.append('')
-        df['timepoint'] = timepoint_list
-
-        # Set up unique_id column
-        if index_column == 'AnalysisID':
-            index_names = df[df[index_column] == ''].index
-            df.drop(index_names, inplace=True)
-            df['unique_id'] = df[index_column]
-        elif index_column == 'ENID+Timepoint':
-            unique_id_list = []
-            for index, row in df.iterrows():
-                unique_id_list.append(svc.convert_to_string(row.study_id) + '-' + row.timepoint + '-' + data_file_name)
-            df['unique_id'] = unique_id_list
-        elif index_column == 'ENID+Timepoint+Annot-1':
-            unique_id_list = []
-            for index, row in df.iterrows():
-                unique_id_list.append(svc.convert_to_string(row.study_id) + '-' + row.timepoint + '-' + str(
-                    row.annot_1) + '-' + data_file_name)
-            df['unique_id'] = unique_id_list
-        elif index_column == 'ENID+Timepoint+Annot-1+Annot-2':
-            unique_id_list = []
-            for index, row in df.iterrows():
-                unique_id_list.append(svc.convert_to_string(row.study_id) + '-' + row.timepoint + '-' +
-                                      str(row.annot_1) + '-' + str(row.annot_2) + '-' + data_file_name)
-            df['unique_id'] = unique_id_list
-
-    if documentName == set_up_globals.biospecimen_document_name:
-        df['sample_id'] = df['id']
-        # Set Specimen ID to ENID, CPET Day, Pre/Post, and Specimen type
-        specimen_id_list = []
-        for val in df['specimen_id']:
-            valMinusTubeNumberList = str(val).split('-')[0:4]
-            specimen_id_list.append('-'.join(valMinusTubeNumberList))
-        df['specimen_id'] = specimen_id_list
-
-    if documentName == set_up_globals.clinical_document_name:
-        # Make sure study ID is numeric (i.e. strip off 'ENID' if it exists)
-        study_id_list = [int(str(val).strip('ENID')) for val in df['study_id']]
-        df['study_id'] = study_id_list
-
-        # Create columns for binned values
-        for binColumn in set_up_globals.binnedColumnsDict:
-            df[binColumn + '_binned'] = ''
-
-    if documentName == set_up_globals.data_label_type_document_name:
-        df['unique_id'] = df.index
-        if 'comp_id' not in df.columns:
-            df['comp_id'] = ''
-            df['biochemical'] = ''
-        if 'gene_name' not in df.columns:
-            df['gene_name'] = ''
-        if 'gene_stable_id' not in df.columns:
-            df['gene_stable_id'] = ''
-        if 'cytokine_label' not in df.columns:
-            df['cytokine_label'] = ''
-
-    if documentName == set_up_globals.seahorse_document_name:
-        df['unique_id'] = df[index_column]
-
-    if documentName == set_up_globals.cpet_recovery_document_name:
-        df['pub_id'] = df['ENID']
-
-    if documentName == set_up_globals.ev_pilot_study_document_name:
-        df['unique_id'] = df['ENID']
-
-
-def process_clinical_data_file(file_path: str, user) -> Tuple[bool, str]:
+    return import_pipeline.prepare_file('Clinical', file_path, data_file_name=data_file_name).df
+
+
+def process_clinical_data_file(file_path: str, user, progress_callback=None) -> Tuple[bool, str]:
     """
     Process clinical data Excel file and import to database.
 
@@ -141,65 +47,15 @@ def process_clinical_data_file(file_path: str, user) -> Tuple[bool, str]:
     log = StringIO()
 
     try:
-        # Determine engine based on file extension
-        ext = os.path.splitext(file_path)[1].lower()
-        engine = 'xlrd' if ext == '.xls' else 'openpyxl'
-
-        # Read Excel file
-        df = pd.read_excel(file_path, engine=engine, keep_default_na=False)
-
-        # Normalize column names
-        df.columns = modify_df_column_names(df.columns)
-
-        # Remove rows with empty study_id
-        index_column = 'study_id'
-        if index_column not in df.columns:
-            log.write(f"Error: Required column 'study_id' not found in file\n")
-            return False, log.getvalue()
-
-        index_names = df[df[index_column] == ''].index
-        df.drop(index_names, inplace=True)
-
-        # Add missing required columns with empty values
-        # These are expected by add_clinical_data in data_service.py
-        required_columns = [
-            'cu_id', 'cor_id', 'pub_id', 'site', 'sex', 'phenotype',
-            'ethnicity', 'race', 'mecfs_sudden_gradual', 'qmep_sudevent',
-            'qmep_mediagnosis', 'qmep_mesymptoms', 'qmep_metimediagnosis',
-            'cpet_d1', 'cpet_d2', 'vo2change', 'atchange',
-            'qmep_lived', 'q_medications', 'q_lastantibiotic',
-            'q_lastantibiotic_details', 'q_supplements', 'pahq_activitylist',
-            'hh24hr_eaten_d1', 'hh24hr_coffeetea_d1', 'hh24hr_smoke_d1',
-            'hh24hr_alcohol_d1', 'hh24hr_blood_d1', 'hh24hr_illness_d1',
-            'hh24hr_respiratory_d1', 'hh24hr_medication_d1',
-            'hh24hr_peyesterday_d1', 'hh24hr_petoday_d1',
-            'hh24hr_eaten_d2', 'hh24hr_coffeetea_d2', 'hh24hr_smoke_d2',
-            'hh24hr_alcohol_d2', 'hh24hr_blood_d2', 'hh24hr_illness_d2',
-            'hh24hr_respiratory_d2', 'hh24hr_medication_d2',
-            'hh24hr_peyesterday_d2', 'hh24hr_petoday_d2',
-        ]
-
-        # Add binned columns from config
-        for bin_col in set_up_globals.binnedColumnsDict.keys():
-            if bin_col not in required_columns:
-                required_columns.append(bin_col)
-
-        for col in required_columns:
-            if col not in df.columns:
-                df[col] = ''
-
-        # Create custom columns (data_file_name, etc.)
         data_file_name = os.path.basename(file_path)
-        create_custom_columns(df, set_up_globals.clinical_document_name, data_file_name)
-
-        # Set index
-        df.set_index(index_column, drop=False, inplace=True, verify_integrity=True)
-
-        log.write(f"Parsed {len(df)} records from {data_file_name}\n")
-
-        # Import to database
-        svc.add_clinical_data(user, df, data_file_name)
+        context = import_pipeline.run_import(user, 'Clinical', file_path, data_file_name=data_file_name,
+                                             progress_callback=progress_callback)
 
+        log.write(f"Parsed {len(context.df)} records from {data_file_name}\n")
+        write_validation_log(log, context)
+        log.write(f"Stage times: {import_pipeline.timing_summary(context.timings)}\n")
+        if context.validation.blocks_import:
+            return False, log.getvalue()
         log.write(f"Successfully imported clinical data\n")
         return True, log.getvalue()
 
@@ -210,33 +66,30 @@ def process_clinical_data_file(file_path: str, user) -> Tuple[bool, str]:
         return False, log.getvalue()
 
 
-def process_biospecimen_file(file_path: str, user) -> Tuple[bool, str]:
+def read_biospecimen_file(file_path: str, data_file_name: str = None) -> pd.DataFrame:
+    """
+    Read a biospecimen Excel file into a DataFrame ready for svc.add_biospecimen_data
+    (the read, normalize, and validate stages of the biospecimen import pipeline).
+    """
+    return import_pipeline.prepare_file('Biospecimen', file_path, data_file_name=data_file_name).df
+
+
+def process_biospecimen_file(file_path: str, user, progress_callback=None) -> Tuple[bool, str]:
     """
     Process biospecimen data Excel file and import to database.
     """
     log = StringIO()
 
     try:
-        ext = os.path.splitext(file_path)[1].lower()
-        engine = 'xlrd' if ext == '.xls' else 'openpyxl'
-
-        df = pd.read_excel(file_path, engine=engine, keep_default_na=False)
-        df.columns = modify_df_column_names(df.columns)
-
-        index_column = 'specimen_id'
-        index_names = df[df[index_column] == ''].index
-        df.drop(index_names, inplace=True)
-
         data_file_name = os.path.basename(file_path)
-        create_custom_columns(df, set_up_globals.biospecimen_document_name, data_file_name)
-
-        # Don't verify integrity for biospecimen (may have duplicates)
-        df.set_index(index_column, drop=False, inplace=True, verify_integrity=False)
-
-        log.write(f"Parsed {len(df)} records from {data_file_name}\n")
-
-        svc.add_biospecimen_data(user, df, data_file_name)
+        context = import_pipeline.run_import(user, 'Biospecimen', file_path, data_file_name=data_file_name,
+                                             progress_callback=progress_callback)
 
+        log.write(f"Parsed {len(context.df)} records from {data_file_name}\n")
+        write_validation_log(log, context)
+        log.write(f"Stage times: {import_pipeline.timing_summary(context.timings)}\n")
+        if context.validation.blocks_import:
+            return False, log.getvalue()
         log.write(f"Successfully imported biospecimen data\n")
         return True, log.getvalue()
 
@@ -253,17 +106,8 @@ def parse_assay_metadata(file_path: str) -> Tuple[dict, str]:
         Tuple of (metadata_dict, error_message or empty string)
     """
     try:
-        ext = os.path.splitext(file_path)[1].lower()
-        engine = 'xlrd' if ext == '.xls' else 'openpyxl'
-
         # Parse metadata sheet
-        metadata_df = pd.read_excel(
-            file_path,
-            sheet_name='Metadata',
-            skiprows=range(0, 3),
-            engine=engine,
-            keep_default_na=False
-        )
+        metadata_df = workbook_cache.read_sheet(file_path, sheet_name='Metadata', skiprows=range(0, 3))
 
         metadata_dict = {}
         for _, row in metadata_df.iterrows():
@@ -278,15 +122,167 @@ def parse_assay_metadata(file_path: str) -> Tuple[dict, str]:
         return {}, str(e)
 
 
-def process_assay_file(file_path: str, user, metadata_dict: dict = None) -> Tuple[bool, str]:
+VALID_ASSAY_TYPES = import_pipeline.validAssayTypes
+
+
+def read_assay_data_file(file_path: str, metadata_dict: dict, data_file_name: str = None) -> pd.DataFrame:
+    """
+    Read the Data Table sheet of an assay Excel file (or a TSV, CSV, or Parquet data table uploaded with the
+    workbook) into a DataFrame ready for svc.add_assay_meta_data
+    (the read, normalize, and validate stages of the assay import pipeline).
+
+    Raises:
+        ValueError: If the assay type in the metadata is not valid or the unique IDs are not unique
+    """
+    return import_pipeline.prepare_file('Assay', file_path, data_file_name=data_file_name,
+                                        meta_data=metadata_dict).df
+
+
+def should_stream_assay_data(file_path: str) -> bool:
+    """
+    Whether an assay workbook or data table is large enough to be imported in chunks rather than read whole.
+    """
+    if table_reader.is_data_table_file(file_path):
+        return os.path.getsize(file_path) >= workbook_cache.streamThresholdBytes
+    return workbook_cache.should_stream(file_path)
+
+
+def assay_data_row_count(file_path: str) -> int:
+    """
+    Number of data rows in an assay workbook's Data Table sheet or in a data table (0 if it isn't recorded).
+    """
+    if table_reader.is_data_table_file(file_path):
+        return table_reader.data_table_row_count(file_path)
+    return workbook_cache.sheet_row_count(file_path, sheet_name='Data Table') or 0
+
+
+def iter_assay_data_chunks(file_path: str, metadata_dict: dict, data_file_name: str = None, start_row: int = 0,
+                           chunk_rows: int = None):
+    """
+    Stream the Data Table sheet of a large assay Excel file (or a data table) in chunks of at most chunk_rows rows,
+    yielding an import context per chunk that has been through the read, normalize, and validate stages.
+    Rows with validation errors are left out of context.rows(), and the first start_row of the other rows are skipped
+    (counted as in run_import). Each context records its rows' position in the file for the import journal.
+
+    Raises:
+        ValueError: If the assay type in the metadata is not valid or the unique IDs are not unique (a unique ID
+            in an earlier chunk is checked for too, as in a whole-sheet import)
+    """
+    pipeline = import_pipeline.get_pipeline('Assay')
+
+    if table_reader.is_data_table_file(file_path):
+        chunks = table_reader.iter_data_table_chunks(file_path, chunk_rows)
+    else:
+        chunks = workbook_cache.iter_sheet_chunks(file_path, sheet_name='Data Table',
+                                                  skiprows=import_pipeline.assay_sheet_skiprows(file_path),
+                                                  chunk_rows=chunk_rows)
+
+    content_hash = workbook_cache.file_content_hash(file_path)
+    rows_before = 0  # Valid rows in the chunks so far
+    rows_read = 0
+    seen_ids = set()  # Unique IDs of the chunks so far
+    while True:
+        start_time = time.perf_counter()
+        chunk_df = next(chunks, None)
+        if chunk_df is None:
+            break
+
+        context = import_pipeline.new_context(None, 'Assay', file_path, data_file_name=data_file_name,
+                                              meta_data=metadata_dict)
+        context.df = chunk_df
+        context.first_row = rows_read
+        context.content_hash = content_hash
+        context.completes_file = False  # The journal is completed after the last chunk
+        context.timings['read'] = time.perf_counter() - start_time
+        pipeline.run(context, ('normalize', 'validate'))
+        rows_read += len(context.df)
+
+        duplicates = context.df.index[context.df.index.isin(seen_ids)]
+        if len(duplicates):
+            raise ValueError(f'Create of index for {context.document_name} data resulted in exception: '
+                             f'Index has duplicate keys: {list(duplicates.unique())}')
+        seen_ids.update(context.df.index)
+
+        chunk_start = rows_before
+        rows_before += len(context.valid_rows())
+        if chunk_start < start_row and rows_before <= start_row:
+            continue  # Every valid row of the chunk was imported before (a chunk without any is still validated)
+        context.row_offset = chunk_start
+        context.start_row = max(0, start_row - chunk_start)
+        yield context
+
+
+def import_assay_data_chunks(user, file_path: str, metadata_dict: dict, data_file_name: str = None,
+                             start_row: int = 0, progress_callback=None, chunk_rows: int = None,
+                             resume: bool = False) -> import_pipeline.ImportContext:
+    """
+    Import a large assay Excel file (or data table) one chunk of rows at a time, so only one chunk is held in
+    memory. Each chunk runs through the resolve and write stages of the assay import pipeline, and the import
+    is logged once, with the stage times summed over the chunks. Progress is reported across the whole table
+    (the total is estimated from the sheet dimensions or line count until the last chunk has been read).
+    The chunks share one import journal entry for the file; with resume set, rows already imported are skipped.
+
+    Returns:
+        The import context of the whole file (rows_processed, error_count, and the validation report of every chunk)
+    """
+    pipeline = import_pipeline.get_pipeline('Assay')
+    summary = import_pipeline.new_context(user, 'Assay', file_path, data_file_name=data_file_name,
+                                          meta_data=metadata_dict)
+
+    total_rows = max(0, assay_data_row_count(file_path) - start_row)
+    rows_done = 0
+    valid_rows = 0
+    error_count = 0
+    reports = []
+    first_rows = []
+
+    for context in iter_assay_data_chunks(file_path, metadata_dict, data_file_name, start_row, chunk_rows):
+        def chunk_progress(rows_processed, chunk_total, errors):
+            if progress_callback is not None:
+                processed = rows_done + rows_processed
+                progress_callback(processed, max(total_rows, processed + 1), error_count + errors)
+
+        context.active_account = user
+        context.progress_callback = chunk_progress
+        context.resume = resume
+        pipeline.run(context, ('resolve', 'diff', 'write'))
+
+        rows_done += len(context.rows())
+        valid_rows = context.row_offset + len(context.valid_rows())
+        error_count += context.error_count
+        summary.dropped_rows += context.dropped_rows
+        reports.append(context.validation)
+        first_rows.append(context.first_row)
+        for stage_name, seconds in context.timings.items():
+            summary.timings[stage_name] = summary.timings.get(stage_name, 0.0) + seconds
+
+    # Complete the file's journal entry (or, if rows failed, commit the rows before the first one)
+    journal = journal_svc.find_import_journal(summary.data_file_name, workbook_cache.file_content_hash(file_path),
+                                              summary.document_name)
+    if journal:
+        svc.finish_journal(journal, valid_rows)
+
+    summary.rows_processed = rows_done
+    summary.error_count = error_count
+    summary.validation = validation_svc.combine_reports(reports, first_rows, summary.document_name,
+                                                        summary.data_file_name)
+    pipeline.run(summary, ('log',))
+
+    if progress_callback is not None:
+        progress_callback(rows_done, rows_done, error_count)
+
+    return summary
+
+
+def process_assay_file(file_path: str, user, metadata_dict: dict = None, progress_callback=None,
+                       data_table_path: str = None) -> Tuple[bool, str]:
     """
     Process assay data Excel file with metadata sheet and import to database.
+    If data_table_path is given, the data is read from that TSV, CSV, or Parquet file instead of the Data Table sheet.
     """
     log = StringIO()
 
     try:
-        ext = os.path.splitext(file_path)[1].lower()
-        engine = 'xlrd' if ext == '.xls' else 'openpyxl'
         data_file_name = os.path.basename(file_path)
 
         # Parse metadata if not provided
@@ -299,51 +295,28 @@ def process_assay_file(file_path: str, user, metadata_dict: dict = None) -> Tupl
         log.write(f"Parsed metadata: {metadata_dict.get('unique_assay_name', 'Unknown')}\n")
         log.write(f"Assay type: {metadata_dict.get('assay_type', 'Unknown')}\n")
 
-        # Validate assay type
-        valid_types = [
-            set_up_globals.proteomics_document_name,
-            set_up_globals.cytokines_document_name,
-            set_up_globals.metabolomics_document_name,
-            set_up_globals.mirnaseq_document_name,
-            set_up_globals.scrnaseq_document_name,
-            set_up_globals.seahorse_document_name,
-            'BDNF', 'CPET', 'LPS', 'Other'
-        ]
-
-        assay_type = metadata_dict.get('assay_type', '')
-        if assay_type not in valid_types:
-            log.write(f"Error: Invalid assay type: {assay_type}\n")
-            log.write(f"Valid types: {', '.join(valid_types)}\n")
-            return False, log.getvalue()
+        data_path = data_table_path or file_path
 
-        # Parse data sheet
-        data_df = pd.read_excel(
-            file_path,
-            sheet_name='Data Table',
-            engine=engine,
-            keep_default_na=False
-        )
-
-        # Normalize column names
-        data_df.columns = modify_df_column_names(data_df.columns)
-
-        # Get sample identifier type
-        sample_identifier_type = metadata_dict.get('sample_identifier_type', 'ENID+Timepoint')
-
-        # Create custom columns
-        create_custom_columns(data_df, assay_type, data_file_name, index_column=sample_identifier_type)
-
-        log.write(f"Parsed {len(data_df)} data rows\n")
+        # Data too large to read whole is imported a chunk of rows at a time
+        if should_stream_assay_data(data_path):
+            summary = import_assay_data_chunks(user, data_path, metadata_dict, data_file_name,
+                                               progress_callback=progress_callback)
+            log.write(f"Imported {summary.rows_processed} data rows in chunks of {workbook_cache.streamChunkRows}\n")
+            write_validation_log(log, summary)
+            log.write(f"Stage times: {import_pipeline.timing_summary(summary.timings)}\n")
+            if summary.validation.blocks_import:
+                return False, log.getvalue()
+            log.write(f"Successfully imported assay data\n")
+            return True, log.getvalue()
 
-        # Import assay data
-        svc.add_assay_meta_data(
-            user,
-            data_df,
-            data_file_name,
-            metadata_dict,
-            assay_type
-        )
+        context = import_pipeline.run_import(user, 'Assay', data_path, data_file_name=data_file_name,
+                                             meta_data=metadata_dict, progress_callback=progress_callback)
 
+        log.write(f"Parsed {len(context.df)} data rows\n")
+        write_validation_log(log, context)
+        log.write(f"Stage times: {import_pipeline.timing_summary(context.timings)}\n")
+        if context.validation.blocks_import:
+            return False, log.getvalue()
         log.write(f"Successfully imported assay data\n")
         return True, log.getvalue()
 
@@ -352,3 +325,34 @@ def process_assay_file(file_path: str, user, metadata_dict: dict = None) -> Tupl
         import traceback
         log.write(traceback.format_exc())
         return False, log.getvalue()
+
+
+# Background import job runners (see services/job_service.py). Each re-reads the job's copy of the file; a resumed
+# job resumes from the import journal, so a cancelled or interrupted job picks up after the last committed batch
+# of rows (or the first row that failed). Biospecimen imports aren't journaled and are imported again whole.
+# An assay job's file is either the workbook or the data table uploaded with it (job.file_name is the workbook's).
+# Each returns the file's validation report, so a job whose file fails validation isn't reported as completed.
+
+def run_clinical_import_job(job, resume, progress_callback):
+    return import_pipeline.run_import(job.created_by, 'Clinical', job.file_path, data_file_name=job.file_name,
+                                      resume=resume, progress_callback=progress_callback).validation
+
+
+def run_biospecimen_import_job(job, resume, progress_callback):
+    return import_pipeline.run_import(job.created_by, 'Biospecimen', job.file_path, data_file_name=job.file_name,
+                                      progress_callback=progress_callback).validation
+
+
+def run_assay_import_job(job, resume, progress_callback):
+    metadata_dict = dict(job.meta_data)
+    if should_stream_assay_data(job.file_path):
+        return import_assay_data_chunks(job.created_by, job.file_path, metadata_dict, job.file_name,
+                                        progress_callback=progress_callback, resume=resume).validation
+    return import_pipeline.run_import(job.created_by, 'Assay', job.file_path, data_file_name=job.file_name,
+                                      meta_data=metadata_dict, resume=resume,
+                                      progress_callback=progress_callback).validation
+
+
+job_svc.register_job_type('Clinical', run_clinical_import_job)
+job_svc.register_job_type('Biospecimen', run_biospecimen_import_job)
+job_svc.register_job_type('Assay', run_assay_import_job)
@@ -5,14 +5,71 @@ import sys
 
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))))
 
+import services.table_reader as table_reader
+import services.workbook_cache as workbook_cache
+import services.job_service as job_svc
 from src.mecfs_ui.components.file_handlers import (
-    process_clinical_data_file,
-    process_biospecimen_file,
-    process_assay_file,
-    parse_assay_metadata
+    parse_assay_metadata,
+    VALID_ASSAY_TYPES
 )
 
 
+def format_duration(seconds):
+    """Format a number of seconds as e.g. '1h 02m', '3m 05s' or '12s'."""
+    if seconds is None:
+        return "unknown"
+    seconds = int(round(seconds))
+    hours, remainder = divmod(seconds, 3600)
+    minutes, seconds = divmod(remainder, 60)
+    if hours:
+        return f"{hours}h {minutes:02d}m"
+    if minutes:
+        return f"{minutes}m {seconds:02d}s"
+    return f"{seconds}s"
+
+
+def format_job_progress(progress: dict):
+    """Return the status HTML and log text for the progress of an import job."""
+    status = progress['status']
+    css_class = {'Completed': 'success-msg', 'Failed': 'error-msg', 'Cancelled': 'warning-msg',
+                 'Interrupted': 'warning-msg'}.get(status, '')
+    if status == 'Completed' and progress['error_count']:
+        css_class = 'warning-msg'
+
+    counts = f"{progress['rows_processed']:,} of {progress['total_rows']:,} rows"
+    if status == 'Running':
+        counts += f" ({progress['rows_per_second']:.1f} rows/sec, ETA {format_duration(progress['eta_seconds'])})"
+    html = (f"<span class='{css_class}'>{progress['job_type']} import {status.lower()}: {counts}, "
+            f"{progress['error_count']} errors</span>")
+
+    log = (f"Job ID: {progress['job_id']}\n"
+           f"File: {progress['file_name']}\n"
+           f"Status: {status}\n"
+           f"Rows processed: {progress['rows_processed']:,} / {progress['total_rows']:,}\n"
+           f"Rate: {progress['rows_per_second']:.1f} rows/sec\n"
+           f"Errors: {progress['error_count']} (see the event log for details)\n")
+    if progress['message']:
+        log += f"{progress['message']}\n"
+
+    return html, log
+
+
+def stream_import_job(job_id):
+    """Yield (job_id, status_html, log_update) until the import job finishes."""
+    for progress in job_svc.watch_job(job_id):
+        html, log = format_job_progress(progress)
+        yield job_id, html, gr.update(value=log, visible=True)
+
+
+def cancel_import_job(job_id):
+    """Request cancellation of an import job and return a status message."""
+    if not job_id:
+        return "<span class='error-msg'>No import is running</span>"
+    if job_svc.cancel_job(job_id):
+        return "<span class='warning-msg'>Cancelling import...</span>"
+    return "<span class='error-msg'>This import is not queued or running</span>"
+
+
 def create_import_tabs(current_user: gr.State):
     """Create import functionality tabs."""
 
@@ -32,7 +89,10 @@ def create_import_tabs(current_user: gr.State):
                 interactive=False,
                 visible=False
             )
-            clinical_import_btn = gr.Button("Import to Database", variant="primary")
+            with gr.Row():
+                clinical_import_btn = gr.Button("Import to Database", variant="primary")
+                clinical_cancel_btn = gr.Button("Cancel Import", variant="stop")
+            clinical_job_id = gr.State(value=None)
             clinical_status = gr.HTML(value="")
             clinical_log = gr.Textbox(
                 label="Import Log",
@@ -46,9 +106,7 @@ def create_import_tabs(current_user: gr.State):
                 if not file_path:
                     return gr.update(visible=False), ""
                 try:
-                    ext = os.path.splitext(file_path)[1].lower()
-                    engine = 'xlrd' if ext == '.xls' else 'openpyxl'
-                    df = pd.read_excel(file_path, nrows=10, engine=engine)
+                    df = workbook_cache.read_sheet(file_path, nrows=10)
                     return gr.update(value=df, visible=True), ""
                 except Exception as e:
                     return gr.update(visible=False), f"<span class='error-msg'>Error: {e}</span>"
@@ -61,31 +119,29 @@ def create_import_tabs(current_user: gr.State):
 
             def import_clinical(file_path, user):
                 if not user:
-                    return "<span class='error-msg'>Please login first</span>", gr.update(visible=False)
+                    yield None, "<span class='error-msg'>Please login first</span>", gr.update(visible=False)
+                    return
                 if not file_path:
-                    return "<span class='error-msg'>Please upload a file</span>", gr.update(visible=False)
+                    yield None, "<span class='error-msg'>Please upload a file</span>", gr.update(visible=False)
+                    return
 
                 try:
-                    result, log = process_clinical_data_file(file_path, user)
-                    if result:
-                        return (
-                            f"<span class='success-msg'>Successfully imported clinical data</span>",
-                            gr.update(value=log, visible=True)
-                        )
-                    return (
-                        f"<span class='error-msg'>Import failed</span>",
-                        gr.update(value=log, visible=True)
-                    )
+                    job = job_svc.submit_job(user, 'Clinical', file_path)
                 except Exception as e:
-                    return (
-                        f"<span class='error-msg'>Error: {e}</span>",
-                        gr.update(visible=False)
-                    )
+                    yield None, f"<span class='error-msg'>Error: {e}</span>", gr.update(visible=False)
+                    return
+
+                yield from stream_import_job(str(job.id))
 
             clinical_import_btn.click(
                 fn=import_clinical,
                 inputs=[clinical_file, current_user],
-                outputs=[clinical_status, clinical_log]
+                outputs=[clinical_job_id, clinical_status, clinical_log]
+            )
+            clinical_cancel_btn.click(
+                fn=cancel_import_job,
+                inputs=[clinical_job_id],
+                outputs=[clinical_status]
             )
 
         # Biospecimen Data Import
@@ -103,7 +159,10 @@ def create_import_tabs(current_user: gr.State):
                 interactive=False,
                 visible=False
             )
-            biospecimen_import_btn = gr.Button("Import to Database", variant="primary")
+            with gr.Row():
+                biospecimen_import_btn = gr.Button("Import to Database", variant="primary")
+                biospecimen_cancel_btn = gr.Button("Cancel Import", variant="stop")
+            biospecimen_job_id = gr.State(value=None)
             biospecimen_status = gr.HTML(value="")
             biospecimen_log = gr.Textbox(
                 label="Import Log",
@@ -117,9 +176,7 @@ def create_import_tabs(current_user: gr.State):
                 if not file_path:
                     return gr.update(visible=False), ""
                 try:
-                    ext = os.path.splitext(file_path)[1].lower()
-                    engine = 'xlrd' if ext == '.xls' else 'openpyxl'
-                    df = pd.read_excel(file_path, nrows=10, engine=engine)
+                    df = workbook_cache.read_sheet(file_path, nrows=10)
                     return gr.update(value=df, visible=True), ""
                 except Exception as e:
                     return gr.update(visible=False), f"<span class='error-msg'>Error: {e}</span>"
@@ -132,37 +189,39 @@ def create_import_tabs(current_user: gr.State):
 
             def import_biospecimen(file_path, user):
                 if not user:
-                    return "<span class='error-msg'>Please login first</span>", gr.update(visible=False)
+                    yield None, "<span class='error-msg'>Please login first</span>", gr.update(visible=False)
+                    return
                 if not file_path:
-                    return "<span class='error-msg'>Please upload a file</span>", gr.update(visible=False)
+                    yield None, "<span class='error-msg'>Please upload a file</span>", gr.update(visible=False)
+                    return
 
                 try:
-                    result, log = process_biospecimen_file(file_path, user)
-                    if result:
-                        return (
-                            f"<span class='success-msg'>Successfully imported biospecimen data</span>",
-                            gr.update(value=log, visible=True)
-                        )
-                    return (
-                        f"<span class='error-msg'>Import failed</span>",
-                        gr.update(value=log, visible=True)
-                    )
+                    job = job_svc.submit_job(user, 'Biospecimen', file_path)
                 except Exception as e:
-                    return (
-                        f"<span class='error-msg'>Error: {e}</span>",
-                        gr.update(visible=False)
-                    )
+                    yield None, f"<span class='error-msg'>Error: {e}</span>", gr.update(visible=False)
+                    return
+
+                yield from stream_import_job(str(job.id))
 
             biospecimen_import_btn.click(
                 fn=import_biospecimen,
                 inputs=[biospecimen_file, current_user],
-                outputs=[biospecimen_status, biospecimen_log]
+                outputs=[biospecimen_job_id, biospecimen_status, biospecimen_log]
+            )
+            biospecimen_cancel_btn.click(
+                fn=cancel_import_job,
+                inputs=[biospecimen_job_id],
+                outputs=[biospecimen_status]
             )
 
         # Assay Data Import
         with gr.TabItem("Assay Data"):
             gr.Markdown("### Import Assay Data")
             gr.Markdown("Upload an Excel file with 'Metadata' and 'Data Table' sheets.")
+            gr.Markdown(
+                "Large data tables can be uploaded as a separate TSV, CSV, or Parquet file, which is imported "
+                "instead of the 'Data Table' sheet."
+            )
             gr.Markdown("Supported assay types: Proteomics, Cytokines, Metabolomics, miRNA-seq, scRNA-seq, Seahorse, etc.")
 
             assay_file = gr.File(
@@ -170,6 +229,11 @@ def create_import_tabs(current_user: gr.State):
                 file_types=[".xlsx", ".xls"],
                 type="filepath"
             )
+            assay_table_file = gr.File(
+                label="Upload Data Table File (optional)",
+                file_types=[".tsv", ".csv", ".txt", ".parquet"],
+                type="filepath"
+            )
 
             # Metadata display
             with gr.Accordion("Metadata Preview", open=True):
@@ -188,7 +252,10 @@ def create_import_tabs(current_user: gr.State):
                 visible=False
             )
 
-            assay_import_btn = gr.Button("Import to Database", variant="primary", interactive=False)
+            with gr.Row():
+                assay_import_btn = gr.Button("Import to Database", variant="primary", interactive=False)
+                assay_cancel_btn = gr.Button("Cancel Import", variant="stop")
+            assay_job_id = gr.State(value=None)
             assay_status = gr.HTML(value="")
             assay_log = gr.Textbox(
                 label="Import Log",
@@ -198,7 +265,7 @@ def create_import_tabs(current_user: gr.State):
                 visible=False
             )
 
-            def preview_assay(file_path):
+            def preview_assay(file_path, table_path):
                 if not file_path:
                     return (
                         gr.update(visible=False),
@@ -208,9 +275,6 @@ def create_import_tabs(current_user: gr.State):
                         ""
                     )
                 try:
-                    ext = os.path.splitext(file_path)[1].lower()
-                    engine = 'xlrd' if ext == '.xls' else 'openpyxl'
-
                     # Parse metadata sheet
                     metadata_dict, error = parse_assay_metadata(file_path)
                     if error:
@@ -222,8 +286,15 @@ def create_import_tabs(current_user: gr.State):
                             f"<span class='error-msg'>Error parsing metadata: {error}</span>"
                         )
 
-                    # Parse data sheet
-                    data_df = pd.read_excel(file_path, sheet_name='Data Table', nrows=10, engine=engine)
+                    # Parse data sheet (or the first rows of the data table)
+                    if table_path:
+                        chunks = table_reader.iter_data_table_chunks(table_path, chunk_rows=10)
+                        try:
+                            data_df = next(chunks, pd.DataFrame())
+                        finally:
+                            chunks.close()
+                    else:
+                        data_df = workbook_cache.read_sheet(file_path, sheet_name='Data Table', nrows=10)
 
                     return (
                         gr.update(value=metadata_dict, visible=True),
@@ -241,11 +312,12 @@ def create_import_tabs(current_user: gr.State):
                         f"<span class='error-msg'>Error parsing file: {e}</span>"
                     )
 
-            assay_file.change(
-                fn=preview_assay,
-                inputs=[assay_file],
-                outputs=[metadata_display, assay_preview, assay_confirm, assay_import_btn, assay_status]
-            )
+            for assay_input in (assay_file, assay_table_file):
+                assay_input.change(
+                    fn=preview_assay,
+                    inputs=[assay_file, assay_table_file],
+                    outputs=[metadata_display, assay_preview, assay_confirm, assay_import_btn, assay_status]
+                )
 
             # Enable import button when confirmed
             assay_confirm.change(
@@ -254,35 +326,124 @@ def create_import_tabs(current_user: gr.State):
                 outputs=[assay_import_btn]
             )
 
-            def import_assay(file_path, user, confirmed):
+            def import_assay(file_path, table_path, user, confirmed):
                 if not user:
-                    return "<span class='error-msg'>Please login first</span>", gr.update(visible=False)
+                    yield None, "<span class='error-msg'>Please login first</span>", gr.update(visible=False)
+                    return
                 if not file_path:
-                    return "<span class='error-msg'>Please upload a file</span>", gr.update(visible=False)
+                    yield None, "<span class='error-msg'>Please upload a file</span>", gr.update(visible=False)
+                    return
                 if not confirmed:
-                    return "<span class='error-msg'>Please confirm metadata is correct</span>", gr.update(visible=False)
+                    yield (
+                        None,
+                        "<span class='error-msg'>Please confirm metadata is correct</span>",
+                        gr.update(visible=False)
+                    )
+                    return
 
                 try:
-                    result, log = process_assay_file(file_path, user)
-                    if result:
-                        return (
-                            f"<span class='success-msg'>Successfully imported assay data</span>",
-                            gr.update(value=log, visible=True)
+                    metadata_dict, error = parse_assay_metadata(file_path)
+                    if error:
+                        yield (
+                            None,
+                            f"<span class='error-msg'>Error parsing metadata: {error}</span>",
+                            gr.update(visible=False)
                         )
-                    return (
-                        f"<span class='error-msg'>Import failed</span>",
-                        gr.update(value=log, visible=True)
-                    )
+                        return
+                    if metadata_dict.get('assay_type', '') not in VALID_ASSAY_TYPES:
+                        yield (
+                            None,
+                            f"<span class='error-msg'>Invalid assay type: {metadata_dict.get('assay_type', '')}</span>",
+                            gr.update(value=f"Valid types: {', '.join(VALID_ASSAY_TYPES)}", visible=True)
+                        )
+                        return
+                    if table_path:
+                        # The job imports the data table, recorded under the workbook's name
+                        job = job_svc.submit_job(user, 'Assay', table_path, meta_data=metadata_dict,
+                                                 file_name=os.path.basename(file_path))
+                    else:
+                        job = job_svc.submit_job(user, 'Assay', file_path, meta_data=metadata_dict)
                 except Exception as e:
-                    return (
-                        f"<span class='error-msg'>Error: {e}</span>",
-                        gr.update(visible=False)
-                    )
+                    yield None, f"<span class='error-msg'>Error: {e}</span>", gr.update(visible=False)
+                    return
+
+                yield from stream_import_job(str(job.id))
 
             assay_import_btn.click(
                 fn=import_assay,
-                inputs=[assay_file, current_user, assay_confirm],
-                outputs=[assay_status, assay_log]
+                inputs=[assay_file, assay_table_file, current_user, assay_confirm],
+                outputs=[assay_job_id, assay_status, assay_log]
+            )
+            assay_cancel_btn.click(
+                fn=cancel_import_job,
+                inputs=[assay_job_id],
+                outputs=[assay_status]
+            )
+
+        # Import Jobs
+        with gr.TabItem("Import Jobs"):
+            gr.Markdown("### Import Jobs")
+            gr.Markdown(
+                "Imports run in the background. Cancelled, failed, or interrupted imports can be resumed "
+                "from the last row imported."
+            )
+
+            jobs_table = gr.Dataframe(label="Recent Imports", interactive=False)
+            jobs_refresh_btn = gr.Button("Refresh")
+            job_id_input = gr.Textbox(label="Job ID")
+            with gr.Row():
+                job_resume_btn = gr.Button("Resume Import", variant="primary")
+                job_cancel_btn = gr.Button("Cancel Import", variant="stop")
+            job_status = gr.HTML(value="")
+            job_log = gr.Textbox(
+                label="Import Log",
+                lines=10,
+                max_lines=20,
+                interactive=False,
+                visible=False
+            )
+
+            def list_jobs():
+                rows = []
+                for job in job_svc.find_recent_jobs():
+                    progress = job_svc.job_progress(job)
+                    rows.append({
+                        'Job ID': progress['job_id'],
+                        'Type': progress['job_type'],
+                        'File': progress['file_name'],
+                        'Status': progress['status'],
+                        'Rows': f"{progress['rows_processed']:,} / {progress['total_rows']:,}",
+                        'Errors': progress['error_count'],
+                        'Created': job.created_date.strftime('%Y-%m-%d %H:%M') if job.created_date else '',
+                    })
+                return pd.DataFrame(rows)
+
+            def resume_job(job_id, user):
+                if not user:
+                    yield job_id, "<span class='error-msg'>Please login first</span>", gr.update(visible=False)
+                    return
+                job_id = (job_id or '').strip()
+                job = job_svc.resume_job(job_id)
+                if not job:
+                    yield (
+                        job_id,
+                        "<span class='error-msg'>This import cannot be resumed (see the server log)</span>",
+                        gr.update(visible=False)
+                    )
+                    return
+
+                yield from stream_import_job(str(job.id))
+
+            jobs_refresh_btn.click(fn=list_jobs, outputs=[jobs_table])
+            job_resume_btn.click(
+                fn=resume_job,
+                inputs=[job_id_input, current_user],
+                outputs=[job_id_input, job_status, job_log]
+            )
+            job_cancel_btn.click(
+                fn=lambda job_id: cancel_import_job((job_id or '').strip()),
+                inputs=[job_id_input],
+                outputs=[job_status]
             )
 
     return {}
@@ -28,7 +28,7 @@ def create_query_tabs(current_user: gr.State):
 
             def load_clinical_data():
                 try:
-                    clinical_data_list = svc.find_clinical_data()
+                    clinical_data_list = svc.find_clinical_data(analytics=True)
 
                     if not clinical_data_list:
                         return "<span class='warning-msg'>No clinical data found</span>", pd.DataFrame()
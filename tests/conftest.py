@@ -0,0 +1,46 @@
+import datetime
+
+import mongoengine
+import pytest
+
+
+# Newer pymongo passes a sort option to the bulk write builder, which mongomock doesn't accept (and has no use for)
+def _without_sort(method):
+    def add(self, *args, sort=None, **kwargs):
+        return method(self, *args, **kwargs)
+    return add
+
+
+@pytest.fixture
+def database(monkeypatch):
+    """Connect the 'core' alias to an in-memory mongomock database for the duration of a test."""
+    mongomock = pytest.importorskip('mongomock')
+    from mongomock.collection import BulkOperationBuilder
+    for name in ('add_update', 'add_replace'):
+        monkeypatch.setattr(BulkOperationBuilder, name, _without_sort(getattr(BulkOperationBuilder, name)))
+    mongoengine.connect('mecfs_test', alias='core', mongo_client_class=mongomock.MongoClient,
+                        uuidRepresentation='standard')
+    yield
+    mongoengine.disconnect(alias='core')
+
+
+@pytest.fixture
+def user(database):
+    from data.users import User
+    return User(name='Test User', email='test@example.org').save()
+
+
+@pytest.fixture
+def participant(user):
+    """Factory for clinical data documents: participant(study_id, **fields)."""
+    from data.clinical_data import ClinicalData
+
+    def make(study_id, **fields):
+        now = datetime.datetime(2026, 1, 1)
+        values = dict(created_by=user, created_date=now, last_modified_by=user, last_modified_date=now,
+                      study_id=study_id, version_number=1, phenotype='ME/CFS', age=40, data_file_name='clinical.xlsx',
+                      cu_id=f'CU{study_id}', cor_id=f'COR{study_id}', pub_id=f'PUB{study_id}')
+        values.update(fields)
+        return ClinicalData(**values).save()
+
+    return make
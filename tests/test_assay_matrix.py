@@ -0,0 +1,85 @@
+import numpy as np
+import pytest
+import scipy.sparse
+
+from data.clinical_data import ClinicalData
+import services.assay_matrix_service as matrix_svc
+
+
+def sample(unique_id, timepoint, results, unique_assay_name='Cytokine Plasma MFI', sparse=False):
+    return {'unique_assay_name': unique_assay_name, 'timepoint': timepoint, 'unique_id': unique_id,
+            'zero_results_omitted': sparse,
+            'assay_results': [{'data_label': label, 'data_label_type': 'Cytokine Label', 'result': result}
+                              for label, result in results.items()]}
+
+
+@pytest.fixture
+def assay_data(database):
+    def insert(*participants):
+        ClinicalData._get_collection().insert_many(
+            [{'study_id': study_id, 'assay_meta_data': samples} for study_id, samples in participants])
+    return insert
+
+
+def test_matrix_has_a_row_per_sample_and_a_column_per_label(assay_data):
+    assay_data((102, [sample('102-D1-PRE', 'D1-PRE', {'IL6': 4.0, 'TNF': 5.0})]),
+               (101, [sample('101-D1-PRE', 'D1-PRE', {'IL6': 1.0}),
+                      sample('101-D2-PRE', 'D2-PRE', {'TNF': 3.0}),
+                      sample('101-other', 'D1-PRE', {'IL6': 9.0}, unique_assay_name='Other')]))
+
+    matrix = matrix_svc.get_assay_matrix('Cytokine Plasma MFI')
+
+    assert list(matrix.study_ids) == [101, 101, 102]
+    assert list(matrix.timepoints) == ['D1-PRE', 'D2-PRE', 'D1-PRE']
+    assert list(matrix.labels) == ['IL6', 'TNF']
+    np.testing.assert_array_equal(matrix.values, [[1.0, np.nan], [np.nan, 3.0], [4.0, 5.0]])
+
+
+def test_results_without_a_value_keep_the_labels_aligned(assay_data):
+    results = {'IL1': 1.0, 'IL6': None, 'TNF': 3.0}
+    assay_data((101, [sample('101-D1-PRE', 'D1-PRE', results)]))
+    ClinicalData._get_collection().update_one({'study_id': 101},
+                                              {'$unset': {'assay_meta_data.0.assay_results.1.result': ''}})
+
+    matrix = matrix_svc.get_assay_matrix('Cytokine Plasma MFI')
+
+    assert list(matrix.labels) == ['IL1', 'IL6', 'TNF']
+    np.testing.assert_array_equal(matrix.values, [[1.0, np.nan, 3.0]])
+
+
+def test_labels_and_timepoints_select_the_columns_and_rows(assay_data):
+    assay_data((101, [sample('101-D1-PRE', 'D1-PRE', {'IL6': 1.0, 'TNF': 2.0}),
+                      sample('101-D2-PRE', 'D2-PRE', {'IL6': 3.0, 'TNF': 4.0})]))
+
+    matrix = matrix_svc.get_assay_matrix('Cytokine Plasma MFI', labels=['TNF', 'IL2', 'TNF'], timepoints=['D2-PRE'])
+
+    assert list(matrix.labels) == ['TNF', 'IL2']
+    assert list(matrix.unique_ids) == ['101-D2-PRE']
+    np.testing.assert_array_equal(matrix.values, [[4.0, np.nan]])
+
+
+def test_samples_without_a_study_id_are_left_out(assay_data):
+    assay_data((None, [sample('x-D1-PRE', 'D1-PRE', {'IL6': 1.0})]),
+               (101, [sample('101-D1-PRE', 'D1-PRE', {'IL6': 2.0})]))
+
+    matrix = matrix_svc.get_assay_matrix('Cytokine Plasma MFI')
+
+    assert list(matrix.study_ids) == [101]
+    np.testing.assert_array_equal(matrix.values, [[2.0]])
+
+
+def test_pathway_averages_count_results_not_stored_in_sparse_rows_as_0(assay_data):
+    assay_data((101, [sample('101-D1-PRE', 'D1-PRE', {'CD4': 6.0}, sparse=True)]),
+               (102, [sample('102-D1-PRE', 'D1-PRE', {'CD4': 6.0, 'CD8A': np.nan}, sparse=True)]))
+    labels = ['CD4', 'CD8A', 'GAPDH']
+
+    # 101: CD8A and GAPDH weren't stored (0); 102: CD8A was missing from the file
+    matrix = matrix_svc.get_assay_matrix('Cytokine Plasma MFI', labels=labels)
+    assert scipy.sparse.issparse(matrix.values)
+    np.testing.assert_array_equal(matrix_svc.pathway_averages(matrix, labels), [2.0, 3.0])
+
+    # Rows stored with their results of 0 in the same matrix (which is then dense)
+    assay_data((103, [sample('103-D1-PRE', 'D1-PRE', {'CD4': 6.0})]))
+    matrix = matrix_svc.get_assay_matrix('Cytokine Plasma MFI', labels=labels)
+    assert not scipy.sparse.issparse(matrix.values)
+    np.testing.assert_array_equal(matrix_svc.pathway_averages(matrix, labels), [2.0, 3.0, 6.0])
@@ -0,0 +1,90 @@
+import os
+
+import numpy as np
+import pytest
+import scipy.sparse
+
+from data.assay_change_counters import AssayChangeCounter
+from data.clinical_data import ClinicalData
+import services.assay_matrix_cache as matrix_cache
+import services.assay_matrix_service as matrix_svc
+
+assayName = 'scRNA-seq pseudobulk'
+
+
+@pytest.fixture(autouse=True)
+def cache_directory(tmp_path, monkeypatch):
+    directory = str(tmp_path / 'matrix_cache')
+    monkeypatch.setattr(matrix_cache, 'cacheDirectory', directory)
+    matrix_cache._sidecarMemo.clear()
+    return directory
+
+
+def insert_assay(study_id, results, sparse=True):
+    ClinicalData._get_collection().insert_one(
+        {'study_id': study_id,
+         'assay_meta_data': [{'unique_assay_name': assayName, 'timepoint': 'D1-PRE', 'unique_id': f'{study_id}-D1-PRE',
+                              'zero_results_omitted': sparse,
+                              'assay_results': [{'data_label': label, 'result': result}
+                                                for label, result in results.items()]}]})
+
+
+def record_change():
+    AssayChangeCounter.objects(unique_assay_name=assayName).update_one(inc__counter=1, upsert=True)
+
+
+def test_sparse_matrix_round_trips_through_the_cache(database, cache_directory):
+    insert_assay(101, {'CD4': 3.0, 'GAPDH': 7.0})
+    insert_assay(102, {'CD8A': 1.0})
+
+    built = matrix_cache.load_assay_matrix(assayName)
+    loaded = matrix_cache.load_assay_matrix(assayName)
+
+    expected = matrix_svc.get_assay_matrix(assayName)
+    assert scipy.sparse.issparse(loaded.values)
+    assert list(loaded.labels) == list(expected.labels) == ['CD4', 'CD8A', 'GAPDH']
+    np.testing.assert_array_equal(loaded.values.toarray(), expected.values.toarray())
+    np.testing.assert_array_equal(built.values.toarray(), expected.values.toarray())
+    assert list(loaded.study_ids) == [101, 102]
+    assert sorted(name.split('.', 1)[1] for name in os.listdir(cache_directory) if name.endswith('.npy')) == \
+        ['data.npy', 'indices.npy', 'indptr.npy', 'study_ids.npy']
+
+
+def test_dense_matrix_round_trips_through_the_cache(database):
+    insert_assay(101, {'IL6': 1.5, 'TNF': None}, sparse=False)
+
+    matrix_cache.load_assay_matrix(assayName)
+    loaded = matrix_cache.load_assay_matrix(assayName)
+
+    assert isinstance(loaded.values, np.ndarray)
+    np.testing.assert_array_equal(loaded.values, [[1.5, np.nan]])
+
+
+def test_a_change_to_the_assay_rebuilds_the_matrix(database, cache_directory):
+    insert_assay(101, {'CD4': 3.0})
+    assert matrix_cache.load_assay_matrix(assayName).values.toarray().tolist() == [[3.0]]
+
+    ClinicalData._get_collection().update_one({'study_id': 101},
+                                              {'$set': {'assay_meta_data.0.assay_results.0.result': 5.0}})
+    assert matrix_cache.load_assay_matrix(assayName).values.toarray().tolist() == [[3.0]]  # Counter not bumped
+
+    record_change()
+    assert matrix_cache.load_assay_matrix(assayName).values.toarray().tolist() == [[5.0]]
+    counters = {name.split('-')[1] for name in os.listdir(cache_directory) if name.endswith('.npy')}
+    assert counters == {'1'}  # The files of the build before the change are removed
+
+
+def test_a_write_keeps_builds_of_the_same_counter(database, cache_directory):
+    insert_assay(101, {'CD4': 3.0})
+    record_change()
+    record_change()
+    key = matrix_cache._assay_key(assayName)
+    os.makedirs(cache_directory)
+    for name in (f'{key}-1-99.data.npy', f'{key}-2-99.data.npy'):
+        np.save(os.path.join(cache_directory, name), np.zeros(1))
+
+    matrix_cache.load_assay_matrix(assayName)
+
+    names = os.listdir(cache_directory)
+    assert f'{key}-1-99.data.npy' not in names
+    assert f'{key}-2-99.data.npy' in names  # Another process's build of the current counter
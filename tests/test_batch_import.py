@@ -0,0 +1,36 @@
+import pandas as pd
+import pytest
+
+pytest.importorskip('utilities')
+
+import batch_import
+from data.event_log import Event_log
+import services.validation_service as validation_svc
+import set_up_globals
+
+
+def test_partitions_are_split_by_participant():
+    df = pd.DataFrame({'study_id': [101, 102, 103, 'x']}, index=['a', 'b', 'c', 'd'])
+
+    partitions = batch_import.partition_by_participant(df, 2)
+
+    assert {i: list(p.index) for i, p in partitions.items()} == {0: ['b', 'd'], 1: ['a', 'c']}
+
+
+def test_workbook_import_is_logged_once_with_its_validation(user):
+    issues = pd.DataFrame([[2, '103-D1-PRE', 'study_id', '103', 'error', 'reference', 'No clinical data']],
+                          columns=validation_svc.reportColumns)
+    parsed = {'file_path': '/incoming/proteomics.xlsx', 'data_file_name': 'proteomics.xlsx',
+              'meta_data': {'unique_assay_name': 'proteomics-test'},
+              'document_name': set_up_globals.proteomics_document_name,
+              'validation': validation_svc.ValidationReport('Proteomics', 'proteomics.xlsx', issues, 3),
+              'invalid_rows': 1, 'dropped_rows': 0, 'timings': {'read': 1.0, 'validate': 0.5}}
+    summary = {'rows': 2, 'errors': 1}
+
+    batch_import.log_workbook_import(user, parsed, summary, {'write': 2.0, 'resolve': 0.25})
+
+    events = Event_log.objects(file_name='proteomics.xlsx')
+    assert events.count() == 1
+    assert not events[0].success
+    assert ': 2 rows, 0 errors. Validation: 1 errors in 1 rows (reference 1)' in events[0].message
+    assert 'read 1.00 s, validate 0.50 s, write 2.00 s, resolve 0.25 s' in events[0].message
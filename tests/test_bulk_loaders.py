@@ -0,0 +1,177 @@
+import pandas as pd
+import pytest
+
+pytest.importorskip('utilities')
+
+from data.biospecimens import Biospecimen
+from data.clinical_data import ClinicalData
+from data.event_log import Event_log
+from data.version_history import VersionDelta
+import services.data_service as svc
+import services.version_history_service as history_svc
+import set_up_globals
+
+
+@pytest.fixture(autouse=True)
+def no_retry_delay(monkeypatch):
+    monkeypatch.setattr(set_up_globals, 'clinicalDataRetryDelay', 0)
+
+
+def deltas(**key):
+    return sorted(VersionDelta.objects(**key).values_list('version_number'))
+
+def biospecimen_row(specimen_id, sample_id, **fields):
+    study_id, cpet_day, pre_post_cpet, specimen_type = specimen_id.split('-')
+    row = dict(specimen_id=specimen_id, study_id=study_id, cpet_day=cpet_day, pre_post_cpet=pre_post_cpet,
+               specimen_type=specimen_type, sample_id=str(sample_id), date_received='2026-01-05 00:00:00',
+               data_file_name='biospecimens.xlsx', tube_number='1', freezer_id='F1', box_number='1',
+               box_position=str(sample_id), analysis_id='', is_removed='FALSE', comments='')
+    row.update(fields)
+    return row
+
+
+def biospecimen_sheet(*rows):
+    return pd.DataFrame(list(rows)).set_index('specimen_id', drop=False)
+
+
+def tubes(specimen_id):
+    biospecimen = Biospecimen.objects(specimen_id=specimen_id).first()
+    return {t.sample_id: t.box_number for t in biospecimen.biospecimen_tube_info}
+
+
+def test_biospecimens_are_inserted_then_replaced_with_a_version_delta(user):
+    svc.add_biospecimen_data(user, biospecimen_sheet(biospecimen_row('101-D1-PRE-Serum', 1),
+                                                     biospecimen_row('101-D1-PRE-Serum', 2),
+                                                     biospecimen_row('102-D1-PRE-Serum', 3),
+                                                     biospecimen_row('103-D1-PRE-Serum', 4, tube_number='x')),
+                             'biospecimens.xlsx')
+    assert Biospecimen.objects.count() == 2  # The specimen whose only tube can't be converted isn't written
+    assert tubes('101-D1-PRE-Serum') == {1: 1, 2: 1}
+    assert Event_log.objects(success=False, document_id='103-D1-PRE-Serum').count() == 1
+    assert deltas() == []
+
+    svc.add_biospecimen_data(user, biospecimen_sheet(biospecimen_row('101-D1-PRE-Serum', 1, box_number='7'),
+                                                     biospecimen_row('101-D1-PRE-Serum', 5)),
+                             'biospecimens.xlsx')
+    saved = Biospecimen.objects(specimen_id='101-D1-PRE-Serum').first()
+    assert (saved.version_number, tubes(saved.specimen_id)) == (2, {1: 7, 2: 1, 5: 1})
+    assert deltas(specimen_id='101-D1-PRE-Serum') == [1]
+    oldTubes = history_svc.snapshot_as_of('101-D1-PRE-Serum', 1, 'Biospecimen')['biospecimen_tube_info']
+    assert {t['sample_id']: t['box_number'] for t in oldTubes} == {1: 1, 2: 1}
+    assert Biospecimen.objects(specimen_id='102-D1-PRE-Serum').first().version_number == 1
+
+
+def test_biospecimen_saved_meanwhile_is_merged_again(user):
+    svc.add_biospecimen_data(user, biospecimen_sheet(biospecimen_row('101-D1-PRE-Serum', 1)), 'biospecimens.xlsx')
+    stale = svc.find_biospecimen_data_by_specimen_ids(['101-D1-PRE-Serum'])
+    svc.add_biospecimen_data(user, biospecimen_sheet(biospecimen_row('101-D1-PRE-Serum', 2)), 'biospecimens.xlsx')
+
+    svc.add_biospecimen_data(user, biospecimen_sheet(biospecimen_row('101-D1-PRE-Serum', 3)), 'biospecimens.xlsx',
+                             existingBiospecimens=stale)
+
+    saved = Biospecimen.objects(specimen_id='101-D1-PRE-Serum').first()
+    assert (saved.version_number, tubes(saved.specimen_id)) == (3, {1: 1, 2: 1, 3: 1})
+    assert deltas(specimen_id='101-D1-PRE-Serum') == [1, 2]
+
+
+def enid_sheet(*rows):
+    return pd.DataFrame([{'study_id': study_id, 'cu_id': cu_id, 'cor_id': cor_id, 'pub_id': pub_id,
+                          'data_file_name': 'enids.xlsx'} for study_id, cu_id, cor_id, pub_id in rows]) \
+        .set_index('study_id', drop=False)
+
+
+def test_enids_are_inserted_updated_or_left_unchanged(user, participant):
+    participant(101)
+
+    counts = svc.add_enid_data(user, enid_sheet((101, 'CU101', 'COR101', 'PUB101'), (102, 'CU102', 'COR102', 'PUB102')),
+                               'enids.xlsx')
+    assert counts == {'inserted': 1, 'updated': 0, 'unchanged': 1, 'errors': 0}
+    assert deltas() == []
+
+    counts = svc.add_enid_data(user, enid_sheet((101, 'CU101', 'COR101', 'PUB101'), (102, 'CU102', 'COR-2', 'PUB102')),
+                               'enids.xlsx')
+    assert counts == {'inserted': 0, 'updated': 1, 'unchanged': 1, 'errors': 0}
+    saved = ClinicalData.objects(study_id=102).first()
+    assert (saved.cor_id, saved.version_number, saved.revision) == ('COR-2', 2, 2)
+    assert deltas(study_id=102) == [1]
+    assert history_svc.snapshot_as_of(102, 1)['cor_id'] == 'COR102'
+    assert ClinicalData.objects(study_id=101).first().version_number == 1
+
+
+def test_enid_update_of_a_participant_saved_meanwhile_is_retried(user, participant, monkeypatch):
+    participant(101)
+    stale = svc.find_clinical_data_by_study_ids([101])
+    other = ClinicalData.objects(study_id=101).first()
+    other.age = 41
+    assert svc.save_clinical_data_revision(other)
+    monkeypatch.setattr(svc, 'find_clinical_data_by_study_ids', lambda study_ids: stale)
+
+    counts = svc.add_enid_data(user, enid_sheet((101, 'CU-1', 'COR101', 'PUB101')), 'enids.xlsx')
+
+    assert counts == {'inserted': 0, 'updated': 1, 'unchanged': 0, 'errors': 0}
+    saved = ClinicalData.objects(study_id=101).first()
+    assert (saved.cu_id, saved.age, saved.version_number) == ('CU-1', 41, 2)
+    assert deltas(study_id=101) == [1]  # The record written for the stale copy is deleted
+    assert history_svc.snapshot_as_of(101, 1)['cu_id'] == 'CU101'
+
+
+def scrnaseq_row(study_id, sampleid, cells=1000):
+    counts = ['mean_reads_per_cell', 'median_genes_per_cell', 'number_of_reads', 'ten_x_batch', 'firstpass_nextseq',
+              'secondpass_nextseq', 'hiseq_x5', 'novaseq_s4', 'nextseq2k']
+    fractions = ['valid_barcodes', 'sequencing_saturation', 'q30_bases_in_barcode', 'q30_bases_in_rna_read',
+                 'q30_bases_in_sample_index', 'q30_bases_in_umi', 'reads_mapped_to_genome',
+                 'reads_mapped_confidently_to_genome', 'reads_mapped_confidently_to_intergenic_regions',
+                 'reads_mapped_confidently_to_intronic_regions', 'reads_mapped_confidently_to_exonic_regions',
+                 'reads_mapped_confidently_to_transcriptome', 'reads_mapped_antisense_to_gene',
+                 'fraction_reads_in_cells', 'total_genes_detected', 'median_umi_counts_per_cell']
+    row = {'sampleid': sampleid, 'study_id': study_id, 'data_file_name': 'metrics.xlsx', 'enid': study_id,
+           'estimated_number_of_cells': cells, 'brc_id': f'BRC{sampleid}', 'bc': 'A1', 'notes': '',
+           'sample_name': f'{study_id}-D1-PRE-PBMC-{sampleid}'}
+    row.update({field: 1 for field in counts})
+    row.update({field: 0.5 for field in fractions})
+    return row
+
+
+def scrnaseq_sheet(*rows):
+    return pd.DataFrame(list(rows)).set_index('sampleid', drop=False)
+
+
+def samples(study_id):
+    clinicalData = ClinicalData.objects(study_id=study_id).first()
+    return {s.sampleid: s.estimated_number_of_cells for s in clinicalData.scrnaseq_summary}
+
+
+def test_scrnaseq_samples_are_merged_into_each_participant(user, participant):
+    participant(101)
+    participant(102)
+
+    svc.add_scrnaseq_summary_data(user, scrnaseq_sheet(scrnaseq_row(101, 1), scrnaseq_row(101, 2),
+                                                       scrnaseq_row(102, 3)), 'metrics.xlsx')
+    svc.add_scrnaseq_summary_data(user, scrnaseq_sheet(scrnaseq_row(101, 1, cells=2000), scrnaseq_row(999, 4)),
+                                  'metrics.xlsx')
+
+    assert samples(101) == {1: 2000, 2: 1000}
+    assert samples(102) == {3: 1000}
+    assert ClinicalData.objects(study_id=101).first().revision == 2
+    assert Event_log.objects(success=False, study_id='999').count() == 1
+
+
+def test_scrnaseq_participant_saved_meanwhile_is_merged_again(user, participant, monkeypatch):
+    participant(101)
+    embeddedIndex = svc.embedded_index
+    calls = []
+
+    # Another import saves the participant after this one has fetched it
+    def save_meanwhile(document, listName, key):
+        if not calls:
+            ClinicalData.objects(study_id=101).update(set__age=41, inc__revision=1)
+        calls.append(document.revision)
+        return embeddedIndex(document, listName, key)
+
+    monkeypatch.setattr(svc, 'embedded_index', save_meanwhile)
+
+    svc.add_scrnaseq_summary_data(user, scrnaseq_sheet(scrnaseq_row(101, 1)), 'metrics.xlsx')
+
+    saved = ClinicalData.objects(study_id=101).first()
+    assert calls == [0, 1]
+    assert (samples(101), saved.age, saved.revision) == ({1: 1000}, 41, 2)
@@ -0,0 +1,51 @@
+import pytest
+
+pytest.importorskip('utilities')
+
+from data.clinical_data import ClinicalData
+import services.data_service as svc
+import set_up_globals
+
+
+@pytest.fixture(autouse=True)
+def no_retry_delay(monkeypatch):
+    monkeypatch.setattr(set_up_globals, 'clinicalDataRetryDelay', 0)
+
+
+def test_save_fails_if_saved_since_loaded(participant):
+    participant(101)
+    stale = ClinicalData.objects(study_id=101).first()
+    fresh = ClinicalData.objects(study_id=101).first()
+    fresh.age = 41
+    assert svc.save_clinical_data_revision(fresh)
+
+    stale.phenotype = 'Healthy Control'
+    assert not svc.save_clinical_data_revision(stale)
+    saved = ClinicalData.objects(study_id=101).first()
+    assert (saved.age, saved.phenotype, saved.revision) == (41, 'ME/CFS', 1)
+
+
+def test_update_reapplies_mutate_to_reloaded_document(user, participant):
+    participant(101)
+    stale = ClinicalData.objects(study_id=101).first()
+    other = ClinicalData.objects(study_id=101).first()
+    other.age = 41
+    assert svc.save_clinical_data_revision(other)
+
+    calls = []
+
+    def set_phenotype(clinical_data):
+        calls.append(clinical_data.age)
+        clinical_data.phenotype = 'Healthy Control'
+
+    svc.update_clinical_data(user, 101, set_phenotype, clinical_data=stale)
+    saved = ClinicalData.objects(study_id=101).first()
+    assert calls == [40, 41]  # The stale copy first, then the reloaded one
+    assert (saved.age, saved.phenotype, saved.revision) == (41, 'Healthy Control', 2)
+
+
+def test_update_gives_up_after_retries(user, participant, monkeypatch):
+    participant(101)
+    monkeypatch.setattr(svc, 'save_clinical_data_revision', lambda clinical_data: False)
+    with pytest.raises(svc.ConcurrentUpdateError):
+        svc.update_clinical_data(user, 101, lambda clinical_data: None)
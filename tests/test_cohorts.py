@@ -0,0 +1,33 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('utilities')
+
+import services.cohort_service as cohort_svc
+import set_up_globals
+
+
+def test_unregistered_default_cohort_is_counted_from_its_default_study_ids(database):
+    name = 'scRNA-seq ME/CFS'
+    members = set_up_globals.defaultCohortsDict[name][:3]
+    study_ids = np.array(members + [999999], dtype=object)
+    bin_numbers = [1, 2, 2, 1]
+
+    masks = cohort_svc.cohort_membership(study_ids, [name])
+    counts = cohort_svc.count_cohorts_by_bin(bin_numbers, masks, 2)
+
+    assert masks[name].tolist() == [True, True, True, False]
+    assert counts[name].tolist() == [0, 1, 2]
+
+
+def test_registered_cohort_replaces_the_default_study_ids(user):
+    name = 'scRNA-seq HC'
+    cohort_svc.save_cohort(user, name, ['ENID5', 'ENID6'])
+
+    masks = cohort_svc.cohort_membership([5, 6, set_up_globals.defaultCohortsDict[name][0]], [name])
+
+    assert masks[name].tolist() == [True, True, False]
+
+
+def test_unknown_cohort_has_no_members(database):
+    assert len(cohort_svc.get_cohort_study_ids('No such cohort')) == 0
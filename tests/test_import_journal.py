@@ -0,0 +1,112 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import services.import_journal_service as journal_svc
+
+
+def rows(count):
+    return pd.DataFrame({'study_id': range(101, 101 + count)})
+
+
+def open_journal(user, df, resume=False, row_offset=0):
+    return journal_svc.open_import_journal(user, 'clinical.xlsx', 'Clinical', df, resume, content_hash='file-hash',
+                                           row_offset=row_offset)
+
+
+def test_resume_keeps_the_committed_offset_and_a_new_import_resets_it(user):
+    journal = open_journal(user, rows(10))
+    journal_svc.commit_import_batch(journal, 4)
+
+    resumed = open_journal(user, rows(10), resume=True)
+    assert (resumed.id, resumed.status, resumed.committed_rows, resumed.run_count) == \
+        (journal.id, 'In progress', 4, 2)
+
+    restarted = open_journal(user, rows(10))
+    assert (restarted.committed_rows, restarted.run_count) == (0, 3)
+
+
+def test_committed_offset_stays_before_the_first_failed_row(user):
+    journal = open_journal(user, rows(10))
+    journal_svc.record_failed_row(journal, 6)
+    journal_svc.record_failed_row(journal, 8)  # A later failure doesn't move the offset
+
+    assert journal_svc.commit_import_batch(journal, 5) == 5
+    assert journal_svc.finish_import_journal(journal, 10) == 6
+    assert journal.status == 'In progress'
+
+    resumed = open_journal(user, rows(10), resume=True)
+    assert (resumed.committed_rows, resumed.failed_row) == (6, None)  # The failed row is retried
+
+
+def test_chunks_share_one_journal_until_the_last_completes_the_file(user):
+    journal = open_journal(user, rows(5))
+    assert journal_svc.finish_import_journal(journal, 5, completes_file=False) == 5
+    assert journal.status == 'In progress'
+
+    journal = open_journal(user, rows(3), row_offset=5)
+    journal_svc.record_failed_row(journal, 6)
+    assert (journal.total_rows, journal.run_count) == (8, 1)
+    assert journal_svc.finish_import_journal(journal, 8, completes_file=False) == 6
+
+    journal = open_journal(user, rows(2), row_offset=8)
+    assert journal.failed_row == 6  # Only a run starting at the first row clears it
+    journal_svc.finish_import_journal(journal, 10, completes_file=False)
+    assert journal_svc.find_import_journal('clinical.xlsx', 'file-hash', 'Clinical').committed_rows == 6
+
+
+def test_complete_journal_commits_every_row(user):
+    open_journal(user, rows(5))
+    journal = open_journal(user, rows(3), row_offset=5)
+    journal_svc.finish_import_journal(journal, 8)
+
+    saved = journal_svc.find_import_journal('clinical.xlsx', 'file-hash', 'Clinical')
+    assert (saved.status, saved.committed_rows, saved.total_rows) == ('Completed', 8, 8)
+    assert saved.completed_date is not None
+
+
+def test_open_journal_returns_the_row_to_resume_from(user):
+    pytest.importorskip('utilities')
+    import services.data_service as svc
+
+    journal, startRow = svc.open_journal(user, 'clinical.xlsx', 'Clinical', rows(5), contentHash='file-hash',
+                                         rowOffset=5)
+    assert startRow == 0
+    journal_svc.commit_import_batch(journal, 7)
+
+    assert svc.open_journal(user, 'clinical.xlsx', 'Clinical', rows(5), resume=True, contentHash='file-hash',
+                            rowOffset=5)[1] == 2
+
+    journal_svc.complete_import_journal(journal)
+    assert svc.open_journal(user, 'clinical.xlsx', 'Clinical', rows(5), resume=True, contentHash='file-hash',
+                            rowOffset=5)[1] == 5
+
+
+def test_row_hashes_do_not_depend_on_the_dtypes_a_sheet_was_read_with():
+    asNumbers = pd.DataFrame({'study_id': [101, 102, 103],
+                              'age': [40.0, np.nan, 41.5],
+                              'bmi': pd.Series([22, 23, 24], dtype='int64'),
+                              'sex': ['F', None, 'M']})
+    asText = pd.DataFrame({'sex': ['F ', '', 'M'],
+                           'bmi': ['22', '23', '24'],
+                           'age': ['40', '', '41.5'],
+                           'study_id': ['101', '102', '103']})
+    asObjects = pd.DataFrame({'study_id': [101, 102, 103],
+                              'age': pd.Series([40.0, float('nan'), 41.5], dtype=object),
+                              'bmi': [22.0, 23.0, 24.0],
+                              'sex': ['F', np.nan, 'M']})
+
+    hashes = journal_svc.row_content_hashes(asNumbers)
+    assert hashes.tolist() == journal_svc.row_content_hashes(asText).tolist()
+    assert hashes.tolist() == journal_svc.row_content_hashes(asObjects).tolist()
+    assert hashes.is_unique
+
+
+def test_row_hashes_change_with_a_value_or_a_column():
+    df = pd.DataFrame({'study_id': [101], 'age': [40.0]})
+
+    rowHash = journal_svc.row_content_hashes(df).iloc[0]
+
+    assert journal_svc.row_content_hashes(df.assign(age=40.5)).iloc[0] != rowHash
+    assert journal_svc.row_content_hashes(df.assign(age=np.nan)).iloc[0] != rowHash
+    assert journal_svc.row_content_hashes(df.rename(columns={'age': 'bmi'})).iloc[0] != rowHash
@@ -0,0 +1,97 @@
+import pytest
+
+pytest.importorskip('utilities')
+openpyxl = pytest.importorskip('openpyxl')
+
+from data.clinical_data import ClinicalData
+import services.import_pipeline as import_pipeline
+import services.workbook_cache as workbook_cache
+import set_up_globals
+
+
+@pytest.fixture(autouse=True)
+def parse_cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(workbook_cache, 'cacheDirectory', str(tmp_path / 'parse_cache'))
+
+
+# An assay workbook as submitted: the Metadata sheet first (three title rows, then a field/value table) and the
+# Data Table sheet second
+def write_assay_workbook(path, rows):
+    workbook = openpyxl.Workbook()
+    metadata = workbook.active
+    metadata.title = 'Metadata'
+    for _ in range(3):
+        metadata.append(['Assay metadata'])
+    metadata.append(['Field', 'Value'])
+    metadata.append(['Unique Assay Name', 'proteomics-test'])
+    metadata.append(['Assay Type', set_up_globals.proteomics_document_name])
+    metadata.append(['Sample Identifier Type', 'ENID+Timepoint'])
+    metadata.append(['Biospecimen Type', 'Serum'])
+    metadata.append(['Data Label Type', 'Gene Symbol'])
+
+    dataTable = workbook.create_sheet('Data Table')
+    dataTable.append(['ENID', 'Timepoint', 'Annot-1', 'Annot-2', 'Annot-3', 'Plate', 'APOA1', 'CRP'])
+    for row in rows:
+        dataTable.append(row)
+    workbook.save(path)
+
+
+def test_run_import_reads_the_data_table_of_an_assay_workbook(tmp_path, user, participant):
+    participant(101)
+    participant(102)
+    path = tmp_path / 'proteomics.xlsx'
+    write_assay_workbook(path, [[101, 'Pre-Day1', '', '', '', 1, 1.5, 2.5],
+                                [102, 'Pre-Day1', '', '', '', 1, 3.5, 'NA']])
+
+    metaData, documentName, externalFileName = import_pipeline.read_assay_metadata(str(path))
+    assert documentName == set_up_globals.proteomics_document_name
+    context = import_pipeline.run_import(user, 'Assay', str(path), meta_data=metaData)
+
+    assert context.sheet_name == "Data Table"
+    assert len(context.valid_rows().index) == 2
+    results = {}
+    for clinicalData in ClinicalData.objects(study_id__in=[101, 102]):
+        for assayRow in clinicalData.assay_meta_data:
+            assert assayRow.unique_assay_name == 'proteomics-test'
+            results.update({(clinicalData.study_id, r.data_label): r.result for r in assayRow.assay_results})
+    assert results == {(101, 'APOA1'): 1.5, (101, 'CRP'): 2.5, (102, 'APOA1'): 3.5}
+
+
+def write_assay_data_table(path, rows):
+    lines = ['ENID,Timepoint,Annot-1,Annot-2,Annot-3,Plate,APOA1,CRP'] + [','.join(map(str, row)) for row in rows]
+    path.write_text('\n'.join(lines) + '\n')
+
+
+def proteomics_meta_data(**fields):
+    metaData = {'unique_assay_name': 'proteomics-test', 'assay_type': set_up_globals.proteomics_document_name,
+                'sample_identifier_type': 'ENID+Timepoint', 'biospecimen_type': 'Serum',
+                'data_label_type': 'Gene Symbol'}
+    metaData.update(fields)
+    return metaData
+
+
+def test_chunked_import_rejects_a_unique_id_repeated_in_a_later_chunk(tmp_path, user, participant):
+    file_handlers = pytest.importorskip('src.mecfs_ui.components.file_handlers')
+    participant(101)
+    path = tmp_path / 'proteomics.csv'
+    write_assay_data_table(path, [[101, 'Pre-Day1', '', '', '', 1, 1.5, 2.5],
+                                  [101, 'Pre-Day1', '', '', '', 1, 3.5, 4.5]])
+
+    with pytest.raises(ValueError, match='duplicate'):
+        file_handlers.import_assay_data_chunks(user, str(path), proteomics_meta_data(), chunk_rows=1)
+
+
+def test_chunked_import_returns_the_validation_of_the_whole_file(tmp_path, user, participant):
+    file_handlers = pytest.importorskip('src.mecfs_ui.components.file_handlers')
+    participant(101)
+    participant(102)
+    path = tmp_path / 'proteomics.csv'
+    write_assay_data_table(path, [[101, 'Pre-Day1', '', '', '', 1, 1.5, 2.5],
+                                  [102, 'Pre-Day1', '', '', '', 1, 3.5, 4.5]])
+
+    summary = file_handlers.import_assay_data_chunks(user, str(path), proteomics_meta_data(data_label_type=None),
+                                                     chunk_rows=1)
+
+    assert summary.validation.blocks_import
+    assert summary.validation.row_count == 2
+    assert not ClinicalData.objects(study_id=101).first().assay_meta_data
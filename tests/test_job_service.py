@@ -0,0 +1,53 @@
+import datetime
+
+import pandas as pd
+import pytest
+
+pytest.importorskip('utilities')
+
+from data.import_jobs import ImportJob
+import services.job_service as job_svc
+import services.validation_service as validation_svc
+
+
+def validation_report(*issues, row_count=2):
+    issues = pd.DataFrame([dict(zip(validation_svc.reportColumns, issue)) for issue in issues],
+                          columns=validation_svc.reportColumns)
+    return validation_svc.ValidationReport('Clinical', 'clinical.xlsx', issues, row_count)
+
+
+@pytest.fixture
+def run_job(user, tmp_path, monkeypatch):
+    """Run a clinical import job in this thread with the given runner, returning the finished job."""
+    def run(runner):
+        monkeypatch.setitem(job_svc._jobRunners, 'Clinical', runner)
+        path = tmp_path / 'clinical.xlsx'
+        path.write_text('')
+        job = ImportJob(created_by=user, created_date=datetime.datetime.now(), job_type='Clinical',
+                        file_name='clinical.xlsx', file_path=str(path)).save()
+        job_svc._run_job(str(job.id))
+        return job_svc.find_job(job.id)
+    return run
+
+
+def test_job_completes_with_the_validation_errors_counted(run_job):
+    def runner(job, resume, progress_callback):
+        progress_callback(1, 1, 0)
+        return validation_report((1, '102', 'sex', 'X', 'error', 'choices', 'sex must be one of M, F'))
+
+    job = run_job(runner)
+
+    assert job.status == 'Completed'
+    assert job.error_count == 1
+    assert 'with 1 errors' in job.message
+
+
+def test_job_fails_when_validation_blocks_the_import(run_job):
+    def runner(job, resume, progress_callback):
+        return validation_report((None, '', 'cu_id', '', 'error', 'column', 'Column cu_id is missing'))
+
+    job = run_job(runner)
+
+    assert job.status == 'Failed'
+    assert job.error_count == 1
+    assert job.message.startswith('Nothing imported from clinical.xlsx')
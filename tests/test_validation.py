@@ -0,0 +1,135 @@
+import pandas as pd
+import pytest
+
+pytest.importorskip('utilities')
+
+import services.validation_service as validation_svc
+import set_up_globals
+
+
+def issue_set(report):
+    return {(None if pd.isna(row) else int(row), column, severity, rule)
+            for row, column, severity, rule in report.issues[['row', 'column', 'severity', 'rule']].itertuples(
+                index=False)}
+
+
+def biospecimen_row(specimen_id, **fields):
+    row = dict(specimen_id=specimen_id, study_id='101', cpet_day='D1', pre_post_cpet='PRE', specimen_type='Serum',
+               sample_id='1', date_received='2026-01-05 00:00:00', tube_number='1', freezer_id='F1',
+               box_number='2', box_position='3', analysis_id='A1')
+    row.update(fields)
+    return row
+
+
+def biospecimen_sheet(*rows):
+    return pd.DataFrame(list(rows)).set_index('specimen_id', drop=False)
+
+
+def test_biospecimen_rows_are_checked_against_the_model(participant):
+    participant(101)
+    df = biospecimen_sheet(biospecimen_row('101-D1-PRE-Serum'),
+                           biospecimen_row('101-D3-PRE-Serum', cpet_day='D3'),
+                           biospecimen_row('101-D1-PRE-Urine', specimen_type='Urine', tube_number=''),
+                           biospecimen_row('101-D1-POST-Serum', pre_post_cpet='POST', box_number='NA'),
+                           biospecimen_row('101-D2-PRE-Serum', cpet_day='D2', date_received='yesterday'),
+                           biospecimen_row('999-D1-PRE-Serum', study_id='999'))
+
+    report = validation_svc.validate_dataframe('Biospecimen', df)
+
+    assert issue_set(report) == {(1, 'cpet_day', 'error', 'choices'),
+                                 (2, 'tube_number', 'error', 'required'),
+                                 (3, 'box_number', 'error', 'integer'),
+                                 (4, 'date_received', 'error', 'date'),
+                                 (5, 'study_id', 'warning', 'reference')}
+    assert report.issues.loc[report.issues['rule'] == 'choices', 'id'].tolist() == ['101-D3-PRE-Serum']
+    assert not report.blocks_import
+    assert report.valid_row_mask().tolist() == [True, False, False, False, False, True]
+    assert report.invalid_row_count == 4
+    assert report.summary().startswith('4 errors in 4 rows (')
+    assert report.summary().endswith(', 1 warnings (reference 1)')
+
+
+def clinical_sheet(*rows):
+    columns = validation_svc.loaderFields['Clinical'][0][1] + validation_svc.clinical_numeric_fields()
+    df = pd.DataFrame([{column: '' for column in columns} for _ in rows])
+    for position, fields in enumerate(rows):
+        for column, value in fields.items():
+            df.loc[position, column] = value
+    df['study_id'] = [str(101 + position) for position in range(len(rows))]
+    return df.set_index('study_id', drop=False)
+
+
+def test_clinical_values_the_loader_skips_are_not_errors(database):
+    df = clinical_sheet({'cu_id': 'CU1', 'age': '40', 'bmi': '22.5', 'qmep_mediagnosis': '2020-01-31 00:00:00'},
+                        {'cu_id': 'CU2', 'age': 'NA', 'bmi': 'pending', 'qmep_mediagnosis': 'NA'},
+                        {'cu_id': 'CU3', 'age': 'forty', 'bmi': '22,5', 'qmep_mediagnosis': '31/01/2020'},
+                        {'cu_id': None})
+
+    report = validation_svc.validate_dataframe('Clinical', df)
+
+    assert issue_set(report) == {(2, 'age', 'error', 'integer'),
+                                 (2, 'bmi', 'error', 'number'),
+                                 (2, 'qmep_mediagnosis', 'error', 'date'),
+                                 (3, 'cu_id', 'error', 'required')}
+    assert report.valid_row_mask().tolist() == [True, True, False, False]
+    assert report.summary().startswith('4 errors in 2 rows (')
+
+
+def test_a_missing_column_blocks_the_whole_sheet(database):
+    df = clinical_sheet({'cu_id': 'CU1'}, {'cu_id': 'CU2'}).drop(columns=['bmi'])
+
+    report = validation_svc.validate_dataframe('Clinical', df)
+
+    assert issue_set(report) == {(None, 'bmi', 'error', 'column')}
+    assert report.blocks_import
+    assert report.valid_row_mask().tolist() == [False, False]
+    assert report.summary() == '1 errors in all rows (column 1), 0 warnings'
+
+
+def assay_sheet(*study_ids):
+    df = pd.DataFrame({'enid': [str(i) for i in study_ids], 'timepoint': 'D1-PRE', 'annot_1': '', 'annot_2': '',
+                       'annot_3': '', 'plate': '1', 'IL6': '1.5', 'TNF': '2.5', 'data_file_name': 'cytokines.xlsx',
+                       'study_id': list(study_ids), 'unique_id': [f'{i}-D1-PRE' for i in study_ids]})
+    return df.set_index('unique_id', drop=False)
+
+
+def test_assay_rows_need_clinical_data_and_metadata(participant):
+    participant(101)
+    metaData = {'unique_assay_name': 'cytokines-test', 'data_label_type': set_up_globals.cytokine_data_label_type,
+                'biospecimen_type': 'Serum'}
+
+    report = validation_svc.validate_dataframe('Assay', assay_sheet(101, 999), meta_data=metaData)
+
+    assert issue_set(report) == {(1, 'study_id', 'error', 'reference'),
+                                 (0, 'timepoint', 'warning', 'reference'),
+                                 (1, 'timepoint', 'warning', 'reference'),
+                                 (None, 'IL6', 'warning', 'reference'),
+                                 (None, 'TNF', 'warning', 'reference')}
+    assert report.issues.loc[report.issues['column'] == 'timepoint', 'value'].tolist() == \
+        ['101-D1-PRE-Serum', '999-D1-PRE-Serum']
+    assert not report.blocks_import  # A warning about the whole sheet doesn't block it
+    assert report.valid_row_mask().tolist() == [True, False]
+
+
+def test_assay_metadata_errors_block_the_sheet_without_reading_the_database():
+    metaData = {'unique_assay_name': None, 'data_label_type': 'Bogus'}
+
+    report = validation_svc.validate_dataframe('Assay', assay_sheet(101), meta_data=metaData,
+                                               check_references=False)
+
+    assert issue_set(report) == {(None, 'unique_assay_name', 'error', 'required'),
+                                 (None, 'data_label_type', 'error', 'choices')}
+    assert report.blocks_import
+    assert report.invalid_row_count == 1
+
+
+def test_combined_report_numbers_rows_across_the_file():
+    first = validation_svc.ValidationReport('Assay', 'a.csv', pd.DataFrame(
+        [[1, '101-D1-PRE', 'timepoint', 'X', 'error', 'choices', '']], columns=validation_svc.reportColumns), 2)
+    second = validation_svc.ValidationReport('Assay', 'a.csv', pd.DataFrame(
+        [[0, '102-D1-PRE', 'timepoint', 'X', 'error', 'choices', '']], columns=validation_svc.reportColumns), 2)
+
+    combined = validation_svc.combine_reports([first, second], [0, 2])
+
+    assert combined.errors['row'].tolist() == [1, 2]
+    assert combined.valid_row_mask().tolist() == [True, False, False, True]
@@ -0,0 +1,156 @@
+import copy
+import datetime
+import random
+
+import pytest
+
+from data.clinical_data import ClinicalData, ClinicalDataVersionHistory
+from data.version_history import VersionDelta
+import services.version_history_service as history_svc
+
+
+def assay_row(unique_id, results):
+    return {'unique_id': unique_id, 'timepoint': 'D1-PRE',
+            'assay_results': [{'data_label': label, 'data_label_type': labelType, 'result': result}
+                              for (label, labelType), result in results.items()]}
+
+
+def test_results_of_a_label_with_two_types_are_diffed_one_by_one():
+    results = {(f'G{i}', 'Gene Symbol'): float(i) for i in range(2000)}
+    results[('G7', 'Ensembl Gene ID')] = 7.5
+    old = {'study_id': 101, 'version_number': 1, 'assay_meta_data': [assay_row('101-D1-PRE', results)]}
+    new = copy.deepcopy(old)
+    new['version_number'] = 2
+    new['assay_meta_data'][0]['assay_results'][3]['result'] = 30.0
+
+    delta = history_svc.diff_documents(new, old)
+
+    rowDelta = delta['arrays']['assay_meta_data']['changed'][0][1]
+    assert rowDelta['arrays']['assay_results']['changed'] == [[('G3', 'Gene Symbol'), {'set': {'result': 3.0}}]]
+    assert len(repr(delta)) < 500
+    assert history_svc.apply_delta(new, delta) == old
+
+
+def test_delta_read_back_from_the_database_applies(database, user):
+    old = {'study_id': 101, 'version_number': 1,
+           'assay_meta_data': [assay_row('101-D1-PRE', {('IL6', 'Cytokine Label'): 1.0, ('IL6', 'Gene Symbol'): 2.0,
+                                                        ('TNF', 'Gene Symbol'): 3.0})]}
+    new = copy.deepcopy(old)
+    new['version_number'] = 2
+    results = new['assay_meta_data'][0]['assay_results']
+    results[0]['result'] = 9.0
+    del results[1]
+    results.reverse()
+    results.append({'data_label': 'IL10', 'data_label_type': 'Cytokine Label', 'result': 4.0})
+
+    record = VersionDelta(created_by=user, created_date=datetime.datetime.now(), document_type='ClinicalData',
+                          study_id=101, version_number=1, delta=history_svc.diff_documents(new, old)).save()
+    storedDelta = VersionDelta.objects(id=record.id).as_pymongo().first()['delta']
+
+    assert history_svc.apply_delta(new, storedDelta) == old
+
+
+def random_document(rng):
+    labels = [(f'G{i}', rng.choice(['Gene Symbol', 'Ensembl Gene ID'])) for i in rng.sample(range(20), 6)]
+    rows = [assay_row(f'101-{i}', {label: rng.choice([1.0, 2.0, None]) for label in rng.sample(labels, 4)})
+            for i in rng.sample(range(8), rng.randint(0, 4))]
+    document = {'study_id': 101, 'version_number': 1, 'assay_meta_data': rows,
+                'biospecimen_tube_info': [{'sample_id': f'S{i}', 'box_number': rng.randint(1, 3)}
+                                          for i in rng.sample(range(5), rng.randint(0, 3))]}
+    for field in ['age', 'bmi', 'phenotype']:
+        if rng.random() < 0.7:
+            document[field] = rng.choice([40, 41.5, 'ME/CFS', None])
+    return document
+
+
+def test_diff_and_apply_round_trip_random_documents():
+    rng = random.Random(31)
+    for _ in range(500):
+        old = random_document(rng)
+        new = random_document(rng) if rng.random() < 0.3 else copy.deepcopy(old)
+        for row in new['assay_meta_data']:
+            if row['assay_results'] and rng.random() < 0.5:
+                rng.choice(row['assay_results'])['result'] = 5.0
+            rng.shuffle(row['assay_results'])
+        rng.shuffle(new['assay_meta_data'])
+        new['version_number'] = 2
+        newCopy = copy.deepcopy(new)
+
+        assert history_svc.apply_delta(new, history_svc.diff_documents(new, old)) == old
+        assert new == newCopy  # The newer document isn't modified
+
+
+# Update a participant's clinical data the way the loaders do, recording the superseded version
+def save_version(user, clinicalData, **fields):
+    oldSnapshot = history_svc.document_snapshot(clinicalData)
+    for field, value in fields.items():
+        setattr(clinicalData, field, value)
+    clinicalData.version_number += 1
+    clinicalData.last_modified_date = datetime.datetime(2026, 1, clinicalData.version_number)
+    history_svc.save_version_delta(user, clinicalData, oldSnapshot)
+    clinicalData.save()
+
+
+@pytest.fixture
+def twelve_versions(user, participant):
+    """ENID 101 at version 12, with age 39 + version at each version (version 10 is saved as a keyframe)."""
+    clinicalData = participant(101, age=40)
+    for version in range(2, 13):
+        save_version(user, clinicalData, age=39 + version)
+    return clinicalData
+
+
+def test_every_version_is_rebuilt_from_the_deltas_and_keyframe(twelve_versions):
+    assert VersionDelta.objects(study_id=101, is_keyframe=True).distinct('version_number') == [10]
+    for version in range(1, 13):
+        snapshot = history_svc.snapshot_as_of(101, version)
+        assert (snapshot['version_number'], snapshot['age']) == (version, 39 + version)
+    assert history_svc.snapshot_as_of(101, 13) is None
+
+
+def test_replay_stops_at_a_missing_version(twelve_versions):
+    VersionDelta.objects(study_id=101, version_number=5).delete()
+
+    assert history_svc.snapshot_as_of(101, 4) is None
+    assert history_svc.snapshot_as_of(101, 6)['age'] == 45  # Rebuilt from the keyframe above the gap
+
+
+def test_replay_skips_a_duplicate_record_of_a_version():
+    records = [{'version_number': 2, 'delta': {'set': {'age': 41}}},
+               {'version_number': 2, 'delta': {'set': {'age': 99}}},
+               {'version_number': 1, 'delta': {'set': {'age': 40}}}]
+
+    state, version = history_svc._replay({'version_number': 3, 'age': 42}, 3, records)
+
+    assert (state['age'], version) == (40, 1)
+
+
+def legacy_snapshot(clinicalData, version_number, **fields):
+    snapshot = history_svc.document_snapshot(clinicalData)
+    snapshot.pop('_id')
+    snapshot.update(version_number=version_number, **fields)
+    ClinicalDataVersionHistory._get_collection().insert_one(snapshot)
+
+
+def test_version_without_a_delta_falls_back_to_the_full_snapshot_history(participant):
+    clinicalData = participant(101, age=41, version_number=2)
+    legacy_snapshot(clinicalData, 1, age=40)
+
+    snapshot = history_svc.snapshot_as_of(101, 1)
+
+    assert (snapshot['version_number'], snapshot['age']) == (1, 40)
+    assert snapshot['_id'] == clinicalData.id
+
+
+def test_migrated_history_rebuilds_every_version(user, participant):
+    clinicalData = participant(101, age=42, version_number=3)
+    legacy_snapshot(clinicalData, 1, age=40)
+    legacy_snapshot(clinicalData, 2, age=41)
+    legacy_snapshot(clinicalData, 2, age=41)  # Duplicate left by a failed save
+
+    assert history_svc.migrate_version_history(user, ['ClinicalData']) == {'ClinicalData': 2}
+    assert history_svc.migrate_version_history(user, ['ClinicalData']) == {'ClinicalData': 0}
+    ClinicalDataVersionHistory.drop_collection()
+
+    assert VersionDelta.objects(study_id=101, migrated=True).count() == 2
+    assert [history_svc.snapshot_as_of(101, version)['age'] for version in (1, 2, 3)] == [40, 41, 42]